@@ -0,0 +1,155 @@
+"""
+ブース集計 (public.booth_stats) とイベント集計 (public.event_stats) の再構築と検証。
+
+通常はトリガー (schema.py のマイグレーション 002) で増分更新されるため不要ですが、
+トリガー導入前のデータ投入や手作業での修正後に実行します。
+
+使い方:
+    python aggregates.py rebuild   # 全件から集計し直し、検証まで行う
+    python aggregates.py verify    # 集計と実データを突き合わせる
+"""
+import os
+import sys
+
+import psycopg2
+from dotenv import load_dotenv
+
+# 1行あたりのスコア (マイグレーション 005 以降。score 列がなければ is_processed による暫定スコア)
+SESSION_SCORE_SQL = "public.session_score(s.score, s.is_processed)"
+
+# sessions から booth_stats を作り直すSQL
+# (マイグレーション 002 のバックフィルは schema.py にその時点のSQLを固定してあり、ここを変えても影響しません)
+REBUILD_BOOTH_STATS_SQL = f"""
+    DELETE FROM public.booth_stats;
+
+    INSERT INTO public.booth_stats (
+        booth_id, total_count, processed_count, score_sum,
+        praise_ratio_sum, advice_ratio_sum, last_session_id
+    )
+    SELECT
+        s.booth_id,
+        COUNT(*),
+        COUNT(*) FILTER (WHERE s.is_processed),
+        SUM({SESSION_SCORE_SQL}),
+        SUM(COALESCE(s.praise_ratio, 0)),
+        SUM(COALESCE(s.advice_ratio, 0)),
+        MAX(s.id)
+    FROM
+        public.sessions s
+    GROUP BY
+        s.booth_id;
+
+    INSERT INTO public.event_stats (key, value)
+        SELECT 'total_teams_count', COUNT(DISTINCT team_key) FROM public.students
+    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+"""
+
+# 集計と実データの差分を返すSQL
+VERIFY_BOOTH_STATS_SQL = f"""
+    WITH live AS (
+        SELECT
+            s.booth_id,
+            COUNT(*) AS total_count,
+            COUNT(*) FILTER (WHERE s.is_processed) AS processed_count,
+            SUM({SESSION_SCORE_SQL}) AS score_sum,
+            SUM(COALESCE(s.praise_ratio, 0))::double precision AS praise_ratio_sum,
+            SUM(COALESCE(s.advice_ratio, 0))::double precision AS advice_ratio_sum
+        FROM
+            public.sessions s
+        GROUP BY
+            s.booth_id
+    )
+    SELECT
+        COALESCE(live.booth_id, b.booth_id) AS booth_id,
+        live.total_count, b.total_count,
+        live.processed_count, b.processed_count,
+        live.score_sum, b.score_sum,
+        live.praise_ratio_sum, b.praise_ratio_sum,
+        live.advice_ratio_sum, b.advice_ratio_sum
+    FROM
+        live
+        FULL OUTER JOIN (
+            -- 全件削除されたブースは0件の行として残るため除外
+            SELECT * FROM public.booth_stats WHERE total_count <> 0
+        ) b ON b.booth_id = live.booth_id
+    WHERE
+        live.booth_id IS NULL
+        OR b.booth_id IS NULL
+        OR live.total_count <> b.total_count
+        OR live.processed_count <> b.processed_count
+        OR live.score_sum <> b.score_sum
+        OR ABS(live.praise_ratio_sum - b.praise_ratio_sum) > 1e-6
+        OR ABS(live.advice_ratio_sum - b.advice_ratio_sum) > 1e-6;
+"""
+
+VERIFY_TEAMS_SQL = """
+    SELECT
+        (SELECT COUNT(DISTINCT team_key) FROM public.students),
+        (SELECT value FROM public.event_stats WHERE key = 'total_teams_count');
+"""
+
+
+def rebuild(conn):
+    """集計を全件から作り直します。再構築中の sessions への書き込みはブロックされます。"""
+    try:
+        with conn.cursor() as cursor:
+            # 集計中に挿入された行が漏れないよう、書き込みを止める
+            cursor.execute("LOCK TABLE public.sessions IN SHARE MODE;")
+            cursor.execute(REBUILD_BOOTH_STATS_SQL)
+            cursor.execute("SELECT COUNT(*) FROM public.booth_stats;")
+            booth_count = cursor.fetchone()[0]
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    print(f"✅ {booth_count} ブース分の集計を再構築しました。")
+    return booth_count
+
+
+def verify(conn):
+    """集計と実データを突き合わせ、不一致の内容をリストで返します (一致すれば空)。"""
+    mismatches = []
+    with conn.cursor() as cursor:
+        cursor.execute(VERIFY_BOOTH_STATS_SQL)
+        for row in cursor.fetchall():
+            booth_id, live_values, stored_values = row[0], row[1::2], row[2::2]
+            mismatches.append(f"booth {booth_id}: 実データ={live_values} 集計={stored_values}")
+
+        cursor.execute(VERIFY_TEAMS_SQL)
+        live_teams, stored_teams = cursor.fetchone()
+        if live_teams != stored_teams:
+            mismatches.append(f"total_teams_count: 実データ={live_teams} 集計={stored_teams}")
+    conn.rollback()
+    return mismatches
+
+
+def main(argv):
+    load_dotenv()
+    command = argv[1] if len(argv) > 1 else "verify"
+    if command not in ("rebuild", "verify"):
+        print(__doc__)
+        return 2
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        print("❌ DATABASE_URLが設定されていません。")
+        return 1
+
+    conn = psycopg2.connect(database_url, connect_timeout=5)
+    try:
+        if command == "rebuild":
+            rebuild(conn)
+
+        mismatches = verify(conn)
+        if mismatches:
+            for mismatch in mismatches:
+                print(f"❌ {mismatch}")
+            return 1
+        print("✅ 集計は実データと一致しています。")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
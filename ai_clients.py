@@ -0,0 +1,128 @@
+import os
+import time
+import threading
+
+from app_logging import get_logger
+from audio_preprocess import preprocess_enabled
+
+logger = get_logger("ai_clients")
+
+# -------------------------------------------------------------
+# app.py が使う AI クライアント (Speech-to-Text / GenAI) の遅延初期化
+# -------------------------------------------------------------
+# google.cloud.speech と google.genai は import だけで合わせて1秒以上かかるため、モジュールの読み込み時には
+# 行わず、最初に使うときにプロセスで1つだけ作ります (スレッドセーフ)。
+# - AI_CLIENTS_WARMUP=background (既定): 起動直後から別スレッドで作っておき、リクエストの受付は待たせない
+#   blocking: 作り終えてから起動を続ける / off: 最初のリクエストで作る
+# - 準備ができたかは readiness() (app.py の GET /readyz) で確認できます
+# - GEMINI_BASE_URL で GenAI クライアントの接続先をローカルのフェイクサーバーなどに差し替えられます
+
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-2.5-flash')
+
+
+class LazyClient:
+    """factory() で作ったクライアントをプロセスで共有します。作成に失敗した場合は次の get() で作り直します。"""
+
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._client = None
+        self.init_seconds = None
+        self.error = None
+
+    def get(self):
+        client = self._client
+        if client is not None:
+            return client
+        with self._lock:
+            if self._client is None:
+                started = time.perf_counter()
+                try:
+                    self._client = self.factory()
+                except Exception as e:
+                    self.error = str(e)
+                    raise
+                self.init_seconds = time.perf_counter() - started
+                self.error = None
+                logger.info("✅ %s クライアントを初期化しました (%.0fms)", self.name, self.init_seconds * 1000)
+            return self._client
+
+    def set(self, client):
+        """作成済みのクライアント (テストやベンチマークのフェイクなど) に差し替えます。"""
+        with self._lock:
+            self._client = client
+            self.init_seconds = 0.0
+            self.error = None
+
+    @property
+    def ready(self):
+        return self._client is not None
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "init_ms": round(self.init_seconds * 1000, 1) if self.init_seconds is not None else None,
+            "error": self.error,
+        }
+
+
+def _create_speech_client():
+    from google.cloud import speech_v1p1beta1 as speech
+    return speech.SpeechClient()
+
+
+def _create_genai_client():
+    from google import genai
+    from google.genai import types
+
+    base_url = os.environ.get('GEMINI_BASE_URL')
+    return genai.Client(
+        api_key=os.environ.get('GEMINI_API_KEY'),
+        http_options=types.HttpOptions(base_url=base_url) if base_url else None,
+    )
+
+
+speech_client = LazyClient("speech", _create_speech_client)
+genai_client = LazyClient("genai", _create_genai_client)
+CLIENTS = (speech_client, genai_client)
+
+_warmup_state = {"mode": "off", "started": None, "finished": None}
+
+
+def warm_up(clients=CLIENTS):
+    """クライアントを作っておきます。失敗したクライアントは最初のリクエストで作り直します。"""
+    _warmup_state["started"] = time.perf_counter()
+    # 最初の音声で PyAV の import を待たないように読み込んでおく
+    preprocess_enabled()
+    for lazy in clients:
+        try:
+            lazy.get()
+        except Exception as e:
+            logger.warning("⚠️ %s クライアントのウォームアップに失敗しました: %s", lazy.name, e)
+    _warmup_state["finished"] = time.perf_counter()
+
+
+def warm_up_from_env():
+    """AI_CLIENTS_WARMUP (background / blocking / off) に従ってウォームアップします。"""
+    mode = os.environ.get('AI_CLIENTS_WARMUP', 'background')
+    _warmup_state["mode"] = mode
+    if mode == 'blocking':
+        warm_up()
+    elif mode == 'background':
+        threading.Thread(target=warm_up, name="ai-clients-warmup", daemon=True).start()
+
+
+def readiness():
+    """(全クライアントの準備ができたか, 状態の dict) を返します。"""
+    started, finished = _warmup_state["started"], _warmup_state["finished"]
+    ready = all(lazy.ready for lazy in CLIENTS)
+    return ready, {
+        "ready": ready,
+        "warmup": {
+            "mode": _warmup_state["mode"],
+            "running": started is not None and finished is None,
+            "ms": round((finished - started) * 1000, 1) if started is not None and finished is not None else None,
+        },
+        "clients": {lazy.name: lazy.status() for lazy in CLIENTS},
+    }
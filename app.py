@@ -1,18 +1,25 @@
 import os
 import json
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
 # flask_corsをインポート
 from flask_cors import CORS 
-from google.cloud import speech_v1p1beta1 as speech
-from google import genai
-from google.genai.errors import APIError
 import base64
+from ai_clients import GEMINI_MODEL, genai_client, readiness, speech_client, warm_up_from_env
+from app_logging import get_logger
+from metrics import instrument_flask, observe_size, registry, span
+from rate_limit import PRIORITY_BACKGROUND, RateLimitTimeout, governor_from_env
+from streaming_stt import recognize_content, stream_registry_from_env
 
 # ... (設定ファイルの読み込み、クライアント初期化のコードは省略) ...
 
+logger = get_logger("app")
+
 # Flask アプリと Google Cloud Speech Client の初期化
 app = Flask(__name__)
 
+# リクエスト・ステージごとの計測と GET /metrics (flask_app.py と同じ SLOW_REQUEST_MS / PROFILE_SAMPLE_HZ)
+instrument_flask(app, "app")
+
 # --- CORS設定の追加 ---
 # 全てのオリジン(*)からのアクセスを許可、または特定のオリジンを指定
 # 開発環境では全てのオリジンを許可するのが最も簡単です
@@ -20,7 +27,18 @@ CORS(app)
 # 特定のオリジンを許可する場合は以下のようにします:
 # CORS(app, origins=["http://localhost:5173"]) 
 
-# ... (クライアントとモデルの初期化コード) ...
+# Speech-to-Text と GenAI のクライアントは ai_clients.py で遅延初期化する (プロセスで1つずつ共有)。
+# AI_CLIENTS_WARMUP (既定 background) に従い、起動直後から作っておく
+warm_up_from_env()
+
+# Gemini 呼び出しのレート制限と同時実行数の上限 (flask_app.py と同じ GEMINI_RATE_LIMITS などで設定)
+gemini_governor = governor_from_env()
+
+# 録音中の音声を逐次認識するストリーミングセッション (/recognize/stream)
+stt_streams = stream_registry_from_env()
+registry.add_collector("stt_streams", stt_streams.stats)
+STT_CHUNK_MAX_BYTES = int(os.environ.get('STT_CHUNK_MAX_BYTES', 1024 * 1024))
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
 
 # --- ルーティング ---
 
@@ -45,31 +63,119 @@ def recognize_audio():
         audio_data_base64 = data['audio_data']
         audio_content = base64.b64decode(audio_data_base64)
 
-        # Google Cloud Speech-to-Text の設定
-        audio = speech.RecognitionAudio(content=audio_content)
-        config = speech.RecognitionConfig(
-            encoding=speech.RecognitionConfig.AudioEncoding.WEBM_OPUS,  # ReactのMediaRecorderがデフォルトで出力する形式
-            sample_rate_hertz=48000, # 適切なレートを設定
-            language_code="ja-JP",
-        )
-
-        # 同期リクエストで文字起こしを実行
-        response = client.recognize(config=config, audio=audio)
-
-        transcript = ""
-        # 応答から最も確信度の高い結果を取得
-        for result in response.results:
-            transcript += result.alternatives[0].transcript
-        
+        # 無音を詰めて16kHzモノラルにしてから認識する。同期認識の上限を超える長さの音声は long_running_recognize で文字起こしする
+        transcript, mode, preprocess = recognize_content(speech_client.get(), audio_content)
+
         if transcript:
-            return jsonify({"success": True, "text": transcript})
+            return jsonify({"success": True, "text": transcript, "mode": mode, "preprocess": preprocess})
         else:
             return jsonify({"success": False, "error": "文字起こしの結果が空でした。"}), 500
     
     except Exception as e:
-        print(f"Speech-to-Textエラー: {e}")
+        logger.error("Speech-to-Textエラー: %s", e)
         return jsonify({"success": False, "error": f"Speech-to-Textエラーが発生しました: {str(e)}"}), 500
 
+# --- ストリーミング認識 ---
+# 1. POST /recognize/stream で開始し stream_id を受け取る
+# 2. GET /recognize/stream/<stream_id>/events (EventSource) で途中結果・確定結果を受け取る
+# 3. 録音中は MediaRecorder の各チャンクを POST /recognize/stream/<stream_id>/chunk に生バイナリで送る
+# 4. 録音を止めたら POST /recognize/stream/<stream_id>/finish。最終結果は done イベントで届く
+
+@app.route('/recognize/stream', methods=['POST'])
+def start_recognize_stream():
+    """ストリーミング認識のセッションを開始する"""
+    try:
+        client = speech_client.get()
+    except Exception as e:
+        logger.error("Speech-to-Textクライアントの初期化エラー: %s", e)
+        return jsonify({"success": False, "error": "Speech-to-Textクライアントが初期化されていません。"}), 500
+    session = stt_streams.create(client)
+    if session is None:
+        response = jsonify({"success": False, "error": "同時に認識できる録音数の上限に達しています。"})
+        response.headers["Retry-After"] = "5"
+        return response, 503
+    return jsonify({"success": True, "stream_id": session.session_id}), 201
+
+
+def _stream_not_found():
+    return jsonify({"success": False, "error": "ストリームが見つかりません。"}), 404
+
+
+@app.route('/recognize/stream/<stream_id>/chunk', methods=['POST'])
+def feed_recognize_stream(stream_id):
+    """録音中の音声チャンク (生バイナリ) を受け取る"""
+    session = stt_streams.get(stream_id)
+    if session is None:
+        return _stream_not_found()
+    if (request.content_length or 0) > STT_CHUNK_MAX_BYTES:
+        return jsonify({"success": False, "error": f"チャンクは {STT_CHUNK_MAX_BYTES} bytes 以下にしてください"}), 413
+    try:
+        session.feed(request.get_data())
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+    return jsonify({"success": True, "bytes_received": session.bytes_received})
+
+
+@app.route('/recognize/stream/<stream_id>/finish', methods=['POST'])
+def finish_recognize_stream(stream_id):
+    """録音の終了を受け取る (最終結果は SSE の done イベントで返す)"""
+    session = stt_streams.get(stream_id)
+    if session is None:
+        return _stream_not_found()
+    session.abort()
+    return jsonify({"success": True}), 202
+
+
+@app.route('/recognize/stream/<stream_id>/events')
+def recognize_stream_events(stream_id):
+    """途中結果・確定結果を Server-Sent Events で配信する (Last-Event-ID で再接続時の続きから)"""
+    session = stt_streams.get(stream_id)
+    if session is None:
+        return _stream_not_found()
+    try:
+        after = int(request.headers.get('Last-Event-ID', -1)) + 1
+    except ValueError:
+        after = 0
+
+    def generate():
+        # 接続直後にヘッダーを送り出し、切断時の再接続間隔も伝える
+        yield f"retry: {int(SSE_HEARTBEAT_SECONDS * 1000)}\n\n"
+        position = after
+        while True:
+            events = session.wait_events(position, SSE_HEARTBEAT_SECONDS)
+            if not events:
+                if session.closed:
+                    return
+                yield ": keep-alive\n\n"
+                continue
+            for index, event in events:
+                yield f"id: {index}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+            position = events[-1][0] + 1
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/recognize/stream/stats')
+def recognize_stream_stats():
+    """ストリーミング認識のセッション数と最初の単語までの時間"""
+    return jsonify(stt_streams.stats())
+
+# --- ヘルスチェック ---
+# /healthz: プロセスが応答できるか (liveness)
+# /readyz: AI クライアントの準備ができたか (readiness)。ロードバランサーはこちらが 200 になってから振り分ける
+
+@app.route('/healthz')
+def healthz():
+    return jsonify({"ok": True})
+
+@app.route('/readyz')
+def readyz():
+    ready, status = readiness()
+    return jsonify(status), 200 if ready else 503
+
 @app.route('/summarize', methods=['POST'])
 def summarize_feedback():
     """フィードバックテキストをAIに送信し、要約と評価の割合を取得する"""
@@ -84,8 +190,13 @@ def summarize_feedback():
     if not text:
         return jsonify({"success": False, "error": "テキストが提供されていません。"}), 400
 
-    if not gemini_client:
+    try:
+        gemini_client = genai_client.get()
+    except Exception as e:
+        logger.error("Geminiクライアントの初期化エラー: %s", e)
         return jsonify({"success": False, "error": "Geminiクライアントが初期化されていません。"}), 500
+    # google.genai はクライアントの作成時に読み込み済み
+    from google.genai.errors import APIError
 
     prompt = f"""
     あなたは企業のブース評価の専門家です。以下のブース来場者からのフィードバックを分析し、JSON形式で以下の構造に従って要約と評価の比率を出力してください。
@@ -111,37 +222,41 @@ def summarize_feedback():
     """
     
     try:
-        response = gemini_client.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=[prompt],
-            config={
-                "response_mime_type": "application/json",
-                "response_schema": {
-                    "type": "OBJECT",
-                    "properties": {
-                        "ratio_good": {"type": "INTEGER", "description": "10点満点での褒める点の評価。"},
-                        "ratio_advice": {"type": "INTEGER", "description": "10点満点での改善点（アドバイス）の評価。"},
-                        "summary": {
-                            "type": "ARRAY",
-                            "description": "要約と分析の各セクション。",
-                            "items": {
-                                "type": "OBJECT",
-                                "properties": {
-                                    "title": {"type": "STRING", "description": "セクションのタイトル（例: 評価されている点, 改善提案）。"},
-                                    "items": {
-                                        "type": "ARRAY",
-                                        "description": "箇条書きの項目。",
-                                        "items": {"type": "STRING"}
+        observe_size("gemini.request", len(prompt.encode("utf-8")))
+        with gemini_governor.slot(GEMINI_MODEL, "summarize", PRIORITY_BACKGROUND), span("gemini.summarize"):
+            response = gemini_client.models.generate_content(
+                model=GEMINI_MODEL,
+                contents=[prompt],
+                config={
+                    "response_mime_type": "application/json",
+                    "response_schema": {
+                        "type": "OBJECT",
+                        "properties": {
+                            "ratio_good": {"type": "INTEGER", "description": "10点満点での褒める点の評価。"},
+                            "ratio_advice": {"type": "INTEGER", "description": "10点満点での改善点（アドバイス）の評価。"},
+                            "summary": {
+                                "type": "ARRAY",
+                                "description": "要約と分析の各セクション。",
+                                "items": {
+                                    "type": "OBJECT",
+                                    "properties": {
+                                        "title": {"type": "STRING", "description": "セクションのタイトル（例: 評価されている点, 改善提案）。"},
+                                        "items": {
+                                            "type": "ARRAY",
+                                            "description": "箇条書きの項目。",
+                                            "items": {"type": "STRING"}
+                                        }
                                     }
                                 }
                             }
-                        }
-                    },
-                    "required": ["ratio_good", "ratio_advice", "summary"]
+                        },
+                        "required": ["ratio_good", "ratio_advice", "summary"]
+                    }
                 }
-            }
-        )
+            )
         
+        observe_size("gemini.response", len(response.text.encode("utf-8")) if response.text else 0)
+
         # 応答からJSON文字列を抽出
         json_string = response.text.strip().lstrip('```json').rstrip('```')
         summary_data = json.loads(json_string)
@@ -168,11 +283,16 @@ def summarize_feedback():
             "ratio_advice": ratio_advice
         })
             
+    except RateLimitTimeout as e:
+        logger.warning("Gemini APIの実行枠待ちタイムアウト: %s", e)
+        response = jsonify({"success": False, "error": str(e)})
+        response.headers["Retry-After"] = str(int(e.retry_after) + 1)
+        return response, 503
     except APIError as e:
-        print(f"Gemini APIエラー: {e}")
+        logger.error("Gemini APIエラー: %s", e)
         return jsonify({"success": False, "error": f"Gemini APIエラーが発生しました: {str(e)}"}), 500
     except Exception as e:
-        print(f"サーバー処理エラー: {e}")
+        logger.error("サーバー処理エラー: %s", e)
         return jsonify({"success": False, "error": f"サーバー処理エラーが発生しました: {str(e)}"}), 500
 
 if __name__ == '__main__':
@@ -0,0 +1,51 @@
+import os
+import sys
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+# -------------------------------------------------------------
+# レベル付きのノンブロッキングなロガー
+# -------------------------------------------------------------
+# リクエストを処理するスレッドはキューに積むだけで、標準出力への書き込みは専用のスレッドが行います
+# (print() のように、出力先が遅いときにリクエストが待たされることがありません)。
+# - LOG_LEVEL: DEBUG / INFO / WARNING / ERROR (既定は INFO)
+# - LOG_FORMAT: 1行の書式 (logging の % 形式)
+#
+# 使い方:
+#     from app_logging import get_logger
+#     logger = get_logger(__name__)
+#     logger.warning("⚠️ ...: %s", e)
+
+DEFAULT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+def _setup():
+    """ルートの hyoka ロガーにキューのハンドラーを付け、書き込みスレッドを起動します (初回のみ)。"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        records = SimpleQueue()  # put() は待たない
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(logging.Formatter(os.environ.get('LOG_FORMAT', DEFAULT_FORMAT)))
+        _listener = QueueListener(records, output, respect_handler_level=False)
+        _listener.start()
+        # 終了時に積まれている分を書き出す
+        atexit.register(_listener.stop)
+
+        root = logging.getLogger("hyoka")
+        root.addHandler(QueueHandler(records))
+        root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+        root.propagate = False
+
+
+def get_logger(name):
+    """hyoka.<name> のロガーを返します。"""
+    _setup()
+    return logging.getLogger(f"hyoka.{name}")
@@ -0,0 +1,311 @@
+"""
+flask_app.py の ASGI (asyncio) 版のサーバー。
+
+上流 (Gemini) の応答を待つエンドポイントと submit_feedback を async で実装し、
+待ち時間の間はイベントループに制御を返します。1プロセスで数百件の上流待ちを同時に抱えられます。
+- POST /api/process_audio      (multipart / 生バイナリ / JSON の3形式。aiohttp で Gemini に送信)
+- POST /api/generate_summary
+- POST /api/submit_feedback    (asyncpg のプールで挿入)
+それ以外のルートは flask_app.app をそのまま (スレッドプール上で) 提供します。
+パス・リクエスト形式・JSON の応答は flask_app.py と同じです。
+
+必要なパッケージ (requirements.txt の「ASGI モード」の分を含む):
+    pip install -r requirements.txt
+
+使い方:
+    uvicorn asgi_app:app --port 5000
+    python asgi_app.py
+"""
+import os
+import json
+import asyncio
+import tempfile
+from contextlib import asynccontextmanager
+
+import asyncpg
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+import flask_app
+from app_logging import get_logger
+from db_pool import DBPoolError, close_async_pool, get_async_pool
+from feedback_ingest import SESSION_COLUMNS, session_row
+from flask_app import (
+    AUDIO_SPOOL_MAX_MEMORY,
+    MAX_AUDIO_UPLOAD_BYTES,
+    MULTIPART_OVERHEAD_BYTES,
+    _after_feedback_insert,
+    _parse_feedback,
+    dashboard_cache,
+    idempotency,
+    summary_queue,
+)
+from idempotency import IdempotencyConflict
+from gemini_api_async import (
+    acall_gemini_api_for_stt,
+    acall_gemini_api_for_stt_file,
+    acall_gemini_api_for_summary,
+    gemini_async_http,
+)
+
+logger = get_logger("asgi_app")
+
+INSERT_SESSION_SQL = f"""
+    INSERT INTO public.sessions ({", ".join(SESSION_COLUMNS)})
+    VALUES ({", ".join(f"${i}" for i in range(1, len(SESSION_COLUMNS) + 1))})
+    RETURNING id;
+"""
+
+
+def _degraded_response(message, error_detail, retry_after):
+    return JSONResponse({"message": message, "error_detail": error_detail, "degraded": True},
+                        status_code=503, headers={"Retry-After": str(int(retry_after) + 1)})
+
+
+def _audio_too_large_response():
+    return JSONResponse({
+        "message": "❌ 音声データが大きすぎます",
+        "error_detail": f"音声データは {MAX_AUDIO_UPLOAD_BYTES} bytes 以下にしてください"
+    }, status_code=413)
+
+
+async def _spool_raw_audio(request, limit):
+    """生バイナリのリクエストボディを SpooledTemporaryFile に書き出します。上限を超えたら None。"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=AUDIO_SPOOL_MAX_MEMORY)
+    total = 0
+    async for chunk in request.stream():
+        total += len(chunk)
+        if total > limit:
+            spooled.close()
+            return None
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled
+
+
+async def _idempotent(request, scope, data, handler):
+    """flask_app._idempotent の asyncio 版。handler は JSONResponse を返すコルーチン関数です。"""
+    if idempotency is None:
+        return await handler()
+
+    try:
+        key, request_hash, ttl = idempotency.request_key(request.headers.get('Idempotency-Key'), data)
+        token, replay = await idempotency.abegin(scope, key, request_hash, ttl)
+    except IdempotencyConflict as conflict:
+        headers = {"Retry-After": str(int(conflict.retry_after))} if conflict.retry_after else None
+        return JSONResponse({"message": f"❌ {conflict.message}"}, status_code=conflict.status, headers=headers)
+    except (DBPoolError, asyncpg.PostgresError, OSError) as e:
+        logger.warning("⚠️ 冪等キーを確認できないため、重複チェックなしで処理します: %s", e)
+        return await handler()
+
+    if replay is not None:
+        status_code, body = replay
+        return JSONResponse(body, status_code=status_code, headers={"Idempotent-Replayed": "true"})
+
+    succeeded = False
+    try:
+        response = await handler()
+        if 200 <= response.status_code < 300 and response.media_type == "application/json":
+            # 処理はすでにコミット済み。応答を保存できなくてもキーは解放しない (解放すると再送で重複する)
+            succeeded = True
+            try:
+                await idempotency.acomplete(scope, key, token, response.status_code, json.loads(response.body))
+            except (DBPoolError, asyncpg.PostgresError, OSError) as e:
+                logger.warning("⚠️ 冪等キーに応答を保存できませんでした (キーはロックの期限まで処理中のままです): %s", e)
+        return response
+    finally:
+        if not succeeded:
+            # 失敗した場合は、クライアントが再試行できるようにキーを解放する
+            try:
+                await idempotency.arelease(scope, key, token)
+            except (DBPoolError, asyncpg.PostgresError, OSError) as e:
+                logger.warning("⚠️ 冪等キーの解放に失敗しました: %s", e)
+
+
+def _stt_response(gemini_result):
+    if gemini_result.get("degraded"):
+        return _degraded_response("⚠️ 音声認識サービスが混雑しています。しばらくしてから再度お試しください。",
+                                  gemini_result["stt_text"], gemini_result["retry_after"])
+    return JSONResponse({"message": "✅ 音声処理成功", "stt_text": gemini_result["stt_text"],
+                         "preprocess": gemini_result.get("preprocess")})
+
+
+# -------------------------------------------------------------
+# エンドポイント: POST /api/process_audio
+# -------------------------------------------------------------
+async def process_audio(request):
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type == "application/json":
+        return await _process_audio_json(request)
+
+    content_length = int(request.headers.get("content-length") or 0)
+    if content_length > MAX_AUDIO_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES:
+        return _audio_too_large_response()
+
+    form = None
+    if content_type == "multipart/form-data":
+        # Starlette は大きなファイルを自動的に一時ファイルへ書き出す
+        form = await request.form()
+        upload = form.get("audio")
+        booth_id = form.get("booth_id")
+        mime_type = form.get("mime_type") or (upload.content_type if upload else None)
+        audio_file = upload.file if upload else None
+        if audio_file is not None:
+            audio_file.seek(0, os.SEEK_END)
+            if audio_file.tell() > MAX_AUDIO_UPLOAD_BYTES:
+                await form.close()
+                return _audio_too_large_response()
+    else:
+        booth_id = request.query_params.get("booth_id")
+        mime_type = request.query_params.get("mime_type") or content_type
+        audio_file = await _spool_raw_audio(request, MAX_AUDIO_UPLOAD_BYTES)
+        if audio_file is None:
+            return _audio_too_large_response()
+
+    try:
+        if audio_file is None or not mime_type or not booth_id:
+            return JSONResponse({"message": "❌ 必須データ（audio, mime_type, booth_id）が不足しています"}, status_code=400)
+
+        prompt_text = f"ブースID {booth_id} へのフィードバックをテキスト化してください。"
+        return _stt_response(await acall_gemini_api_for_stt_file(audio_file, prompt_text, mime_type))
+
+    except Exception as e:
+        error_detail = f"音声処理中のエラー: {e}"
+        logger.error("❌ %s", error_detail)
+        return JSONResponse({
+            "message": "❌ サーバーでの音声処理に失敗しました。",
+            "error_detail": error_detail
+        }, status_code=500)
+
+    finally:
+        if form is not None:
+            await form.close()
+        elif audio_file is not None:
+            audio_file.close()
+
+
+async def _process_audio_json(request):
+    try:
+        data = await request.json()
+    except Exception as e:
+        return JSONResponse({"message": "❌ 無効なJSONデータ", "error_detail": str(e)}, status_code=400)
+
+    base64_audio = data.get('audio_data')
+    mime_type = data.get('mime_type')
+    booth_id = data.get('booth_id')
+    if not base64_audio or not mime_type or not booth_id:
+        return JSONResponse({"message": "❌ 必須データ（audio_data, mime_type, booth_id）が不足しています"}, status_code=400)
+
+    prompt_text = f"ブースID {booth_id} へのフィードバックをテキスト化してください。"
+    return _stt_response(await acall_gemini_api_for_stt(base64_audio, prompt_text, mime_type))
+
+
+# -------------------------------------------------------------
+# エンドポイント: POST /api/generate_summary
+# -------------------------------------------------------------
+async def generate_summary(request):
+    try:
+        data = await request.json()
+        raw_text = data.get('raw_text')
+        if not raw_text:
+            return JSONResponse({"message": "❌ 必須データ（raw_text）が不足しています"}, status_code=400)
+    except Exception as e:
+        return JSONResponse({"message": "❌ 無効なJSONデータ", "error_detail": str(e)}, status_code=400)
+
+    return await _idempotent(request, "generate_summary", data, lambda: _generate_summary(raw_text))
+
+
+async def _generate_summary(raw_text):
+    gemini_result = await acall_gemini_api_for_summary(raw_text)
+    if gemini_result.get("degraded"):
+        return _degraded_response("⚠️ 要約サービスが混雑しています。しばらくしてから再度お試しください。",
+                                  gemini_result["summary_text"], gemini_result["retry_after"])
+    return JSONResponse({"message": "✅ 要約生成成功", "summary_text": gemini_result["summary_text"]})
+
+
+# -------------------------------------------------------------
+# エンドポイント: POST /api/submit_feedback
+# -------------------------------------------------------------
+async def submit_feedback(request):
+    try:
+        data = await request.json()
+    except Exception as e:
+        return JSONResponse({"message": "❌ 無効なJSONデータ", "error_detail": str(e)}, status_code=400)
+    if not data:
+        return JSONResponse({"message": "❌ リクエストボディが空です"}, status_code=400)
+
+    feedback, error = _parse_feedback(data)
+    if error:
+        return JSONResponse(error[0], status_code=error[1])
+
+    return await _idempotent(request, "submit_feedback", data, lambda: _submit_feedback(feedback))
+
+
+async def _invalidate_dashboard(booth_id):
+    """dashboard_cache.invalidate() の asyncio 版。共有ストア (SQLite / Redis) の更新はスレッドで行います。"""
+    if dashboard_cache.blocking:
+        await asyncio.to_thread(dashboard_cache.invalidate, booth_id)
+    else:
+        dashboard_cache.invalidate(booth_id)
+
+
+async def _submit_feedback(feedback):
+    try:
+        pool = await get_async_pool()
+        inserted_id = await pool.fetchval(INSERT_SESSION_SQL, *session_row(feedback))
+        await _invalidate_dashboard(feedback["booth_id"])
+        return JSONResponse(_after_feedback_insert(inserted_id, feedback, invalidate_cache=False), status_code=201)
+
+    except DBPoolError as pool_err:
+        logger.error("❌ データベース接続に失敗しました！エラー: %s", pool_err)
+        return JSONResponse({"message": "❌ サーバー側のデータベース接続エラー", "error_detail": str(pool_err)}, status_code=500)
+
+    except asyncpg.PostgresError as db_err:
+        error_detail = f"データベースエラー: {db_err}"
+        logger.error("❌ %s", error_detail)
+        return JSONResponse({
+            "message": "❌ データベースへの挿入中にエラーが発生しました。",
+            "error_detail": error_detail
+        }, status_code=500)
+
+    except Exception as e:
+        error_detail = f"予期せぬサーバーエラー: {e}"
+        logger.error("❌ %s", error_detail)
+        return JSONResponse({
+            "message": "❌ 予期せぬサーバーエラーが発生しました。",
+            "error_detail": error_detail
+        }, status_code=500)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # flask_app の before_request と同じく要約ワーカーを起動する
+    summary_queue.start()
+    yield
+    await gemini_async_http.aclose()
+    await close_async_pool()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/process_audio', process_audio, methods=['POST']),
+        Route('/api/generate_summary', generate_summary, methods=['POST']),
+        Route('/api/submit_feedback', submit_feedback, methods=['POST']),
+        # 上流を待たないルート (ダッシュボード・統計など) は Flask アプリで処理する
+        Mount('/', app=WSGIMiddleware(flask_app.app, workers=int(os.environ.get('ASGI_WSGI_THREADS', 10)))),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=["http://localhost:5173"], allow_methods=["*"],
+                   allow_headers=["*"], expose_headers=["ETag", "Retry-After", "Idempotent-Replayed"]),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, port=int(os.environ.get('PORT', 5000)))
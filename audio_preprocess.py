@@ -0,0 +1,343 @@
+import os
+import io
+import time
+from fractions import Fraction
+
+from app_logging import get_logger
+
+logger = get_logger("audio_preprocess")
+
+# -------------------------------------------------------------
+# 音声認識の前処理 (無音の除去・モノラル化・16kHzへのリサンプリング)
+# -------------------------------------------------------------
+# MediaRecorder の 48kHz Opus (WebM) をデコードし、次の処理をしてから
+# 16kHz モノラルの低ビットレート Opus (Ogg) に再エンコードして認識器に送ります。
+#   1. チャンネルの平均でモノラル化
+#   2. ローパスフィルタ (窓付きsinc) をかけて 16kHz に間引き
+#   3. フレームごとのエネルギーによるVADで、前後の無音と長い途中の無音を詰める
+# 1〜3 はデコードした約1秒ごとに進め (前のチャンクの末尾だけを持ち越す)、ためておくのは
+# 16kHz モノラルの int16 (1秒あたり 32KB。48kHz ステレオの float32 の 1/12) とフレームのエネルギーだけです。
+# AUDIO_PREPROCESS_MAX_SECONDS より長い音声はデコードを途中でやめ、前処理をせずにそのまま送ります。
+# 信号処理は NumPy の配列演算で行い、Pythonのループは約1秒のチャンク単位でだけ回します。
+# NumPy と PyAV (pip install numpy av) は任意依存で、入っていない場合は前処理をせずにそのまま送ります。
+
+TARGET_SAMPLE_RATE = 16000
+OUTPUT_MIME_TYPE = "audio/ogg"
+OUTPUT_BITRATE = int(os.environ.get('AUDIO_PREPROCESS_BITRATE', 24000))
+MAX_SECONDS = float(os.environ.get('AUDIO_PREPROCESS_MAX_SECONDS', 900))
+
+# VAD の設定
+FRAME_MS = 20
+SPEECH_MARGIN_DB = float(os.environ.get('AUDIO_VAD_MARGIN_DB', 12))  # 推定ノイズフロアからの差
+SPEECH_FLOOR_DBFS = -55.0      # これより小さいフレームは常に無音
+HANGOVER_MS = 200              # 発話の前後に残す余白
+MAX_SILENCE_MS = int(os.environ.get('AUDIO_MAX_SILENCE_MS', 600))  # 途中の無音はこの長さまで詰める
+
+# 前処理後の長さがこれより短い場合は発話なしとみなし、元の音声をそのまま送る
+MIN_SPEECH_MS = 300
+
+
+class PreprocessedAudio:
+    """前処理後の音声と、元の音声からの削減量。"""
+
+    def __init__(self, data, mime_type, original_bytes, original_seconds, processed_seconds, elapsed):
+        self.data = data
+        self.mime_type = mime_type
+        self.original_bytes = original_bytes
+        self.original_seconds = original_seconds
+        self.processed_seconds = processed_seconds
+        self.elapsed = elapsed
+
+    @property
+    def processed_bytes(self):
+        return len(self.data)
+
+    def report(self):
+        return {
+            "original_bytes": self.original_bytes,
+            "processed_bytes": self.processed_bytes,
+            "bytes_saved": self.original_bytes - self.processed_bytes,
+            "original_seconds": round(self.original_seconds, 2),
+            "processed_seconds": round(self.processed_seconds, 2),
+            "seconds_saved": round(self.original_seconds - self.processed_seconds, 2),
+            "preprocess_ms": round(self.elapsed * 1000, 1),
+        }
+
+
+def _av():
+    try:
+        import av
+    except ImportError:
+        return None
+    return av
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def preprocess_enabled():
+    """AUDIO_PREPROCESS=0 で無効。PyAV か NumPy が入っていない場合も無効です。"""
+    return os.environ.get('AUDIO_PREPROCESS', '1') != '0' and _av() is not None and _numpy() is not None
+
+
+# --- デコード / エンコード (PyAV) ---
+
+def decode_chunks(source, chunk_seconds=1.0):
+    """音声ファイル (バイト列かファイルオブジェクト) をデコードし、chunk_seconds 秒ほどずつ
+    (float32 の [チャンネル, サンプル] 配列, サンプルレート) を返すジェネレータ。"""
+    import numpy as np
+    av = _av()
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    frames = []
+    buffered = 0
+    with av.open(source, mode="r") as container:
+        stream = container.streams.audio[0]
+        for frame in container.decode(stream):
+            samples = frame.to_ndarray()
+            if not frame.format.is_planar:
+                samples = samples.reshape(-1, len(frame.layout.channels)).T
+            if samples.dtype == np.int16:
+                samples = samples.astype(np.float32) / 32768.0
+            # 1フレーム (20ms 程度) ずつだと NumPy の呼び出しの固定費が大きいため、まとめてから返す
+            frames.append(samples.astype(np.float32, copy=False))
+            buffered += samples.shape[1]
+            if buffered >= frame.sample_rate * chunk_seconds:
+                yield np.concatenate(frames, axis=1), frame.sample_rate
+                frames = []
+                buffered = 0
+        if frames:
+            yield np.concatenate(frames, axis=1), frame.sample_rate
+
+
+def encode_opus(samples, sample_rate=TARGET_SAMPLE_RATE, bitrate=OUTPUT_BITRATE):
+    """モノラルの int16 か float32 の配列を Ogg Opus のバイト列にします。"""
+    import numpy as np
+    av = _av()
+    buffer = io.BytesIO()
+    if samples.dtype != np.int16:
+        samples = (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)
+    pcm = samples.reshape(1, -1)
+    with av.open(buffer, mode="w", format="ogg") as container:
+        # 音声認識に送るだけなので、エンコードの計算量を既定 (10) より下げる
+        stream = container.add_stream("libopus", rate=sample_rate, options={"compression_level": "5"})
+        stream.layout = "mono"
+        stream.bit_rate = bitrate
+        # 全体を1つのフレームにすると PyAV が内部で全体分の変換バッファを作るため、1秒ずつ渡す
+        for start in range(0, pcm.shape[1], sample_rate):
+            frame = av.AudioFrame.from_ndarray(pcm[:, start:start + sample_rate], format="s16", layout="mono")
+            frame.sample_rate = sample_rate
+            frame.pts = start
+            frame.time_base = Fraction(1, sample_rate)
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buffer.getvalue()
+
+
+# --- 信号処理 (NumPy) ---
+
+def downmix(samples):
+    """[チャンネル, サンプル] をチャンネルの平均でモノラルにします。"""
+    return samples.mean(axis=0) if samples.ndim == 2 else samples
+
+
+def _lowpass_kernel(cutoff, taps=101):
+    """cutoff (ナイキスト周波数に対する比) の窓付きsincローパスフィルタ。"""
+    import numpy as np
+    n = np.arange(taps) - (taps - 1) / 2
+    kernel = np.sinc(cutoff * n) * np.hamming(taps)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+class Resampler:
+    """モノラル信号をチャンクごとに target_rate にリサンプリングします。
+
+    ダウンサンプリング時は先にローパスフィルタをかけて折り返しを防ぎます。出力の位置は入力全体での
+    位置から線形補間で求めるため、整数比 (48kHz → 16kHz など) なら単純な間引きと同じになります。
+    最後のチャンクの後に flush() を呼んでください。
+    """
+
+    def __init__(self, source_rate, target_rate=TARGET_SAMPLE_RATE, taps=101):
+        import numpy as np
+        self.step = source_rate / target_rate
+        self.kernel = _lowpass_kernel(0.9 * target_rate / source_rate, taps) if target_rate < source_rate else None
+        filtered = self.kernel is not None
+        # フィルタにかけるための前のチャンクの末尾と、フィルタの遅れ (この分だけ先頭の出力を捨てる)
+        self._history = np.zeros(taps - 1 if filtered else 0, dtype=np.float32)
+        self._delay = (taps - 1) // 2 if filtered else 0
+        self._pending = np.zeros(0, dtype=np.float32)  # まだ補間に使う入力 (先頭の入力全体での位置が _offset)
+        self._offset = 0
+        self._next = 0  # 次に出力するサンプルの番号
+
+    def process(self, samples):
+        import numpy as np
+        if self.kernel is not None:
+            padded = np.concatenate((self._history, samples))
+            self._history = padded[len(samples):]
+            samples = np.convolve(padded, self.kernel, mode="valid")
+            if self._delay:
+                dropped = min(self._delay, len(samples))
+                samples = samples[dropped:]
+                self._delay -= dropped
+        return samples if self.step == 1 else self._interpolate(samples)
+
+    def flush(self):
+        """フィルタの遅れの分だけ残っている末尾を出力します。"""
+        import numpy as np
+        return self.process(np.zeros((len(self._history) + 1) // 2, dtype=np.float32))
+
+    def _interpolate(self, samples):
+        import numpy as np
+        buffer = np.concatenate((self._pending, samples))
+        received = self._offset + len(buffer)
+        last = int((received - 1) // self.step) if received else -1  # この入力で補間できる最後の出力の番号
+        if last < self._next:
+            self._pending = buffer
+            return np.zeros(0, dtype=np.float32)
+        positions = np.arange(self._next, last + 1) * self.step - self._offset
+        output = np.interp(positions, np.arange(len(buffer)), buffer).astype(np.float32)
+        self._next = last + 1
+        consumed = min(int(self._next * self.step) - self._offset, len(buffer))
+        self._pending = buffer[consumed:]
+        self._offset += consumed
+        return output
+
+
+def frame_energy_db(samples, sample_rate, frame_ms=FRAME_MS):
+    """フレームごとのRMS (dBFS)。"""
+    import numpy as np
+    frame_length = sample_rate * frame_ms // 1000
+    frame_count = len(samples) // frame_length
+    frames = samples[:frame_count * frame_length].reshape(frame_count, frame_length)
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+
+def speech_mask(energy_db, frame_ms=FRAME_MS):
+    """フレームごとの発話判定。ノイズフロアは下位10%のエネルギーから推定します。"""
+    import numpy as np
+    if len(energy_db) == 0:
+        return np.zeros(0, dtype=bool)
+    noise_floor = np.percentile(energy_db, 10)
+    threshold = max(noise_floor + SPEECH_MARGIN_DB, SPEECH_FLOOR_DBFS)
+    mask = energy_db > threshold
+    # 語頭・語尾の小さな音を切らないよう、発話フレームの前後を広げる
+    hangover = HANGOVER_MS // frame_ms
+    if hangover:
+        mask = np.convolve(mask, np.ones(2 * hangover + 1), mode="same") > 0
+    return mask
+
+
+def keep_mask(speech, frame_ms=FRAME_MS, max_silence_ms=MAX_SILENCE_MS):
+    """残すフレームの判定。前後の無音はすべて、途中の無音は max_silence_ms を超える部分を落とします。"""
+    import numpy as np
+    keep = speech.copy()
+    if not speech.any():
+        return keep
+    # 無音区間の開始・終了位置を求め、途中の区間は先頭から max_silence_ms 分だけ残す
+    edges = np.diff(np.concatenate(([1], speech.astype(np.int8), [1])))
+    starts = np.flatnonzero(edges == -1)
+    ends = np.flatnonzero(edges == 1)
+    internal = (starts > 0) & (ends < len(speech))
+    max_frames = max_silence_ms // frame_ms
+    lengths = np.minimum(ends[internal] - starts[internal], max_frames)
+    # 各区間の残す長さ分のインデックスを一度に作る
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    keep[np.repeat(starts[internal], lengths) + offsets] = True
+    return keep
+
+
+class SpeechBuffer:
+    """16kHz モノラルの信号を int16 でためながら、フレームごとのエネルギーを計算しておきます。"""
+
+    def __init__(self, sample_rate=TARGET_SAMPLE_RATE, frame_ms=FRAME_MS):
+        import numpy as np
+        self.sample_rate = sample_rate
+        self.frame_ms = frame_ms
+        self.frame_length = sample_rate * frame_ms // 1000
+        self._pcm = bytearray()
+        self._energy = []
+        self._partial = np.zeros(0, dtype=np.float32)  # フレームに満たない末尾
+
+    def append(self, samples):
+        import numpy as np
+        if len(samples) == 0:
+            return
+        self._pcm += (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16).tobytes()
+        pending = np.concatenate((self._partial, samples))
+        usable = len(pending) // self.frame_length * self.frame_length
+        if usable:
+            self._energy.append(frame_energy_db(pending[:usable], self.sample_rate, self.frame_ms))
+        self._partial = pending[usable:]
+
+    def trim_silence(self, max_silence_ms=MAX_SILENCE_MS):
+        """VADで無音を詰めた int16 の信号を返します。"""
+        import numpy as np
+        energy = np.concatenate(self._energy) if self._energy else np.zeros(0)
+        keep = keep_mask(speech_mask(energy, self.frame_ms), self.frame_ms, max_silence_ms)
+        pcm = np.frombuffer(self._pcm, dtype=np.int16)  # コピーせずに参照する
+        frames = pcm[:len(keep) * self.frame_length].reshape(len(keep), self.frame_length)
+        return frames[keep].reshape(-1)
+
+
+def preprocess_audio(source, original_bytes=None):
+    """音声ファイルを前処理し、PreprocessedAudio を返します。
+
+    前処理できない (PyAV や NumPy がない・長すぎる・デコードに失敗した・発話が見つからない) 場合は None を返すので、
+    呼び出し側は元の音声をそのまま使ってください。
+    """
+    if not preprocess_enabled():
+        return None
+    started = time.perf_counter()
+    try:
+        if original_bytes is None:
+            if isinstance(source, (bytes, bytearray)):
+                original_bytes = len(source)
+            else:
+                source.seek(0, os.SEEK_END)
+                original_bytes = source.tell()
+        if not isinstance(source, (bytes, bytearray)):
+            source.seek(0)
+
+        resampler = None
+        speech = SpeechBuffer()
+        original_samples = 0
+        for samples, sample_rate in decode_chunks(source):
+            if resampler is None:
+                resampler = Resampler(sample_rate)
+            original_samples += samples.shape[1]
+            if original_samples > MAX_SECONDS * sample_rate:
+                # 長すぎる録音はデコードを続けず (メモリと時間を使わず) にそのまま送る
+                logger.warning("⚠️ 音声前処理: %s秒を超えるため元の音声を使います", MAX_SECONDS)
+                return None
+            speech.append(resampler.process(downmix(samples)))
+        if resampler is None:
+            raise ValueError("音声データをデコードできませんでした")
+        speech.append(resampler.flush())
+        original_seconds = original_samples / sample_rate
+        trimmed = speech.trim_silence()
+        if len(trimmed) < TARGET_SAMPLE_RATE * MIN_SPEECH_MS // 1000:
+            logger.warning("⚠️ 音声前処理: 発話が見つからなかったため元の音声を使います")
+            return None
+        data = encode_opus(trimmed)
+    except Exception as e:
+        logger.warning("⚠️ 音声前処理に失敗したため元の音声を使います: %s", e)
+        return None
+    finally:
+        if not isinstance(source, (bytes, bytearray)):
+            source.seek(0)
+
+    result = PreprocessedAudio(data, OUTPUT_MIME_TYPE, original_bytes, original_seconds,
+                               len(trimmed) / TARGET_SAMPLE_RATE, time.perf_counter() - started)
+    report = result.report()
+    logger.info("✅ 音声前処理: %s秒 → %s秒, %s → %s bytes (%sms)", report['original_seconds'],
+                report['processed_seconds'], report['original_bytes'], report['processed_bytes'],
+                report['preprocess_ms'])
+    return result
@@ -0,0 +1,277 @@
+"""
+フィードバックの一括要約。
+
+複数のフィードバックを1回の generateContent (構造化出力) にまとめて要約し、
+結果をセッションIDに対応付けます。
+- バッチはトークン数の見積もりと件数の上限で分割します。
+- 応答に含まれなかった項目・失敗したバッチの項目だけを、より小さなバッチで再試行します。
+
+CLI では is_processed = false の sessions をすべて要約して保存します。
+
+使い方:
+    python batch_summary.py drain --concurrency 4
+    python batch_summary.py drain --requeue-errors   # 【要約エラー…】の行も要約し直す
+"""
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+
+from cache import generation_store_from_url
+from db_pool import DBPoolError, db_connection
+from gemini_api import call_gemini_api_base
+from summary_jobs import CLAIM_BATCH_SQL, FAIL_SQL
+
+# 1バッチあたりの入力トークン数の目安 (日本語はおおよそ1文字1トークンとして見積もる)
+DEFAULT_MAX_BATCH_TOKENS = 8000
+DEFAULT_MAX_BATCH_ITEMS = 50
+# 項目ごとのJSONの括弧・ID・出力分の余裕
+ITEM_OVERHEAD_TOKENS = 40
+
+BATCH_SYSTEM_INSTRUCTION = (
+    "You are a professional feedback analyst. For each item, summarize its text in Japanese, "
+    "focusing on key positive and negative points, strictly under 30 characters. "
+    "Return exactly one result per input item with the same id. Do not include any introduction or closing phrases."
+)
+
+BATCH_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "id": {"type": "INTEGER"},
+            "summary": {"type": "STRING"},
+        },
+        "required": ["id", "summary"],
+    },
+}
+
+# 要約を一括で保存する (他の経路で処理済みになった行は上書きしない)
+COMPLETE_BATCH_SQL = """
+    UPDATE public.sessions s
+    SET
+        summary_text = v.summary_text,
+        is_processed = true,
+        summary_locked_until = NULL,
+        summary_error = NULL
+    FROM (VALUES %s) AS v (id, summary_text, attempts)
+    WHERE
+        s.id = v.id
+        AND s.summary_attempts = v.attempts
+        AND NOT s.is_processed
+    RETURNING s.booth_id;
+"""
+
+# 要約エラーの文字列が保存された行を未処理に戻す
+REQUEUE_ERRORS_SQL = """
+    UPDATE public.sessions
+    SET
+        summary_text = NULL,
+        is_processed = false,
+        summary_attempts = 0,
+        summary_locked_until = NULL,
+        summary_error = NULL
+    WHERE
+        is_processed
+        AND summary_text LIKE '【要約エラー%%';
+"""
+
+
+def estimate_tokens(text):
+    return len(text or "") + ITEM_OVERHEAD_TOKENS
+
+
+def split_batches(items, max_tokens=DEFAULT_MAX_BATCH_TOKENS, max_items=DEFAULT_MAX_BATCH_ITEMS):
+    """(id, text) のリストを、トークン数と件数の上限を超えないバッチに分けます。
+
+    1件で上限を超えるものは単独のバッチにします。
+    """
+    batches = []
+    current, current_tokens = [], 0
+    for item in items:
+        tokens = estimate_tokens(item[1])
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_items):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(item)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _batch_payload(batch):
+    entries = [{"id": item_id, "text": text} for item_id, text in batch]
+    prompt = (
+        "以下の各フィードバックテキストを読み、ポジティブな点と改善点を抽出し、"
+        "それぞれ30文字以内の簡潔な日本語で要約してください。\n\n"
+        f"フィードバック (JSON):\n{json.dumps(entries, ensure_ascii=False)}"
+    )
+    return {
+        "contents": [{"parts": [{"text": prompt}]}],
+        "systemInstruction": {"parts": [{"text": BATCH_SYSTEM_INSTRUCTION}]},
+        "generationConfig": {
+            "responseMimeType": "application/json",
+            "responseSchema": BATCH_RESPONSE_SCHEMA,
+        },
+    }
+
+
+def _parse_batch_response(text, batch):
+    """応答のJSONから、バッチ内のIDに対応する空でない要約だけを取り出します。"""
+    results = json.loads(text)
+    if not isinstance(results, list):
+        raise ValueError("応答がJSON配列ではありません。")
+    expected = {item_id for item_id, _ in batch}
+    summaries = {}
+    for result in results:
+        if not isinstance(result, dict):
+            continue
+        item_id, summary = result.get("id"), result.get("summary")
+        if item_id in expected and isinstance(summary, str) and summary.strip():
+            summaries[item_id] = summary.strip()
+    return summaries
+
+
+def _summarize_one_batch(batch):
+    """1バッチを要約し、(要約のdict, エラー文字列またはNone) を返します。"""
+    try:
+        text = call_gemini_api_base(_batch_payload(batch), "一括要約", endpoint="batch_summary")
+        return _parse_batch_response(text, batch), None
+    except Exception as e:
+        return {}, str(e)
+
+
+def summarize_batch(items, max_tokens=DEFAULT_MAX_BATCH_TOKENS, max_items=DEFAULT_MAX_BATCH_ITEMS,
+                    concurrency=1, max_rounds=3):
+    """(id, text) のリストを一括で要約します。
+
+    戻り値は (summaries, errors)。summaries は id -> 要約、errors は要約できなかった id -> エラー内容。
+    各ラウンドで失敗した項目だけを、件数の上限を半分にしたバッチで再試行します。
+    """
+    summaries, errors = {}, {}
+    pending = [(item_id, text) for item_id, text in items if text and text.strip()]
+    for item_id, text in items:
+        if not (text and text.strip()):
+            errors[item_id] = "テキストが空です。"
+
+    for _ in range(max_rounds):
+        if not pending:
+            break
+        batches = split_batches(pending, max_tokens, max_items)
+        print(f"🚀 {len(pending)} 件を {len(batches)} バッチで要約中...")
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            results = list(executor.map(_summarize_one_batch, batches))
+
+        retry = []
+        for batch, (batch_summaries, error) in zip(batches, results):
+            summaries.update(batch_summaries)
+            for item in batch:
+                if item[0] in batch_summaries:
+                    errors.pop(item[0], None)
+                else:
+                    errors[item[0]] = error or "応答に要約が含まれていませんでした。"
+                    retry.append(item)
+        pending = retry
+        max_items = max(1, max_items // 2)
+
+    return summaries, errors
+
+
+# -------------------------------------------------------------
+# CLI: 未処理のセッションをすべて要約する
+# -------------------------------------------------------------
+def drain(claim_size=200, concurrency=4, max_tokens=DEFAULT_MAX_BATCH_TOKENS, max_items=DEFAULT_MAX_BATCH_ITEMS,
+          max_attempts=5, lease_seconds=600, retry_delay=60, requeue_errors=False):
+    """is_processed = false の行を claim_size 件ずつリースして要約し、保存します。
+
+    (保存件数, 失敗件数) を返します。失敗した行は retry_delay 秒後に再びリース可能になります。
+    """
+    generations = generation_store_from_url(os.environ.get('CACHE_SHARED_URL'))
+    completed = failed = 0
+
+    if requeue_errors:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(REQUEUE_ERRORS_SQL)
+            print(f"✅ 要約エラーの行を {cursor.rowcount} 件未処理に戻しました。")
+            conn.commit()
+
+    while True:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(CLAIM_BATCH_SQL, {
+                "limit": claim_size, "lease_seconds": lease_seconds, "max_attempts": max_attempts,
+            })
+            claimed = cursor.fetchall()
+            conn.commit()
+        if not claimed:
+            break
+
+        # Gemini の呼び出し中はDB接続を保持しない
+        summaries, errors = summarize_batch(
+            [(session_id, raw_text) for session_id, raw_text, _, _ in claimed],
+            max_tokens=max_tokens, max_items=max_items, concurrency=concurrency,
+        )
+
+        with db_connection() as conn, conn.cursor() as cursor:
+            booth_ids = set()
+            # リースした時の summary_attempts が変わっていない (他のワーカーがリースし直していない) 行だけ保存する
+            attempts = {session_id: attempt for session_id, _, _, attempt in claimed}
+            if summaries:
+                rows = execute_values(cursor, COMPLETE_BATCH_SQL, [
+                    (session_id, summary_text, attempts[session_id]) for session_id, summary_text in summaries.items()
+                ], fetch=True)
+                booth_ids.update(row[0] for row in rows)
+            for session_id, error in errors.items():
+                cursor.execute(FAIL_SQL, {"delay": retry_delay, "error": error[:500], "session_id": session_id,
+                                          "attempts": attempts[session_id]})
+            conn.commit()
+
+        # 各ワーカープロセスのダッシュボードキャッシュを無効化 (flask_app.dashboard_cache と同じキー)
+        for booth_id in booth_ids:
+            if booth_id:
+                generations.bump(booth_id.lower().strip())
+
+        completed += len(summaries)
+        failed += len(errors)
+        print(f"✅ {len(summaries)} 件を保存しました (失敗 {len(errors)} 件)。")
+
+    return completed, failed
+
+
+def main(argv):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["drain"])
+    parser.add_argument("--concurrency", type=int, default=4, help="同時に送るバッチ数")
+    parser.add_argument("--claim-size", type=int, default=200, help="1回にリースする行数")
+    parser.add_argument("--max-batch-tokens", type=int, default=DEFAULT_MAX_BATCH_TOKENS)
+    parser.add_argument("--max-batch-items", type=int, default=DEFAULT_MAX_BATCH_ITEMS)
+    parser.add_argument("--max-attempts", type=int, default=int(os.environ.get('SUMMARY_MAX_ATTEMPTS', 5)))
+    parser.add_argument("--retry-delay", type=int, default=60, help="失敗した行を再びリース可能にするまでの秒数")
+    parser.add_argument("--requeue-errors", action="store_true", help="【要約エラー…】が保存された行も要約し直す")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        completed, failed = drain(
+            claim_size=args.claim_size,
+            concurrency=args.concurrency,
+            max_tokens=args.max_batch_tokens,
+            max_items=args.max_batch_items,
+            max_attempts=args.max_attempts,
+            retry_delay=args.retry_delay,
+            requeue_errors=args.requeue_errors,
+        )
+    except (DBPoolError, psycopg2.Error) as e:
+        print(f"❌ データベースエラー: {e}")
+        return 1
+    print(f"✅ 完了: 保存 {completed} 件 / 失敗 {failed} 件")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
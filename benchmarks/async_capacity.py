@@ -0,0 +1,142 @@
+"""
+上流の応答待ちが長いときの同時リクエスト処理能力の比較 (WSGI vs ASGI)。
+- wsgi: flask_app.py を app.run (threaded) で起動 (従来の起動方法)
+- asgi: asgi_app.py を uvicorn で起動
+
+上流はフェイクの Gemini サーバー (--upstream-latency 秒で応答) で、/api/generate_summary に
+同時に N 件 (毎回異なるテキスト、キャッシュ無効) を送り、成功数・レイテンシ・サーバーのピークRSSを測ります。
+ピークRSSが --memory-budget-mb 以下で、全件成功し p95 が上流の待ち時間の2倍以内だった最大の N を
+「そのメモリ予算での同時処理能力」として表示します (Linux のみ)。
+
+使い方:
+    python benchmarks/async_capacity.py --levels 50,100,200,400 --memory-budget-mb 150
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+
+import aiohttp
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_gemini import FakeGeminiServer  # noqa: E402
+from audio_upload_memory import _proc_status_kb, _reset_peak  # noqa: E402
+
+WSGI_SNIPPET = """
+import sys
+sys.path.insert(0, {root!r})
+import flask_app
+flask_app.app.run(port={port}, threaded=True, debug=False, use_reloader=False)
+"""
+
+ASGI_SNIPPET = """
+import sys
+sys.path.insert(0, {root!r})
+import uvicorn
+uvicorn.run("asgi_app:app", port={port}, log_level="warning", backlog=2048)
+"""
+
+
+def _start_server(mode, port, gemini_url):
+    env = dict(
+        os.environ,
+        GEMINI_API_URL=gemini_url,
+        GEMINI_API_KEY="bench",
+        PYTHONUNBUFFERED="1",
+        # 制限やキャッシュで差が出ないようにする
+        GEMINI_CACHE_MEMORY_SIZE="0",
+        GEMINI_DEFAULT_RPM="0",
+        GEMINI_DEFAULT_CONCURRENCY="100000",
+        GEMINI_HTTP_POOL_SIZE="4096",
+        GEMINI_HTTP_MAX_RETRIES="0",
+    )
+    env.pop("DATABASE_URL", None)
+    snippet = WSGI_SNIPPET if mode == "wsgi" else ASGI_SNIPPET
+    proc = subprocess.Popen([sys.executable, "-c", snippet.format(root=ROOT_DIR, port=port)],
+                            env=env, cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}/api/generate_summary"
+    for _ in range(100):
+        try:
+            requests.post(url, json={"raw_text": "warmup"}, timeout=30)
+            return proc, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError(f"{mode} サーバーが起動しませんでした")
+
+
+async def _fire(url, count, timeout):
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as client:
+        async def one(i):
+            started = time.perf_counter()
+            try:
+                async with client.post(url, json={"raw_text": f"ベンチマーク {i} {time.time()}"}) as response:
+                    body = await response.json()
+                ok = response.status == 200 and "要約エラー" not in body.get("summary_text", "")
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                ok = False
+            return ok, time.perf_counter() - started
+
+        return await asyncio.gather(*(one(i) for i in range(count)))
+
+
+def measure(mode, levels, port, gemini_url, timeout):
+    proc, url = _start_server(mode, port, gemini_url)
+    rows = []
+    try:
+        for count in levels:
+            rss_before = _proc_status_kb(proc.pid, "VmRSS")
+            _reset_peak(proc.pid)
+            started = time.perf_counter()
+            results = asyncio.run(_fire(url, count, timeout))
+            elapsed = time.perf_counter() - started
+            latencies = sorted(latency for _, latency in results)
+            rows.append({
+                "mode": mode,
+                "concurrency": count,
+                "ok": sum(1 for ok, _ in results if ok),
+                "elapsed_s": round(elapsed, 2),
+                "p50_s": round(latencies[len(latencies) // 2], 2),
+                "p95_s": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+                "rss_before_mb": round(rss_before / 1024, 1),
+                "peak_rss_mb": round(_proc_status_kb(proc.pid, "VmHWM") / 1024, 1),
+                "threads": _proc_status_kb(proc.pid, "Threads"),
+            })
+    finally:
+        proc.terminate()
+        proc.wait()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", default="50,100,200,400", help="同時リクエスト数 (カンマ区切り)")
+    parser.add_argument("--upstream-latency", type=float, default=2.0)
+    parser.add_argument("--memory-budget-mb", type=float, default=150)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--port", type=int, default=5098)
+    args = parser.parse_args()
+    levels = [int(level) for level in args.levels.split(",")]
+
+    with FakeGeminiServer(latency=args.upstream_latency) as gemini:
+        for mode in ("wsgi", "asgi"):
+            capacity = 0
+            for row in measure(mode, levels, args.port, gemini.url, args.timeout):
+                within_slo = row["ok"] == row["concurrency"] and row["p95_s"] <= args.upstream_latency * 2
+                within_budget = row["peak_rss_mb"] <= args.memory_budget_mb
+                if within_slo and within_budget:
+                    capacity = max(capacity, row["concurrency"])
+                print(f"{mode:<5} N={row['concurrency']:<5} ok={row['ok']:<5} p50={row['p50_s']:>6.2f}s "
+                      f"p95={row['p95_s']:>6.2f}s peakRSS={row['peak_rss_mb']:>7.1f}MB threads={row['threads']}")
+            print(f"==> {mode}: {args.memory_budget_mb:.0f}MB 以内での同時処理能力 {capacity} 件")
+
+
+if __name__ == '__main__':
+    main()
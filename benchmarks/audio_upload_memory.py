@@ -0,0 +1,120 @@
+"""
+/api/process_audio のアップロード形式ごとのサーバー側ピークRSSの比較。
+- json:      従来の Base64 を含むJSON
+- multipart: multipart/form-data の audio ファイル
+- raw:       audio/webm の生バイナリ
+
+形式ごとに flask_app.py を別プロセスで起動し (上流はフェイクの Gemini サーバー)、
+1リクエストの前後で /proc/<pid>/status の VmRSS と VmHWM を比べます (Linux のみ)。
+
+使い方:
+    python benchmarks/audio_upload_memory.py --size-mb 10
+"""
+import io
+import os
+import sys
+import time
+import base64
+import argparse
+import subprocess
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_gemini import FakeGeminiServer  # noqa: E402
+
+SERVER_SNIPPET = """
+import sys
+sys.path.insert(0, {root!r})
+import flask_app
+flask_app.app.run(port={port}, threaded=True, debug=False, use_reloader=False)
+"""
+
+
+def _proc_status_kb(pid, field):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise RuntimeError(f"{field} が取得できません")
+
+
+def _reset_peak(pid):
+    # VmHWM を現在の RSS にリセット (Linux 4.0+)
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _send(mode, url, audio):
+    if mode == "json":
+        return requests.post(url, json={
+            "audio_data": base64.b64encode(audio).decode("ascii"),
+            "mime_type": "audio/webm",
+            "booth_id": "bench",
+        })
+    if mode == "multipart":
+        return requests.post(url, files={"audio": ("clip.webm", io.BytesIO(audio), "audio/webm")},
+                             data={"booth_id": "bench"})
+    return requests.post(url + "?booth_id=bench", data=io.BytesIO(audio),
+                         headers={"Content-Type": "audio/webm"})
+
+
+def measure(mode, audio, gemini_url, port):
+    env = dict(os.environ, GEMINI_API_URL=gemini_url, GEMINI_API_KEY="bench", PYTHONUNBUFFERED="1")
+    root = os.path.dirname(BENCH_DIR)
+    proc = subprocess.Popen([sys.executable, "-c", SERVER_SNIPPET.format(root=root, port=port)],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}/api/process_audio"
+    try:
+        for _ in range(100):
+            try:
+                _send(mode, url, b"warmup")
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError("サーバーが起動しませんでした")
+
+        rss_before = _proc_status_kb(proc.pid, "VmRSS")
+        peak_reset = _reset_peak(proc.pid)
+        started = time.perf_counter()
+        response = _send(mode, url, audio)
+        elapsed = time.perf_counter() - started
+        response.raise_for_status()
+        peak = _proc_status_kb(proc.pid, "VmHWM")
+        return {
+            "mode": mode,
+            "latency_ms": round(elapsed * 1000, 1),
+            "peak_rss_delta_mb": round((peak - rss_before) / 1024, 1),
+            "peak_exact": peak_reset,
+        }
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=10)
+    parser.add_argument("--port", type=int, default=5099)
+    args = parser.parse_args()
+
+    audio = os.urandom(int(args.size_mb * 1024 * 1024))
+    with FakeGeminiServer() as gemini:
+        for mode in ("json", "multipart", "raw"):
+            before = gemini.bytes_received
+            row = measure(mode, audio, gemini.url, args.port)
+            upstream_mb = (gemini.bytes_received - before) / 1024 / 1024
+            note = "" if row["peak_exact"] else " (VmHWM未リセット: 起動時のピークを含む可能性あり)"
+            print(f"{mode:<10} peak RSS +{row['peak_rss_delta_mb']:>7.1f} MB  "
+                  f"latency {row['latency_ms']:>8.1f} ms  upstream {upstream_mb:>6.1f} MB{note}")
+
+
+if __name__ == '__main__':
+    main()
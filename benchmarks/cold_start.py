@@ -0,0 +1,160 @@
+"""
+app.py のコールドスタートと最初のリクエストのレイテンシの比較 (AI_CLIENTS_WARMUP ごと)。
+- blocking:   起動時にクライアントを作り終えてから受付開始 (従来のモジュール読み込み時の初期化に相当)
+- background: 受付を始めてから別スレッドでクライアントを作る (既定)
+- off:        最初のリクエストでクライアントを作る
+
+モードごとに app.py を --runs 回、別プロセスで起動し直し、次の時間の中央値を表示します。
+- listen:     プロセスの起動からリクエストを受け付けるまで (GET /healthz が応答するまで)
+- ready:      GET /readyz が 200 になるまで
+- first_*:    受付開始直後に送った最初の /summarize と /recognize のレイテンシ
+- serviceable: 起動から最初の /summarize と /recognize が両方成功するまで
+
+GenAI クライアントはフェイクの Gemini サーバーに向け (GEMINI_BASE_URL)、Speech クライアントは
+本物と同じく google.cloud.speech を import して SpeechClient を作ったうえで (認証は匿名)、
+認識はフェイク (fake_recognizer.py) で行います。--output を指定すると結果をJSONで書き出します。
+
+使い方:
+    python benchmarks/cold_start.py --runs 5
+"""
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import statistics
+import subprocess
+import threading
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_gemini import FakeGeminiServer  # noqa: E402
+
+MODES = ("blocking", "background", "off")
+
+# 本物の SpeechClient の import と作成のコストはそのまま払い、認識だけフェイクにする
+SERVER_SNIPPET = """
+import sys
+sys.path.insert(0, {root!r})
+sys.path.insert(0, {bench!r})
+import ai_clients
+
+def create_speech_client():
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import speech_v1p1beta1 as speech
+    speech.SpeechClient(credentials=AnonymousCredentials())
+    from fake_recognizer import FakeSpeechClient
+    return FakeSpeechClient(realtime_factor=0.0)
+
+ai_clients.speech_client.factory = create_speech_client
+import app
+app.app.run(port={port}, threaded=True, debug=False, use_reloader=False)
+"""
+
+
+def _wait_listening(url, started, timeout=60):
+    while time.perf_counter() - started < timeout:
+        try:
+            requests.get(url + "/healthz", timeout=5)
+            return time.perf_counter() - started
+        except requests.ConnectionError:
+            time.sleep(0.005)
+    raise RuntimeError("サーバーが起動しませんでした")
+
+
+def _timed_post(url, payload, started, results, name):
+    sent = time.perf_counter()
+    try:
+        ok = requests.post(url, json=payload, timeout=60).status_code == 200
+    except requests.RequestException:
+        ok = False
+    finished = time.perf_counter()
+    results[name] = {"ok": ok, "latency_s": finished - sent, "since_start_s": finished - started}
+
+
+def _wait_ready(url, started, timeout=60):
+    while time.perf_counter() - started < timeout:
+        if requests.get(url + "/readyz", timeout=5).status_code == 200:
+            return time.perf_counter() - started
+        time.sleep(0.01)
+    return None
+
+
+def measure(mode, port, gemini_base, audio):
+    env = dict(os.environ, AI_CLIENTS_WARMUP=mode, GEMINI_API_KEY="bench", GEMINI_MODEL="fake",
+               GEMINI_BASE_URL=gemini_base, GEMINI_DEFAULT_RPM="0", PYTHONUNBUFFERED="1", LOG_LEVEL="WARNING")
+    url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-c", SERVER_SNIPPET.format(root=ROOT_DIR, bench=BENCH_DIR, port=port)],
+                            env=env, cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        listen = _wait_listening(url, started)
+        # 受付開始直後に、最初の要約と文字起こしを同時に送る
+        results = {}
+        threads = [
+            threading.Thread(target=_timed_post, args=(url + "/summarize", {"text": "説明が分かりやすかった"},
+                                                      started, results, "summarize")),
+            threading.Thread(target=_timed_post, args=(url + "/recognize", {"audio_data": audio},
+                                                      started, results, "recognize")),
+        ]
+        for thread in threads:
+            thread.start()
+        ready = _wait_ready(url, started)
+        for thread in threads:
+            thread.join()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    ok = all(result["ok"] for result in results.values())
+    return {
+        "listen_s": listen,
+        "ready_s": ready,
+        "first_summarize_s": results["summarize"]["latency_s"],
+        "first_recognize_s": results["recognize"]["latency_s"],
+        "serviceable_s": max(result["since_start_s"] for result in results.values()) if ok else None,
+        "ok": ok,
+    }
+
+
+def _median(rows, key):
+    values = [row[key] for row in rows if row[key] is not None]
+    return round(statistics.median(values), 3) if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--port", type=int, default=5097)
+    parser.add_argument("--output", default=None, help="結果を書き出すJSONファイル")
+    args = parser.parse_args()
+
+    audio = base64.b64encode(os.urandom(16000 * 2)).decode("ascii")  # 2秒相当
+    summary = {}
+    with FakeGeminiServer() as gemini:
+        gemini_base = gemini.url.split("/v1beta/")[0]
+        for mode in args.modes.split(","):
+            rows = [measure(mode, args.port, gemini_base, audio) for _ in range(args.runs)]
+            summary[mode] = {key: _median(rows, key) for key in rows[0] if key != "ok"}
+            summary[mode]["failed_runs"] = sum(1 for row in rows if not row["ok"])
+
+    print(f"{'mode':<11} {'listen':>8} {'ready':>8} {'1st summarize':>14} {'1st recognize':>14} {'serviceable':>12}")
+    for mode, row in summary.items():
+        cells = [f"{row[key]:.3f}s" if row[key] is not None else "-" for key in
+                 ("listen_s", "ready_s", "first_summarize_s", "first_recognize_s", "serviceable_s")]
+        failed = f"  (失敗 {row['failed_runs']}回)" if row["failed_runs"] else ""
+        print(f"{mode:<11} {cells[0]:>8} {cells[1]:>8} {cells[2]:>14} {cells[3]:>14} {cells[4]:>12}{failed}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"runs": args.runs, "modes": summary}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
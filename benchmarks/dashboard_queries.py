@@ -0,0 +1,84 @@
+"""
+/api/feedback/<email> のDB取得部分のレイテンシ比較。
+従来の4クエリ方式 (fetch_dashboard_separate) と CTE の1往復方式 (fetch_dashboard_combined)
+を同じ接続で交互に実行し、p50/p95/平均を出力します。
+
+使い方:
+    python benchmarks/dashboard_queries.py student@example.com --iterations 200
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+import psycopg2
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from queries import fetch_dashboard_combined, fetch_dashboard_separate  # noqa: E402
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(name, samples):
+    return {
+        "name": name,
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "mean_ms": round(statistics.mean(samples) * 1000, 3),
+    }
+
+
+def run(conn, email, iterations, warmup):
+    fetchers = [("separate (4 queries)", fetch_dashboard_separate), ("combined (1 query)", fetch_dashboard_combined)]
+    samples = {name: [] for name, _ in fetchers}
+
+    with conn.cursor() as cursor:
+        # 結果が同一であることを先に確認
+        results = [fetch(cursor, email) for _, fetch in fetchers]
+        if results[0] is None:
+            raise SystemExit(f"❌ {email} に紐づく学生が見つかりません。")
+        if sorted(results[0][2]) != sorted(results[1][2]) or results[0][3:] != results[1][3:]:
+            raise SystemExit("❌ 2つの方式の結果が一致しません。")
+
+        for i in range(warmup + iterations):
+            # 順番による偏りを避けるため交互に実行
+            for name, fetch in fetchers if i % 2 == 0 else reversed(fetchers):
+                started = time.perf_counter()
+                fetch(cursor, email)
+                elapsed = time.perf_counter() - started
+                if i >= warmup:
+                    samples[name].append(elapsed)
+            conn.rollback()
+
+    return [summarize(name, samples[name]) for name, _ in fetchers]
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("email")
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=10)
+    args = parser.parse_args()
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        raise SystemExit("❌ DATABASE_URLが設定されていません。")
+
+    conn = psycopg2.connect(database_url, connect_timeout=5)
+    try:
+        for row in run(conn, args.email.lower().strip(), args.iterations, args.warmup):
+            print(f"{row['name']:<22} p50={row['p50_ms']:>9.3f}ms  p95={row['p95_ms']:>9.3f}ms  mean={row['mean_ms']:>9.3f}ms")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+ローカルで動くフェイクの Gemini generateContent サーバー。
+ベンチマークや動作確認で、本物のAPIを呼ばずに flask_app.py / app.py を動かすために使います。
+generationConfig.responseMimeType が application/json のリクエストには、responseSchema に沿った
+ダミーのJSONを返します (app.py の /summarize や generate_ratio_scores 用)。
+
+使い方:
+    python benchmarks/fake_gemini.py --port 8090 --latency 0.5 --error-rate 0.1
+    GEMINI_API_URL=http://127.0.0.1:8090/v1beta/models/fake:generateContent python flask_app.py
+"""
+import json
+import time
+import random
+import argparse
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# これより大きいリクエスト本文 (音声を含むもの) は中身を見ずに捨てる
+MAX_KEPT_BODY = 1024 * 1024
+
+
+def _fake_value(schema, text):
+    """responseSchema (OBJECT / ARRAY / STRING / INTEGER / NUMBER / BOOLEAN) に沿ったダミーの値を作ります。"""
+    kind = str(schema.get("type", "STRING")).upper()
+    if kind == "OBJECT":
+        return {name: _fake_value(child, text) for name, child in (schema.get("properties") or {}).items()}
+    if kind == "ARRAY":
+        return [_fake_value(schema.get("items") or {}, text)]
+    if kind in ("INTEGER", "NUMBER"):
+        minimum, maximum = schema.get("minimum"), schema.get("maximum")
+        if minimum is not None and maximum is not None:
+            value = (float(minimum) + float(maximum)) / 2
+        else:
+            value = 5
+        return int(value) if kind == "INTEGER" else float(value)
+    if kind == "BOOLEAN":
+        return True
+    return text
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        """Content-Length と chunked の両方に対応して本文を読み、(バイト数, 本文) を返します。
+
+        音声を含む大きな本文は保持せず捨てます (本文は None)。
+        """
+        total = 0
+        kept = []
+
+        def consume(remaining):
+            while remaining:
+                data = self.rfile.read(min(remaining, 64 * 1024))
+                remaining -= len(data)
+                if sum(map(len, kept)) + len(data) <= MAX_KEPT_BODY:
+                    kept.append(data)
+
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                consume(size)
+                self.rfile.readline()
+                total += size
+        else:
+            total = int(self.headers.get("Content-Length", 0))
+            consume(total)
+        return total, (b"".join(kept) if total <= MAX_KEPT_BODY else None)
+
+    def _response_text(self, body):
+        """JSONモードのリクエストならスキーマに沿ったJSON文字列、それ以外は固定のテキストを返します。"""
+        if body:
+            with contextlib.suppress(ValueError, AttributeError):
+                config = json.loads(body).get("generationConfig") or {}
+                if config.get("responseMimeType") == "application/json" and config.get("responseSchema"):
+                    return json.dumps(_fake_value(config["responseSchema"], self.server.response_text),
+                                      ensure_ascii=False)
+        return self.server.response_text
+
+    def do_POST(self):
+        server = self.server
+        received, request_body = self._read_body()
+        with server.lock:
+            server.requests += 1
+            server.bytes_received += received
+
+        # 音声の長さに応じて上流の処理時間が増えるのを、受信サイズに比例した遅延で模擬する
+        delay = server.latency + server.seconds_per_mb * received / (1024 * 1024)
+        if delay:
+            time.sleep(delay)
+
+        if server.error_rate and random.random() < server.error_rate:
+            body = json.dumps({"error": {"message": "fake upstream error", "code": server.error_status}}).encode()
+            self.send_response(server.error_status)
+            if server.retry_after is not None:
+                self.send_header("Retry-After", str(server.retry_after))
+        else:
+            body = json.dumps({
+                "candidates": [{"content": {"parts": [{"text": self._response_text(request_body)}]}}]
+            }, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    """スレッドで起動するフェイクサーバー。with 文で使うと終了時に停止します。"""
+
+    daemon_threads = True
+    # 同時接続数の多いベンチマークで接続が拒否されないように
+    request_queue_size = 1024
+
+    def __init__(self, port=0, latency=0.0, error_rate=0.0, error_status=503, retry_after=None,
+                 response_text="フェイクの応答テキストです。", seconds_per_mb=0.0):
+        super().__init__(("127.0.0.1", port), FakeGeminiHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.response_text = response_text
+        self.seconds_per_mb = seconds_per_mb
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_received = 0
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1beta/models/fake:generateContent"
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0, help="応答までの遅延 (秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="エラーを返す割合 (0〜1)")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--retry-after", type=int, default=None)
+    parser.add_argument("--seconds-per-mb", type=float, default=0.0, help="リクエストボディ1MBあたりの追加の遅延 (秒)")
+    args = parser.parse_args()
+
+    server = FakeGeminiServer(args.port, args.latency, args.error_rate, args.error_status, args.retry_after,
+                              seconds_per_mb=args.seconds_per_mb)
+    print(f"✅ Fake Gemini server: {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
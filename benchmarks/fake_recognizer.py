@@ -0,0 +1,98 @@
+"""
+ローカルで動くフェイクの Google Cloud Speech-to-Text クライアント。
+app.py の Speech クライアント (ai_clients.speech_client) の代わりに差し込み、本物のAPIを呼ばずに /recognize と /recognize/stream を動かすために使います。
+
+- recognize / long_running_recognize: 音声の長さ (バイト数から推定) × realtime_factor 秒かけて全文を返す
+- streaming_recognize: チャンクを受け取るたびに stream_latency 秒後に途中結果を返し、
+  final_every チャンクごとに確定結果を返す
+- error_rate の割合で ServiceUnavailable (503) を投げる (上流の障害を模擬)
+
+使い方:
+    import ai_clients
+    from fake_recognizer import FakeSpeechClient
+    ai_clients.speech_client.set(FakeSpeechClient())
+"""
+import time
+import random
+
+from google.api_core.exceptions import InvalidArgument, ServiceUnavailable
+from google.cloud import speech_v1p1beta1 as speech
+
+from audio_preprocess import OUTPUT_BITRATE
+
+SYNC_LIMIT_SECONDS = 60
+
+
+def _response(text, is_final=True, streaming=False):
+    alternative = speech.SpeechRecognitionAlternative(transcript=text, confidence=0.9)
+    if streaming:
+        result = speech.StreamingRecognitionResult(alternatives=[alternative], is_final=is_final)
+        return speech.StreamingRecognizeResponse(results=[result])
+    return speech.RecognizeResponse(results=[speech.SpeechRecognitionResult(alternatives=[alternative])])
+
+
+class _FakeOperation:
+    def __init__(self, client, seconds):
+        self.client = client
+        self.seconds = seconds
+
+    def result(self, timeout=None):
+        time.sleep(self.seconds * self.client.realtime_factor)
+        return _response(self.client.transcript(self.seconds))
+
+
+class FakeSpeechClient:
+    def __init__(self, bytes_per_second=16000, realtime_factor=0.3, stream_latency=0.15, final_every=8,
+                 error_rate=0.0):
+        self.bytes_per_second = bytes_per_second  # 128kbps の Opus 相当
+        self.realtime_factor = realtime_factor
+        self.stream_latency = stream_latency
+        self.final_every = final_every
+        self.error_rate = error_rate
+        self.calls = {"recognize": 0, "long_running_recognize": 0, "streaming_recognize": 0}
+        self.errors = 0
+
+    def _maybe_fail(self):
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            raise ServiceUnavailable("fake speech upstream error")
+
+    def transcript(self, seconds):
+        return "".join(f"単語{i}" for i in range(max(1, int(seconds))))
+
+    def _seconds(self, config, audio):
+        # 前処理 (audio_preprocess.py) 済みの Ogg Opus は低ビットレート
+        if config.encoding == speech.RecognitionConfig.AudioEncoding.OGG_OPUS:
+            return len(audio.content) / (OUTPUT_BITRATE / 8)
+        return len(audio.content) / self.bytes_per_second
+
+    def recognize(self, config, audio):
+        self.calls["recognize"] += 1
+        self._maybe_fail()
+        seconds = self._seconds(config, audio)
+        if seconds > SYNC_LIMIT_SECONDS:
+            raise InvalidArgument("Sync input too long. For audio longer than 1 min use LongRunningRecognize.")
+        time.sleep(seconds * self.realtime_factor)
+        return _response(self.transcript(seconds))
+
+    def long_running_recognize(self, config, audio):
+        self.calls["long_running_recognize"] += 1
+        self._maybe_fail()
+        return _FakeOperation(self, self._seconds(config, audio))
+
+    def streaming_recognize(self, config, requests):
+        self.calls["streaming_recognize"] += 1
+        self._maybe_fail()
+        words = []
+        pending = 0
+        for request in requests:
+            time.sleep(self.stream_latency)
+            words.append(f"単語{len(words)}")
+            pending += 1
+            if pending >= self.final_every:
+                yield _response("".join(words[-pending:]), is_final=True, streaming=True)
+                pending = 0
+            else:
+                yield _response("".join(words[-pending:]), is_final=False, streaming=True)
+        if pending:
+            yield _response("".join(words[-pending:]), is_final=True, streaming=True)
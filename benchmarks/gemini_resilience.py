@@ -0,0 +1,74 @@
+"""
+フェイクの Gemini サーバーに対する http_client.ResilientHTTPClient の動作確認。
+
+シナリオ:
+- flaky:   30% が 503 → 再試行で成功率が上がること
+- retry_after: 429 + Retry-After: 1 → 指定した秒数だけ待って再試行すること
+- outage:  100% が 503 → サーキットブレーカーが開き、以降は上流を呼ばずに即座に失敗すること
+- recover: 上流が回復した後、half_open の試行を経て closed に戻ること
+
+使い方:
+    python benchmarks/gemini_resilience.py
+"""
+import os
+import sys
+import time
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fake_gemini import FakeGeminiServer  # noqa: E402
+from http_client import CircuitBreaker, CircuitOpenError, ResilientHTTPClient  # noqa: E402
+
+
+def _run(client, url, count):
+    ok = failed = rejected = 0
+    started = time.perf_counter()
+    for _ in range(count):
+        try:
+            response = client.post(url, json={"contents": []})
+            if response.status_code == 200:
+                ok += 1
+            else:
+                failed += 1
+        except CircuitOpenError:
+            rejected += 1
+    return {"ok": ok, "failed": failed, "rejected": rejected,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    def new_client(open_seconds=2.0):
+        breaker = CircuitBreaker(failure_threshold=0.5, min_requests=10, window=10, open_seconds=open_seconds)
+        return ResilientHTTPClient(max_retries=3, backoff_base=0.01, backoff_max=5, timeout=5, breaker=breaker)
+
+    with FakeGeminiServer(error_rate=0.3) as server:
+        client = new_client()
+        result = _run(client, server.url, args.requests)
+        print(f"flaky       {result}  upstream={server.requests} retries={client.retries}")
+
+    with FakeGeminiServer(error_rate=1.0, error_status=429, retry_after=1) as server:
+        client = ResilientHTTPClient(max_retries=1, backoff_base=0.01, timeout=5)
+        result = _run(client, server.url, 1)
+        print(f"retry_after {result}  (>= 1000ms なら Retry-After を守っている)")
+
+    with FakeGeminiServer(error_rate=1.0) as server:
+        client = new_client()
+        result = _run(client, server.url, args.requests)
+        print(f"outage      {result}  upstream={server.requests} breaker={client.breaker.stats()['state']}")
+
+        server.error_rate = 0.0
+        time.sleep(client.breaker.open_seconds)
+        result = _run(client, server.url, 5)
+        print(f"recover     {result}  breaker={client.breaker.stats()['state']}")
+        print(client.stats())
+
+
+if __name__ == '__main__':
+    main()
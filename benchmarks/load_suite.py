@@ -0,0 +1,537 @@
+"""
+オフラインの負荷試験スイート (本物の Google のサービスを使わずに再現できるもの)。
+
+- 上流: フェイクの Gemini サーバー (fake_gemini.py) とフェイクの Speech クライアント (fake_recognizer.py)。
+  どちらも遅延とエラーの割合を指定できます
+- DB: DATABASE_URL (--database-url) のデータベースに、合成したイベントのデータ
+  (N チーム × M 人の学生、ブースごとに K 件のフィードバック) を投入します。
+  指定がなければ pgserver でローカルの Postgres を一時的に起動します (pip install pgserver)
+- サーバー: flask_app.py と app.py をそれぞれ別プロセスで起動し (app.run の threaded)、
+  app.py にはフェイクの Speech クライアントを差し込み、GenAI クライアントはフェイクサーバーに向けます
+- 負荷: トラフィックの構成 (--mixes) ごとに --concurrency 本のクライアントが --duration 秒間、
+  重み付きで選んだリクエストを送り続けます (クローズドループ)
+
+エンドポイントごとの p50/p95/p99・RPS・エラー数と、各サーバーのピークRSS (Linux のみ) を
+--output のJSONに書き出します。--baseline に以前の結果を渡すと差分を表示し、
+--max-regression を超えて p95 が悪化したエンドポイントがあれば終了コード 1 で終わります。
+
+サーバーは実行時の環境変数をそのまま引き継ぐので、設定 (キャッシュ、DBプール、書き込みバッファなど) を
+変えて比べられます。Gemini のレート制限だけは、指定がなければ上流の待ちが結果を支配しないよう緩めます。
+ベンチマークで入れた行 (booth_id が bench- で始まる行、メールアドレスが @bench.invalid の学生) は
+終了時に削除します (--keep で残す)。
+
+使い方:
+    python benchmarks/load_suite.py --output bench.json
+    python benchmarks/load_suite.py --teams 40 --students 5 --sessions 500 --concurrency 32 --duration 60
+    python benchmarks/load_suite.py --gemini-latency 1.5 --gemini-error-rate 0.05 --stt-error-rate 0.05
+    python benchmarks/load_suite.py --baseline bench.json --output bench-new.json --max-regression 10
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+import requests
+from psycopg2.extras import execute_values
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from fake_gemini import FakeGeminiServer  # noqa: E402
+from dashboard_queries import percentile  # noqa: E402
+from audio_upload_memory import _proc_status_kb, _reset_peak  # noqa: E402
+import schema  # noqa: E402
+from feedback_scorer import score_feedback  # noqa: E402
+from feedback_ingest import SESSION_COLUMNS  # noqa: E402
+
+BENCH_BOOTH_PREFIX = "bench-"
+BENCH_EMAIL_DOMAIN = "bench.invalid"
+
+FLASK_SNIPPET = """
+import sys
+sys.path.insert(0, {root!r})
+import flask_app
+flask_app.app.run(port={port}, threaded=True, debug=False, use_reloader=False)
+"""
+
+# app.py の Speech クライアントはフェイクに差し替える (GenAI クライアントは GEMINI_BASE_URL でフェイクサーバーへ)
+APP_SNIPPET = """
+import sys
+sys.path.insert(0, {root!r})
+sys.path.insert(0, {bench!r})
+import ai_clients
+from fake_recognizer import FakeSpeechClient
+ai_clients.speech_client.set(FakeSpeechClient(realtime_factor={stt_realtime_factor!r}, error_rate={stt_error_rate!r}))
+import app
+app.app.run(port={port}, threaded=True, debug=False, use_reloader=False)
+"""
+
+# 指定がなければサーバーに渡す設定 (上流のレート制限で頭打ちにならないように)
+SERVER_ENV_DEFAULTS = {
+    "GEMINI_DEFAULT_RPM": "0",
+    "GEMINI_DEFAULT_CONCURRENCY": "1024",
+    "GEMINI_HTTP_POOL_SIZE": "256",
+}
+
+# 既存のテーブル (Supabase 側で作成済みのもの)。空のデータベースで試すときだけ作る
+BASE_TABLES_SQL = """
+    CREATE TABLE IF NOT EXISTS public.students (
+        id bigserial PRIMARY KEY,
+        full_name text,
+        email text,
+        team_name text,
+        booth_id text
+    );
+    CREATE TABLE IF NOT EXISTS public.sessions (
+        id bigserial PRIMARY KEY,
+        created_at timestamptz NOT NULL DEFAULT now(),
+        booth_id text,
+        praise_ratio double precision,
+        advice_ratio double precision,
+        raw_text text,
+        visitor_attribute text,
+        summary_text text,
+        is_processed boolean DEFAULT false
+    );
+"""
+
+CLEANUP_SQL = f"""
+    DELETE FROM public.sessions WHERE booth_id LIKE '{BENCH_BOOTH_PREFIX}%';
+    DELETE FROM public.booth_stats WHERE booth_id LIKE '{BENCH_BOOTH_PREFIX}%';
+    DELETE FROM public.students WHERE email LIKE '%@{BENCH_EMAIL_DOMAIN}';
+"""
+
+# 合成するフィードバックの文 (褒める点と改善点が混ざるように組み合わせる)
+PRAISE_PHRASES = [
+    "説明がとても分かりやすかったです。", "デモが面白くて引き込まれました。", "資料のデザインが素晴らしいです。",
+    "質問に丁寧に答えてくれて良かった。", "発想がユニークで感動しました。", "実用性が高くすごいと思います。",
+]
+ADVICE_PHRASES = [
+    "もう少し結論を先に話すと良いと思います。", "文字が小さくて見にくかったので改善してほしい。",
+    "デモの待ち時間が長いのが気になりました。", "専門用語が多く、説明が足りないと感じました。",
+    "費用の根拠をもっと具体的に示すべきです。",
+]
+FILLER_PHRASES = ["ブースに立ち寄りました。", "友人に勧められて来ました。", "全体として見応えがありました。"]
+VISITOR_ATTRIBUTES = ["student", "teacher", "company", "general_visitor"]
+
+
+def feedback_text(rng, sentences=None):
+    """それらしいフィードバック本文を合成します。"""
+    count = sentences or rng.randint(2, 6)
+    phrases = [rng.choice(rng.choice((PRAISE_PHRASES, PRAISE_PHRASES, ADVICE_PHRASES, FILLER_PHRASES)))
+               for _ in range(count)]
+    return "".join(phrases)
+
+
+# -------------------------------------------------------------
+# 合成イベントの投入
+# -------------------------------------------------------------
+
+def start_local_postgres():
+    """pgserver で一時ディレクトリに Postgres を起動し、(サーバー, DATABASE_URL) を返します。"""
+    try:
+        import pgserver
+    except ImportError:
+        raise SystemExit("❌ DATABASE_URL を指定するか、pip install pgserver でローカルの Postgres を使えるようにしてください。")
+    data_dir = tempfile.mkdtemp(prefix="hyoka-bench-pg-")
+    server = pgserver.get_server(data_dir, cleanup_mode="delete")
+    return server, f"postgresql://postgres@/postgres?host={data_dir}"
+
+
+def seed_event(conn, teams, students, sessions, rng):
+    """N チーム × M 人の学生と、ブースごとに K 件のフィードバックを投入し、学生のメールアドレスを返します。"""
+    with conn.cursor() as cursor:
+        cursor.execute(BASE_TABLES_SQL)
+    conn.commit()
+    schema.migrate(conn)
+    with conn.cursor() as cursor:
+        cursor.execute(CLEANUP_SQL)
+    conn.commit()
+
+    emails = []
+    student_rows = []
+    for team in range(teams):
+        booth_id = f"{BENCH_BOOTH_PREFIX}{team:03d}"
+        for member in range(students):
+            email = f"team{team:03d}-{member}@{BENCH_EMAIL_DOMAIN}"
+            emails.append(email)
+            student_rows.append((f"ベンチ学生{team}-{member}", email, f"ベンチチーム{team:03d}", booth_id))
+
+    # 開催時間 (8時間) に散らばるように作成日時を振る
+    event_start = datetime.now(timezone.utc) - timedelta(hours=8)
+    with conn.cursor() as cursor:
+        execute_values(cursor, "INSERT INTO public.students (full_name, email, team_name, booth_id) VALUES %s",
+                       student_rows, page_size=1000)
+        for team in range(teams):
+            booth_id = f"{BENCH_BOOTH_PREFIX}{team:03d}"
+            rows = []
+            for _ in range(sessions):
+                raw_text = feedback_text(rng)
+                scored = score_feedback(raw_text)
+                feedback = {
+                    "booth_id": booth_id,
+                    "praise_ratio": scored["praise_ratio"],
+                    "advice_ratio": scored["advice_ratio"],
+                    "raw_text": raw_text,
+                    "visitor_attribute": rng.choice(VISITOR_ATTRIBUTES),
+                    # 要約済みの行にして、起動時に要約ジョブが走らないようにする
+                    "summary_text": "ベンチマーク用の要約です。",
+                    "is_processed": True,
+                    "score": scored["score"],
+                    "scorer": scored["scorer"],
+                }
+                created_at = event_start + timedelta(seconds=rng.uniform(0, 8 * 3600))
+                rows.append(tuple(feedback[column] for column in SESSION_COLUMNS) + (created_at,))
+            execute_values(
+                cursor,
+                f"INSERT INTO public.sessions ({', '.join(SESSION_COLUMNS)}, created_at) VALUES %s",
+                rows, page_size=1000,
+            )
+    conn.commit()
+    return emails
+
+
+def cleanup_event(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(CLEANUP_SQL)
+    conn.commit()
+
+
+# -------------------------------------------------------------
+# サーバーの起動
+# -------------------------------------------------------------
+
+def _server_env(**overrides):
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    for name, value in SERVER_ENV_DEFAULTS.items():
+        env.setdefault(name, value)
+    env.update(overrides)
+    return env
+
+
+def start_server(name, snippet, port, env, ready_path, log_dir):
+    """サーバーを別プロセスで起動し、ready_path が 200 を返すまで待ちます。"""
+    log = open(os.path.join(log_dir, f"{name}.log"), "w")
+    proc = subprocess.Popen([sys.executable, "-c", snippet], env=env, cwd=ROOT_DIR, stdout=log, stderr=log)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(300):
+        if proc.poll() is not None:
+            break
+        try:
+            if requests.get(url + ready_path, timeout=5).status_code == 200:
+                return proc, url
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError(f"{name} が起動しませんでした (ログ: {log.name})")
+
+
+# -------------------------------------------------------------
+# リクエストの種類とトラフィックの構成
+# -------------------------------------------------------------
+
+class Workload:
+    """負荷をかけるリクエストを組み立てます (各スレッドが自分の乱数で呼び出す)。"""
+
+    def __init__(self, urls, emails, teams, audio_clips):
+        self.urls = urls  # {"flask_app": ..., "app": ...}
+        self.emails = emails
+        self.booths = [f"{BENCH_BOOTH_PREFIX}{team:03d}" for team in range(teams)]
+        self.audio_clips = audio_clips
+        self.audio_base64 = [base64.b64encode(clip).decode("ascii") for clip in audio_clips]
+
+    def feedback(self, http, rng):
+        return http.get(f"{self.urls['flask_app']}/api/feedback/{rng.choice(self.emails)}", timeout=60)
+
+    def submit_feedback(self, http, rng):
+        # 割合を送らない (サーバー側で採点する) 新しいフォームの送り方。要約は要約ジョブで作られる
+        return http.post(f"{self.urls['flask_app']}/api/submit_feedback", timeout=60,
+                         headers={"Idempotency-Key": str(uuid.uuid4())},
+                         json={"booth_id": rng.choice(self.booths), "raw_text": feedback_text(rng),
+                               "visitor_attribute": rng.choice(VISITOR_ATTRIBUTES)})
+
+    def process_audio(self, http, rng):
+        return http.post(f"{self.urls['flask_app']}/api/process_audio", timeout=120,
+                         params={"booth_id": rng.choice(self.booths), "mime_type": "audio/webm"},
+                         data=rng.choice(self.audio_clips), headers={"Content-Type": "audio/webm"})
+
+    def generate_summary(self, http, rng):
+        return http.post(f"{self.urls['flask_app']}/api/generate_summary", timeout=60,
+                         headers={"Idempotency-Key": str(uuid.uuid4())},
+                         json={"raw_text": feedback_text(rng, sentences=8)})
+
+    def recognize(self, http, rng):
+        return http.post(f"{self.urls['app']}/recognize", timeout=120,
+                         json={"audio_data": rng.choice(self.audio_base64)})
+
+    def summarize(self, http, rng):
+        return http.post(f"{self.urls['app']}/summarize", timeout=60,
+                         json={"text": feedback_text(rng, sentences=8), "attribute": rng.choice(VISITOR_ATTRIBUTES),
+                               "booth_number": rng.choice(self.booths)})
+
+
+# 構成名: [(リクエストの種類, 重み)]
+TRAFFIC_MIXES = {
+    # 来場者が少ない時間帯に、学生がダッシュボードを何度も開く
+    "dashboard": [("feedback", 80), ("submit_feedback", 20)],
+    # 来場のピーク: フォームと録音からの登録が中心
+    "event_peak": [("submit_feedback", 45), ("process_audio", 20), ("generate_summary", 15), ("feedback", 20)],
+    # app.py の受付端末 (録音して文字起こし、要約)
+    "kiosk": [("recognize", 60), ("summarize", 40)],
+}
+
+
+def run_mix(workload, mix, concurrency, duration, seed):
+    """concurrency 本のスレッドで duration 秒間リクエストを送り、[(種類, 秒, ステータス)] を返します。"""
+    names = [name for name, _ in TRAFFIC_MIXES[mix]]
+    weights = [weight for _, weight in TRAFFIC_MIXES[mix]]
+    deadline = time.monotonic() + duration
+    lock = threading.Lock()
+    samples = []
+
+    def worker(index):
+        rng = random.Random(f"{seed}-{mix}-{index}")
+        local = []
+        with requests.Session() as http:
+            while time.monotonic() < deadline:
+                name = rng.choices(names, weights)[0]
+                started = time.perf_counter()
+                try:
+                    status = getattr(workload, name)(http, rng).status_code
+                except requests.RequestException:
+                    status = 0  # 接続エラー・タイムアウト
+                local.append((name, time.perf_counter() - started, status))
+        with lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def summarize_samples(samples, elapsed):
+    endpoints = {}
+    for name in sorted({name for name, _, _ in samples}):
+        latencies = [latency for sample_name, latency, _ in samples if sample_name == name]
+        statuses = {}
+        for sample_name, _, status in samples:
+            if sample_name == name:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+        endpoints[name] = {
+            "count": len(latencies),
+            "errors": sum(count for status, count in statuses.items() if not 200 <= int(status) < 400),
+            "rps": round(len(latencies) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+            "status": statuses,
+        }
+    return endpoints
+
+
+# -------------------------------------------------------------
+# 結果の比較
+# -------------------------------------------------------------
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _change(current, previous):
+    if not previous:
+        return "   n/a"
+    return f"{(current - previous) / previous * 100:+6.1f}%"
+
+
+def compare(result, baseline, max_regression):
+    """baseline との差分を表示し、p95 が max_regression % を超えて悪化した (構成, 種類) のリストを返します。"""
+    regressions = []
+    print(f"\n📊 ベースライン ({baseline['meta'].get('git_commit')}, {baseline['meta'].get('started_at')}) との比較")
+    for mix, current in result["mixes"].items():
+        previous = baseline.get("mixes", {}).get(mix)
+        if previous is None:
+            print(f"{mix}: ベースラインにありません")
+            continue
+        for name, row in current["endpoints"].items():
+            before = previous["endpoints"].get(name)
+            if before is None:
+                continue
+            print(f"{mix:<11} {name:<17} p50 {_change(row['p50_ms'], before['p50_ms'])}  "
+                  f"p95 {_change(row['p95_ms'], before['p95_ms'])}  p99 {_change(row['p99_ms'], before['p99_ms'])}  "
+                  f"rps {_change(row['rps'], before['rps'])}  errors {before['errors']} -> {row['errors']}")
+            if (max_regression is not None and before["p95_ms"]
+                    and (row["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100 > max_regression):
+                regressions.append((mix, name))
+        for server, peak in current["peak_rss_mb"].items():
+            before = previous.get("peak_rss_mb", {}).get(server)
+            if before is not None and peak is not None:
+                print(f"{mix:<11} peak RSS {server:<8} {before:>7.1f}MB -> {peak:>7.1f}MB ({_change(peak, before)})")
+    return regressions
+
+
+def _audio_clips(seconds, count, rng):
+    """MediaRecorder と同じ WebM Opus の合成音声。PyAV がなければ同じサイズのランダムなバイト列。"""
+    try:
+        import numpy as np
+        from stt_preprocess import encode_webm, synthetic_clip
+    except ImportError:
+        print("⚠️ PyAV がないため、音声はランダムなバイト列で代用します (前処理は失敗して元の音声のまま送られます)。")
+        return [rng.randbytes(int(seconds * 16000)) for _ in range(count)]
+    np_rng = np.random.default_rng(rng.randrange(2 ** 32))
+    return [encode_webm(synthetic_clip(seconds, 0.3, np_rng)) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.environ.get("DATABASE_URL"),
+                        help="省略時は pgserver でローカルの Postgres を起動")
+    parser.add_argument("--teams", type=int, default=30, help="チーム数 (= ブース数) N")
+    parser.add_argument("--students", type=int, default=4, help="チームあたりの学生数 M")
+    parser.add_argument("--sessions", type=int, default=300, help="ブースあたりのフィードバック件数 K")
+    parser.add_argument("--mixes", default=",".join(TRAFFIC_MIXES), help="トラフィックの構成 (カンマ区切り)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30, help="構成ごとの計測秒数")
+    parser.add_argument("--warmup", type=float, default=3, help="構成ごとの計測前のウォームアップ秒数")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--gemini-latency", type=float, default=0.8, help="フェイク Gemini の応答遅延 (秒)")
+    parser.add_argument("--gemini-seconds-per-mb", type=float, default=2.0)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-error-status", type=int, default=503)
+    parser.add_argument("--stt-realtime-factor", type=float, default=0.1,
+                        help="フェイク Speech の処理時間 (音声の長さに対する比)")
+    parser.add_argument("--stt-error-rate", type=float, default=0.0)
+    parser.add_argument("--audio-seconds", type=float, default=8)
+    parser.add_argument("--db-latency-ms", type=float, default=0, help="DBとの往復に加える遅延")
+    parser.add_argument("--flask-port", type=int, default=5111)
+    parser.add_argument("--app-port", type=int, default=5112)
+    parser.add_argument("--output", default="load_suite_result.json")
+    parser.add_argument("--baseline", help="比較する以前の結果 (--output のJSON)")
+    parser.add_argument("--max-regression", type=float, default=None,
+                        help="p95 の悪化がこの % を超えたら終了コード 1")
+    parser.add_argument("--keep", action="store_true", help="投入したデータを残す")
+    args = parser.parse_args()
+
+    mixes = [mix.strip() for mix in args.mixes.split(",") if mix.strip()]
+    unknown = [mix for mix in mixes if mix not in TRAFFIC_MIXES]
+    if unknown:
+        raise SystemExit(f"❌ 不明な構成: {', '.join(unknown)} (選べるもの: {', '.join(TRAFFIC_MIXES)})")
+
+    rng = random.Random(args.seed)
+    pg_server = None
+    database_url = args.database_url
+    if not database_url:
+        pg_server, database_url = start_local_postgres()
+        print(f"✅ ローカルの Postgres を起動しました: {database_url}")
+
+    conn = psycopg2.connect(database_url, connect_timeout=5)
+    started_seed = time.perf_counter()
+    emails = seed_event(conn, args.teams, args.students, args.sessions, rng)
+    print(f"✅ 合成イベントを投入しました: {args.teams}チーム × {args.students}人、"
+          f"ブースごとに{args.sessions}件 ({time.perf_counter() - started_seed:.1f}秒)")
+
+    server_database_url = database_url
+    if args.db_latency_ms:
+        from submit_throughput import _proxy_database_url
+        server_database_url = _proxy_database_url(database_url, args.db_latency_ms / 1000)
+
+    audio_clips = _audio_clips(args.audio_seconds, 4, rng)
+    log_dir = tempfile.mkdtemp(prefix="hyoka-bench-logs-")
+    procs = {}
+    result = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "params": {key: value for key, value in vars(args).items()
+                       if key not in ("database_url", "output", "baseline")},
+        },
+        "mixes": {},
+    }
+    try:
+        with FakeGeminiServer(latency=args.gemini_latency, error_rate=args.gemini_error_rate,
+                              error_status=args.gemini_error_status,
+                              seconds_per_mb=args.gemini_seconds_per_mb) as gemini:
+            flask_env = _server_env(DATABASE_URL=server_database_url, GEMINI_API_URL=gemini.url,
+                                    GEMINI_API_KEY="bench")
+            app_env = _server_env(DATABASE_URL=server_database_url, GEMINI_API_KEY="bench", GEMINI_MODEL="fake",
+                                  GEMINI_BASE_URL=gemini.url.split("/v1beta/")[0])
+            procs["flask_app"], flask_url = start_server(
+                "flask_app", FLASK_SNIPPET.format(root=ROOT_DIR, port=args.flask_port),
+                args.flask_port, flask_env, "/api/db_pool/stats", log_dir)
+            procs["app"], app_url = start_server(
+                "app", APP_SNIPPET.format(root=ROOT_DIR, bench=BENCH_DIR, port=args.app_port,
+                                          stt_realtime_factor=args.stt_realtime_factor,
+                                          stt_error_rate=args.stt_error_rate),
+                args.app_port, app_env, "/readyz", log_dir)
+            workload = Workload({"flask_app": flask_url, "app": app_url}, emails, args.teams, audio_clips)
+
+            for mix in mixes:
+                if args.warmup:
+                    run_mix(workload, mix, args.concurrency, args.warmup, f"{args.seed}-warmup")
+                peak_exact = all(_reset_peak(proc.pid) for proc in procs.values())
+                upstream_before = gemini.requests
+                started = time.perf_counter()
+                samples = run_mix(workload, mix, args.concurrency, args.duration, args.seed)
+                elapsed = time.perf_counter() - started
+                result["mixes"][mix] = {
+                    "duration_s": round(elapsed, 2),
+                    "requests": len(samples),
+                    "rps": round(len(samples) / elapsed, 2),
+                    "gemini_requests": gemini.requests - upstream_before,
+                    "endpoints": summarize_samples(samples, elapsed),
+                    "peak_rss_mb": {name: round(_proc_status_kb(proc.pid, "VmHWM") / 1024, 1)
+                                    for name, proc in procs.items()},
+                    "peak_rss_exact": peak_exact,
+                }
+                summary = result["mixes"][mix]
+                print(f"\n🚀 {mix}: {summary['requests']}件 {summary['rps']:.1f} req/s "
+                      f"(peak RSS " + ", ".join(f"{name} {mb:.1f}MB" for name, mb in summary["peak_rss_mb"].items()) + ")")
+                for name, row in summary["endpoints"].items():
+                    print(f"   {name:<17} n={row['count']:<6} rps={row['rps']:>7.2f} p50={row['p50_ms']:>8.1f}ms "
+                          f"p95={row['p95_ms']:>8.1f}ms p99={row['p99_ms']:>8.1f}ms errors={row['errors']}")
+    finally:
+        for proc in procs.values():
+            proc.terminate()
+            proc.wait()
+        if not args.keep:
+            cleanup_event(conn)
+        conn.close()
+        if pg_server is not None:
+            pg_server.cleanup()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\n✅ 結果を {args.output} に書き出しました (サーバーのログ: {log_dir})")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.max_regression)
+        if regressions:
+            print(f"❌ p95 が {args.max_regression}% を超えて悪化しました: "
+                  + ", ".join(f"{mix}/{name}" for mix, name in regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+"""
+フィードバック全文検索 (feedback_search.py / GET /api/search) のレイテンシ。
+合成した日本語のフィードバック (既定 10万件) を bench- ブースに投入し、検索語の種類
+(よく出る語・まれな語・1文字・複数語・ブース/属性での絞り込み・ヒットなし) ごとに
+bi-gram の GIN インデックスを使う検索と、ILIKE '%語%' の全件走査を比べて p50/p95 を出力します。
+
+DATABASE_URL を指定しなければ pgserver でローカルの Postgres を一時的に起動します。
+投入したデータは終了時に削除します (--keep で残す。2回目以降は --skip-seed で投入を省略)。
+
+使い方:
+    python benchmarks/search_queries.py --rows 100000 --iterations 30
+"""
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import statistics
+
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import schema  # noqa: E402
+from dashboard_queries import percentile  # noqa: E402
+from feedback_search import parse_terms, search_feedbacks  # noqa: E402
+from load_suite import (  # noqa: E402
+    BASE_TABLES_SQL,
+    BENCH_BOOTH_PREFIX,
+    VISITOR_ATTRIBUTES,
+    cleanup_event,
+    feedback_text,
+    start_local_postgres,
+)
+
+# 展示のテーマ (先頭ほど多く出る) と、それを含む文のひな形
+TOPICS = [
+    "ロボット", "アプリ", "AI", "ゲーム", "環境", "防災", "ドローン", "VR", "農業", "医療", "観光", "音楽",
+    "プログラミング", "電子工作", "宇宙", "天気予報", "地域活性化", "キャッシュレス", "食品ロス", "リサイクル",
+    "センサー", "自動運転", "翻訳", "手話", "点字", "eスポーツ", "プロジェクションマッピング", "ブロックチェーン",
+]
+TOPIC_SENTENCES = [
+    "{topic}の展示が印象に残りました。", "{topic}を使った仕組みが面白かったです。",
+    "{topic}についての説明がもう少し欲しかった。", "{topic}の活用例をもっと知りたいです。",
+]
+RARE_SENTENCE = "量子暗号の話が出てきて驚きました。"
+RARE_RATE = 0.002
+SUMMARY_TEMPLATES = [
+    "{topic}の展示について、説明の分かりやすさが評価されています。",
+    "{topic}のデモは好評ですが、待ち時間の改善が求められています。",
+    "{topic}への関心が高く、資料の充実を望む声があります。",
+]
+
+CASES = [
+    ("common", "説明", {}),
+    ("topic", "ドローン", {}),
+    ("rare", "量子暗号", {}),
+    ("one_char", "驚", {}),
+    ("two_terms", "デモ 待ち時間", {}),
+    ("fullwidth", "ＡＩ　説明", {}),
+    ("booth", "説明", {"booth_id": f"{BENCH_BOOTH_PREFIX}007"}),
+    ("attribute", "ロボット", {"visitor_attribute": "teacher"}),
+    ("no_hits", "量子コンピュータ", {}),
+    ("recent", "説明", {"sort": "recent"}),
+    ("page_10", "説明", {"offset": 200}),
+]
+
+# 比較用: インデックスを使わない単純な部分一致 (語ごとに本文か要約に含まれる)
+SCAN_SQL_TEMPLATE = """
+    SELECT s.id, COUNT(*) OVER () AS total
+    FROM public.sessions s
+    WHERE {conditions}
+        AND (%(booth_id)s::text IS NULL OR s.booth_id = %(booth_id)s::text)
+        AND (%(visitor_attribute)s::text IS NULL OR s.visitor_attribute = %(visitor_attribute)s::text)
+    ORDER BY s.id DESC
+    LIMIT %(limit)s OFFSET %(offset)s;
+"""
+
+
+def _topic(rng):
+    # 先頭のテーマほど多く出るように (おおよそ Zipf 分布)
+    return TOPICS[min(int(rng.paretovariate(1.0)) - 1, len(TOPICS) - 1)]
+
+
+def synthetic_feedback(rng):
+    topic = _topic(rng)
+    sentences = [rng.choice(TOPIC_SENTENCES).format(topic=topic), feedback_text(rng)]
+    if rng.random() < RARE_RATE:
+        sentences.insert(rng.randint(0, 1), RARE_SENTENCE)
+    summary = rng.choice(SUMMARY_TEMPLATES).format(topic=topic) if rng.random() < 0.8 else None
+    return "".join(sentences), summary
+
+
+def seed(conn, rows, booths, rng, batch=5000):
+    """bench- ブースに rows 件の合成フィードバックを投入し、かかった秒数を返します。"""
+    with conn.cursor() as cursor:
+        cursor.execute(BASE_TABLES_SQL)
+    conn.commit()
+    schema.migrate(conn)
+    cleanup_event(conn)
+
+    started = time.perf_counter()
+    for first in range(0, rows, batch):
+        values = []
+        for _ in range(first, min(rows, first + batch)):
+            raw_text, summary = synthetic_feedback(rng)
+            values.append((f"{BENCH_BOOTH_PREFIX}{rng.randrange(booths):03d}", raw_text, summary,
+                           summary is not None, rng.choice(VISITOR_ATTRIBUTES)))
+        with conn.cursor() as cursor:
+            execute_values(cursor, """
+                INSERT INTO public.sessions (booth_id, raw_text, summary_text, is_processed, visitor_attribute)
+                VALUES %s
+            """, values, page_size=1000)
+        conn.commit()
+    elapsed = time.perf_counter() - started
+    # 前回の実行で削除した行 (と索引の項目) を片付け、統計を取り直す (VACUUM はトランザクション外で実行)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("VACUUM ANALYZE public.sessions;")
+    finally:
+        conn.autocommit = False
+    return elapsed
+
+
+def scan_search(cursor, terms, booth_id=None, visitor_attribute=None, sort="recent", limit=20, offset=0):
+    conditions = " AND ".join(
+        f"(s.raw_text ILIKE %(term{i})s OR s.summary_text ILIKE %(term{i})s)" for i in range(len(terms))
+    )
+    params = {f"term{i}": f"%{term}%" for i, term in enumerate(terms)}
+    params.update(booth_id=booth_id, visitor_attribute=visitor_attribute, limit=limit, offset=offset)
+    cursor.execute(SCAN_SQL_TEMPLATE.format(conditions=conditions), params)
+    rows = cursor.fetchall()
+    return rows[0][-1] if rows else 0
+
+
+def measure(conn, search, terms, options, iterations):
+    samples = []
+    total = None
+    with conn.cursor() as cursor:
+        search(cursor, terms, **options)  # ウォームアップ
+        for _ in range(iterations):
+            started = time.perf_counter()
+            total = search(cursor, terms, **options)
+            samples.append(time.perf_counter() - started)
+    conn.rollback()
+    if isinstance(total, tuple):
+        total = total[0]
+    return {
+        "total": total,
+        "p50_ms": round(percentile(samples, 50) * 1000, 2),
+        "p95_ms": round(percentile(samples, 95) * 1000, 2),
+        "mean_ms": round(statistics.mean(samples) * 1000, 2),
+    }
+
+
+def index_size(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT pg_relation_size('public.sessions_search_grams_idx'),
+                   pg_table_size('public.sessions')
+        """)
+        index_bytes, table_bytes = cursor.fetchone()
+    conn.rollback()
+    return index_bytes, table_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--booths", type=int, default=100)
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--scan-iterations", type=int, default=5, help="全件走査の比較は遅いので回数を減らす")
+    parser.add_argument("--seed", type=int, default=24)
+    parser.add_argument("--skip-seed", action="store_true", help="前回 --keep で残したデータをそのまま使う")
+    parser.add_argument("--keep", action="store_true", help="投入したデータを削除しない")
+    parser.add_argument("--output", default=None, help="結果を書き出すJSONファイル")
+    args = parser.parse_args()
+
+    load_dotenv()
+    server = None
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        server, database_url = start_local_postgres()
+        print(f"✅ ローカルの Postgres を起動しました: {database_url}")
+
+    conn = psycopg2.connect(database_url, connect_timeout=5)
+    result = {"rows": args.rows, "cases": {}}
+    try:
+        if not args.skip_seed:
+            rng = random.Random(args.seed)
+            elapsed = seed(conn, args.rows, args.booths, rng)
+            result["seed_rows_per_s"] = round(args.rows / elapsed)
+            print(f"✅ {args.rows}件を投入しました ({elapsed:.1f}秒, {args.rows / elapsed:.0f}件/秒, 索引の更新を含む)")
+
+        index_bytes, table_bytes = index_size(conn)
+        result["index_mb"] = round(index_bytes / 1024 / 1024, 1)
+        result["table_mb"] = round(table_bytes / 1024 / 1024, 1)
+        print(f"   索引 {result['index_mb']}MB / テーブル {result['table_mb']}MB")
+
+        print(f"{'case':<11} {'hits':>7} {'index p50':>10} {'p95':>9} {'scan p50':>10} {'p95':>9} {'speedup':>8}")
+        for name, query, options in CASES:
+            terms, _ = parse_terms(query)
+            indexed = measure(conn, search_feedbacks, terms, options, args.iterations)
+            scan = measure(conn, scan_search, terms, options, args.scan_iterations)
+            if indexed["total"] != scan["total"]:
+                print(f"⚠️ {name}: 件数が一致しません (index {indexed['total']} / scan {scan['total']})")
+            speedup = scan["p50_ms"] / indexed["p50_ms"] if indexed["p50_ms"] else float("inf")
+            result["cases"][name] = {"query": query, "options": options, "index": indexed, "scan": scan}
+            print(f"{name:<11} {indexed['total']:>7} {indexed['p50_ms']:>8.2f}ms {indexed['p95_ms']:>7.2f}ms "
+                  f"{scan['p50_ms']:>8.2f}ms {scan['p95_ms']:>7.2f}ms {speedup:>7.1f}x")
+    finally:
+        if not args.keep:
+            cleanup_event(conn)
+        conn.close()
+        if server is not None:
+            server.cleanup()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
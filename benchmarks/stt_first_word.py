@@ -0,0 +1,114 @@
+"""
+app.py の音声認識で、録音開始から最初の単語が表示されるまでの時間 (time-to-first-word) を比較します。
+- sync:      録音を最後まで終えてから /recognize に一括アップロード (従来の方式)
+- streaming: 録音中に chunk_seconds ごとのチャンクを /recognize/stream に送り、SSE で途中結果を受け取る
+
+本物の Speech-to-Text の代わりに fake_recognizer.FakeSpeechClient を使い、録音は実時間で模擬します。
+録音停止から最終結果までの時間 (final_after_stop) もあわせて表示します。
+
+使い方:
+    python benchmarks/stt_first_word.py --clip-seconds 10 --chunk-seconds 0.25
+    python benchmarks/stt_first_word.py --clip-seconds 90   # 同期認識の上限を超える音声 (long_running にフォールバック)
+"""
+import os
+import sys
+import time
+import json
+import base64
+import argparse
+import threading
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import app as stt_app  # noqa: E402
+from fake_recognizer import FakeSpeechClient  # noqa: E402
+
+
+def _fake_audio(seconds, bytes_per_second):
+    return os.urandom(int(seconds * bytes_per_second))
+
+
+def measure_sync(http, fake, clip_seconds):
+    started = time.perf_counter()
+    time.sleep(clip_seconds)  # 録音中
+    stopped = time.perf_counter()
+    audio = base64.b64encode(_fake_audio(clip_seconds, fake.bytes_per_second)).decode()
+    response = http.post('/recognize', json={"audio_data": audio})
+    finished = time.perf_counter()
+    body = response.get_json()
+    return {
+        "mode": body.get("mode", "error"),
+        "first_word_s": finished - started,
+        "final_after_stop_s": finished - stopped,
+    }
+
+
+def _read_events(response, started, result):
+    buffer = ""
+    for chunk in response.response:
+        buffer += chunk.decode() if isinstance(chunk, bytes) else chunk
+        while "\n\n" in buffer:
+            message, buffer = buffer.split("\n\n", 1)
+            data = [line[6:] for line in message.splitlines() if line.startswith("data: ")]
+            if not data:
+                continue
+            event = json.loads(data[0])
+            if event.get("text") and "first_word_s" not in result:
+                result["first_word_s"] = time.perf_counter() - started
+            if event["type"] in ("done", "error"):
+                result["done_at"] = time.perf_counter()
+                result["mode"] = event.get("mode", "error")
+                return
+
+
+def measure_streaming(http, fake, clip_seconds, chunk_seconds):
+    stream_id = http.post('/recognize/stream').get_json()["stream_id"]
+    result = {}
+    started = time.perf_counter()
+    events = http.get(f'/recognize/stream/{stream_id}/events', buffered=False)
+    reader = threading.Thread(target=_read_events, args=(events, started, result))
+    reader.start()
+
+    for _ in range(int(clip_seconds / chunk_seconds)):
+        time.sleep(chunk_seconds)  # MediaRecorder の timeslice
+        http.post(f'/recognize/stream/{stream_id}/chunk', data=_fake_audio(chunk_seconds, fake.bytes_per_second),
+                  content_type='audio/webm')
+    stopped = time.perf_counter()
+    http.post(f'/recognize/stream/{stream_id}/finish')
+    reader.join()
+    events.close()
+    return {
+        "mode": result.get("mode", "error"),
+        "first_word_s": result.get("first_word_s", float("nan")),
+        "final_after_stop_s": result["done_at"] - stopped,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clip-seconds", type=float, default=10)
+    parser.add_argument("--chunk-seconds", type=float, default=0.25)
+    parser.add_argument("--stream-latency", type=float, default=0.15, help="フェイク認識器の途中結果の遅延 (秒)")
+    parser.add_argument("--realtime-factor", type=float, default=0.3, help="フェイク認識器の一括認識にかかる時間 (音声の長さ比)")
+    args = parser.parse_args()
+
+    fake = FakeSpeechClient(realtime_factor=args.realtime_factor, stream_latency=args.stream_latency)
+    stt_app.speech_client.set(fake)
+    http = stt_app.app.test_client()
+
+    rows = [
+        ("sync", measure_sync(http, fake, args.clip_seconds)),
+        ("streaming", measure_streaming(http, fake, args.clip_seconds, args.chunk_seconds)),
+    ]
+    print(f"録音 {args.clip_seconds:.0f} 秒 (チャンク {args.chunk_seconds} 秒ごと)")
+    for name, row in rows:
+        print(f"{name:<10} mode={row['mode']:<13} first_word={row['first_word_s']:>6.2f}s "
+              f"final_after_stop={row['final_after_stop_s']:>6.2f}s")
+    print(f"認識器の呼び出し: {fake.calls}")
+    print(f"サーバー側の計測: {json.dumps(stt_app.stt_streams.stats(), ensure_ascii=False)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+音声前処理 (audio_preprocess.py) による STT の上流ペイロードとレイテンシの削減量。
+
+MediaRecorder 相当の 48kHz ステレオ WebM Opus (128kbps) の合成音声を作り、
+call_gemini_api_for_stt_file() で前処理なし / ありの両方を送って比べます。
+合成音声は、発話 (倍音を持つ変調音) と無音 (小さなノイズ) を交互に並べ、前後にも無音を置いたものです。
+上流はフェイクの Gemini サーバーで、受信サイズに比例した遅延 (--seconds-per-mb) で処理時間を模擬します。
+
+使い方:
+    python benchmarks/stt_preprocess.py --clip-seconds 15,30,60 --silence-ratio 0.5
+"""
+import io
+import os
+import sys
+import time
+import argparse
+
+import av
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_gemini import FakeGeminiServer  # noqa: E402
+
+RECORD_RATE = 48000
+
+
+def synthetic_clip(seconds, silence_ratio, rng):
+    """発話と無音が交互に並ぶ合成音声 (float32 モノラル) を作ります。"""
+    total = int(seconds * RECORD_RATE)
+    noise = (rng.standard_normal(total) * 0.001).astype(np.float32)
+    signal = np.zeros(total, dtype=np.float32)
+    speech_seconds = seconds * (1 - silence_ratio)
+    position = 1.5  # 録音開始直後の無音
+    spoken = 0.0
+    while spoken < speech_seconds and position < seconds - 1.5:
+        length = min(rng.uniform(0.6, 2.5), speech_seconds - spoken)
+        start, end = int(position * RECORD_RATE), min(total, int((position + length) * RECORD_RATE))
+        t = np.arange(end - start) / RECORD_RATE
+        f0 = rng.uniform(110, 240) * (1 + 0.1 * np.sin(2 * np.pi * 2 * t))
+        phase = 2 * np.pi * np.cumsum(f0) / RECORD_RATE
+        voiced = sum(np.sin(k * phase) / k for k in range(1, 6))
+        envelope = 0.5 * (1 - np.cos(2 * np.pi * np.minimum(1, t / length)))  # 語頭・語尾をなめらかに
+        signal[start:end] = (0.15 * voiced * envelope * (0.6 + 0.4 * np.sin(2 * np.pi * 4 * t))).astype(np.float32)
+        spoken += length
+        # 残りの無音を発話の間に割り振る
+        position += length + rng.uniform(0.3, 2.0) * silence_ratio / max(1e-3, 1 - silence_ratio)
+    return signal + noise
+
+
+def encode_webm(mono):
+    """MediaRecorder と同じ 48kHz ステレオ WebM Opus にします。"""
+    buffer = io.BytesIO()
+    stereo = np.repeat((np.clip(mono, -1, 1) * 32767).astype(np.int16), 2).reshape(1, -1)
+    with av.open(buffer, mode="w", format="webm") as container:
+        stream = container.add_stream("libopus", rate=RECORD_RATE)
+        stream.layout = "stereo"
+        stream.bit_rate = 128000
+        frame = av.AudioFrame.from_ndarray(stereo, format="s16", layout="stereo")
+        frame.sample_rate = RECORD_RATE
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buffer.getvalue()
+
+
+def send(gemini_api, server, data, preprocess):
+    os.environ['AUDIO_PREPROCESS'] = '1' if preprocess else '0'
+    before = server.bytes_received
+    started = time.perf_counter()
+    result = gemini_api.call_gemini_api_for_stt_file(io.BytesIO(data), "ベンチマーク", "audio/webm")
+    elapsed = time.perf_counter() - started
+    if "【STTエラー" in result["stt_text"]:
+        raise RuntimeError(result["stt_text"])
+    return server.bytes_received - before, elapsed, result.get("preprocess")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clip-seconds", default="15,30,60", help="合成音声の長さ (カンマ区切り)")
+    parser.add_argument("--silence-ratio", type=float, default=0.5, help="無音の割合")
+    parser.add_argument("--seconds-per-mb", type=float, default=2.0, help="フェイク上流の1MBあたりの処理時間 (秒)")
+    parser.add_argument("--latency", type=float, default=0.3, help="フェイク上流の固定の遅延 (秒)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with FakeGeminiServer(latency=args.latency, seconds_per_mb=args.seconds_per_mb) as server:
+        os.environ.update(GEMINI_API_URL=server.url, GEMINI_API_KEY="bench", GEMINI_CACHE_MEMORY_SIZE="0",
+                          GEMINI_HTTP_MAX_RETRIES="0")
+        import gemini_api
+
+        print(f"{'clip':>6} {'upstream(raw)':>14} {'upstream(pre)':>14} {'latency(raw)':>13} {'latency(pre)':>13} "
+              f"{'speech':>8} {'prep':>7}")
+        for seconds in (float(s) for s in args.clip_seconds.split(",")):
+            data = encode_webm(synthetic_clip(seconds, args.silence_ratio, rng))
+            raw_bytes, raw_latency, _ = send(gemini_api, server, data, preprocess=False)
+            pre_bytes, pre_latency, report = send(gemini_api, server, data, preprocess=True)
+            if report is None:
+                raise RuntimeError("前処理が行われませんでした (PyAV が入っているか確認してください)")
+            print(f"{seconds:>5.0f}s {raw_bytes / 1024:>11.1f}KiB {pre_bytes / 1024:>11.1f}KiB "
+                  f"{raw_latency:>12.2f}s {pre_latency:>12.2f}s {report['processed_seconds']:>7.1f}s "
+                  f"{report['preprocess_ms']:>5.0f}ms")
+            print(f"       削減: {1 - pre_bytes / raw_bytes:.0%} のペイロード, "
+                  f"{report['seconds_saved']:.1f}秒の無音, {raw_latency - pre_latency:.2f}秒の待ち時間")
+
+
+if __name__ == '__main__':
+    main()
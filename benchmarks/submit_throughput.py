@@ -0,0 +1,203 @@
+"""
+フィードバック登録のスループット比較。
+- per_row:      /api/submit_feedback を1件ずつ (1件1トランザクション、従来の方式)
+- write_buffer: /api/submit_feedback を1件ずつ、書き込みバッファでまとめてコミット
+- bulk:         /api/submit_feedback/bulk に --bulk-size 件ずつ (オフラインの端末が貯めた分を再送する場合)
+
+flask_app をプロセス内で動かし (テストクライアント)、--clients 本のスレッドから合計 --records 件を登録して
+件数/秒と1リクエストあたりのレイテンシを表示します。DATABASE_URL のデータベースに実際に書き込み、
+終了時にベンチマークで入れた行 (booth_id が bench- で始まる行) を削除します。
+--db-latency-ms を指定すると、DBとの間に往復でその遅延を加えるプロキシを挟みます
+(ローカルのDBでも、Supabase などネットワーク越しのDBに近い条件で比べられます)。
+
+使い方:
+    DATABASE_URL=postgresql://... python benchmarks/submit_throughput.py --records 2000 --clients 16
+    DATABASE_URL=postgresql://... python benchmarks/submit_throughput.py --db-latency-ms 20
+"""
+import os
+import sys
+import time
+import queue
+import socket
+import argparse
+import threading
+
+from psycopg2.extensions import make_dsn, parse_dsn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import flask_app  # noqa: E402
+from db_pool import db_connection  # noqa: E402
+from feedback_ingest import FeedbackWriteBuffer  # noqa: E402
+
+BENCH_BOOTH_PREFIX = "bench-"
+
+
+class LatencyProxy:
+    """TCP で受けた接続を DB に中継し、片道 latency/2 秒ずつ遅らせるプロキシ。"""
+
+    def __init__(self, target, latency):
+        self.target = target  # (host, port) か UNIX ソケットのパス
+        self.half_latency = latency / 2
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _connect_target(self):
+        if isinstance(self.target, str):
+            upstream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            upstream.connect(self.target)
+            return upstream
+        return socket.create_connection(self.target)
+
+    def _accept(self):
+        while True:
+            client, _ = self.listener.accept()
+            upstream = self._connect_target()
+            for source, destination in ((client, upstream), (upstream, client)):
+                delayed = queue.Queue()
+                threading.Thread(target=self._read, args=(source, delayed), daemon=True).start()
+                threading.Thread(target=self._write, args=(destination, delayed), daemon=True).start()
+
+    def _read(self, source, delayed):
+        while True:
+            data = source.recv(65536)
+            delayed.put((time.monotonic() + self.half_latency, data))
+            if not data:
+                return
+
+    def _write(self, destination, delayed):
+        while True:
+            deliver_at, data = delayed.get()
+            time.sleep(max(0.0, deliver_at - time.monotonic()))
+            if not data:
+                destination.close()
+                return
+            destination.sendall(data)
+
+
+def _proxy_database_url(database_url, latency):
+    """DATABASE_URL の接続先をプロキシに置き換えた DSN を返します。"""
+    params = parse_dsn(database_url)
+    host = params.get("host") or "/var/run/postgresql"
+    port = int(params.get("port") or 5432)
+    target = os.path.join(host, f".s.PGSQL.{port}") if host.startswith("/") else (host, port)
+    proxy = LatencyProxy(target, latency)
+    params.update(host="127.0.0.1", port=str(proxy.port))
+    return make_dsn(**params)
+
+
+def _record(i):
+    return {
+        "booth_id": f"{BENCH_BOOTH_PREFIX}{i % 20}",
+        "praise_ratio": 0.6,
+        "advice_ratio": 0.4,
+        "raw_text": f"ベンチマーク用のフィードバック {i}",
+        "visitor_attribute": "student",
+        # 要約ジョブを発生させない
+        "summary_text": "ベンチマーク",
+    }
+
+
+def _run_clients(clients, jobs, send):
+    """jobs を clients 本のスレッドで分け合って送り、(経過秒, レイテンシのリスト, 失敗数) を返します。"""
+    lock = threading.Lock()
+    latencies = []
+    failures = [0]
+    position = [0]
+
+    def worker():
+        http = flask_app.app.test_client()
+        while True:
+            with lock:
+                if position[0] >= len(jobs):
+                    return
+                job = jobs[position[0]]
+                position[0] += 1
+            started = time.perf_counter()
+            ok = send(http, job)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                failures[0] += 0 if ok else 1
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, sorted(latencies), failures[0]
+
+
+def _send_one(http, record):
+    return http.post('/api/submit_feedback', json=record).status_code == 201
+
+
+def _send_bulk(http, records):
+    return http.post('/api/submit_feedback/bulk', json={"records": records}).status_code == 201
+
+
+def measure(mode, records, clients, bulk_size, buffer_size, buffer_interval_ms):
+    flask_app.feedback_write_buffer = None
+    if mode == "write_buffer":
+        flask_app.feedback_write_buffer = FeedbackWriteBuffer(flush_size=buffer_size,
+                                                              flush_interval=buffer_interval_ms / 1000)
+    if mode == "bulk":
+        jobs = [[_record(i) for i in range(start, min(records, start + bulk_size))]
+                for start in range(0, records, bulk_size)]
+        elapsed, latencies, failures = _run_clients(clients, jobs, _send_bulk)
+    else:
+        elapsed, latencies, failures = _run_clients(clients, [_record(i) for i in range(records)], _send_one)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    row = {
+        "mode": mode,
+        "rows_per_s": round(records / elapsed),
+        "requests": len(latencies),
+        "failed_requests": failures,
+        "p50_ms": round(percentile(0.50), 1),
+        "p95_ms": round(percentile(0.95), 1),
+    }
+    if flask_app.feedback_write_buffer is not None:
+        row["avg_batch_size"] = flask_app.feedback_write_buffer.stats()["avg_batch_size"]
+    return row
+
+
+def cleanup():
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("DELETE FROM public.sessions WHERE booth_id LIKE %s;", (BENCH_BOOTH_PREFIX + "%",))
+        cursor.execute("DELETE FROM public.booth_stats WHERE booth_id LIKE %s;", (BENCH_BOOTH_PREFIX + "%",))
+        conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=16, help="同時に送信するスレッド数")
+    parser.add_argument("--bulk-size", type=int, default=200)
+    parser.add_argument("--buffer-size", type=int, default=100)
+    parser.add_argument("--buffer-interval-ms", type=float, default=20)
+    parser.add_argument("--modes", default="per_row,write_buffer,bulk")
+    parser.add_argument("--db-latency-ms", type=float, default=0, help="DBとの往復に加える遅延 (ミリ秒)")
+    args = parser.parse_args()
+
+    if args.db_latency_ms:
+        # プールは最初の利用時に DATABASE_URL を読むので、ここで差し替えれば全モードに効く
+        os.environ['DATABASE_URL'] = _proxy_database_url(os.environ['DATABASE_URL'], args.db_latency_ms / 1000)
+
+    try:
+        for mode in args.modes.split(","):
+            row = measure(mode, args.records, args.clients, args.bulk_size, args.buffer_size, args.buffer_interval_ms)
+            print(f"{row['mode']:<13} {row['rows_per_s']:>7} rows/s  requests={row['requests']:<6} "
+                  f"failed={row['failed_requests']:<4} p50={row['p50_ms']:>7.1f}ms p95={row['p95_ms']:>7.1f}ms"
+                  + (f"  avg_batch={row['avg_batch_size']}" if "avg_batch_size" in row else ""))
+            cleanup()
+    finally:
+        cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# -------------------------------------------------------------
+# プロセス内 TTL 付き LRU キャッシュ
+# -------------------------------------------------------------
+# 複数ワーカープロセス間の整合性は「世代番号」で取ります。
+# 無効化のたびに共有ストア上のキーの世代を1つ進め、各プロセスは
+# エントリ作成時の世代と現在の世代が違えばミスとして扱います。
+
+
+class LocalGenerationStore:
+    """単一プロセス用の世代ストア (共有バックエンドを使わない場合)。"""
+
+    # 操作がロックやネットワークを待つか (True ならイベントループからはスレッドで呼ぶ)
+    blocking = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generations = {}
+
+    def get(self, key):
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def bump(self, key):
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            return self._generations[key]
+
+
+class SQLiteGenerationStore:
+    """同一ホスト上の複数ワーカーで共有する世代ストア (Redis の代わりのローカル実装)。"""
+
+    blocking = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS generations (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute("SELECT value FROM generations WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, key):
+        conn = self._connect()
+        conn.execute(
+            "INSERT INTO generations (key, value) VALUES (?, 1) "
+            "ON CONFLICT(key) DO UPDATE SET value = value + 1",
+            (key,),
+        )
+        return self.get(key)
+
+
+class RedisGenerationStore:
+    """Redis を使う世代ストア (redis パッケージがある場合のみ)。"""
+
+    blocking = True
+
+    def __init__(self, url, prefix="hyoka:gen:"):
+        import redis  # 任意依存のため遅延インポート
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self._redis.get(self.prefix + key)
+        return int(value) if value is not None else 0
+
+    def bump(self, key):
+        return int(self._redis.incr(self.prefix + key))
+
+
+def generation_store_from_url(url):
+    """CACHE_SHARED_URL の値から世代ストアを作ります。
+
+    - 未指定: プロセス内のみ (LocalGenerationStore)
+    - sqlite:///path/to/file.db: 同一ホストのワーカー間で共有
+    - redis://...: Redis で共有
+    """
+    if not url:
+        return LocalGenerationStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteGenerationStore(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://")):
+        return RedisGenerationStore(url)
+    raise ValueError(f"未対応のキャッシュ共有バックエンドです: {url}")
+
+
+class TTLCache:
+    """有効期限付きの LRU キャッシュ。スレッドセーフです。
+
+    ttl が 0 以下の場合は何もキャッシュしません。
+    generations を渡すと、invalidate() が他のプロセスにも伝わります。
+    """
+
+    def __init__(self, maxsize=256, ttl=5.0, generations=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generations = generations or LocalGenerationStore()
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, generation, value)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.maxsize > 0
+
+    @property
+    def blocking(self):
+        """get() / set() / invalidate() が共有ストアを待つか (True ならイベントループからはスレッドで呼ぶ)。"""
+        return self.generations.blocking
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        generation = self.generations.get(key)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, entry_generation, value = entry
+            if expires_at <= now or entry_generation != generation:
+                # 期限切れ、または他のプロセスで無効化された
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        """値を保存します。
+
+        generation には値を組み立てる前に current_generation() で取得した世代を渡してください。
+        組み立て中に無効化された場合、古い値が新しい世代で保存されるのを防げます。
+        """
+        if not self.enabled:
+            return
+        if generation is None:
+            generation = self.generations.get(key)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, generation, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def current_generation(self, key):
+        return self.generations.get(key)
+
+    def invalidate(self, key):
+        self.generations.bump(key)
+        with self._lock:
+            self._entries.pop(key, None)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+def cache_from_env(prefix, maxsize=256, ttl=5.0):
+    """<prefix>_MAXSIZE / <prefix>_TTL と CACHE_SHARED_URL からキャッシュを作ります。"""
+    return TTLCache(
+        maxsize=int(os.environ.get(f'{prefix}_MAXSIZE', maxsize)),
+        ttl=float(os.environ.get(f'{prefix}_TTL', ttl)),
+        generations=generation_store_from_url(os.environ.get('CACHE_SHARED_URL')),
+    )
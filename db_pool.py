@@ -0,0 +1,287 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+
+from metrics import span
+
+# -------------------------------------------------------------
+# PostgreSQL コネクションプール
+# -------------------------------------------------------------
+# リクエストごとに psycopg2.connect() すると、TCP+TLS+認証のハンドシェイクが
+# クエリ本体より遅くなるため、プロセス内で接続を使い回します。
+
+
+class DBPoolError(Exception):
+    """プールから接続を取得できなかった場合のエラー。"""
+
+
+class ConnectionPool:
+    """スレッドセーフな psycopg2 コネクションプール。
+
+    - min_size 本までは起動時に接続を張っておく
+    - max_size 本に達したら、空きが出るまで acquire_timeout 秒待つ
+    - 貸し出し時に SELECT 1 で死活確認し、壊れた接続は作り直す
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=10, acquire_timeout=5.0, connect_timeout=5):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("min_size/max_size の指定が不正です。")
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.connect_timeout = connect_timeout
+
+        self._cond = threading.Condition()
+        self._idle = []  # 空き接続 (LIFO)
+        self._in_use = 0
+        self._opened = 0
+        self._closed = False
+
+        # 統計情報
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._recycled = 0
+        self._peak_in_use = 0
+
+        for _ in range(min_size):
+            self._idle.append(self._connect())
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, connect_timeout=self.connect_timeout)
+        with self._cond:
+            self._opened += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._opened -= 1
+            self._recycled += 1
+
+    @staticmethod
+    def _is_healthy(conn):
+        """貸し出し前の死活確認。"""
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            # 死活確認で開始されたトランザクションを閉じておく
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        """接続を1本借ります。空きがなければ acquire_timeout 秒まで待ちます。"""
+        started = time.monotonic()
+        deadline = started + self.acquire_timeout
+
+        while True:
+            conn = None
+            create = False
+            with self._cond:
+                if self._closed:
+                    raise DBPoolError("コネクションプールは既に閉じられています。")
+                while not self._idle and self._in_use >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise DBPoolError(
+                            f"コネクションプールの空き待ちがタイムアウトしました ({self.acquire_timeout}秒)。"
+                        )
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn = self._idle.pop()
+                else:
+                    create = True
+                self._in_use += 1
+
+            try:
+                if create:
+                    conn = self._connect()
+                elif not self._is_healthy(conn):
+                    # 壊れた接続は捨てて張り直す
+                    self._discard(conn)
+                    conn = self._connect()
+            except Exception as e:
+                with self._cond:
+                    self._in_use -= 1
+                    self._cond.notify()
+                raise DBPoolError(f"データベース接続エラー: {e}")
+
+            waited = time.monotonic() - started
+            with self._cond:
+                self._checkouts += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+                self._peak_in_use = max(self._peak_in_use, self._in_use)
+            return conn
+
+    def putconn(self, conn, broken=False):
+        """接続を返却します。broken=True または異常な接続は破棄します。"""
+        if not broken and not conn.closed:
+            try:
+                # 返却時点で開いているトランザクションは必ず閉じる
+                conn.rollback()
+            except Exception:
+                broken = True
+
+        if broken or conn.closed:
+            self._discard(conn)
+            conn = None
+
+        with self._cond:
+            self._in_use -= 1
+            if conn is not None:
+                if self._closed:
+                    conn.close()
+                    self._opened -= 1
+                else:
+                    self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """接続を借りて、ブロックを抜けたら必ず返却するコンテキストマネージャ。
+
+        例外が発生した場合はロールバックし、接続エラーであれば接続を破棄します。
+        コミットは呼び出し側で明示的に行います。
+        """
+        with span("db.connect"):
+            conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+        except Exception as e:
+            if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                broken = True
+            else:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            raise
+        finally:
+            self.putconn(conn, broken=broken)
+
+    def stats(self):
+        """待ち時間と使用率の統計を返します。"""
+        with self._cond:
+            checkouts = self._checkouts
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "opened": self._opened,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "peak_in_use": self._peak_in_use,
+                "utilization": round(self._in_use / self.max_size, 3),
+                "checkouts": checkouts,
+                "wait_avg_ms": round(self._wait_total / checkouts * 1000, 3) if checkouts else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+                "timeouts": self._timeouts,
+                "recycled": self._recycled,
+            }
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+# -------------------------------------------------------------
+# プロセス全体で共有するプール
+# -------------------------------------------------------------
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """環境変数から設定を読み込み、プロセス共有のプールを返します。"""
+    global _pool
+    if _pool is not None:
+        return _pool
+
+    with _pool_lock:
+        if _pool is None:
+            database_url = os.environ.get('DATABASE_URL')
+            if not database_url:
+                raise DBPoolError("DATABASE_URLが設定されていません。")
+            try:
+                _pool = ConnectionPool(
+                    database_url,
+                    min_size=int(os.environ.get('DB_POOL_MIN_SIZE', 1)),
+                    max_size=int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+                    acquire_timeout=float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', 5)),
+                )
+            except psycopg2.Error as e:
+                raise DBPoolError(f"データベース接続エラー: {e}")
+        return _pool
+
+
+@contextmanager
+def db_connection():
+    """共有プールから接続を借りるコンテキストマネージャ。"""
+    with get_pool().connection() as conn:
+        yield conn
+
+
+# -------------------------------------------------------------
+# ASGI モード用の非同期プール (asyncpg)
+# -------------------------------------------------------------
+_async_pool = None
+_async_pool_lock = None
+
+
+async def get_async_pool():
+    """asyncpg のプロセス共有プールを返します (asgi_app.py で使用)。
+
+    設定は同期版と同じ DATABASE_URL / DB_POOL_* です。
+    """
+    global _async_pool, _async_pool_lock
+    if _async_pool is not None:
+        return _async_pool
+
+    import asyncio
+    import asyncpg  # ASGI モードでのみ使う任意依存のため遅延インポート
+
+    if _async_pool_lock is None:
+        _async_pool_lock = asyncio.Lock()
+    async with _async_pool_lock:
+        if _async_pool is None:
+            database_url = os.environ.get('DATABASE_URL')
+            if not database_url:
+                raise DBPoolError("DATABASE_URLが設定されていません。")
+            try:
+                _async_pool = await asyncio.wait_for(asyncpg.create_pool(
+                    database_url,
+                    min_size=int(os.environ.get('DB_POOL_MIN_SIZE', 1)),
+                    max_size=int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+                ), timeout=float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', 5)) + 5)
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+                raise DBPoolError(f"データベース接続エラー: {e}")
+        return _async_pool
+
+
+async def close_async_pool():
+    global _async_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
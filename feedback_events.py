@@ -0,0 +1,351 @@
+import os
+import json
+import time
+import queue
+import select
+import threading
+import itertools
+from collections import deque
+
+import psycopg2
+
+from app_logging import get_logger
+from db_pool import DBPoolError, db_connection
+
+logger = get_logger("feedback_events")
+
+# -------------------------------------------------------------
+# 新着フィードバックのリアルタイム配信 (Server-Sent Events 用のブローカー)
+# -------------------------------------------------------------
+# ダッシュボードを開いたままのタブが /api/feedback/<email> を繰り返し取得しなくて済むように、
+# ブースごとの購読者へ「新しく登録された行」「要約が付いた行」と更新後の集計だけを送ります。
+# - announce(): submit_feedback のコミット後・要約の完了後に呼ぶ。送信用スレッドがブースごとにまとめて
+#   loader で行と集計を1クエリで読み、publish() する (購読者がいないブースは何もしない)
+# - イベントIDはブースごとの履歴 (history_size 件) 上の位置で扱い、Last-Event-ID からの再開に使う。
+#   履歴から外れたIDで再開した場合や取りこぼしがあった場合は "reset" を送り、クライアントに全件を取り直させる
+# - FEEDBACK_EVENTS_NOTIFY=1 のときは Postgres の NOTIFY を経由して配信し、複数のワーカープロセスで
+#   同じイベントを同じ順序で受け取る (NOTIFY はコミット順にすべての LISTEN 中の接続へ届く)
+
+NOTIFY_CHANNEL = "hyoka_feedback_events"
+# NOTIFY のペイロードの上限は 8000 バイト
+NOTIFY_MAX_BYTES = 7900
+
+
+class TooManySubscribers(Exception):
+    """購読者数の上限に達しています。"""
+
+
+class Subscription:
+    """1つの SSE 接続の購読。get() でイベントを1件ずつ受け取ります。"""
+
+    def __init__(self, broker, booth_id, backlog, queue_size):
+        self.broker = broker
+        self.booth_id = booth_id
+        self._queue = queue.Queue(maxsize=queue_size)
+        for event in backlog:
+            self._queue.put_nowait(event)
+        self._overflowed = False
+        self.closed = False
+
+    def _offer(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # 読み出しが追いつかない接続は、たまった分を捨てて全件の取り直しを求める
+            self._overflowed = True
+
+    def get(self, timeout):
+        """次のイベントを返します。timeout 秒以内に来なければ None。"""
+        if self._overflowed:
+            self._overflowed = False
+            with self._queue.mutex:
+                self._queue.queue.clear()
+            return self.broker._reset_event(self.booth_id, "overflow")
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.broker._unsubscribe(self)
+
+
+class FeedbackEventBroker:
+    """ブースごとの購読者へイベントを配信するプロセス内ブローカー。"""
+
+    def __init__(self, loader=None, max_subscribers=100, history_size=200, subscriber_queue=100,
+                 announce_queue=10000):
+        self.loader = loader  # loader(booth_id, session_ids) -> イベントの data (dict) か None
+        self.max_subscribers = max_subscribers
+        self.history_size = history_size
+        self.subscriber_queue = subscriber_queue
+        self.relay = None  # PostgresEventRelay (NOTIFY 経由で配信する場合)
+
+        self._lock = threading.RLock()
+        self._subscribers = {}  # booth_id -> set(Subscription)
+        self._history = {}      # booth_id -> deque(イベント)
+        self._instance = f"{os.getpid():x}{int(time.time()) % 0x10000:04x}"
+        self._ids = itertools.count(1)
+
+        self._announcements = queue.Queue(maxsize=announce_queue)
+        self._dropped = set()
+        self._thread = None
+
+        self.published = 0
+        self.delivered = 0
+        self.rejected = 0
+        self.resets = 0
+        self.dropped = 0
+
+    # --- 購読 ---
+
+    def subscribe(self, booth_id, last_event_id=None):
+        """購読を開始します。last_event_id を渡すと、その次のイベントから受け取ります。"""
+        if self.relay is not None:
+            self.relay.listen()
+        with self._lock:
+            if sum(len(subscribers) for subscribers in self._subscribers.values()) >= self.max_subscribers:
+                self.rejected += 1
+                raise TooManySubscribers(f"同時接続数の上限 ({self.max_subscribers}) に達しています")
+            backlog = []
+            if last_event_id:
+                history = list(self._history.get(booth_id, ()))
+                ids = [event["id"] for event in history]
+                if last_event_id in ids:
+                    backlog = history[ids.index(last_event_id) + 1:]
+                else:
+                    backlog = [self._reset_event(booth_id, "expired")]
+            subscription = Subscription(self, booth_id, backlog[-self.subscriber_queue:], self.subscriber_queue)
+            self._subscribers.setdefault(booth_id, set()).add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.booth_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.booth_id]
+
+    def has_subscribers(self, booth_id):
+        """このブースのイベントを作る必要があるか。NOTIFY 経由の場合は他のワーカーの購読者がいるかもしれない。"""
+        if self.relay is not None:
+            return True
+        with self._lock:
+            return bool(self._subscribers.get(booth_id))
+
+    # --- 配信 ---
+
+    def _new_event(self, booth_id, event_type, data):
+        return {"id": f"{self._instance}-{next(self._ids)}", "booth_id": booth_id, "type": event_type, "data": data}
+
+    def _reset_event(self, booth_id, reason):
+        with self._lock:
+            self.resets += 1
+        # 履歴には残さない (再開位置にはならない) ので id は付けない
+        return {"id": None, "booth_id": booth_id, "type": "reset", "data": {"reason": reason}}
+
+    def publish(self, booth_id, event_type, data):
+        """イベントを配信します。NOTIFY 経由の場合は全ワーカー (自分を含む) の LISTEN で受け取って配信します。"""
+        event = self._new_event(booth_id, event_type, data)
+        if self.relay is not None:
+            self.relay.send(event)
+        else:
+            self._deliver(event)
+        with self._lock:
+            self.published += 1
+
+    def _deliver(self, event):
+        booth_id = event["booth_id"]
+        with self._lock:
+            self._history.setdefault(booth_id, deque(maxlen=self.history_size)).append(event)
+            subscribers = list(self._subscribers.get(booth_id, ()))
+            self.delivered += len(subscribers)
+        for subscription in subscribers:
+            subscription._offer(event)
+
+    def reset_all(self, reason):
+        """取りこぼしがあったかもしれない場合に、履歴を捨てて全購読者に取り直しを求めます。"""
+        with self._lock:
+            self._history.clear()
+            subscriptions = [s for subscribers in self._subscribers.values() for s in subscribers]
+        for subscription in subscriptions:
+            subscription._offer(self._reset_event(subscription.booth_id, reason))
+
+    # --- コミット後の通知 (送信用スレッドでまとめて読み込み・配信) ---
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="feedback-events", daemon=True)
+                self._thread.start()
+
+    def announce(self, booth_id, event_type, session_id):
+        """session_id の行が登録された ("feedback")・要約が付いた ("summary") ことを知らせます。"""
+        if self.loader is None or not self.has_subscribers(booth_id):
+            return
+        self.start()
+        try:
+            self._announcements.put_nowait((booth_id, event_type, session_id))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                self._dropped.add(booth_id)
+
+    def _take_announcements(self):
+        """通知を1件以上待ち、(ブース, 種類) ごとの session_id のリストにまとめて返します。"""
+        groups = {}
+        item = self._announcements.get()
+        while item is not None:
+            booth_id, event_type, session_id = item
+            groups.setdefault((booth_id, event_type), []).append(session_id)
+            try:
+                item = self._announcements.get_nowait()
+            except queue.Empty:
+                item = None
+        return groups
+
+    def _run(self):
+        while True:
+            groups = self._take_announcements()
+            with self._lock:
+                dropped, self._dropped = self._dropped, set()
+            for booth_id in dropped:
+                self.publish(booth_id, "reset", {"reason": "dropped"})
+            for (booth_id, event_type), session_ids in groups.items():
+                try:
+                    data = self.loader(booth_id, session_ids)
+                    if data is not None:
+                        self.publish(booth_id, event_type, data)
+                except Exception as e:
+                    logger.warning("⚠️ フィードバックのイベント配信に失敗しました (booth=%s): %s", booth_id, e)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "subscribers": sum(len(subscribers) for subscribers in self._subscribers.values()),
+                "booths": len(self._subscribers),
+                "max_subscribers": self.max_subscribers,
+                "published": self.published,
+                "delivered": self.delivered,
+                "rejected": self.rejected,
+                "resets": self.resets,
+                "dropped": self.dropped,
+                "pending": self._announcements.qsize(),
+                "notify": self.relay is not None,
+            }
+
+
+# -------------------------------------------------------------
+# Postgres の LISTEN/NOTIFY による複数ワーカー間の配信
+# -------------------------------------------------------------
+def _notify_payload(event, feedbacks, suffix=""):
+    data = {**event["data"], "feedbacks": feedbacks} if "feedbacks" in (event["data"] or {}) else event["data"]
+    return json.dumps({**event, "id": event["id"] + suffix, "data": data}, ensure_ascii=False, default=str)
+
+
+def _split_for_notify(event):
+    """NOTIFY の上限に収まるよう、イベントを feedbacks 単位で分けたペイロードのリストにします。"""
+    feedbacks = (event.get("data") or {}).get("feedbacks") or []
+    payload = _notify_payload(event, feedbacks)
+    if len(payload.encode("utf-8")) <= NOTIFY_MAX_BYTES or not feedbacks:
+        return [payload]
+
+    # 上限に収まるだけ詰めて分割する (分割したイベントの id には .1, .2, ... を付ける)
+    chunks = [[]]
+    for item in feedbacks:
+        if chunks[-1] and len(_notify_payload(event, chunks[-1] + [item]).encode("utf-8")) > NOTIFY_MAX_BYTES:
+            chunks.append([])
+        chunks[-1].append(item)
+    payloads = []
+    for index, chunk in enumerate(chunks, 1):
+        payload = _notify_payload(event, chunk, f".{index}")
+        if len(payload.encode("utf-8")) > NOTIFY_MAX_BYTES:
+            # 1行でも収まらない長文は本文を省き、クライアントに取り直してもらう
+            item = {key: value for key, value in chunk[0].items() if key not in ("raw_text", "summary_text")}
+            payload = _notify_payload({**event, "data": {**event["data"], "truncated": True}}, [item], f".{index}")
+        payloads.append(payload)
+    return payloads
+
+
+class PostgresEventRelay:
+    """publish() を NOTIFY で送り、LISTEN で受けたイベントをこのプロセスのブローカーに配信します。"""
+
+    def __init__(self, broker, dsn, channel=NOTIFY_CHANNEL, poll_seconds=5.0):
+        self.broker = broker
+        self.dsn = dsn
+        self.channel = channel
+        self.poll_seconds = poll_seconds
+        self.reconnects = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        broker.relay = self
+
+    def listen(self):
+        """LISTEN 用のスレッドを起動します (最初の購読時。2回目以降は何もしない)。"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, name="feedback-events-listen", daemon=True)
+                self._thread.start()
+
+    def send(self, event):
+        try:
+            with db_connection() as conn, conn.cursor() as cursor:
+                for payload in _split_for_notify(event):
+                    cursor.execute("SELECT pg_notify(%s, %s);", (self.channel, payload))
+                conn.commit()
+        except (DBPoolError, psycopg2.Error) as e:
+            logger.warning("⚠️ フィードバックのイベントを NOTIFY できませんでした: %s", e)
+
+    def _listen(self):
+        delay = 1.0
+        connected_before = False
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn, keepalives=1, keepalives_idle=30)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.channel};")
+                if connected_before:
+                    # 切断中のイベントは届いていないため、購読者に取り直してもらう
+                    self.reconnects += 1
+                    self.broker.reset_all("reconnected")
+                connected_before = True
+                delay = 1.0
+                while True:
+                    if select.select([conn], [], [], self.poll_seconds) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            self.broker._deliver(json.loads(notify.payload))
+                        except (ValueError, KeyError) as e:
+                            logger.warning("⚠️ 不正なイベントを受信しました: %s", e)
+            except (psycopg2.Error, OSError) as e:
+                logger.warning("⚠️ フィードバックのイベントの LISTEN が切断されました (%.0f秒後に再接続): %s", delay, e)
+                time.sleep(delay)
+                delay = min(delay * 2, 30.0)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+def event_broker_from_env(loader):
+    """FEEDBACK_EVENTS_* 環境変数からブローカーを作ります。
+
+    - FEEDBACK_EVENTS_MAX_SUBSCRIBERS: 同時に接続できる SSE の数 (1接続につき1スレッドを使う)
+    - FEEDBACK_EVENTS_HISTORY: 再開 (Last-Event-ID) のためにブースごとに残すイベント数
+    - FEEDBACK_EVENTS_NOTIFY=1: DATABASE_URL の Postgres の LISTEN/NOTIFY でワーカー間に配信する
+    """
+    broker = FeedbackEventBroker(
+        loader=loader,
+        max_subscribers=int(os.environ.get('FEEDBACK_EVENTS_MAX_SUBSCRIBERS', 100)),
+        history_size=int(os.environ.get('FEEDBACK_EVENTS_HISTORY', 200)),
+    )
+    if os.environ.get('FEEDBACK_EVENTS_NOTIFY', '0') == '1' and os.environ.get('DATABASE_URL'):
+        PostgresEventRelay(broker, os.environ['DATABASE_URL'])
+    return broker
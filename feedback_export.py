@@ -0,0 +1,443 @@
+"""
+フィードバック (sessions) の一括エクスポート (CSV / NDJSON / Parquet)。
+
+イベント後の分析用に、sessions の全行をチーム名 (students) 付きで書き出します。
+id の順に chunk 行ずつ (キーセット) 読んでは書き出すため、件数によらずメモリ使用量は一定で、
+長いトランザクションも張りません。GET /api/export (flask_app.py) からも同じ処理で配信します。
+- CSV: チャンクごとに COPY (...) TO STDOUT で Postgres に CSV を作らせる
+- NDJSON: 1行1件の JSON (row_to_json)
+- Parquet: チャンクごとに1つの row group (pip install pyarrow が必要)
+
+--resume で前回の続き (チェックポイントに記録した最後の id の次) から書き出します。
+完了後にもう一度 --resume で実行すると、その後に増えた行だけを追記します。
+Parquet は1ファイルに追記できないため、出力先をディレクトリにして --part-rows 件ごとにファイルを分けます。
+
+使い方:
+    python feedback_export.py --format csv --output sessions.csv
+    python feedback_export.py --format ndjson --output sessions.ndjson --booth-id booth-a --resume
+    python feedback_export.py --format parquet --output sessions_parquet --after-id 1000 --until-id 50000
+"""
+import io
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import argparse
+import resource
+from contextlib import nullcontext
+
+import psycopg2
+from dotenv import load_dotenv
+
+from metrics import observe_size, span
+
+# -------------------------------------------------------------
+# チャンク単位の読み出し
+# -------------------------------------------------------------
+
+EXPORT_FORMATS = ("csv", "ndjson", "parquet")
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', 5000))
+
+EXPORT_COLUMNS = ("id", "created_at", "booth_id", "team_name", "visitor_attribute", "raw_text", "summary_text",
+                  "is_processed", "praise_ratio", "advice_ratio", "score", "scorer")
+
+# チーム名はブースごとに1つ (students.booth_id は正規化されていないため揃えて突き合わせる)。
+# until_id は含む。limit が NULL なら範囲内をすべて返す。
+EXPORT_ROWS_SQL = """
+    WITH teams AS (
+        SELECT DISTINCT ON (TRIM(LOWER(t.booth_id)))
+            TRIM(LOWER(t.booth_id)) AS booth_key,
+            t.team_name
+        FROM
+            public.students t
+        WHERE
+            t.booth_id IS NOT NULL
+        ORDER BY
+            TRIM(LOWER(t.booth_id)), t.team_name
+    )
+    SELECT
+        s.id,
+        s.created_at,
+        s.booth_id,
+        teams.team_name,
+        s.visitor_attribute,
+        s.raw_text,
+        s.summary_text,
+        s.is_processed,
+        s.praise_ratio,
+        s.advice_ratio,
+        s.score,
+        s.scorer
+    FROM
+        public.sessions s
+        LEFT JOIN teams ON teams.booth_key = s.booth_id
+    WHERE
+        s.id > %(after_id)s
+        AND (%(until_id)s::bigint IS NULL OR s.id <= %(until_id)s::bigint)
+        AND (%(booth_id)s::text IS NULL OR s.booth_id = %(booth_id)s::text)
+        AND (%(visitor_attribute)s::text IS NULL OR s.visitor_attribute = %(visitor_attribute)s::text)
+    ORDER BY
+        s.id
+    LIMIT %(limit)s
+"""
+
+# NDJSON の行は Postgres で JSON の文字列にする (日時などを Python のオブジェクトにせずに済む)
+EXPORT_NDJSON_SQL = f"""
+    SELECT r.id, row_to_json(r)::text
+    FROM ({EXPORT_ROWS_SQL}) r
+    ORDER BY r.id;
+"""
+
+# COPY にはパラメータを渡せないため、先に次のチャンクの id の範囲と件数を求めておく
+EXPORT_BOUNDS_SQL = """
+    SELECT MAX(c.id), COUNT(*)
+    FROM (
+        SELECT s.id
+        FROM public.sessions s
+        WHERE
+            s.id > %(after_id)s
+            AND (%(until_id)s::bigint IS NULL OR s.id <= %(until_id)s::bigint)
+            AND (%(booth_id)s::text IS NULL OR s.booth_id = %(booth_id)s::text)
+            AND (%(visitor_attribute)s::text IS NULL OR s.visitor_attribute = %(visitor_attribute)s::text)
+        ORDER BY s.id
+        LIMIT %(limit)s
+    ) c;
+"""
+
+
+def export_filters(booth_id=None, visitor_attribute=None, after_id=None, until_id=None):
+    """絞り込み条件を正規化して dict にします (booth_id / visitor_attribute は保存時と同じく lower().strip())。"""
+    return {
+        "booth_id": (booth_id or "").lower().strip() or None,
+        "visitor_attribute": (visitor_attribute or "").lower().strip() or None,
+        "after_id": after_id or 0,
+        "until_id": until_id,
+    }
+
+
+def _fetch_chunk(conn, sql, filters, after_id, chunk_rows):
+    with span("sql.export_chunk"):
+        with conn.cursor() as cursor:
+            cursor.execute(sql, dict(filters, after_id=after_id, limit=chunk_rows))
+            rows = cursor.fetchall()
+        # チャンクごとにトランザクションを閉じる (エクスポート中にスナップショットを持ち続けない)
+        conn.rollback()
+    return rows
+
+
+def _copy_csv_chunk(conn, filters, after_id, chunk_rows):
+    """次のチャンクを COPY で CSV にします。戻り値は (CSV のバイト列, 最後の id, 件数) で、行がなければ None。"""
+    params = dict(filters, after_id=after_id, limit=chunk_rows)
+    with span("sql.export_chunk"):
+        with conn.cursor() as cursor:
+            cursor.execute(EXPORT_BOUNDS_SQL, params)
+            last_id, count = cursor.fetchone()
+            if not count:
+                conn.rollback()
+                return None
+            query = cursor.mogrify(EXPORT_ROWS_SQL, dict(params, until_id=last_id, limit=None)).decode("utf-8")
+            buffer = io.BytesIO()
+            cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv)", buffer)
+        conn.rollback()
+    return buffer.getvalue(), last_id, count
+
+
+# -------------------------------------------------------------
+# 形式ごとの書き出し
+# -------------------------------------------------------------
+
+def _csv_header():
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerow(EXPORT_COLUMNS)
+    return buffer.getvalue().encode("utf-8")
+
+
+def _ndjson_lines(rows):
+    return ("\n".join(line for _, line in rows) + "\n").encode("utf-8")
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def parquet_available():
+    return _pyarrow() is not None
+
+
+def _parquet_schema(pa):
+    return pa.schema([
+        ("id", pa.int64()),
+        ("created_at", pa.timestamp("us", tz="UTC")),
+        ("booth_id", pa.string()),
+        ("team_name", pa.string()),
+        ("visitor_attribute", pa.string()),
+        ("raw_text", pa.string()),
+        ("summary_text", pa.string()),
+        ("is_processed", pa.bool_()),
+        ("praise_ratio", pa.float64()),
+        ("advice_ratio", pa.float64()),
+        ("score", pa.int16()),
+        ("scorer", pa.string()),
+    ])
+
+
+class _ChunkSink:
+    """ParquetWriter の書き込み先。書かれたバイト列を溜めておき、take() で取り出します。"""
+
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ParquetChunkWriter:
+    """チャンクを1つずつ row group として書き、書けた分のバイト列を返します。"""
+
+    def __init__(self):
+        pa = _pyarrow()
+        if pa is None:
+            raise RuntimeError("Parquet の書き出しには pyarrow が必要です (pip install pyarrow)")
+        self._pa = pa
+        self._schema = _parquet_schema(pa)
+        self._sink = _ChunkSink()
+        self._writer = pa.parquet.ParquetWriter(self._sink, self._schema, compression="zstd")
+
+    def write_rows(self, rows):
+        columns = list(zip(*rows))
+        table = self._pa.Table.from_arrays(
+            [self._pa.array(column, type=field.type) for column, field in zip(columns, self._schema)],
+            schema=self._schema,
+        )
+        self._writer.write_table(table, row_group_size=len(rows))
+        return self._sink.take()
+
+    def close(self):
+        self._writer.close()
+        return self._sink.take()
+
+
+def export_chunks(connect, export_format, filters, chunk_rows=None, header=True, max_rows=None):
+    """filters の行を id の順に書き出し、(バイト列, 最後の id, 件数) をチャンクごとに返すジェネレータ。
+
+    connect() は接続を返すコンテキストマネージャ (db_pool.db_connection など) で、チャンクを読む間だけ使い、
+    チャンクを返す (呼び出し側が書き出す・クライアントが受け取る) 間は接続を持ちません。
+    header=False のときは CSV のヘッダー行を付けません (続きからの追記用)。
+    max_rows を指定するとその件数で打ち切ります。Parquet は最後に footer (件数 0) を返します。
+    """
+    chunk_rows = chunk_rows or EXPORT_CHUNK_ROWS
+    after_id = filters["after_id"]
+    total = 0
+    parquet = ParquetChunkWriter() if export_format == "parquet" else None
+    if export_format == "csv" and header:
+        yield _csv_header(), after_id, 0
+
+    while max_rows is None or total < max_rows:
+        limit = chunk_rows if max_rows is None else min(chunk_rows, max_rows - total)
+        if export_format == "csv":
+            with connect() as conn:
+                chunk = _copy_csv_chunk(conn, filters, after_id, limit)
+            if chunk is None:
+                break
+            data, after_id, count = chunk
+        else:
+            sql = EXPORT_ROWS_SQL if parquet else EXPORT_NDJSON_SQL
+            with connect() as conn:
+                rows = _fetch_chunk(conn, sql, filters, after_id, limit)
+            if not rows:
+                break
+            data = parquet.write_rows(rows) if parquet else _ndjson_lines(rows)
+            after_id, count = rows[-1][0], len(rows)
+        total += count
+        observe_size("export.chunk", len(data))
+        yield data, after_id, count
+        if count < limit:
+            break
+
+    if parquet:
+        yield parquet.close(), after_id, 0
+
+
+def peak_rss_mb():
+    """このプロセスの最大常駐メモリ (MB)。"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# -------------------------------------------------------------
+# CLI (チェックポイントによる再開)
+# -------------------------------------------------------------
+# チェックポイント: {"format", "filters", "last_id", "rows", "bytes" (CSV/NDJSON の書き込み済みバイト数)}
+# CSV/NDJSON はチャンクを書くたびに記録し、再開時は bytes までで切り詰めてから追記します
+# (書きかけのチャンクは捨てて読み直す)。Parquet は part ファイルを閉じるたびに記録します。
+
+def _checkpoint_path(export_format, output):
+    return os.path.join(output, "_checkpoint.json") if export_format == "parquet" else output + ".checkpoint.json"
+
+
+def _load_checkpoint(path, export_format, filters):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    base = {key: value for key, value in filters.items() if key != "after_id"}
+    saved = {key: value for key, value in checkpoint["filters"].items() if key != "after_id"}
+    if checkpoint["format"] != export_format or saved != base:
+        raise SystemExit("❌ チェックポイントの形式・絞り込み条件が今回の指定と異なります。")
+    return checkpoint
+
+
+def _save_checkpoint(path, checkpoint):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def export_to_file(conn, export_format, output, filters, chunk_rows=None, resume=False, part_rows=1_000_000,
+                   progress_every=100_000):
+    """output に書き出し、(書き出した件数, バイト数) を返します。resume=True なら前回の続きから書き出します。"""
+    checkpoint_path = _checkpoint_path(export_format, output)
+    checkpoint = _load_checkpoint(checkpoint_path, export_format, filters) if resume else None
+    if checkpoint is None:
+        checkpoint = {"format": export_format, "filters": filters, "last_id": filters["after_id"], "rows": 0,
+                      "bytes": 0, "parts": 0}
+    elif checkpoint["last_id"] is not None:
+        print(f"✅ id {checkpoint['last_id']} の次から再開します (書き出し済み {checkpoint['rows']}件)")
+    resume_filters = dict(filters, after_id=checkpoint["last_id"])
+
+    if export_format == "parquet":
+        written = _export_parquet_parts(conn, output, resume_filters, checkpoint, checkpoint_path, chunk_rows,
+                                        part_rows, progress_every)
+    else:
+        written = _export_stream_file(conn, export_format, output, resume_filters, checkpoint, checkpoint_path,
+                                      chunk_rows, progress_every)
+    return written
+
+
+def _export_stream_file(conn, export_format, output, filters, checkpoint, checkpoint_path, chunk_rows,
+                        progress_every):
+    rows = written = 0
+    mode = "r+b" if checkpoint["bytes"] and os.path.exists(output) else "wb"
+    with open(output, mode) as f:
+        # 前回の書きかけのチャンクを捨てる
+        f.seek(checkpoint["bytes"] if mode == "r+b" else 0)
+        f.truncate()
+        next_report = progress_every
+        for data, last_id, count in export_chunks(lambda: nullcontext(conn), export_format, filters, chunk_rows,
+                                                  header=checkpoint["bytes"] == 0):
+            f.write(data)
+            f.flush()
+            rows += count
+            written += len(data)
+            checkpoint.update(last_id=last_id, rows=checkpoint["rows"] + count, bytes=f.tell())
+            _save_checkpoint(checkpoint_path, checkpoint)
+            if rows >= next_report:
+                print(f"   {rows}件 (id {last_id} まで)")
+                next_report += progress_every
+    return rows, written
+
+
+def _export_parquet_parts(conn, output, filters, checkpoint, checkpoint_path, chunk_rows, part_rows,
+                          progress_every):
+    os.makedirs(output, exist_ok=True)
+    # 前回の書きかけの part を捨てる (最初から書き出す場合は以前の part もすべて消す)
+    for path in glob.glob(os.path.join(output, "part-*.parquet*")):
+        if path.endswith(".tmp") or checkpoint["parts"] == 0:
+            os.remove(path)
+
+    rows = written = 0
+    next_report = progress_every
+    while True:
+        part_path = os.path.join(output, f"part-{checkpoint['parts']:05d}.parquet")
+        part_count = part_bytes = 0
+        last_id = filters["after_id"]
+        with open(part_path + ".tmp", "wb") as f:
+            for data, last_id, count in export_chunks(lambda: nullcontext(conn), "parquet", filters, chunk_rows,
+                                                      max_rows=part_rows):
+                f.write(data)
+                part_count += count
+                part_bytes += len(data)
+        if not part_count:
+            os.remove(part_path + ".tmp")
+            break
+
+        os.replace(part_path + ".tmp", part_path)
+        rows += part_count
+        written += part_bytes
+        checkpoint.update(last_id=last_id, rows=checkpoint["rows"] + part_count, parts=checkpoint["parts"] + 1)
+        _save_checkpoint(checkpoint_path, checkpoint)
+        filters = dict(filters, after_id=last_id)
+        if rows >= next_report:
+            print(f"   {rows}件 (id {last_id} まで, part {checkpoint['parts']}個)")
+            next_report += progress_every
+        if part_count < part_rows:
+            break
+    return rows, written
+
+
+def main(argv):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    parser.add_argument("--output", required=True, help="出力ファイル (parquet はディレクトリ)")
+    parser.add_argument("--booth-id", default=None)
+    parser.add_argument("--visitor-attribute", default=None)
+    parser.add_argument("--after-id", type=int, default=None, help="この id より後の行だけ")
+    parser.add_argument("--until-id", type=int, default=None, help="この id までの行だけ (含む)")
+    parser.add_argument("--chunk-rows", type=int, default=EXPORT_CHUNK_ROWS)
+    parser.add_argument("--part-rows", type=int, default=1_000_000, help="parquet の1ファイルあたりの件数")
+    parser.add_argument("--resume", action="store_true", help="チェックポイントの続きから書き出す")
+    args = parser.parse_args(argv[1:])
+
+    if args.format == "parquet" and not parquet_available():
+        print("❌ Parquet の書き出しには pyarrow が必要です (pip install pyarrow)")
+        return 1
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        print("❌ DATABASE_URLが設定されていません。")
+        return 1
+
+    filters = export_filters(args.booth_id, args.visitor_attribute, args.after_id, args.until_id)
+    conn = psycopg2.connect(database_url, connect_timeout=5)
+    started = time.perf_counter()
+    try:
+        rows, written = export_to_file(conn, args.format, args.output, filters, chunk_rows=args.chunk_rows,
+                                       resume=args.resume, part_rows=args.part_rows)
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - started
+    print(f"✅ {rows}件を書き出しました: {args.output} ({written / 1024 / 1024:.1f}MB, {elapsed:.1f}秒, "
+          f"{rows / elapsed if elapsed else 0:.0f}件/秒, 最大メモリ {peak_rss_mb():.0f}MB)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
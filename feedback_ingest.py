@@ -0,0 +1,211 @@
+import os
+import time
+import threading
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from app_logging import get_logger
+from db_pool import db_connection
+
+logger = get_logger("feedback_ingest")
+
+# -------------------------------------------------------------
+# フィードバック (sessions) のまとめ書き込み
+# -------------------------------------------------------------
+# - insert_feedbacks(): 複数件を execute_values の1文・1トランザクションで挿入する
+#   (/api/submit_feedback/bulk と書き込みバッファで使用)
+# - FeedbackWriteBuffer: /api/submit_feedback の1件ずつの挿入を貯めて、件数か時間のしきい値でまとめて書き込む
+#   リクエストは自分の行がコミットされるまで待つので、inserted_id とエラーの返し方は従来どおりです。
+
+SESSION_COLUMNS = ("booth_id", "praise_ratio", "advice_ratio", "raw_text", "visitor_attribute", "summary_text",
+                   "is_processed", "score", "scorer")
+
+INSERT_SESSIONS_SQL = f"""
+    INSERT INTO public.sessions ({", ".join(SESSION_COLUMNS)})
+    VALUES %s
+    RETURNING id;
+"""
+
+INSERT_SESSION_SQL = f"""
+    INSERT INTO public.sessions ({", ".join(SESSION_COLUMNS)})
+    VALUES ({", ".join(["%s"] * len(SESSION_COLUMNS))})
+    RETURNING id;
+"""
+
+# 特定の行の値が原因のエラー (ValueError は NUL 文字を含む文字列など、psycopg2 が送信前に弾いたもの)
+ROW_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError, ValueError)
+
+
+def session_row(feedback):
+    """検証済みのフィードバック (flask_app._parse_feedback の戻り値) を SESSION_COLUMNS の順のタプルにします。"""
+    return tuple(feedback[column] for column in SESSION_COLUMNS)
+
+
+def insert_feedbacks(conn, feedbacks):
+    """検証済みのフィードバックを1トランザクションで挿入し、[(inserted_id, None) か (None, 例外)] を返します。
+
+    まず全件を execute_values の1文で挿入します。どれかの行でエラーになった場合は、
+    同じトランザクション内で1行ずつ SAVEPOINT を切って入れ直し、失敗した行だけをエラーにします。
+    接続エラーなど行に依らない例外はそのまま伝えます。
+    """
+    if not feedbacks:
+        return []
+    rows = [session_row(feedback) for feedback in feedbacks]
+
+    try:
+        with conn.cursor() as cursor:
+            # RETURNING は VALUES の順に返る (page_size を件数以上にして1文で送る)
+            ids = execute_values(cursor, INSERT_SESSIONS_SQL, rows, page_size=len(rows), fetch=True)
+        conn.commit()
+        return [(row[0], None) for row in ids]
+    except ROW_ERRORS:
+        conn.rollback()
+
+    results = []
+    with conn.cursor() as cursor:
+        for row in rows:
+            cursor.execute("SAVEPOINT feedback_row;")
+            try:
+                cursor.execute(INSERT_SESSION_SQL, row)
+                results.append((cursor.fetchone()[0], None))
+                cursor.execute("RELEASE SAVEPOINT feedback_row;")
+            except ROW_ERRORS as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT feedback_row;")
+                results.append((None, e))
+    conn.commit()
+    return results
+
+
+class PendingFeedback:
+    """書き込みバッファに入れた1件。wait() でコミットを待ちます。"""
+
+    def __init__(self, feedback):
+        self.feedback = feedback
+        self.enqueued_at = time.monotonic()
+        self._done = threading.Event()
+        self.inserted_id = None
+        self.error = None
+
+    def _resolve(self, inserted_id, error):
+        self.inserted_id = inserted_id
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout):
+        """挿入された id を返します。挿入に失敗した場合はその例外を投げます。"""
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"フィードバックの書き込みが {timeout} 秒以内に完了しませんでした")
+        if self.error is not None:
+            raise self.error
+        return self.inserted_id
+
+
+class FeedbackWriteBuffer:
+    """/api/submit_feedback の挿入をまとめて書き込むバッファ。
+
+    flush_size 件たまるか、最も古い1件が flush_interval 秒待ったら1トランザクションで書き込みます。
+    max_pending 件を超えて貯めることはせず、submit() が None を返すので呼び出し側で直接挿入してください。
+    """
+
+    def __init__(self, flush_size=100, flush_interval=0.05, max_pending=10000, connection=db_connection):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.connection = connection
+        self._cond = threading.Condition()
+        self._pending = []
+        self._thread = None
+
+        self.batches = 0
+        self.rows = 0
+        self.failed_rows = 0
+        self.rejected = 0
+        self.largest_batch = 0
+        self._flush_seconds = 0.0
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="feedback-write-buffer", daemon=True)
+                self._thread.start()
+
+    def submit(self, feedback):
+        """1件を追加します。バッファが満杯なら None を返します。"""
+        self.start()
+        pending = PendingFeedback(feedback)
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                self.rejected += 1
+                return None
+            self._pending.append(pending)
+            if len(self._pending) == 1 or len(self._pending) >= self.flush_size:
+                self._cond.notify()
+        return pending
+
+    def _take_batch(self):
+        """書き込む分を取り出します。しきい値に達するまで待ちます。"""
+        with self._cond:
+            while True:
+                if len(self._pending) >= self.flush_size:
+                    break
+                if self._pending:
+                    remaining = self._pending[0].enqueued_at + self.flush_interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+            batch, self._pending = self._pending[:self.flush_size], self._pending[self.flush_size:]
+            return batch
+
+    def _run(self):
+        while True:
+            self._flush(self._take_batch())
+
+    def _flush(self, batch):
+        started = time.perf_counter()
+        try:
+            with self.connection() as conn:
+                results = insert_feedbacks(conn, [pending.feedback for pending in batch])
+        except Exception as e:
+            logger.error("❌ フィードバックのまとめ書き込みに失敗しました (%d件): %s", len(batch), e)
+            results = [(None, e)] * len(batch)
+
+        for pending, (inserted_id, error) in zip(batch, results):
+            pending._resolve(inserted_id, error)
+        with self._cond:
+            self.batches += 1
+            self.rows += len(batch)
+            self.failed_rows += sum(1 for _, error in results if error is not None)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            self._flush_seconds += time.perf_counter() - started
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "batches": self.batches,
+                "rows": self.rows,
+                "failed_rows": self.failed_rows,
+                "rejected": self.rejected,
+                "avg_batch_size": round(self.rows / self.batches, 1) if self.batches else 0.0,
+                "largest_batch": self.largest_batch,
+                "avg_flush_ms": round(self._flush_seconds / self.batches * 1000, 2) if self.batches else 0.0,
+            }
+
+
+def write_buffer_from_env():
+    """FEEDBACK_WRITE_BUFFER=1 のときだけ書き込みバッファを作ります (既定は無効で、1件ずつ挿入)。
+
+    - FEEDBACK_BUFFER_SIZE: この件数たまったら書き込む
+    - FEEDBACK_BUFFER_INTERVAL_MS: 最も古い1件がこの時間待ったら書き込む
+    - FEEDBACK_BUFFER_MAX_PENDING: これ以上は貯めずに直接挿入する
+    """
+    if os.environ.get('FEEDBACK_WRITE_BUFFER', '0') != '1':
+        return None
+    return FeedbackWriteBuffer(
+        flush_size=int(os.environ.get('FEEDBACK_BUFFER_SIZE', 100)),
+        flush_interval=float(os.environ.get('FEEDBACK_BUFFER_INTERVAL_MS', 50)) / 1000,
+        max_pending=int(os.environ.get('FEEDBACK_BUFFER_MAX_PENDING', 10000)),
+    )
@@ -0,0 +1,243 @@
+"""
+フィードバック本文からの褒め/アドバイスの割合とスコアのローカル算出。
+
+submit_feedback の挿入時に呼び、Gemini を待たずに数ミリ秒で praise_ratio / advice_ratio / score を決めます。
+既存の行の再採点 (バッチ) と、Gemini による補正 (任意) もここから実行できます。
+
+使い方:
+    python feedback_scorer.py score "説明が丁寧で分かりやすかった。もう少し字が大きいと良い"
+    python feedback_scorer.py rescore            # 未採点・古い版で採点した行を採点し直す
+    python feedback_scorer.py rescore --all      # ローカルで採点した行をすべて採点し直す
+    python feedback_scorer.py rescore --refine   # 手がかりが見つからなかった行は Gemini で補正する
+"""
+import os
+import re
+import sys
+import argparse
+
+import psycopg2
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+
+# -------------------------------------------------------------
+# 辞書による採点
+# -------------------------------------------------------------
+# 日本語は分かち書きしないため、辞書の表現をすべて1つの正規表現 (長い表現を優先) にまとめて
+# 本文を1回走査します。表現ごとの極性と重みは辞書引きで求めます。
+# - 直後の否定 (「良くない」「不満はありません」) で極性を反転
+# - 直前の強調 (「とても」「すごく」) で重みを 1.5 倍
+# - 逆接 (「が、」「けど」「ただ」) の後ろは来場者の言いたいことであることが多いため重みを 1.25 倍
+# 採点のロジックや辞書を変えたら SCORER_VERSION を上げ、rescore で既存の行を採点し直してください。
+
+SCORER_VERSION = "local:1"
+
+PRAISE_TERMS = {
+    "良かった": 1.0, "よかった": 1.0, "良く": 0.8, "よく出来": 1.0, "よくでき": 1.0, "良い": 0.8, "よい": 0.6,
+    "いいと思": 1.0, "いい": 0.6, "素晴らし": 1.5, "すばらし": 1.5, "すごい": 1.0, "凄い": 1.0, "すごかった": 1.0,
+    "面白": 1.0, "おもしろ": 1.0, "楽し": 1.0, "分かりやす": 1.2, "わかりやす": 1.2, "見やす": 1.0,
+    "聞きやす": 1.0, "使いやす": 1.0, "丁寧": 1.0, "感動": 1.5, "興味深": 1.2, "興味を持": 1.0, "魅力": 1.0,
+    "上手": 1.0, "完成度が高": 1.5, "ありがとう": 0.8, "最高": 1.5, "素敵": 1.2, "すてき": 1.2, "感心": 1.0,
+    "驚き": 0.8, "工夫": 0.8, "綺麗": 1.0, "きれい": 1.0, "かっこい": 1.0, "カッコい": 1.0, "便利": 1.0,
+    "役に立": 1.0, "参考にな": 1.0, "斬新": 1.2, "独創": 1.2, "熱意": 1.0, "親切": 1.0, "印象的": 1.0,
+    "気に入": 1.0, "好き": 0.8, "満足": 1.0, "完璧": 1.5, "さすが": 1.0, "納得": 0.8, "勉強にな": 1.0,
+    "すごく良": 1.5, "good": 0.8, "Good": 0.8, "nice": 0.8, "Nice": 0.8, "👍": 1.0,
+}
+
+ADVICE_TERMS = {
+    "ほしい": 1.2, "欲しい": 1.2, "てほしかった": 1.2, "たらいい": 1.2, "たら良": 1.2, "ればいい": 1.2,
+    "れば良": 1.2, "と良い": 1.0, "といい": 1.0, "方がいい": 1.2, "方が良": 1.2, "ほうがいい": 1.2,
+    "ほうが良": 1.2, "もう少し": 1.0, "もうすこし": 1.0, "もっと": 0.8, "改善": 1.2, "べき": 1.0,
+    "足りな": 1.2, "不足": 1.2, "分かりにく": 1.5, "わかりにく": 1.5, "分かりづら": 1.5, "わかりづら": 1.5,
+    "見にく": 1.2, "見づら": 1.2, "聞き取りにく": 1.2, "聞こえにく": 1.2, "使いにく": 1.2, "難しかった": 1.0,
+    "難しい": 0.8, "残念": 1.2, "惜しい": 1.0, "課題": 1.0, "気になった": 1.0, "気になる": 0.8,
+    "物足りな": 1.2, "不満": 1.2, "不便": 1.2, "小さ": 0.5, "長すぎ": 1.0, "短すぎ": 1.0, "多すぎ": 1.0,
+    "少な": 0.6, "遅": 0.6, "つまらな": 1.5, "退屈": 1.5, "微妙": 1.0, "雑": 0.8, "ミス": 0.8, "間違": 0.8,
+    "提案": 0.8, "アドバイス": 0.8, "してみては": 1.0, "検討": 0.8, "期待": 0.5,
+}
+
+INTENSIFIERS = ("とても", "すごく", "非常に", "かなり", "本当に", "ほんとうに", "めちゃくちゃ", "とっても", "大変")
+CONTRASTS = ("が、", "けど", "けれど", "しかし", "ただ、", "ただ ", "一方", "でも", "ですが")
+
+# 表現の直後の否定 (「良くない」「面白くなかった」「不満はありません」)
+NEGATION_RE = re.compile(r"(?:く|は|が|も)?(?:ない|なかった|なく|なさ|ありません|ません|ず)")
+SENTENCE_RE = re.compile(r"[^。．.！!？?\n]+")
+
+INTENSIFIER_WEIGHT = 1.5
+CONTRAST_WEIGHT = 1.25
+NEGATED_WEIGHT = 0.8
+
+_TERMS = {term: (1, weight) for term, weight in PRAISE_TERMS.items()}
+_TERMS.update({term: (-1, weight) for term, weight in ADVICE_TERMS.items()})
+_TERMS.update({term: (0, 0.0) for term in INTENSIFIERS + CONTRASTS})
+# 同じ位置から始まる表現は長いものを優先する
+TERMS_RE = re.compile("|".join(re.escape(term) for term in sorted(_TERMS, key=len, reverse=True)))
+
+
+def score_from_ratio(praise_ratio):
+    """褒めの割合 (0〜100) からスコア (40〜100) を求めます。
+
+    アドバイスだけのフィードバックも評価の一つなので、最低点は 40 にしています。
+    """
+    return int(round(40 + 0.6 * min(max(praise_ratio, 0.0), 100.0)))
+
+
+def _sentence_weights(sentence):
+    """1文の (褒めの重み, アドバイスの重み, 手がかりの数) を返します。"""
+    praise = advice = 0.0
+    hits = 0
+    boost = 1.0
+    contrast = 1.0
+    for match in TERMS_RE.finditer(sentence):
+        polarity, weight = _TERMS[match.group()]
+        if polarity == 0:
+            if match.group() in INTENSIFIERS:
+                boost = INTENSIFIER_WEIGHT
+            else:
+                contrast = CONTRAST_WEIGHT
+            continue
+        if NEGATION_RE.match(sentence, match.end()):
+            polarity, weight = -polarity, weight * NEGATED_WEIGHT
+        weight *= boost * contrast
+        boost = 1.0
+        hits += 1
+        if polarity > 0:
+            praise += weight
+        else:
+            advice += weight
+    return praise, advice, hits
+
+
+def score_feedback(text):
+    """本文から praise_ratio / advice_ratio (0〜100、合計100) と score を求めます。
+
+    戻り値の confidence は手がかりの多さ (0〜1)。手がかりが1つもなければ 50/50 で confidence は 0 です。
+    """
+    praise = advice = 0.0
+    hits = 0
+    for sentence in SENTENCE_RE.findall(text or ""):
+        sentence_praise, sentence_advice, sentence_hits = _sentence_weights(sentence)
+        praise += sentence_praise
+        advice += sentence_advice
+        hits += sentence_hits
+
+    # 手がかりが少ないときに極端な割合にならないよう、両側に 0.5 ずつ足して平滑化する
+    praise_ratio = round(100 * (praise + 0.5) / (praise + advice + 1.0), 1)
+    return {
+        "praise_ratio": praise_ratio,
+        "advice_ratio": round(100 - praise_ratio, 1),
+        "score": score_from_ratio(praise_ratio),
+        "confidence": round(min(hits / 4, 1.0), 2),
+        "scorer": SCORER_VERSION,
+    }
+
+
+# -------------------------------------------------------------
+# 既存の行の再採点
+# -------------------------------------------------------------
+# ローカルで採点した行と、採点の導入前の行 (scorer が NULL。フォームが固定の 50/50 を送っていた) が対象。
+# クライアントが割合を指定した行 (client) と Gemini で補正した行 (gemini) は変更しません。
+RESCORE_SELECT_SQL = """
+    SELECT
+        s.id,
+        s.raw_text
+    FROM
+        public.sessions s
+    WHERE
+        s.id > %(after_id)s
+        AND (s.scorer IS NULL OR (s.scorer LIKE 'local:%%' AND (%(all)s OR s.scorer <> %(version)s)))
+    ORDER BY
+        s.id
+    LIMIT %(limit)s;
+"""
+
+RESCORE_UPDATE_SQL = """
+    UPDATE public.sessions AS s
+    SET
+        praise_ratio = v.praise_ratio,
+        advice_ratio = v.advice_ratio,
+        score = v.score,
+        scorer = v.scorer
+    FROM (VALUES %s) AS v(id, praise_ratio, advice_ratio, score, scorer)
+    WHERE s.id = v.id;
+"""
+
+
+def _refine(raw_text):
+    """Gemini で割合を求め直します。失敗した場合は None (ローカルの採点のまま)。"""
+    from gemini_api import generate_ratio_scores  # CLIで --refine を指定したときだけ読み込む
+
+    try:
+        praise_ratio, advice_ratio = generate_ratio_scores(raw_text)
+    except Exception as e:
+        print(f"⚠️ Gemini による補正に失敗しました: {e}")
+        return None
+    return {"praise_ratio": praise_ratio, "advice_ratio": advice_ratio,
+            "score": score_from_ratio(praise_ratio), "scorer": "gemini"}
+
+
+def rescore(conn, rescore_all=False, batch_size=500, refine=False):
+    """対象の行をIDの順に batch_size 件ずつ採点し直し、1バッチごとにコミットします。
+
+    refine=True のときは、辞書の手がかりが見つからなかった行 (confidence 0) だけ Gemini で補正します。
+    集計 (booth_stats) は UPDATE のトリガーで更新されます。戻り値は (採点した件数, Gemini で補正した件数)。
+    """
+    after_id = 0
+    updated = refined = 0
+    while True:
+        with conn.cursor() as cursor:
+            cursor.execute(RESCORE_SELECT_SQL, {"after_id": after_id, "all": rescore_all,
+                                                "version": SCORER_VERSION, "limit": batch_size})
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            values = []
+            for session_id, raw_text in rows:
+                result = score_feedback(raw_text)
+                if refine and result["confidence"] == 0:
+                    refined_result = _refine(raw_text)
+                    if refined_result is not None:
+                        result = refined_result
+                        refined += 1
+                values.append((session_id, result["praise_ratio"], result["advice_ratio"], result["score"],
+                               result["scorer"]))
+            execute_values(cursor, RESCORE_UPDATE_SQL, values, page_size=len(values))
+        conn.commit()
+        updated += len(rows)
+        after_id = rows[-1][0]
+        print(f"✅ {updated}件を採点しました (id {after_id} まで)")
+    return updated, refined
+
+
+def main(argv):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    score_parser = subparsers.add_parser("score", help="テキストを採点して表示する")
+    score_parser.add_argument("text")
+    rescore_parser = subparsers.add_parser("rescore", help="既存の行を採点し直す")
+    rescore_parser.add_argument("--all", action="store_true", help="現在の版で採点済みの行も採点し直す")
+    rescore_parser.add_argument("--batch-size", type=int, default=500)
+    rescore_parser.add_argument("--refine", action="store_true", help="手がかりのない行を Gemini で補正する")
+    args = parser.parse_args(argv[1:])
+
+    if args.command == "score":
+        print(score_feedback(args.text))
+        return 0
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        print("❌ DATABASE_URLが設定されていません。")
+        return 1
+
+    conn = psycopg2.connect(database_url, connect_timeout=5)
+    try:
+        updated, refined = rescore(conn, rescore_all=args.all, batch_size=args.batch_size, refine=args.refine)
+    finally:
+        conn.close()
+    print(f"✅ 再採点が完了しました: {updated}件 (Gemini で補正: {refined}件)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,231 @@
+import os
+import unicodedata
+
+from aggregates import SESSION_SCORE_SQL
+from metrics import span
+
+# -------------------------------------------------------------
+# フィードバック (本文・要約) の全文検索
+# -------------------------------------------------------------
+# - 索引: schema.py のマイグレーション 006 で作る sessions_search_grams_idx
+#   (正規化した本文 + 要約 (search_raw / search_summary 列) の文字 1-gram/2-gram の GIN 式インデックス)
+# - 検索語は空白区切りの AND。各語の 2-gram (1文字の語はその文字) をすべて含む行をインデックスで絞り込み、
+#   正規化した本文・要約に語が実際に含まれるかを strpos で確かめます (2-gram の並びの偶然の一致を除く)
+#   ブースで絞り込む場合は、そのブースの行を (booth_id, id) インデックスで読んで strpos で確かめます
+# - 並び順: relevance (語の出現回数。要約での一致は2倍、長い本文ほど割り引く (日本語で約100文字ごと)) か recent (新しい順)
+# - 一致箇所を含む抜粋とハイライト位置 (元の文字列での [開始, 終了)) は Python 側で作ります
+
+SEARCH_MAX_TERMS = int(os.environ.get('SEARCH_MAX_TERMS', 5))
+SEARCH_MAX_TERM_LENGTH = 64
+SEARCH_MAX_LIMIT = 100
+SEARCH_MAX_OFFSET = int(os.environ.get('SEARCH_MAX_OFFSET', 1000))
+SEARCH_SNIPPET_CHARS = int(os.environ.get('SEARCH_SNIPPET_CHARS', 80))
+SUMMARY_WEIGHT = 2
+
+SEARCH_ORDERS = {
+    "relevance": "rank DESC, id DESC",
+    "recent": "id DESC",
+}
+
+# 検索語は呼び出し側で正規化済み (parse_terms) だが、インデックスと同じ関数で正規化し直して比較する
+# (引数が定数なのでプランナが1回だけ評価する)。語の数ごとに SQL を組み立てておきます。
+# 件数の計算と並べ替えは (id, rank) だけの行で行い、そのページの行だけ sessions から本文を読みます。
+# 1行目は必ず件数の行 (一致なし・範囲外のページでも id が NULL の1行が返る)。
+# score はダッシュボード・集計と同じ public.session_score (採点の導入前の行は is_processed による暫定スコア)。
+SEARCH_SQL_TEMPLATE = """
+    WITH matches AS (
+        SELECT
+            s.id,
+            ({hits}) / sqrt(1 + (octet_length(s.search_raw) + octet_length(s.search_summary)) / 300.0::float8) AS rank
+        FROM
+            public.sessions s
+        WHERE
+            {candidates}
+            AND {matched}
+            AND (%(visitor_attribute)s::text IS NULL OR s.visitor_attribute = %(visitor_attribute)s::text)
+    )
+    SELECT
+        c.total,
+        s.id,
+        s.booth_id,
+        s.visitor_attribute,
+        {score} AS score,
+        s.created_at,
+        s.raw_text,
+        s.summary_text,
+        p.rank
+    FROM
+        (SELECT COUNT(*) AS total FROM matches) c
+        LEFT JOIN (
+            SELECT id, rank FROM matches ORDER BY {order} LIMIT %(limit)s OFFSET %(offset)s
+        ) p ON true
+        LEFT JOIN public.sessions s ON s.id = p.id
+    ORDER BY
+        {order};
+"""
+
+
+def _search_sql(sort, term_count, by_booth):
+    terms = [f"public.search_normalize(%(term{i})s)" for i in range(term_count)]
+    if by_booth:
+        # 1ブース分は (booth_id, id) インデックスで読んで strpos で確かめるほうが、
+        # よく出る語の gram の一致行 (数万件) をインデックスから読むより速い
+        candidates = "s.booth_id = %(booth_id)s::text"
+    else:
+        grams = " || ".join(f"public.search_query_grams({term})" for term in terms)
+        candidates = f"public.search_text_grams(s.search_raw || E'\\n' || s.search_summary) @> ({grams})"
+    return SEARCH_SQL_TEMPLATE.format(
+        score=SESSION_SCORE_SQL,
+        order=SEARCH_ORDERS[sort],
+        candidates=candidates,
+        matched=" AND ".join(
+            f"(strpos(s.search_raw, {term}) > 0 OR strpos(s.search_summary, {term}) > 0)" for term in terms
+        ),
+        # 語ごとの出現回数 (要約での出現は SUMMARY_WEIGHT 倍) の合計。
+        # length() は文字数を数えるため遅く、バイト数 (octet_length) で数えても回数は同じになる
+        hits=" + ".join(
+            f"((octet_length(s.search_raw) - octet_length(replace(s.search_raw, {term}, '')))"
+            f" + {SUMMARY_WEIGHT} * (octet_length(s.search_summary) - octet_length(replace(s.search_summary, {term}, ''))))"
+            f"::float8 / octet_length({term})"
+            for term in terms
+        ),
+    )
+
+
+# (並び順, 語の数, ブースで絞り込むか) ごとの SQL
+SEARCH_SQL = {
+    (sort, term_count, by_booth): _search_sql(sort, term_count, by_booth)
+    for sort in SEARCH_ORDERS
+    for term_count in range(1, SEARCH_MAX_TERMS + 1)
+    for by_booth in (False, True)
+}
+
+# EXPLAINチェック (schema.py check) の対象: (名前, SQL, サンプルパラメータ)
+_SAMPLE_PARAMS = {"term0": "説明", "booth_id": None, "visitor_attribute": None, "limit": 20, "offset": 0}
+SEARCH_QUERIES = [
+    ("search", SEARCH_SQL[("relevance", 1, False)], _SAMPLE_PARAMS),
+    ("search_recent", SEARCH_SQL[("recent", 1, False)], dict(_SAMPLE_PARAMS, visitor_attribute="student")),
+    ("search_booth", SEARCH_SQL[("relevance", 1, True)], dict(_SAMPLE_PARAMS, booth_id="booth")),
+]
+
+
+def normalize_text(text):
+    """search_normalize (SQL) と同じ正規化: 小文字化してから NFKC。"""
+    return unicodedata.normalize("NFKC", (text or "").lower())
+
+
+def parse_terms(query):
+    """検索文字列を空白 (全角スペースを含む) で区切った語のリストにします。戻り値は (terms, error)。"""
+    terms = []
+    for term in normalize_text(query).split():
+        if term not in terms:
+            terms.append(term)
+    if not terms:
+        return None, "qに検索語を指定してください"
+    if len(terms) > SEARCH_MAX_TERMS:
+        return None, f"検索語は{SEARCH_MAX_TERMS}個までにしてください"
+    if any(len(term) > SEARCH_MAX_TERM_LENGTH for term in terms):
+        return None, f"検索語は1語{SEARCH_MAX_TERM_LENGTH}文字までにしてください"
+    return terms, None
+
+
+def search_feedbacks(cursor, terms, booth_id=None, visitor_attribute=None, sort="relevance", limit=20, offset=0):
+    """検索語 (parse_terms の戻り値) をすべて含むフィードバックを返します。戻り値は (total, items)。
+
+    booth_id / visitor_attribute は呼び出し側で lower().strip() 済みの値を渡してください (None なら絞り込まない)。
+    items は search_result_item() の dict のリスト、total は条件に一致した全件数です。
+    """
+    params = {f"term{i}": term for i, term in enumerate(terms)}
+    params.update(booth_id=booth_id, visitor_attribute=visitor_attribute, limit=limit, offset=offset)
+    with span("sql.search"):
+        cursor.execute(SEARCH_SQL[(sort, len(terms), booth_id is not None)], params)
+        rows = cursor.fetchall()
+    total = rows[0][0]
+    with span("search.snippets"):
+        items = [search_result_item(row[1:], terms) for row in rows if row[1] is not None]
+    return total, items
+
+
+def search_result_item(row, terms):
+    session_id, booth_id, visitor_attribute, score, created_at, raw_text, summary_text, rank = row
+    snippets = [snippet for snippet in (
+        make_snippet("raw_text", raw_text, terms),
+        make_snippet("summary_text", summary_text, terms),
+    ) if snippet["highlights"]]
+    if not snippets:
+        # 正規化の差でPython側では位置を特定できなかった場合は本文の先頭を返す
+        snippets = [make_snippet("raw_text", raw_text, [])]
+    return {
+        "id": session_id,
+        "booth_id": booth_id,
+        "visitor_attribute": visitor_attribute,
+        "score": score,
+        "created_at": created_at.isoformat() if created_at else None,
+        "rank": round(rank, 4),
+        "snippets": snippets,
+    }
+
+
+# -------------------------------------------------------------
+# 抜粋とハイライト
+# -------------------------------------------------------------
+
+def _normalized_with_offsets(text):
+    """正規化した文字列と、その各文字が元の文字列のどこ (開始, 終了) から来たかのリストを返します。
+
+    NFKC は1文字が複数文字 (「㈱」→「(株)」) になったり、半角カナの濁点のように後ろの文字と
+    まとまったりするため、結合文字が続く場合はひとまとめにして正規化します。
+    """
+    normalized = []
+    offsets = []
+    i = 0
+    while i < len(text):
+        j = i + 1
+        while j < len(text) and unicodedata.combining(normalize_text(text[j])[:1] or " "):
+            j += 1
+        chunk = normalize_text(text[i:j])
+        normalized.append(chunk)
+        offsets.extend([(i, j)] * len(chunk))
+        i = j
+    return "".join(normalized), offsets
+
+
+def _find_matches(normalized, offsets, terms):
+    """各語の出現位置を元の文字列での (開始, 終了) にし、重なりをまとめて返します。"""
+    spans = []
+    for term in terms:
+        start = normalized.find(term)
+        while start != -1:
+            end = start + len(term)
+            spans.append((offsets[start][0], offsets[end - 1][1]))
+            start = normalized.find(term, end)
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def make_snippet(field, text, terms, width=None):
+    """最初の一致箇所を中心に width 文字ほどを切り出し、抜粋内でのハイライト位置を付けて返します。"""
+    text = text or ""
+    width = width or SEARCH_SNIPPET_CHARS
+    matches = _find_matches(*_normalized_with_offsets(text), terms) if terms else []
+
+    if matches:
+        first_start, first_end = matches[0]
+        start = max(0, min(first_start - width // 3, len(text) - width))
+        end = max(min(len(text), start + width), first_end)
+    else:
+        start, end = 0, min(len(text), width)
+
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end < len(text) else ""
+    highlights = [
+        [max(match_start, start) - start + len(prefix), min(match_end, end) - start + len(prefix)]
+        for match_start, match_end in matches
+        if match_start < end and match_end > start
+    ]
+    return {"field": field, "text": prefix + text[start:end] + suffix, "highlights": highlights}
@@ -1,47 +1,259 @@
 import os
+import time
 import json
+import hashlib
+import tempfile
 import psycopg2
-import base64
-import requests 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, make_response, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
+from app_logging import get_logger
+from cache import cache_from_env
+from gemini_api import (
+    call_gemini_api_for_stt,
+    call_gemini_api_for_stt_file,
+    call_gemini_api_for_summary,
+    gemini_governor,
+    gemini_http,
+    gemini_response_cache,
+    generate_summary_text,
+)
+from db_pool import DBPoolError, db_connection, get_pool
+from feedback_events import TooManySubscribers, event_broker_from_env
+from feedback_export import EXPORT_FORMATS, export_chunks, export_filters, parquet_available
+from feedback_search import SEARCH_MAX_LIMIT, SEARCH_MAX_OFFSET, SEARCH_ORDERS, parse_terms, search_feedbacks
+from feedback_ingest import INSERT_SESSION_SQL, insert_feedbacks, session_row, write_buffer_from_env
+from feedback_scorer import score_feedback, score_from_ratio
+from idempotency import IdempotencyConflict, idempotency_from_env
+from metrics import instrument_flask, registry, span
+from summary_jobs import queue_from_env
+from queries import (
+    DASHBOARD_VERSION_SQL,
+    FEEDBACK_EVENT_SQL,
+    SESSIONS_SQL,
+    fetch_dashboard_combined,
+    fetch_dashboard_separate,
+)
 
 # .envファイルから環境変数をロード
 load_dotenv()
 
+logger = get_logger("flask_app")
+
 # -------------------------------------------------------------
 # デバッグコード
 # -------------------------------------------------------------
 debug_key = os.environ.get('GEMINI_API_KEY')
 if debug_key:
-    print(f"✅ DEBUG: GEMINI_API_KEYは読み込まれています (最初の5文字: {debug_key[:5]}...)")
+    logger.info("✅ DEBUG: GEMINI_API_KEYは読み込まれています (最初の5文字: %s...)", debug_key[:5])
 else:
-    print("❌ DEBUG: GEMINI_API_KEYは読み込まれていません！")
+    logger.error("❌ DEBUG: GEMINI_API_KEYは読み込まれていません！")
 # -------------------------------------------------------------
 
 
 app = Flask(__name__)
 
 # Reactアプリ (http://localhost:5173) からのアクセスを許可
-CORS(app, resources={r"/api/*": {"origins": "http://localhost:5173"}}) 
+CORS(app, resources={r"/api/*": {"origins": "http://localhost:5173"}},
+     expose_headers=["ETag", "Retry-After", "Idempotent-Replayed"])
+
+# リクエスト・ステージごとの計測と GET /metrics (SLOW_REQUEST_MS / PROFILE_SAMPLE_HZ で遅いリクエストのログとプロファイラ)
+instrument_flask(app, "flask_app")
+
+def db_error_response(db_error):
+    """接続プールから接続を取得できなかった場合の共通レスポンス。"""
+    logger.error("❌ データベース接続に失敗しました！エラー: %s", db_error)
+    return jsonify({"message": "❌ サーバー側のデータベース接続エラー", "error_detail": str(db_error)}), 500
+
+# 再送・ダブルタップによる重複登録と重複した Gemini 呼び出しの抑止 (IDEMPOTENCY=0 で無効)
+# 処理中のキーのロックは generate_summary の最大の所要時間 (実行枠の待ち + 再試行を含む上流の呼び出し) より長くする
+idempotency = idempotency_from_env(
+    lock_seconds=gemini_governor.max_wait + gemini_http.max_call_seconds() + 60,
+)
 
-def get_db_connection():
-    """データベース接続を確立し、接続オブジェクトを返します。"""
-    database_url = os.environ.get('DATABASE_URL')
-    
-    if not database_url:
-        print("❌ データベース接続に失敗しました！エラー: DATABASE_URLが設定されていません。")
-        return None, "DATABASE_URLが設定されていません。"
+
+def _idempotent(scope, data, handler):
+    """Idempotency-Key ヘッダー (なければボディのハッシュ) で重複を抑止して handler() を実行します。
+
+    同じキーの成功済みの応答があれば handler() を呼ばずにそれを返します (Idempotent-Replayed: true)。
+    冪等キーの確認でDBエラーが起きた場合は、重複チェックなしで処理します。
+    """
+    if idempotency is None:
+        return handler()
 
     try:
-        # 接続タイムアウトを設定
-        conn = psycopg2.connect(database_url, connect_timeout=5)
-        return conn, None
-    except Exception as e:
-        error_message = f"データベース接続エラー: {e}"
-        print(f"❌ {error_message}")
-        return None, error_message
+        key, request_hash, ttl = idempotency.request_key(request.headers.get('Idempotency-Key'), data)
+        token, replay = idempotency.begin(scope, key, request_hash, ttl)
+    except IdempotencyConflict as conflict:
+        response = jsonify({"message": f"❌ {conflict.message}"})
+        if conflict.retry_after:
+            response.headers["Retry-After"] = str(int(conflict.retry_after))
+        return response, conflict.status
+    except (DBPoolError, psycopg2.Error) as e:
+        logger.warning("⚠️ 冪等キーを確認できないため、重複チェックなしで処理します: %s", e)
+        return handler()
+
+    if replay is not None:
+        status_code, body = replay
+        response = jsonify(body)
+        response.status_code = status_code
+        response.headers["Idempotent-Replayed"] = "true"
+        return response
+
+    succeeded = False
+    try:
+        response = make_response(handler())
+        if 200 <= response.status_code < 300 and response.is_json:
+            # 処理はすでにコミット済み。応答を保存できなくてもキーは解放しない (解放すると再送で重複する)
+            succeeded = True
+            try:
+                idempotency.complete(scope, key, token, response.status_code, response.get_json())
+            except (DBPoolError, psycopg2.Error) as e:
+                logger.warning("⚠️ 冪等キーに応答を保存できませんでした (キーはロックの期限まで処理中のままです): %s", e)
+        return response
+    finally:
+        if not succeeded:
+            # 失敗した場合は、クライアントが再試行できるようにキーを解放する
+            try:
+                idempotency.release(scope, key, token)
+            except (DBPoolError, psycopg2.Error) as e:
+                logger.warning("⚠️ 冪等キーの解放に失敗しました: %s", e)
+
+
+# ダッシュボードの取得方式 (combined: 1往復 / separate: 従来の4クエリ)
+if os.environ.get('DASHBOARD_QUERY_MODE', 'combined') == 'separate':
+    fetch_dashboard = fetch_dashboard_separate
+else:
+    fetch_dashboard = fetch_dashboard_combined
+
+# ダッシュボードのレスポンスキャッシュ
+# - student_booth_cache: メールアドレス -> 正規化済みブースID
+# - dashboard_cache: 正規化済みブースID -> 組み立て済みのダッシュボードデータ (submit_feedback で無効化)
+# CACHE_SHARED_URL を設定すると、無効化が他のワーカープロセスにも伝わります。
+student_booth_cache = cache_from_env('STUDENT_BOOTH_CACHE', maxsize=4096, ttl=300)
+dashboard_cache = cache_from_env('DASHBOARD_CACHE', maxsize=256, ttl=30)
+
+# ページングの1ページあたりの最大件数
+FEEDBACK_PAGE_MAX_LIMIT = 500
+# ストリーミング時にサーバーサイドカーソルから一度に取り出す行数
+FEEDBACK_STREAM_ITERSIZE = 200
+
+
+def _feedback_score(score, is_processed):
+    # 挿入時に本文から算出したスコア (feedback_scorer.py)。採点の導入前の行は is_processed による暫定スコア
+    # ※ 集計トリガーが使う SQL 関数 public.session_score と同じロジックに保つこと
+    if score is not None:
+        return score
+    return 85 if is_processed else 50
+
+
+def _feedback_item(row):
+    """SESSIONS_SQL の1行をレスポンスの feedbacks 要素に変換します。"""
+    session_id, raw_text, summary_text, is_processed, visitor_attribute, praise_ratio, advice_ratio, score = row
+    return {
+        "id": session_id,  # リアルタイム配信 (/api/booths/<booth_id>/events) の行と突き合わせるため
+        "raw_text": raw_text,
+        "summary_text": summary_text,
+        "visitor_attribute": visitor_attribute,
+        "score": _feedback_score(score, is_processed),
+        "is_processed": is_processed,
+        "praise_ratio": praise_ratio,
+        "advice_ratio": advice_ratio
+    }
+
+
+def _average_score(total_count, score_sum):
+    """ブース全体の平均スコア (全フィードバックの平均)。"""
+    if not total_count:
+        return None
+    return round(score_sum / total_count)
+
+
+def _dashboard_body(payload, search_email):
+    """組み立て済みのダッシュボードデータに、閲覧者ごとの is_current_user を付けてレスポンス本体にします。"""
+    team_members_list = []
+    for name, member_email in payload["team_members"]:
+        # 現在ログインしているユーザーを特定するために、メールアドレスを保持
+        is_current_user = (member_email.lower().strip() == search_email)
+        team_members_list.append({
+            "name": name,
+            "email": member_email,
+            "is_current_user": is_current_user
+        })
+    return {**payload, "team_members": team_members_list}
+
+
+def _dashboard_etag(booth_key, total_count, last_session_id, updated_at, team_name, members, total_teams_count,
+                    limit=None, after_id=None):
+    """ブースの件数・最新セッションID・集計の更新時刻と、チーム名・メンバー・全チーム数から弱いETagを作ります。
+
+    要約の完了などで既存行が更新された場合も、集計トリガーが updated_at を進めるため変化します。
+    メンバーの追加・変更やチーム数の変化 (students の更新) でも変化します。
+    """
+    updated = updated_at.timestamp() if updated_at else 0
+    # メンバーの順序はクエリで保証されないため並べ替えてから使う
+    roster = json.dumps(sorted([list(member) for member in members]), ensure_ascii=False)
+    version = (f"{booth_key}|{total_count}|{last_session_id}|{updated}|{team_name}|{roster}|{total_teams_count}"
+               f"|{limit}|{after_id}")
+    return 'W/"' + hashlib.sha1(version.encode("utf-8")).hexdigest()[:20] + '"'
+
+
+def _etag_response(body, etag, status=200):
+    """ETag と再検証を促す Cache-Control を付けたレスポンスを返します。"""
+    with span("json.encode"):
+        response = jsonify(body) if body is not None else Response(status=304)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return response, status
+
+
+def _parse_page_args(args):
+    """クエリパラメータ limit / after_id を検証します。戻り値は (limit, after_id, error)。"""
+    limit = args.get('limit')
+    after_id = args.get('after_id')
+    try:
+        limit = int(limit) if limit not in (None, "") else None
+        after_id = int(after_id) if after_id not in (None, "") else None
+    except ValueError:
+        return None, None, "limit/after_idは整数である必要があります"
+    if limit is not None and not 1 <= limit <= FEEDBACK_PAGE_MAX_LIMIT:
+        return None, None, f"limitは1〜{FEEDBACK_PAGE_MAX_LIMIT}の範囲で指定してください"
+    return limit, after_id, None
+
+
+def _stream_feedbacks(header, booth_key, after_id, limit, stream_format):
+    """サーバーサイド(名前付き)カーソルでセッションを少しずつ取り出し、逐次書き出します。
+
+    stream_format が "ndjson" の場合は1行目にヘッダー(feedbacks以外の項目)、以降1行1件。
+    "json" の場合は通常のレスポンスと同じ形のJSONを、feedbacks配列を分割して書き出します。
+    """
+    if stream_format == "json":
+        yield json.dumps(header, ensure_ascii=False)[:-1] + ', "feedbacks": ['
+    else:
+        yield json.dumps(header, ensure_ascii=False) + "\n"
+
+    try:
+        with db_connection() as conn, conn.cursor(name="feedback_stream") as cursor:
+            cursor.itersize = FEEDBACK_STREAM_ITERSIZE
+            cursor.execute(SESSIONS_SQL, {"booth_id": booth_key, "after_id": after_id, "limit": limit})
+            first = True
+            for row in cursor:
+                item = json.dumps(_feedback_item(row), ensure_ascii=False, default=str)
+                if stream_format == "json":
+                    yield item if first else "," + item
+                else:
+                    yield item + "\n"
+                first = False
+    except (DBPoolError, psycopg2.Error) as e:
+        # ヘッダー送信後はステータスコードを変えられないため、エラーを本文に含める
+        logger.error("❌ フィードバックのストリーミング中にエラーが発生しました: %s", e)
+        error = json.dumps({"error_detail": f"ストリーミングエラー: {e}"}, ensure_ascii=False)
+        yield ("]," + error[1:]) if stream_format == "json" else error + "\n"
+        return
+
+    if stream_format == "json":
+        yield "]}"
+
 
 # =========================================================================
 # 既存のエンドポイント: GET /api/feedback/<email> (全件取得と属性の追加)
@@ -50,275 +262,469 @@ def get_db_connection():
 def get_feedback_by_email(email):
     """
     学生のメールアドレス（students.email）を起点として、所属チームのブースIDに紐づく
-    フィードバックデータ（sessions）をデータベースから**全件**取得します。
+    フィードバックデータ（sessions）をデータベースから取得します。
     また、全チームの総数とチームメンバーリストも同時に取得します。
+
+    クエリパラメータ:
+    - limit / after_id: id の降順でのキーセットページネーション。
+      指定しない場合は従来通り全件を返します。次ページの after_id は next_after_id で返します。
+    - stream=ndjson / stream=json: サーバーサイドカーソルで逐次書き出します (メモリ使用量が一定)。
+
+    ストリーミング以外のレスポンスには ETag を付けます。If-None-Match が一致すれば、
+    セッションを取得せずに 304 を返します。
     """
     search_email = email.lower().strip() 
 
-    print(f"✅ Route matched! Processing GET request for student email: {search_email}") 
-    
-    conn, db_error = get_db_connection()
-    if db_error:
-        return jsonify({"message": "❌ サーバー側のデータベース接続エラー", "error_detail": db_error}), 500
-    
-    cursor = conn.cursor()
+    logger.debug("✅ Route matched! Processing GET request for student email: %s", search_email)
+
+    limit, after_id, page_error = _parse_page_args(request.args)
+    if page_error:
+        return jsonify({"message": "❌ ページング指定が無効です", "error_detail": page_error}), 400
+
+    stream_format = request.args.get('stream')
+    if stream_format not in (None, "ndjson", "json"):
+        return jsonify({"message": "❌ streamの指定が無効です", "error_detail": "streamはndjsonまたはjsonを指定してください"}), 400
     
+    # クライアントが持っているETag (ストリーミング時は使わない)
+    if_none_match = None if stream_format else request.headers.get('If-None-Match')
+
+    # ページングなし・非ストリーミングの全件取得は、ブース単位で組み立て済みのデータをキャッシュする
+    use_cache = limit is None and after_id is None and not stream_format
+    cached_booth_key = student_booth_cache.get(search_email) if use_cache else None
+    cache_generation = None
+    if cached_booth_key is not None:
+        cached = dashboard_cache.get(cached_booth_key)
+        if cached is not None:
+            etag, payload = cached
+            if if_none_match == etag:
+                return _etag_response(None, etag, 304)
+            return _etag_response(_dashboard_body(payload, search_email), etag)
+        # 組み立て前の世代を控えておく (組み立て中に無効化された場合、保存した値は使われない)
+        cache_generation = dashboard_cache.current_generation(cached_booth_key)
+
     try:
-        # 1. チーム名とブースIDを学生テーブルから取得
-        team_info_sql = """
-            SELECT 
-                t.team_name,
-                t.booth_id
-            FROM 
-                public.students t
-            WHERE 
-                TRIM(LOWER(t.email)) = %s;
-        """
-        cursor.execute(team_info_sql, (search_email,))
-        team_result = cursor.fetchone()
-
-        if not team_result:
-            print(f"⚠️ No student found for email: {search_email}. Returning 404.")
+        if if_none_match:
+            # 集計行だけを見てETagを計算し、一致すればセッションを読まずに304を返す
+            with db_connection() as conn, conn.cursor() as cursor:
+                with span("sql.dashboard_version"):
+                    cursor.execute(DASHBOARD_VERSION_SQL, (search_email,))
+                    version = cursor.fetchone()
+            if version:
+                etag = _dashboard_etag(*version, limit=limit, after_id=after_id)
+                if if_none_match == etag:
+                    return _etag_response(None, etag, 304)
+
+        with db_connection() as conn, conn.cursor() as cursor:
+            # チーム情報・メンバー・全チーム数・ブース集計・セッションを取得
+            # (既定ではCTEでまとめた1往復のクエリ。DASHBOARD_QUERY_MODE=separate で従来の方式)
+            # ストリーミング時はセッション本体を名前付きカーソルで別途取得するため、ここでは0件だけ取る
+            dashboard = fetch_dashboard(
+                cursor, search_email,
+                limit=0 if stream_format else limit,
+                after_id=after_id,
+            )
+
+        if not dashboard:
+            logger.info("⚠️ No student found for email: %s. Returning 404.", search_email)
             return jsonify({
                 "message": f"メールアドレス {search_email} に紐づく学生情報が見つかりません。",
                 "score": None
             }), 404
-            
-        team_name, booth_id = team_result
-        
-        # 2. ★★★ 該当チームのメンバーリストを取得 ★★★
-        # team_name でフィルタリングし、全メンバーを取得
-        team_members_sql = """
-            SELECT 
-                s.full_name, 
-                s.email
-            FROM 
-                public.students s
-            WHERE 
-                TRIM(LOWER(s.team_name)) = %s;
-        """
-        # ★★★ 修正: team_name を引数として渡す ★★★
-        cursor.execute(team_members_sql, (team_name.lower().strip(),))
-        member_results = cursor.fetchall()
-
-        team_members_list = []
-        for name, member_email in member_results:
-             # 現在ログインしているユーザーを特定するために、メールアドレスを保持
-            is_current_user = (member_email.lower().strip() == search_email)
-            team_members_list.append({
-                "name": name,
-                "email": member_email,
-                "is_current_user": is_current_user
-            })
-
-        # 3. 全チームの総数を取得
-        total_teams_sql = "SELECT COUNT(DISTINCT team_name) FROM public.students;"
-        cursor.execute(total_teams_sql)
-        total_teams_count = cursor.fetchone()[0] if cursor.rowcount else 0
-
-        # 4. 該当ブースIDの全セッションデータを取得 (visitor_attributeを追加)
-        sessions_sql = """
-            SELECT 
-                s.raw_text, 
-                s.summary_text, 
-                s.is_processed,
-                s.visitor_attribute,
-                s.praise_ratio, 
-                s.advice_ratio
-            FROM 
-                public.sessions s
-            WHERE 
-                TRIM(LOWER(s.booth_id)) = %s 
-            ORDER BY 
-                s.id DESC;
-        """
-        
-        cursor.execute(sessions_sql, (booth_id.lower().strip(),))
-        session_results = cursor.fetchall()
 
-        feedback_list = []
-        total_score = 0
-        
-        for raw_text, summary_text, is_processed, visitor_attribute, praise_ratio, advice_ratio in session_results:
-            # スコアは、is_processedに応じて暫定的に算出
-            # （本来はAI処理で算出すべきだが、現状は仮のロジック）
-            score = 85 if is_processed else 50 
-            total_score += score
-            
-            feedback_list.append({
-                "raw_text": raw_text,
-                "summary_text": summary_text,
-                "visitor_attribute": visitor_attribute,
-                "score": score,
-                "is_processed": is_processed,
-                "praise_ratio": praise_ratio,
-                "advice_ratio": advice_ratio
-            })
-
-        average_score = round(total_score / len(feedback_list)) if feedback_list else None
-        
-        response_data = {
+        team_name, booth_id, member_results, total_teams_count, booth_stats, session_results = dashboard
+        booth_key = booth_id.lower().strip()
+
+        # ブース集計 (booth_stats) から読むため、セッションを走査せずに求まる
+        total_count, _, score_sum, last_session_id, updated_at = booth_stats
+
+        payload = {
             "team_name": team_name,
             "booth_id": booth_id,
-            "total_count": len(feedback_list),
+            "total_count": total_count,
             "total_teams_count": total_teams_count, 
-            "average_score": average_score, # 全フィードバックの平均スコア
-            "team_members": team_members_list, # ★★★ ここで追加 ★★★
-            "feedbacks": feedback_list # 全フィードバックのリスト
+            "average_score": _average_score(total_count, score_sum), # 全フィードバックの平均スコア
+            "team_members": member_results, # is_current_user はレスポンス時に付与
         }
-        
-        if not feedback_list:
-             print(f"⚠️ No feedback data found for team booth: {booth_id}. Returning 200 (No data).")
-             # データがない場合も200で返す（学生情報は取得できているため）
-             return jsonify({
-                "message": f"まだフィードバックがありません。ブースID {booth_id} のフィードバックを収集してください。",
-                "team_name": team_name,
-                "booth_id": booth_id,
-                "total_count": 0,
-                "total_teams_count": total_teams_count, 
-                "average_score": None,
-                "team_members": team_members_list, # ★★★ ここで追加 ★★★
-                "feedbacks": []
-            }), 200
-        
-        return jsonify(response_data), 200
-            
+
+        if not total_count:
+            logger.debug("⚠️ No feedback data found for team booth: %s. Returning 200 (No data).", booth_id)
+            # データがない場合も200で返す（学生情報は取得できているため）
+            payload["message"] = f"まだフィードバックがありません。ブースID {booth_id} のフィードバックを収集してください。"
+            payload["feedbacks"] = []
+
+        elif stream_format:
+            mimetype = "application/x-ndjson" if stream_format == "ndjson" else "application/json"
+            return Response(
+                stream_with_context(_stream_feedbacks(
+                    _dashboard_body(payload, search_email), booth_key, after_id, limit, stream_format
+                )),
+                mimetype=mimetype,
+            ), 200
+
+        else:
+            with span("json.feedback_items"):
+                payload["feedbacks"] = [_feedback_item(row) for row in session_results] # 全フィードバックのリスト
+
+            if limit is not None:
+                # 1ページ分埋まっていれば続きがある可能性がある
+                payload["next_after_id"] = session_results[-1][0] if len(session_results) == limit else None
+
+        etag = _dashboard_etag(booth_key, total_count, last_session_id, updated_at, team_name, member_results,
+                               total_teams_count, limit=limit, after_id=after_id)
+
+        if use_cache:
+            student_booth_cache.set(search_email, booth_key)
+            if cache_generation is not None and booth_key == cached_booth_key:
+                dashboard_cache.set(booth_key, (etag, payload), generation=cache_generation)
+
+        return _etag_response(_dashboard_body(payload, search_email), etag)
+
+    except DBPoolError as pool_err:
+        return db_error_response(pool_err)
+
     except psycopg2.Error as db_err:
-        conn.rollback()
         error_detail = f"データベース検索エラー: {db_err.pgerror}"
-        print(f"❌ {error_detail}")
+        logger.error("❌ %s", error_detail)
         return jsonify({
             "message": "❌ データベース検索中にエラーが発生しました。",
             "error_detail": error_detail
         }), 500
         
     except Exception as e:
-        conn.rollback()
         error_detail = f"予期せぬサーバーエラー: {e}"
-        print(f"❌ {error_detail}")
+        logger.error("❌ %s", error_detail)
         return jsonify({
             "message": "❌ 予期せぬサーバーエラーが発生しました。",
             "error_detail": error_detail
         }), 500
-        
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
 # -------------------------------------------------------------
-# Gemini API呼び出しユーティリティ (共通処理)
+# エンドポイント: GET /api/search (フィードバックの全文検索)
 # -------------------------------------------------------------
-def _call_gemini_api_base(payload, error_prefix):
-    """共通のGemini API呼び出しロジックとエラー処理を扱います。"""
-    API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-09-2025:generateContent"
-    gemini_api_key = os.environ.get('GEMINI_API_KEY')
-    if not gemini_api_key:
-        print("❌ GEMINI_API_KEYが設定されていません。処理をスキップします。")
-        raise Exception("APIキーが設定されていません。")
-
-    headers = {'Content-Type': 'application/json'}
-    
+def _parse_search_args(args):
+    """クエリパラメータ q / sort / limit / offset を検証します。戻り値は (terms, sort, limit, offset, error)。"""
+    terms, error = parse_terms(args.get('q', ''))
+    if error:
+        return None, None, None, None, error
+    sort = args.get('sort') or "relevance"
+    if sort not in SEARCH_ORDERS:
+        return None, None, None, None, f"sortは{'/'.join(SEARCH_ORDERS)}のいずれかを指定してください"
     try:
-        response = requests.post(
-            f"{API_URL}?key={gemini_api_key}", 
-            headers=headers, 
-            json=payload,
-            timeout=30
-        )
-        response.raise_for_status()
-
-        result = response.json()
-        generated_text = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', '')
-        
-        if not generated_text:
-            raise Exception("Gemini APIからの応答テキストが空でした。")
+        limit = int(args.get('limit') or 20)
+        offset = int(args.get('offset') or 0)
+    except ValueError:
+        return None, None, None, None, "limit/offsetは整数である必要があります"
+    if not 1 <= limit <= SEARCH_MAX_LIMIT:
+        return None, None, None, None, f"limitは1〜{SEARCH_MAX_LIMIT}の範囲で指定してください"
+    if not 0 <= offset <= SEARCH_MAX_OFFSET:
+        return None, None, None, None, f"offsetは0〜{SEARCH_MAX_OFFSET}の範囲で指定してください"
+    return terms, sort, limit, offset, None
 
-        print(f"✅ Gemini APIからの応答を受信しました: {error_prefix}")
-        return generated_text
 
-    except requests.exceptions.HTTPError as http_err:
-        status_code = http_err.response.status_code if http_err.response is not None else "Unknown"
-        error_detail = "APIエラー: 詳細不明"
-        try:
-             # エラーメッセージをJSONから抽出
-             error_response = http_err.response.json()
-             error_detail = f"APIエラー: {error_response.get('error', {}).get('message', '詳細不明')} (Status: {status_code})"
-        except:
-             error_detail = http_err.response.text[:100] if http_err.response else "API応答なし"
-        print(f"❌ HTTPエラーが発生しました: {http_err} (Status: {status_code})")
-        raise Exception(error_detail)
-    except requests.exceptions.RequestException as req_err:
-        print(f"❌ リクエストエラーが発生しました: {req_err}")
-        raise Exception(f"ネットワークエラー: {req_err}")
-    except Exception as e:
-        print(f"❌ {error_prefix}エラー: {e}")
-        raise Exception(f"{error_prefix}エラー: {e}")
+@app.route('/api/search', methods=['GET'])
+def search_feedback():
+    """
+    フィードバックの本文・要約を全文検索します (feedback_search.py)。
+
+    クエリパラメータ:
+    - q: 検索語 (空白区切りで AND。全角/半角・大文字/小文字は区別しない)
+    - booth_id / visitor_attribute: 絞り込み (任意)
+    - sort: relevance (既定, 一致度順) / recent (新しい順)
+    - limit / offset: ページング。次ページの offset は next_offset で返します。
+
+    各結果の snippets には一致箇所を含む抜粋と、抜粋内でのハイライト位置 [開始, 終了) が入ります。
+    """
+    terms, sort, limit, offset, search_error = _parse_search_args(request.args)
+    if search_error:
+        return jsonify({"message": "❌ 検索条件が無効です", "error_detail": search_error}), 400
+
+    booth_id = (request.args.get('booth_id') or "").lower().strip() or None
+    visitor_attribute = (request.args.get('visitor_attribute') or "").lower().strip() or None
+
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            total, results = search_feedbacks(
+                cursor, terms,
+                booth_id=booth_id, visitor_attribute=visitor_attribute,
+                sort=sort, limit=limit, offset=offset,
+            )
+    except DBPoolError as pool_err:
+        return db_error_response(pool_err)
+    except psycopg2.Error as db_err:
+        error_detail = f"データベース検索エラー: {db_err.pgerror}"
+        logger.error("❌ %s", error_detail)
+        return jsonify({
+            "message": "❌ データベース検索中にエラーが発生しました。",
+            "error_detail": error_detail
+        }), 500
+
+    next_offset = offset + len(results)
+    return jsonify({
+        "terms": terms,
+        "total": total,
+        "sort": sort,
+        "offset": offset,
+        "next_offset": next_offset if next_offset < total and next_offset <= SEARCH_MAX_OFFSET else None,
+        "results": results,
+    }), 200
 
 # -------------------------------------------------------------
-# STT専用のAPI呼び出し
+# エンドポイント: GET /api/export (フィードバックの一括エクスポート)
 # -------------------------------------------------------------
-def call_gemini_api_for_stt(base64_audio_data, prompt, mime_type):
-    """Base64エンコードされた音声データを受け取り、Gemini APIを呼び出してSTTのみを行います。"""
-    print(f"🚀 Gemini APIに音声データ ({len(base64_audio_data)} bytes) を送信中 (STT専用)...")
-    
-    payload = {
-        "contents": [
-            {
-                "parts": [
-                    {"text": prompt},
-                    {"inlineData": {"mimeType": mime_type, "data": base64_audio_data}}
-                ]
-            }
-        ],
-        "systemInstruction": {
-            "parts": [{"text": "You are a professional transcriber. Accurately transcribe the audio content (STT) in Japanese. Do not add any summary or extra text."}]
-        },
-        "tools": [{"google_search": {} }]
-    }
-    
+EXPORT_CONTENT_TYPES = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+def _stream_export(export_format, filters):
+    started = time.perf_counter()
+    rows = 0
+    written = 0
+    last_id = filters["after_id"]
     try:
-        stt_text = _call_gemini_api_base(payload, "STT")
-        return {"stt_text": stt_text}
-    except Exception as e:
-        # 例外メッセージをSTTエラーとして返す
-        return {"stt_text": f"【STTエラー: {e}】"}
+        # プールの接続はチャンクを読む間だけ借りる (クライアントの受信が遅くても他のリクエストの接続を奪わない)
+        for data, last_id, count in export_chunks(db_connection, export_format, filters):
+            rows += count
+            written += len(data)
+            yield data
+    except (DBPoolError, psycopg2.Error) as e:
+        # 送信を始めた後はステータスを変えられないため、例外で接続を切って途中で終わったことを伝える
+        logger.error("❌ エクスポートが中断されました (%d件, 最後の id %s): %s", rows, last_id, e)
+        raise
+    elapsed = time.perf_counter() - started
+    logger.info("✅ エクスポート完了: %s %d件 %.1fMB (%.1f秒, %.0f件/秒)",
+                export_format, rows, written / 1024 / 1024, elapsed, rows / elapsed if elapsed else 0)
+
+
+@app.route('/api/export', methods=['GET'])
+def export_feedback():
+    """
+    フィードバック (sessions) をチーム名付きで一括エクスポートします (feedback_export.py)。
+
+    クエリパラメータ:
+    - format: csv (既定) / ndjson / parquet (parquet はサーバーに pyarrow が必要)
+    - booth_id / visitor_attribute: 絞り込み (任意)
+    - after_id / until_id: id の範囲 (after_id より大きく until_id 以下)
+
+    id の順にチャンクずつ読んで送るため、件数によらずサーバーのメモリ使用量は一定です。
+    途中で切れた場合は、受け取った最後の行の id を after_id に指定して続きを取得してください。
+    """
+    export_format = request.args.get('format') or "csv"
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"message": "❌ エクスポート条件が無効です",
+                        "error_detail": f"formatは{'/'.join(EXPORT_FORMATS)}のいずれかを指定してください"}), 400
+    try:
+        after_id = int(request.args.get('after_id') or 0)
+        until_id = int(request.args['until_id']) if request.args.get('until_id') else None
+    except ValueError:
+        return jsonify({"message": "❌ エクスポート条件が無効です",
+                        "error_detail": "after_id/until_idは整数である必要があります"}), 400
+    if export_format == "parquet" and not parquet_available():
+        return jsonify({"message": "❌ Parquet 形式は利用できません",
+                        "error_detail": "サーバーに pyarrow がインストールされていません"}), 501
+
+    filters = export_filters(
+        booth_id=request.args.get('booth_id'),
+        visitor_attribute=request.args.get('visitor_attribute'),
+        after_id=after_id,
+        until_id=until_id,
+    )
+    mimetype, extension = EXPORT_CONTENT_TYPES[export_format]
+    response = Response(stream_with_context(_stream_export(export_format, filters)), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f'attachment; filename="sessions.{extension}"'
+    response.headers["Cache-Control"] = "no-store"
+    return response
 
 # -------------------------------------------------------------
-# 要約専用のAPI呼び出し
+# エンドポイント: GET /api/booths/<booth_id>/events (新着フィードバックのリアルタイム配信)
 # -------------------------------------------------------------
-def call_gemini_api_for_summary(raw_text):
-    """テキストを受け取り、Gemini APIを呼び出して要約を行います。"""
-    print("🚀 Gemini APIにテキストを送信中 (要約専用)...")
-    
-    # ここでのpromptはシステム指示ではなく、ユーザーコンテンツとして使用
-    prompt = f"以下のフィードバックテキストを読み、ポジティブな点と改善点を抽出し、30文字以内の簡潔な日本語で要約してください。\n\nテキスト:\n{raw_text}"
-    
-    payload = {
-        "contents": [{"parts": [{"text": prompt}]}],
-        "systemInstruction": {
-            "parts": [{"text": "You are a professional feedback analyst. Summarize the user-provided text in Japanese, focusing on key positive and negative points, strictly under 30 characters. Do not include any introduction or closing phrases."}]
-        },
-        # テキスト処理のためtoolsは省略
+# 接続を保ったまま何も送らない時間の上限 (プロキシに切られないようコメント行を送る)
+FEEDBACK_EVENTS_HEARTBEAT = float(os.environ.get('FEEDBACK_EVENTS_HEARTBEAT', 15))
+
+
+def _load_feedback_event(booth_id, session_ids):
+    """登録・要約された行と更新後の集計を読み、配信するイベントの data を返します。"""
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(FEEDBACK_EVENT_SQL, {"booth_id": booth_id, "session_ids": session_ids})
+        rows = cursor.fetchall()
+    if not rows:
+        return None
+    total_count, score_sum = rows[0][:2]
+    return {
+        "booth_id": booth_id,
+        "total_count": total_count,
+        "average_score": _average_score(total_count, score_sum),
+        "feedbacks": [_feedback_item(row[2:]) for row in rows if row[2] is not None],
     }
-    
+
+
+# submit_feedback のコミット後・要約の完了後に、購読中のダッシュボードへ差分を送る
+feedback_events = event_broker_from_env(_load_feedback_event)
+
+
+def _sse_event(event):
+    """ブローカーのイベントを SSE の1件分の文字列にします (reset は再開位置にしないので id を付けない)。"""
+    lines = f"id: {event['id']}\n" if event["id"] else ""
+    return lines + f"event: {event['type']}\ndata: {json.dumps(event['data'], ensure_ascii=False, default=str)}\n\n"
+
+
+@app.route('/api/booths/<booth_id>/events', methods=['GET'])
+def booth_events(booth_id):
+    """ブースの新着フィードバック (feedback)・要約の完了 (summary) を Server-Sent Events で配信します。
+
+    各イベントの data は登録・更新された行 (feedbacks) と更新後の total_count / average_score です。
+    再接続時は Last-Event-ID ヘッダー (またはクエリパラメータ last_event_id) の次のイベントから送ります。
+    続きを送れない場合は reset イベントを送るので、クライアントは /api/feedback/<email> を取り直してください。
+    """
+    booth_key = booth_id.lower().strip()
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
     try:
-        summary_text = _call_gemini_api_base(payload, "要約")
-        return {"summary_text": summary_text.strip()}
-    except Exception as e:
-        # 例外メッセージを要約エラーとして返す
-        return {"summary_text": f"【要約エラー: {e}】"}
+        subscription = feedback_events.subscribe(booth_key, last_event_id)
+    except TooManySubscribers as e:
+        response = jsonify({"message": "⚠️ 接続数が上限に達しています。しばらくしてから再度お試しください。",
+                            "error_detail": str(e)})
+        response.headers["Retry-After"] = str(int(FEEDBACK_EVENTS_HEARTBEAT))
+        return response, 503
+
+    def generate():
+        try:
+            # 接続直後にヘッダーを送り出し、切断時の再接続間隔も伝える
+            yield f"retry: {int(FEEDBACK_EVENTS_HEARTBEAT * 1000)}\n\n"
+            while True:
+                event = subscription.get(FEEDBACK_EVENTS_HEARTBEAT)
+                yield ": keep-alive\n\n" if event is None else _sse_event(event)
+        finally:
+            # クライアントが切断すると次の書き込みで GeneratorExit になる
+            subscription.close()
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    # 送信を始める前に切断された場合も購読を解除する
+    response.call_on_close(subscription.close)
+    return response
+
+
+@app.route('/api/booths/events/stats', methods=['GET'])
+def booth_events_stats():
+    """リアルタイム配信の購読者数と配信件数を返します。"""
+    return jsonify(feedback_events.stats()), 200
+
 
 # -------------------------------------------------------------
 # エンドポイント: POST /api/process_audio (STTのみを返すように更新)
 # -------------------------------------------------------------
+# 音声アップロードの上限サイズ
+# (Gemini の inlineData はリクエスト全体で約20MBまで。Base64にすると約4/3倍になる)
+MAX_AUDIO_UPLOAD_BYTES = int(os.environ.get('MAX_AUDIO_UPLOAD_BYTES', 14 * 1024 * 1024))
+# これを超える音声はメモリではなく一時ファイルに書き出す
+AUDIO_SPOOL_MAX_MEMORY = 1024 * 1024
+# multipart の境界やフォーム項目のための余裕
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+def _spool_raw_audio(stream, limit):
+    """生バイナリのリクエストボディを少しずつ SpooledTemporaryFile に書き出します。
+
+    上限を超えた場合は None を返します。
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=AUDIO_SPOOL_MAX_MEMORY)
+    total = 0
+    while True:
+        chunk = stream.read(64 * 1024)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > limit:
+            spooled.close()
+            return None
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled
+
+
+def _degraded_response(message, error_detail, retry_after):
+    """サーキットブレーカー作動中、またはレート制限で実行枠を確保できなかった場合の応答 (503 と Retry-After)。"""
+    response = jsonify({"message": message, "error_detail": error_detail, "degraded": True})
+    response.headers["Retry-After"] = str(int(retry_after) + 1)
+    return response, 503
+
+
+def _audio_too_large_response():
+    return jsonify({
+        "message": "❌ 音声データが大きすぎます",
+        "error_detail": f"音声データは {MAX_AUDIO_UPLOAD_BYTES} bytes 以下にしてください"
+    }), 413
+
+
 @app.route('/api/process_audio', methods=['POST'])
 def process_audio():
     """
-    クライアントから送られたBase64エンコードのオーディオデータを受け取り、
+    クライアントから送られたオーディオデータを受け取り、
     Gemini APIでテキスト化（STT）のみを実行します。
+
+    以下の3形式を受け付けます。
+    - multipart/form-data: audio (ファイル), booth_id, mime_type (省略時はファイルのContent-Type)
+    - audio/* などの生バイナリ: booth_id (と任意で mime_type) はクエリパラメータで指定
+    - application/json: audio_data (Base64), mime_type, booth_id (従来の形式)
+    バイナリの2形式は一時ファイルに書き出し、Gemini への送信時にだけBase64へ変換します。
     """
+    if request.mimetype == 'application/json':
+        return _process_audio_json()
+
+    if request.content_length and request.content_length > MAX_AUDIO_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES:
+        return _audio_too_large_response()
+
+    if request.mimetype == 'multipart/form-data':
+        # werkzeug は大きなファイルを自動的に一時ファイルへ書き出す
+        upload = request.files.get('audio')
+        booth_id = request.form.get('booth_id')
+        mime_type = request.form.get('mime_type') or (upload.mimetype if upload else None)
+        audio_file = upload.stream if upload else None
+        if audio_file is not None:
+            audio_file.seek(0, os.SEEK_END)
+            if audio_file.tell() > MAX_AUDIO_UPLOAD_BYTES:
+                return _audio_too_large_response()
+    else:
+        booth_id = request.args.get('booth_id')
+        mime_type = request.args.get('mime_type') or request.mimetype
+        audio_file = _spool_raw_audio(request.stream, MAX_AUDIO_UPLOAD_BYTES)
+        if audio_file is None:
+            return _audio_too_large_response()
+
+    try:
+        if audio_file is None or not mime_type or not booth_id:
+            return jsonify({"message": "❌ 必須データ（audio, mime_type, booth_id）が不足しています"}), 400
+
+        prompt_text = f"ブースID {booth_id} へのフィードバックをテキスト化してください。"
+        gemini_result = call_gemini_api_for_stt_file(audio_file, prompt_text, mime_type)
+        if gemini_result.get("degraded"):
+            return _degraded_response("⚠️ 音声認識サービスが混雑しています。しばらくしてから再度お試しください。",
+                                      gemini_result["stt_text"], gemini_result["retry_after"])
+
+        return jsonify({
+            "message": "✅ 音声処理成功",
+            "stt_text": gemini_result["stt_text"],
+            "preprocess": gemini_result.get("preprocess")
+        }), 200
+
+    except Exception as e:
+        error_detail = f"音声処理中のエラー: {e}"
+        logger.error("❌ %s", error_detail)
+        return jsonify({
+            "message": "❌ サーバーでの音声処理に失敗しました。",
+            "error_detail": error_detail
+        }), 500
+
+    finally:
+        if audio_file is not None:
+            audio_file.close()
+
+
+def _process_audio_json():
+    """従来の形式 (JSON内のBase64文字列) の音声を処理します。"""
     try:
         data = request.json
     except Exception as e:
@@ -336,16 +742,20 @@ def process_audio():
     try:
         # call_gemini_api_for_stt を使用
         gemini_result = call_gemini_api_for_stt(base64_audio, prompt_text, mime_type)
+        if gemini_result.get("degraded"):
+            return _degraded_response("⚠️ 音声認識サービスが混雑しています。しばらくしてから再度お試しください。",
+                                      gemini_result["stt_text"], gemini_result["retry_after"])
         stt_text = gemini_result["stt_text"]
 
         return jsonify({
             "message": "✅ 音声処理成功",
-            "stt_text": stt_text
+            "stt_text": stt_text,
+            "preprocess": gemini_result.get("preprocess")
         }), 200
 
     except Exception as e:
         error_detail = f"音声処理中のエラー: {e}"
-        print(f"❌ {error_detail}")
+        logger.error("❌ %s", error_detail)
         return jsonify({
             "message": "❌ サーバーでの音声処理に失敗しました。",
             "error_detail": error_detail
@@ -365,9 +775,16 @@ def generate_summary():
             
     except Exception as e:
         return jsonify({"message": "❌ 無効なJSONデータ", "error_detail": str(e)}), 400
-        
+
+    return _idempotent("generate_summary", data, lambda: _generate_summary(raw_text))
+
+
+def _generate_summary(raw_text):
     try:
         gemini_result = call_gemini_api_for_summary(raw_text)
+        if gemini_result.get("degraded"):
+            return _degraded_response("⚠️ 要約サービスが混雑しています。しばらくしてから再度お試しください。",
+                                      gemini_result["summary_text"], gemini_result["retry_after"])
         summary_text = gemini_result["summary_text"]
         
         return jsonify({
@@ -377,116 +794,368 @@ def generate_summary():
 
     except Exception as e:
         error_detail = f"要約生成中のエラー: {e}"
-        print(f"❌ {error_detail}")
+        logger.error("❌ %s", error_detail)
         return jsonify({
             "message": "❌ サーバーでの要約生成に失敗しました。",
             "error_detail": error_detail
         }), 500
 
+# -------------------------------------------------------------
+# 要約のバックグラウンドジョブ
+# -------------------------------------------------------------
+def _on_summary_complete(session_id, booth_id):
+    # 要約が保存されたらダッシュボードのキャッシュを無効化し、購読中のダッシュボードに送る
+    dashboard_cache.invalidate(booth_id.lower().strip())
+    feedback_events.announce(booth_id.lower().strip(), "summary", session_id)
+
+
+# リースは要約1件の最大の所要時間 (実行枠の待ち + 再試行を含む上流の呼び出し) より長くする
+summary_queue = queue_from_env(
+    generate_summary_text,
+    on_complete=_on_summary_complete,
+    lease_seconds=gemini_governor.max_wait + gemini_http.max_call_seconds() + 60,
+)
+
+# submit_feedback の書き込みバッファ (FEEDBACK_WRITE_BUFFER=1 で有効。無効なら None)
+feedback_write_buffer = write_buffer_from_env()
+FEEDBACK_BUFFER_WAIT = float(os.environ.get('FEEDBACK_BUFFER_WAIT', 10))
+
+# /api/submit_feedback/bulk で1リクエストに含められる最大件数
+FEEDBACK_BULK_MAX_RECORDS = int(os.environ.get('FEEDBACK_BULK_MAX_RECORDS', 1000))
+
+
+@app.before_request
+def _ensure_summary_workers():
+    # 最初のリクエストで要約ワーカーを起動する (2回目以降は何もしない)
+    # 起動時にリカバリが走り、再起動前に未処理だった行も拾い直される
+    summary_queue.start()
+
+
+def _parse_feedback(data):
+    """submit_feedback のリクエストボディを検証し、保存する値を返します。
+
+    戻り値は (値のdict, None) か、不正な場合は (None, (レスポンスボディ, ステータス))。
+    """
+    booth_id = data.get('booth_id')
+    raw_text = data.get('raw_text')
+    visitor_attribute = data.get('visitor_attribute')
+    summary_text = data.get('summary_text', "") # ★★★ 修正: summary_textを受け取る ★★★
+    
+    try:
+        praise_ratio = data.get('praise_ratio')
+        advice_ratio = data.get('advice_ratio')
+        if praise_ratio is not None:
+            praise_ratio = float(praise_ratio)
+            advice_ratio = float(advice_ratio if advice_ratio is not None else 100 - praise_ratio)
+    except (TypeError, ValueError):
+        return None, ({"message": "❌ 比率データが無効です", "error_detail": "praise_ratio/advice_ratioは数値である必要があります"}, 400)
+
+    if not booth_id or not raw_text or not visitor_attribute:
+        return None, ({"message": "❌ 必須フィールドが不足しています"}, 400)
+
+    if praise_ratio is None:
+        # 割合の指定がなければ本文から算出する (辞書による採点で、Gemini は呼ばない)
+        scored = score_feedback(raw_text)
+        praise_ratio, advice_ratio, score, scorer = (
+            scored["praise_ratio"], scored["advice_ratio"], scored["score"], scored["scorer"])
+    else:
+        score, scorer = score_from_ratio(praise_ratio), "client"
+
+    return {
+        "booth_id": booth_id.lower().strip(),
+        "praise_ratio": praise_ratio,
+        "advice_ratio": advice_ratio,
+        "raw_text": raw_text,
+        "visitor_attribute": visitor_attribute.lower().strip(),
+        "summary_text": summary_text,
+        # summary_textがあれば、is_processedをTrueにする
+        "is_processed": bool(summary_text and summary_text != ""), # ★★★ 修正: summary_textがあればTrueにする ★★★
+        "score": score,
+        "scorer": scorer,
+    }, None
+
+
+def _after_feedback_insert(inserted_id, feedback, invalidate_cache=True):
+    """挿入後の共通処理 (キャッシュの無効化・リアルタイム配信・要約ジョブの投入) を行い、レスポンスボディを返します。
+
+    まとめて挿入した場合は、呼び出し側でブースごとに1回だけ無効化して invalidate_cache=False にします。
+    """
+    # 該当ブースのダッシュボードキャッシュを無効化
+    if invalidate_cache:
+        dashboard_cache.invalidate(feedback["booth_id"])
+    feedback_events.announce(feedback["booth_id"], "feedback", inserted_id)
+
+    response_data = {
+        "message": "✅ Supabaseへのデータ挿入に成功しました。", 
+        "status": "success",
+        "inserted_id": inserted_id
+    }
+
+    if not feedback["is_processed"]:
+        # 要約がない場合はバックグラウンドで生成する (キューが満杯でもリカバリで後から処理される)
+        summary_queue.submit(inserted_id)
+        response_data["summary_job"] = {
+            "status": "queued",
+            "status_url": f"/api/summary_jobs/{inserted_id}"
+        }
+    return response_data
+
+
+def _insert_feedback(feedback):
+    """1件を挿入して id を返します。書き込みバッファが有効ならまとめ書き込みのコミットを待ちます。"""
+    if feedback_write_buffer is not None:
+        pending = feedback_write_buffer.submit(feedback)
+        if pending is not None:
+            with span("db.write_buffer_wait"):
+                return pending.wait(FEEDBACK_BUFFER_WAIT)
+        # バッファが満杯のときは直接挿入する
+
+    with db_connection() as conn, conn.cursor() as cursor:
+        # 列の順は feedback_ingest.SESSION_COLUMNS (summary_text / is_processed / score を含む)
+        with span("sql.insert_session"):
+            cursor.execute(INSERT_SESSION_SQL, session_row(feedback))
+            inserted_id = cursor.fetchone()[0]
+            conn.commit()
+    return inserted_id
+
+
 # =========================================================================
 # 既存のエンドポイント: POST /api/submit_feedback (要約を受け付けて保存するように更新)
 # =========================================================================
 @app.route('/api/submit_feedback', methods=['POST'])
 def submit_feedback():
     """クライアントから受け取った評価データをSupabaseに挿入します。"""
-    
-    conn, db_error = get_db_connection()
-    if db_error:
-        return jsonify({"message": "❌ サーバー側のデータベース接続エラー", "error_detail": db_error}), 500
 
     try:
         data = request.json
     except Exception as e:
-        conn.close()
         return jsonify({"message": "❌ 無効なJSONデータ", "error_detail": str(e)}), 400
 
     if not data:
-        conn.close()
         return jsonify({"message": "❌ リクエストボディが空です"}), 400
 
-    booth_id = data.get('booth_id')
-    raw_text = data.get('raw_text')
-    visitor_attribute = data.get('visitor_attribute')
-    summary_text = data.get('summary_text', "") # ★★★ 修正: summary_textを受け取る ★★★
-    
-    try:
-        praise_ratio = float(data.get('praise_ratio', 0))
-        advice_ratio = float(data.get('advice_ratio', 0))
-    except ValueError:
-        conn.close()
-        return jsonify({"message": "❌ 比率データが無効です", "error_detail": "praise_ratio/advice_ratioは数値である必要があります"}), 400
+    feedback, error = _parse_feedback(data)
+    if error:
+        return jsonify(error[0]), error[1]
 
-    if not booth_id or not raw_text or not visitor_attribute:
-        conn.close()
-        return jsonify({"message": "❌ 必須フィールドが不足しています"}), 400
+    return _idempotent("submit_feedback", data, lambda: _submit_feedback(feedback))
 
-    # summary_textがあれば、is_processedをTrueにする
-    is_processed = bool(summary_text and summary_text != "") # ★★★ 修正: summary_textがあればTrueにする ★★★
 
-    cursor = conn.cursor()
-    inserted_id = None
-    
+def _submit_feedback(feedback):
     try:
-        sql = """
-            INSERT INTO public.sessions
-            (booth_id, praise_ratio, advice_ratio, raw_text, visitor_attribute, summary_text, is_processed) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            RETURNING id;
-        """
-        
-        params = (
-            booth_id.lower().strip(), 
-            praise_ratio, 
-            advice_ratio, 
-            raw_text, 
-            visitor_attribute.lower().strip(), 
-            summary_text,  # ★★★ 修正: 受け取ったsummary_textを保存 ★★★
-            is_processed   # ★★★ 修正: is_processedを更新 ★★★
-        )
-        
-        cursor.execute(sql, params)
-        
-        inserted_id = cursor.fetchone()[0]
-        
-        conn.commit()
-        
-        return jsonify({
-            "message": "✅ Supabaseへのデータ挿入に成功しました。", 
-            "status": "success",
-            "inserted_id": inserted_id
-        }), 201
+        inserted_id = _insert_feedback(feedback)
+        return jsonify(_after_feedback_insert(inserted_id, feedback)), 201
+
+    except DBPoolError as pool_err:
+        return db_error_response(pool_err)
 
     except psycopg2.Error as db_err:
-        conn.rollback()
         error_detail = f"データベースエラー: {db_err.pgerror}"
-        print(f"❌ {error_detail}")
+        logger.error("❌ %s", error_detail)
         return jsonify({
             "message": "❌ データベースへの挿入中にエラーが発生しました。",
             "error_detail": error_detail
         }), 500
         
     except Exception as e:
-        conn.rollback()
         error_detail = f"予期せぬサーバーエラー: {e}"
-        print(f"❌ {error_detail}")
+        logger.error("❌ %s", error_detail)
         return jsonify({
             "message": "❌ 予期せぬサーバーエラーが発生しました。",
             "error_detail": error_detail
         }), 500
-        
-    finally:
-        cursor.close()
-        conn.close()
+
+
+# -------------------------------------------------------------
+# エンドポイント: POST /api/submit_feedback/bulk (オフライン中に貯めた送信の一括登録)
+# -------------------------------------------------------------
+@app.route('/api/submit_feedback/bulk', methods=['POST'])
+def submit_feedback_bulk():
+    """評価データの配列を submit_feedback と同じ規則で検証し、1トランザクションでまとめて挿入します。
+
+    ボディは配列か {"records": [...]}。結果は入力と同じ順の results に、行ごとの inserted_id かエラーを返します。
+    全件成功なら 201、一部失敗なら 207、1件も挿入できなければ 400 です。
+    """
+    try:
+        data = request.json
+    except Exception as e:
+        return jsonify({"message": "❌ 無効なJSONデータ", "error_detail": str(e)}), 400
+
+    records = data.get('records') if isinstance(data, dict) else data
+    if not isinstance(records, list) or not records:
+        return jsonify({"message": "❌ records (評価データの配列) が必要です"}), 400
+    if len(records) > FEEDBACK_BULK_MAX_RECORDS:
+        return jsonify({"message": f"❌ 一度に送信できるのは {FEEDBACK_BULK_MAX_RECORDS} 件までです"}), 413
+
+    return _idempotent("submit_feedback_bulk", records, lambda: _submit_feedback_bulk(records))
+
+
+def _submit_feedback_bulk(records):
+    results = [None] * len(records)
+    valid = []  # (入力の位置, 検証済みの値)
+    for index, record in enumerate(records):
+        feedback, error = _parse_feedback(record) if isinstance(record, dict) else (
+            None, ({"message": "❌ 評価データはオブジェクトである必要があります"}, 400))
+        if error:
+            results[index] = {"index": index, "status": "error", **error[0]}
+        else:
+            valid.append((index, feedback))
+
+    try:
+        if valid:
+            with db_connection() as conn:
+                inserted = insert_feedbacks(conn, [feedback for _, feedback in valid])
+        else:
+            inserted = []
+    except DBPoolError as pool_err:
+        return db_error_response(pool_err)
+    except psycopg2.Error as db_err:
+        error_detail = f"データベースエラー: {db_err.pgerror}"
+        logger.error("❌ %s", error_detail)
+        return jsonify({
+            "message": "❌ データベースへの挿入中にエラーが発生しました。",
+            "error_detail": error_detail
+        }), 500
+
+    # ダッシュボードのキャッシュはブースごとに1回だけ無効化する
+    for booth_id in {feedback["booth_id"] for (_, feedback), (inserted_id, _) in zip(valid, inserted) if inserted_id}:
+        dashboard_cache.invalidate(booth_id)
+
+    for (index, feedback), (inserted_id, db_err) in zip(valid, inserted):
+        if db_err is not None:
+            results[index] = {"index": index, "status": "error", "message": "❌ データベースへの挿入中にエラーが発生しました。",
+                              "error_detail": f"データベースエラー: {getattr(db_err, 'pgerror', None) or db_err}"}
+        else:
+            results[index] = {"index": index, **_after_feedback_insert(inserted_id, feedback, invalidate_cache=False)}
+
+    inserted_count = sum(1 for result in results if result.get("inserted_id"))
+    failed_count = len(results) - inserted_count
+    status = 201 if not failed_count else (207 if inserted_count else 400)
+    return jsonify({
+        "message": f"✅ {inserted_count}件を挿入しました。" + (f" ({failed_count}件はエラー)" if failed_count else ""),
+        "inserted": inserted_count,
+        "failed": failed_count,
+        "results": results,
+    }), status
+
+
+# -------------------------------------------------------------
+# エンドポイント: GET /api/idempotency/stats (冪等キーの統計)
+# -------------------------------------------------------------
+@app.route('/api/idempotency/stats', methods=['GET'])
+def idempotency_stats():
+    if idempotency is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **idempotency.stats()}), 200
+
+
+# -------------------------------------------------------------
+# エンドポイント: GET /api/feedback_buffer/stats (書き込みバッファの統計)
+# -------------------------------------------------------------
+@app.route('/api/feedback_buffer/stats', methods=['GET'])
+def feedback_buffer_stats():
+    if feedback_write_buffer is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **feedback_write_buffer.stats()}), 200
+
+
+# -------------------------------------------------------------
+# エンドポイント: GET /api/summary_jobs/<session_id> (要約ジョブの状態)
+# -------------------------------------------------------------
+@app.route('/api/summary_jobs/<int:session_id>', methods=['GET'])
+def summary_job_status(session_id):
+    """要約ジョブの状態 (queued/running/retrying/pending/done/failed) を返します。"""
+    try:
+        job = summary_queue.status(session_id)
+    except DBPoolError as pool_err:
+        return db_error_response(pool_err)
+    except psycopg2.Error as db_err:
+        return jsonify({"message": "❌ ジョブ状態の取得に失敗しました。", "error_detail": str(db_err)}), 500
+
+    if job is None:
+        return jsonify({"message": f"セッション {session_id} が見つかりません。"}), 404
+    return jsonify(job), 200
+
+
+@app.route('/api/summary_jobs/stats', methods=['GET'])
+def summary_job_stats():
+    """要約ワーカーのキュー長と処理件数を返します。"""
+    return jsonify(summary_queue.stats()), 200
+
+
+# -------------------------------------------------------------
+# エンドポイント: GET /api/gemini_cache/stats (Gemini 応答キャッシュの統計)
+# -------------------------------------------------------------
+@app.route('/api/gemini_cache/stats', methods=['GET'])
+def gemini_cache_stats():
+    """Gemini 応答キャッシュのヒット率と節約できた上流の待ち時間を返します。"""
+    return jsonify(gemini_response_cache.stats()), 200
+
+
+# -------------------------------------------------------------
+# エンドポイント: GET /api/gemini_http/stats (上流呼び出しの統計)
+# -------------------------------------------------------------
+@app.route('/api/gemini_http/stats', methods=['GET'])
+def gemini_http_stats():
+    """Gemini 呼び出しの所要時間・再試行回数・サーキットブレーカーの状態を返します。"""
+    return jsonify(gemini_http.stats()), 200
+
+
+# -------------------------------------------------------------
+# エンドポイント: GET /api/gemini_limits/stats (レート制限の待ち時間)
+# -------------------------------------------------------------
+@app.route('/api/gemini_limits/stats', methods=['GET'])
+def gemini_limits_stats():
+    """モデル・エンドポイントごとの実行枠の待ち時間・待ち件数・タイムアウト数を返します。"""
+    return jsonify(gemini_governor.stats()), 200
+
+
+# -------------------------------------------------------------
+# エンドポイント: GET /api/db_pool/stats (コネクションプールの統計)
+# -------------------------------------------------------------
+@app.route('/api/db_pool/stats', methods=['GET'])
+def db_pool_stats():
+    """コネクションプールの待ち時間と使用率を返します。"""
+    try:
+        return jsonify(get_pool().stats()), 200
+    except DBPoolError as pool_err:
+        return db_error_response(pool_err)
+
+
+# -------------------------------------------------------------
+# エンドポイント: GET /api/cache/stats (レスポンスキャッシュの統計)
+# -------------------------------------------------------------
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """ダッシュボードキャッシュのヒット/ミス/追い出し回数を返します。"""
+    return jsonify({
+        "dashboard": dashboard_cache.stats(),
+        "student_booth": student_booth_cache.stats(),
+    }), 200
+
+
+# /metrics に既存の統計もゲージとして出す
+registry.add_collector("db_pool", lambda: get_pool().stats())
+registry.add_collector("dashboard_cache", dashboard_cache.stats)
+registry.add_collector("student_booth_cache", student_booth_cache.stats)
+registry.add_collector("gemini_cache", gemini_response_cache.stats)
+registry.add_collector("gemini_http", gemini_http.stats)
+registry.add_collector("summary_jobs", summary_queue.stats)
+registry.add_collector("feedback_events", feedback_events.stats)
+if idempotency is not None:
+    registry.add_collector("idempotency", idempotency.stats)
+if feedback_write_buffer is not None:
+    registry.add_collector("feedback_buffer", feedback_write_buffer.stats)
 
 
 if __name__ == '__main__':
-    # 接続テストと実行
-    test_conn, test_error = get_db_connection()
-    if test_conn:
-        print("✅ 起動前にデータベース接続テストに成功しました。")
-        test_conn.close()
-    else:
-        print(f"⚠️ データベース接続テストに失敗しました。{test_error}")
-        print("⚠️ .envファイルに正しいDATABASE_URLが設定されているか確認してください。")
+    # 接続テストと実行 (プールの初期接続を張っておく)
+    try:
+        with db_connection():
+            pass
+        logger.info("✅ 起動前にデータベース接続テストに成功しました。")
+    except DBPoolError as test_error:
+        logger.warning("⚠️ データベース接続テストに失敗しました。%s", test_error)
+        logger.warning("⚠️ .envファイルに正しいDATABASE_URLが設定されているか確認してください。")
         
-    app.run(port=5000, debug=True)
\ No newline at end of file
+    app.run(port=5000, debug=True)
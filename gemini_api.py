@@ -0,0 +1,308 @@
+import os
+import io
+import json
+import base64
+import requests
+
+from app_logging import get_logger
+from audio_preprocess import preprocess_audio, preprocess_enabled
+from gemini_cache import request_key, response_cache_from_env
+from http_client import CircuitOpenError, client_from_env
+from metrics import observe_size, span
+from rate_limit import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, RateLimitTimeout, governor_from_env
+
+# -------------------------------------------------------------
+# Gemini API呼び出しユーティリティ (共通処理)
+# -------------------------------------------------------------
+# flask_app.py のエンドポイントと、batch_summary.py などのCLIの両方から使います。
+
+logger = get_logger("gemini_api")
+
+# Gemini 応答のキャッシュ (GEMINI_CACHE_* で設定)
+gemini_response_cache = response_cache_from_env()
+
+# 接続を再利用し、再試行とサーキットブレーカーを備えたクライアント (GEMINI_HTTP_* / GEMINI_BREAKER_* で設定)
+gemini_http = client_from_env()
+
+# モデル・エンドポイントごとのレート制限と同時実行数の上限 (GEMINI_RATE_LIMITS などで設定)
+# 実行枠は gemini_http の呼び出し (再試行を含む) の間ずっと持つため、リースはその最大の所要時間より長くする
+gemini_governor = governor_from_env(lease_seconds=gemini_http.max_call_seconds() + 60)
+
+# 上流を呼ばずに「混雑中」として扱う例外 (呼び出し側は 503 と Retry-After を返す)
+UPSTREAM_UNAVAILABLE_ERRORS = (CircuitOpenError, RateLimitTimeout)
+
+# GEMINI_API_URL でローカルのフェイクサーバーなどに差し替え可能
+GEMINI_API_URL = os.environ.get(
+    'GEMINI_API_URL',
+    "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-09-2025:generateContent"
+)
+
+
+class _InlineAudioJSONBody:
+    """generateContent のJSONボディを、音声ファイルをBase64に変換しながら少しずつ書き出します。
+
+    音声全体のBase64文字列やペイロードのdictをメモリ上に作らずに済みます。
+    何度でもイテレートできるため、再送時にも使えます。
+    """
+    PLACEHOLDER = "__INLINE_AUDIO_DATA__"
+    # 3の倍数で区切れば、チャンクごとのBase64をそのまま連結できる
+    CHUNK_SIZE = 3 * 64 * 1024
+
+    def __init__(self, payload, audio_file):
+        prefix, suffix = json.dumps(payload).split(self.PLACEHOLDER)
+        self.prefix = prefix.encode("utf-8")
+        self.suffix = suffix.encode("utf-8")
+        self.audio_file = audio_file
+
+    def __iter__(self):
+        yield self.prefix
+        self.audio_file.seek(0)
+        while True:
+            chunk = self.audio_file.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            yield base64.b64encode(chunk)
+        yield self.suffix
+
+
+def _model_name(api_url):
+    """.../models/<model>:generateContent からモデル名を取り出します。"""
+    return api_url.rsplit("/models/", 1)[-1].split(":", 1)[0]
+
+
+def call_gemini_api_base(payload, error_prefix, endpoint="summary", priority=PRIORITY_BACKGROUND):
+    """共通のGemini API呼び出しロジックとエラー処理を扱います。
+
+    payload は dict (JSONとして送信) か、_InlineAudioJSONBody のようなバイト列のイテラブル。
+    endpoint と priority はレート制限の単位と待ち行列での優先度です (キャッシュヒット時は消費しません)。
+    """
+    API_URL = GEMINI_API_URL
+    gemini_api_key = os.environ.get('GEMINI_API_KEY')
+    if not gemini_api_key:
+        logger.error("❌ GEMINI_API_KEYが設定されていません。処理をスキップします。")
+        raise Exception("APIキーが設定されていません。")
+
+    # 同じリクエスト (プロンプト・システム指示・モデル・入力データ) の応答はキャッシュから返す
+    key = request_key(API_URL, payload)
+
+    def call():
+        with gemini_governor.slot(_model_name(API_URL), endpoint, priority), span(f"gemini.{endpoint}"):
+            return _post_gemini(API_URL, gemini_api_key, payload, error_prefix)
+
+    return gemini_response_cache.get_or_call(key, call)
+
+
+def _response_text(result):
+    """generateContent の応答JSONから最初の候補のテキストを取り出します。"""
+    generated_text = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', '')
+    if not generated_text:
+        raise Exception("Gemini APIからの応答テキストが空でした。")
+    return generated_text
+
+
+def _http_error_detail(response):
+    """エラー応答 (requests / httpx の Response) からエラーメッセージを作ります。"""
+    if response is None:
+        return "API応答なし"
+    try:
+        # エラーメッセージをJSONから抽出
+        error_response = response.json()
+        return f"APIエラー: {error_response.get('error', {}).get('message', '詳細不明')} (Status: {response.status_code})"
+    except Exception:
+        return response.text[:100]
+
+
+def _request_size(response):
+    """送信したボディのバイト数 (チャンク転送で分からない場合は None)。"""
+    content_length = response.request.headers.get("Content-Length") if response.request is not None else None
+    return int(content_length) if content_length else None
+
+
+def _post_gemini(API_URL, gemini_api_key, payload, error_prefix):
+    """Gemini API に1回リクエストし、応答テキストを返します。"""
+    headers = {'Content-Type': 'application/json'}
+    
+    try:
+        # 429/5xx とネットワークエラーは gemini_http の中で再試行される
+        response = gemini_http.post(
+            f"{API_URL}?key={gemini_api_key}", 
+            headers=headers, 
+            **({"json": payload} if isinstance(payload, dict) else {"data": payload})
+        )
+        observe_size("gemini.request", _request_size(response))
+        observe_size("gemini.response", len(response.content))
+        response.raise_for_status()
+
+        generated_text = _response_text(response.json())
+        logger.debug("✅ Gemini APIからの応答を受信しました: %s", error_prefix)
+        return generated_text
+
+    except UPSTREAM_UNAVAILABLE_ERRORS:
+        # 呼び出し側で「混雑中」の応答を返せるよう、そのまま伝える
+        raise
+    except requests.exceptions.HTTPError as http_err:
+        status_code = http_err.response.status_code if http_err.response is not None else "Unknown"
+        logger.error("❌ HTTPエラーが発生しました: %s (Status: %s)", http_err, status_code)
+        raise Exception(_http_error_detail(http_err.response))
+    except requests.exceptions.RequestException as req_err:
+        logger.error("❌ リクエストエラーが発生しました: %s", req_err)
+        raise Exception(f"ネットワークエラー: {req_err}")
+    except Exception as e:
+        logger.error("❌ %sエラー: %s", error_prefix, e)
+        raise Exception(f"{error_prefix}エラー: {e}")
+
+# -------------------------------------------------------------
+# STT専用のAPI呼び出し
+# -------------------------------------------------------------
+def _stt_payload(prompt, mime_type, audio_data):
+    """STT用の generateContent ペイロードを組み立てます。"""
+    return {
+        "contents": [
+            {
+                "parts": [
+                    {"text": prompt},
+                    {"inlineData": {"mimeType": mime_type, "data": audio_data}}
+                ]
+            }
+        ],
+        "systemInstruction": {
+            "parts": [{"text": "You are a professional transcriber. Accurately transcribe the audio content (STT) in Japanese. Do not add any summary or extra text."}]
+        },
+        "tools": [{"google_search": {} }]
+    }
+
+
+def _preprocess_base64_audio(base64_audio_data, mime_type):
+    """無音除去・16kHzモノラル化した音声に差し替えます。戻り値は (Base64音声, MIMEタイプ, 削減量のレポート)。
+
+    前処理できない場合は元の音声をそのまま返します (レポートは None)。
+    """
+    if not preprocess_enabled():
+        return base64_audio_data, mime_type, None
+    with span("audio.preprocess"):
+        processed = preprocess_audio(base64.b64decode(base64_audio_data))
+    if processed is None:
+        return base64_audio_data, mime_type, None
+    return base64.b64encode(processed.data).decode("ascii"), processed.mime_type, processed.report()
+
+
+def _preprocess_audio_file(audio_file, mime_type):
+    """_preprocess_base64_audio() のファイル版。戻り値は (音声ファイル, MIMEタイプ, レポート)。"""
+    with span("audio.preprocess"):
+        processed = preprocess_audio(audio_file)
+    if processed is None:
+        return audio_file, mime_type, None
+    return io.BytesIO(processed.data), processed.mime_type, processed.report()
+
+
+def _stt_result(stt_text, preprocess_report):
+    result = {"stt_text": stt_text}
+    if preprocess_report is not None:
+        result["preprocess"] = preprocess_report
+    return result
+
+
+def call_gemini_api_for_stt(base64_audio_data, prompt, mime_type):
+    """Base64エンコードされた音声データを受け取り、Gemini APIを呼び出してSTTのみを行います。"""
+    base64_audio_data, mime_type, preprocess_report = _preprocess_base64_audio(base64_audio_data, mime_type)
+    logger.debug("🚀 Gemini APIに音声データ (%d bytes) を送信中 (STT専用)...", len(base64_audio_data))
+    observe_size("stt.audio", len(base64_audio_data) * 3 // 4)
+    
+    payload = _stt_payload(prompt, mime_type, base64_audio_data)
+    
+    try:
+        stt_text = call_gemini_api_base(payload, "STT", endpoint="stt", priority=PRIORITY_INTERACTIVE)
+        return _stt_result(stt_text, preprocess_report)
+    except UPSTREAM_UNAVAILABLE_ERRORS as e:
+        return {"stt_text": f"【STTエラー: {e}】", "degraded": True, "retry_after": e.retry_after}
+    except Exception as e:
+        # 例外メッセージをSTTエラーとして返す
+        return {"stt_text": f"【STTエラー: {e}】"}
+
+
+def call_gemini_api_for_stt_file(audio_file, prompt, mime_type):
+    """音声ファイル(バイナリ)を受け取り、Base64変換しながら送信してSTTのみを行います。"""
+    audio_file, mime_type, preprocess_report = _preprocess_audio_file(audio_file, mime_type)
+    audio_file.seek(0, os.SEEK_END)
+    logger.debug("🚀 Gemini APIに音声データ (%d bytes, バイナリ) を送信中 (STT専用)...", audio_file.tell())
+    observe_size("stt.audio", audio_file.tell())
+
+    body = _InlineAudioJSONBody(_stt_payload(prompt, mime_type, _InlineAudioJSONBody.PLACEHOLDER), audio_file)
+
+    try:
+        stt_text = call_gemini_api_base(body, "STT", endpoint="stt", priority=PRIORITY_INTERACTIVE)
+        return _stt_result(stt_text, preprocess_report)
+    except UPSTREAM_UNAVAILABLE_ERRORS as e:
+        return {"stt_text": f"【STTエラー: {e}】", "degraded": True, "retry_after": e.retry_after}
+    except Exception as e:
+        # 例外メッセージをSTTエラーとして返す
+        return {"stt_text": f"【STTエラー: {e}】"}
+
+# -------------------------------------------------------------
+# 要約専用のAPI呼び出し
+# -------------------------------------------------------------
+def _summary_payload(raw_text):
+    """要約用の generateContent ペイロードを組み立てます。"""
+    # ここでのpromptはシステム指示ではなく、ユーザーコンテンツとして使用
+    prompt = f"以下のフィードバックテキストを読み、ポジティブな点と改善点を抽出し、30文字以内の簡潔な日本語で要約してください。\n\nテキスト:\n{raw_text}"
+    
+    payload = {
+        "contents": [{"parts": [{"text": prompt}]}],
+        "systemInstruction": {
+            "parts": [{"text": "You are a professional feedback analyst. Summarize the user-provided text in Japanese, focusing on key positive and negative points, strictly under 30 characters. Do not include any introduction or closing phrases."}]
+        },
+        # テキスト処理のためtoolsは省略
+    }
+    return payload
+
+
+def generate_summary_text(raw_text):
+    """テキストを受け取り、Gemini APIで要約した文字列を返します。失敗時は例外を投げます。"""
+    logger.debug("🚀 Gemini APIにテキストを送信中 (要約専用)...")
+    return call_gemini_api_base(_summary_payload(raw_text), "要約").strip()
+
+
+def call_gemini_api_for_summary(raw_text):
+    """テキストを受け取り、Gemini APIを呼び出して要約を行います。"""
+    try:
+        return {"summary_text": generate_summary_text(raw_text)}
+    except UPSTREAM_UNAVAILABLE_ERRORS as e:
+        return {"summary_text": f"【要約エラー: {e}】", "degraded": True, "retry_after": e.retry_after}
+    except Exception as e:
+        # 例外メッセージを要約エラーとして返す
+        return {"summary_text": f"【要約エラー: {e}】"}
+
+
+# -------------------------------------------------------------
+# 褒め/アドバイスの割合の補正 (任意。feedback_scorer.py rescore --refine から使用)
+# -------------------------------------------------------------
+def _ratio_payload(raw_text):
+    """褒め/アドバイスの割合を JSON で返させる generateContent ペイロードを組み立てます。"""
+    prompt = ("以下のブース来場者のフィードバックについて、褒めている内容 (praise_ratio) と改善の提案 (advice_ratio) の"
+              f"割合を、合計が100になる0〜100の整数で答えてください。\n\nテキスト:\n{raw_text}")
+    return {
+        "contents": [{"parts": [{"text": prompt}]}],
+        "generationConfig": {
+            "responseMimeType": "application/json",
+            "responseSchema": {
+                "type": "OBJECT",
+                "properties": {
+                    "praise_ratio": {"type": "INTEGER"},
+                    "advice_ratio": {"type": "INTEGER"},
+                },
+                "required": ["praise_ratio", "advice_ratio"],
+            },
+        },
+    }
+
+
+def generate_ratio_scores(raw_text):
+    """Gemini で (praise_ratio, advice_ratio) を求めます (合計100に正規化)。失敗時は例外を投げます。"""
+    result = json.loads(call_gemini_api_base(_ratio_payload(raw_text), "割合の評価", endpoint="score"))
+    praise_ratio = max(float(result["praise_ratio"]), 0.0)
+    advice_ratio = max(float(result["advice_ratio"]), 0.0)
+    total = praise_ratio + advice_ratio
+    if not total:
+        return 50.0, 50.0
+    praise_ratio = round(100 * praise_ratio / total, 1)
+    return praise_ratio, round(100 - praise_ratio, 1)
@@ -0,0 +1,134 @@
+import os
+import asyncio
+
+import aiohttp
+
+from gemini_api import (
+    GEMINI_API_URL,
+    UPSTREAM_UNAVAILABLE_ERRORS,
+    _InlineAudioJSONBody,
+    _http_error_detail,
+    _model_name,
+    _preprocess_audio_file,
+    _preprocess_base64_audio,
+    _response_text,
+    _stt_result,
+    _stt_payload,
+    _summary_payload,
+    gemini_governor,
+    gemini_http,
+    gemini_response_cache,
+)
+from app_logging import get_logger
+from gemini_cache import request_key
+from http_client import AsyncResilientHTTPClient, HTTPStatusError, client_from_env
+from rate_limit import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+
+logger = get_logger("gemini_api_async")
+
+# -------------------------------------------------------------
+# Gemini API呼び出しユーティリティ (asyncio 版、asgi_app.py で使用)
+# -------------------------------------------------------------
+# 応答キャッシュ・レート制限・サーキットブレーカーは gemini_api.py の同期版と共有します。
+# 上流の応答を待つ間はイベントループに制御を返すため、1プロセスで多数の呼び出しを同時に待てます。
+
+gemini_async_http = client_from_env(AsyncResilientHTTPClient, breaker=gemini_http.breaker)
+
+
+class _AsyncBody:
+    """バイト列のイテラブル (_InlineAudioJSONBody など) を aiohttp 用の非同期イテラブルにします。
+
+    再送時に先頭から読み直せるよう、イテレートのたびに元のイテラブルを iter() し直します。
+    """
+
+    def __init__(self, body):
+        self.body = body
+
+    async def __aiter__(self):
+        for chunk in self.body:
+            yield chunk
+
+
+async def acall_gemini_api_base(payload, error_prefix, endpoint="summary", priority=PRIORITY_BACKGROUND):
+    """call_gemini_api_base() の asyncio 版。"""
+    API_URL = GEMINI_API_URL
+    gemini_api_key = os.environ.get('GEMINI_API_KEY')
+    if not gemini_api_key:
+        logger.error("❌ GEMINI_API_KEYが設定されていません。処理をスキップします。")
+        raise Exception("APIキーが設定されていません。")
+
+    key = request_key(API_URL, payload)
+
+    async def call():
+        async with gemini_governor.aslot(_model_name(API_URL), endpoint, priority):
+            return await _apost_gemini(API_URL, gemini_api_key, payload, error_prefix)
+
+    return await gemini_response_cache.aget_or_call(key, call)
+
+
+async def _apost_gemini(API_URL, gemini_api_key, payload, error_prefix):
+    """Gemini API に1回リクエストし、応答テキストを返します。"""
+    headers = {'Content-Type': 'application/json'}
+
+    try:
+        response = await gemini_async_http.apost(
+            f"{API_URL}?key={gemini_api_key}",
+            headers=headers,
+            **({"json": payload} if isinstance(payload, dict) else {"data": _AsyncBody(payload)})
+        )
+        response.raise_for_status()
+
+        generated_text = _response_text(response.json())
+        logger.debug("✅ Gemini APIからの応答を受信しました: %s", error_prefix)
+        return generated_text
+
+    except UPSTREAM_UNAVAILABLE_ERRORS:
+        raise
+    except HTTPStatusError as http_err:
+        logger.error("❌ HTTPエラーが発生しました: %s (Status: %s)", http_err, http_err.response.status_code)
+        raise Exception(_http_error_detail(http_err.response))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as req_err:
+        logger.error("❌ リクエストエラーが発生しました: %s", req_err)
+        raise Exception(f"ネットワークエラー: {req_err}")
+    except Exception as e:
+        logger.error("❌ %sエラー: %s", error_prefix, e)
+        raise Exception(f"{error_prefix}エラー: {e}")
+
+
+async def acall_gemini_api_for_stt(base64_audio_data, prompt, mime_type):
+    """call_gemini_api_for_stt() の asyncio 版。"""
+    # 前処理はCPUを使うのでスレッドで実行する
+    base64_audio_data, mime_type, preprocess_report = await asyncio.to_thread(
+        _preprocess_base64_audio, base64_audio_data, mime_type)
+    payload = _stt_payload(prompt, mime_type, base64_audio_data)
+    try:
+        stt_text = await acall_gemini_api_base(payload, "STT", endpoint="stt", priority=PRIORITY_INTERACTIVE)
+        return _stt_result(stt_text, preprocess_report)
+    except UPSTREAM_UNAVAILABLE_ERRORS as e:
+        return {"stt_text": f"【STTエラー: {e}】", "degraded": True, "retry_after": e.retry_after}
+    except Exception as e:
+        return {"stt_text": f"【STTエラー: {e}】"}
+
+
+async def acall_gemini_api_for_stt_file(audio_file, prompt, mime_type):
+    """call_gemini_api_for_stt_file() の asyncio 版。"""
+    audio_file, mime_type, preprocess_report = await asyncio.to_thread(_preprocess_audio_file, audio_file, mime_type)
+    body = _InlineAudioJSONBody(_stt_payload(prompt, mime_type, _InlineAudioJSONBody.PLACEHOLDER), audio_file)
+    try:
+        stt_text = await acall_gemini_api_base(body, "STT", endpoint="stt", priority=PRIORITY_INTERACTIVE)
+        return _stt_result(stt_text, preprocess_report)
+    except UPSTREAM_UNAVAILABLE_ERRORS as e:
+        return {"stt_text": f"【STTエラー: {e}】", "degraded": True, "retry_after": e.retry_after}
+    except Exception as e:
+        return {"stt_text": f"【STTエラー: {e}】"}
+
+
+async def acall_gemini_api_for_summary(raw_text):
+    """call_gemini_api_for_summary() の asyncio 版。"""
+    try:
+        summary_text = await acall_gemini_api_base(_summary_payload(raw_text), "要約")
+        return {"summary_text": summary_text.strip()}
+    except UPSTREAM_UNAVAILABLE_ERRORS as e:
+        return {"summary_text": f"【要約エラー: {e}】", "degraded": True, "retry_after": e.retry_after}
+    except Exception as e:
+        return {"summary_text": f"【要約エラー: {e}】"}
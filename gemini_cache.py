@@ -0,0 +1,270 @@
+import os
+import time
+import asyncio
+import json
+import sqlite3
+import hashlib
+import threading
+
+from cache import TTLCache
+
+# -------------------------------------------------------------
+# Gemini 応答のコンテンツアドレス型キャッシュ
+# -------------------------------------------------------------
+# キーはリクエストボディ全体 (プロンプト・システム指示・音声データ) と
+# モデルを含むURLのハッシュです。同じ入力なら同じ応答を再利用します。
+# - メモリ層: TTL付きLRU (cache.TTLCache)
+# - 永続層 (任意): SQLite ファイル。件数上限を超えたら最終アクセスの古い順に削除
+
+
+def request_key(url, payload):
+    """URL とリクエストボディから SHA-256 のキーを作ります。
+
+    payload は dict (キー順を揃えてJSON化) か、バイト列のイテラブル (逐次ハッシュ)。
+    """
+    digest = hashlib.sha256()
+    digest.update(url.encode("utf-8"))
+    digest.update(b"\0")
+    if isinstance(payload, dict):
+        digest.update(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    else:
+        for chunk in payload:
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SQLiteResponseStore:
+    """永続層。max_entries を超えたら最終アクセスの古いものから削除します。"""
+
+    # 操作がファイルのロックを待つか (True ならイベントループからはスレッドで呼ぶ)
+    blocking = True
+
+    def __init__(self, path, max_entries=50000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._writes_since_trim = 0
+        self.evictions = 0
+        self._connect().execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                latency REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._connect().execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute("SELECT value, latency FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return row
+
+    def set(self, key, value, latency):
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, value, latency, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, value, latency, time.time()),
+        )
+        with self._write_lock:
+            self._writes_since_trim += 1
+            trim = self._writes_since_trim >= 100
+            if trim:
+                self._writes_since_trim = 0
+        if trim:
+            evicted = self.trim()
+            with self._write_lock:
+                self.evictions += evicted
+
+    def trim(self):
+        """件数上限を超えた分を削除し、削除件数を返します。"""
+        conn = self._connect()
+        cursor = conn.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "  SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?"
+            ")",
+            (self.max_entries,),
+        )
+        return cursor.rowcount
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+class GeminiResponseCache:
+    """メモリ層と永続層を持つ Gemini 応答キャッシュ。
+
+    同じキーのリクエストが同時に来た場合、上流を呼ぶのは最初の1件だけで、
+    残りはその結果を待って共有します (ダブルクリックや再送の対策)。
+    """
+
+    def __init__(self, memory_size=1024, ttl=86400, store=None):
+        self.memory = TTLCache(maxsize=memory_size, ttl=ttl)
+        self.store = store
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> threading.Event
+        self._ainflight = {}  # key -> asyncio.Event (ASGI モード)
+
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.inflight_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @property
+    def enabled(self):
+        return self.memory.enabled or self.store is not None
+
+    def _lookup(self, key):
+        return self._lookup_memory(key) or self._lookup_store(key)
+
+    def _lookup_memory(self, key):
+        entry = self.memory.get(key)
+        if entry is not None:
+            with self._lock:
+                self.memory_hits += 1
+                self.saved_seconds += entry[1]
+        return entry
+
+    def _lookup_store(self, key):
+        if self.store is None:
+            return None
+        entry = self.store.get(key)
+        if entry is not None:
+            self.memory.set(key, entry)
+            with self._lock:
+                self.store_hits += 1
+                self.saved_seconds += entry[1]
+        return entry
+
+    async def _alookup(self, key):
+        """_lookup() の asyncio 版。永続層 (SQLite) の読み出しはスレッドで行います。"""
+        entry = self._lookup_memory(key)
+        if entry is None and self.store is not None:
+            if self.store.blocking:
+                entry = await asyncio.to_thread(self._lookup_store, key)
+            else:
+                entry = self._lookup_store(key)
+        return entry
+
+    def get_or_call(self, key, call):
+        """キャッシュにあれば返し、なければ call() を呼んで結果を保存します。
+
+        call() が例外を投げた場合は何も保存せず、そのまま例外を伝えます。
+        """
+        if not self.enabled:
+            return call()
+
+        while True:
+            entry = self._lookup(key)
+            if entry is not None:
+                return entry[0]
+
+            with self._lock:
+                waiter = self._inflight.get(key)
+                if waiter is None:
+                    self._inflight[key] = threading.Event()
+                    break
+            # 同じリクエストが処理中なので完了を待ってから再確認する
+            waiter.wait()
+            with self._lock:
+                self.inflight_hits += 1
+
+        try:
+            started = time.perf_counter()
+            value = call()
+            latency = time.perf_counter() - started
+            self.memory.set(key, (value, latency))
+            if self.store is not None:
+                self.store.set(key, value, latency)
+            with self._lock:
+                self.misses += 1
+            return value
+        finally:
+            with self._lock:
+                event = self._inflight.pop(key)
+            event.set()
+
+    async def aget_or_call(self, key, acall):
+        """get_or_call() の asyncio 版。acall はコルーチン関数です。
+
+        同じイベントループ内の同時リクエストは1件にまとめます。
+        """
+        if not self.enabled:
+            return await acall()
+
+        while True:
+            entry = await self._alookup(key)
+            if entry is not None:
+                return entry[0]
+            with self._lock:
+                waiter = self._ainflight.get(key)
+                if waiter is None:
+                    self._ainflight[key] = asyncio.Event()
+                    break
+            await waiter.wait()
+            with self._lock:
+                self.inflight_hits += 1
+
+        try:
+            started = time.perf_counter()
+            value = await acall()
+            latency = time.perf_counter() - started
+            self.memory.set(key, (value, latency))
+            if self.store is not None:
+                if self.store.blocking:
+                    await asyncio.to_thread(self.store.set, key, value, latency)
+                else:
+                    self.store.set(key, value, latency)
+            with self._lock:
+                self.misses += 1
+            return value
+        finally:
+            with self._lock:
+                event = self._ainflight.pop(key)
+            event.set()
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.store_hits
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "store_hits": self.store_hits,
+                "inflight_dedup": self.inflight_hits,
+                "misses": self.misses,
+                "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+                "saved_upstream_seconds": round(self.saved_seconds, 3),
+                "memory": self.memory.stats(),
+                "store_entries": self.store.count() if self.store is not None else None,
+                "store_evictions": self.store.evictions if self.store is not None else None,
+            }
+
+
+def response_cache_from_env():
+    """GEMINI_CACHE_* 環境変数からキャッシュを作ります。
+
+    - GEMINI_CACHE_MEMORY_SIZE: メモリ層の件数 (0で無効)
+    - GEMINI_CACHE_TTL: メモリ層の有効期限 (秒)
+    - GEMINI_CACHE_SQLITE: 永続層のSQLiteファイルのパス (未指定なら永続層なし)
+    - GEMINI_CACHE_MAX_ENTRIES: 永続層の件数上限
+    """
+    path = os.environ.get('GEMINI_CACHE_SQLITE')
+    store = SQLiteResponseStore(path, int(os.environ.get('GEMINI_CACHE_MAX_ENTRIES', 50000))) if path else None
+    return GeminiResponseCache(
+        memory_size=int(os.environ.get('GEMINI_CACHE_MEMORY_SIZE', 1024)),
+        ttl=float(os.environ.get('GEMINI_CACHE_TTL', 86400)),
+        store=store,
+    )
@@ -0,0 +1,402 @@
+import os
+import json
+import time
+import asyncio
+import random
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app_logging import get_logger
+
+logger = get_logger("http_client")
+
+# -------------------------------------------------------------
+# 上流API (Gemini) 用の HTTP クライアント
+# -------------------------------------------------------------
+# - 長寿命の requests.Session で接続を再利用 (keep-alive)
+# - 429 / 5xx / ネットワークエラーは指数バックオフ + ジッターで再試行 (Retry-After を優先)
+# - 失敗率がしきい値を超えたらサーキットブレーカーを開き、一定時間は即座に失敗させる
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているため、上流を呼ばずに失敗したことを表します。"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"上流APIが不安定なため一時的に呼び出しを停止しています (約{int(retry_after) + 1}秒後に再開)")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """直近 window 秒の失敗率で開閉するサーキットブレーカー。スレッドセーフです。
+
+    - closed: 通常どおり呼び出す。失敗率が failure_threshold 以上 (min_requests 件以上) で open へ
+    - open: open_seconds の間は即座に失敗
+    - half_open: 試行を1件だけ通し、成功すれば closed、失敗すれば再び open
+    """
+
+    def __init__(self, failure_threshold=0.5, min_requests=10, window=30.0, open_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.min_requests = min_requests
+        self.window = window
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._outcomes = deque()  # (時刻, 成功したか)
+        self._state = "closed"
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.opened_count = 0
+        self.rejected = 0
+
+    def _prune(self, now):
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            self._outcomes.popleft()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == "open" and time.monotonic() - self._opened_at >= self.open_seconds:
+                return "half_open"
+            return self._state
+
+    def before_call(self):
+        """呼び出してよければ何もせず、だめなら CircuitOpenError を投げます。"""
+        with self._lock:
+            if self._state == "closed":
+                return
+            remaining = self.open_seconds - (time.monotonic() - self._opened_at)
+            if self._state == "open" and remaining <= 0:
+                self._state = "half_open"
+            if self._state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            self.rejected += 1
+            raise CircuitOpenError(max(remaining, 1.0))
+
+    def record(self, success):
+        now = time.monotonic()
+        with self._lock:
+            if self._state == "half_open":
+                self._trial_in_flight = False
+                if success:
+                    self._state = "closed"
+                    self._outcomes.clear()
+                else:
+                    self._open(now)
+                return
+            if self._state == "open":
+                return
+
+            self._outcomes.append((now, success))
+            self._prune(now)
+            total = len(self._outcomes)
+            failures = sum(1 for _, ok in self._outcomes if not ok)
+            if total >= self.min_requests and failures / total >= self.failure_threshold:
+                self._open(now)
+
+    def release_trial(self):
+        """結果を記録せずに half_open の試行を終えます (呼び出しがキャンセルされた場合など)。"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def _open(self, now):
+        self._state = "open"
+        self._opened_at = now
+        self._outcomes.clear()
+        self.opened_count += 1
+        logger.warning("⚠️ サーキットブレーカーを開きました (%s秒間、上流APIの呼び出しを停止します)。", self.open_seconds)
+
+    def stats(self):
+        state = self.state
+        with self._lock:
+            total = len(self._outcomes)
+            failures = sum(1 for _, ok in self._outcomes if not ok)
+            return {
+                "state": state,
+                "window_requests": total,
+                "window_failure_ratio": round(failures / total, 3) if total else 0.0,
+                "opened_count": self.opened_count,
+                "rejected": self.rejected,
+            }
+
+
+def _parse_retry_after(value):
+    """Retry-After ヘッダー (秒数 または HTTP日付) を秒数にします。解釈できなければ None。"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class ResilientHTTPClient:
+    """接続プール・再試行・サーキットブレーカー付きの HTTP クライアント。
+
+    post() の戻り値は最後に受け取った requests.Response です (ステータスの判定は呼び出し側)。
+    再試行しても接続できなかった場合は requests の例外、ブレーカーが開いていれば CircuitOpenError を投げます。
+    data にバイト列のイテラブルを渡す場合は、再送できるよう何度でもイテレートできるものにしてください。
+    """
+
+    def __init__(self, pool_size=20, max_retries=3, backoff_base=0.5, backoff_max=20.0,
+                 timeout=30.0, breaker=None):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = self._make_session(pool_size)
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)  # 直近の呼び出し (再試行込み) の所要時間
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.failures = 0
+        self.status_counts = {}
+
+    def _make_session(self, pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _backoff(self, attempt, retry_after):
+        if retry_after is not None:
+            return retry_after
+        # フルジッター: 0 〜 base * 2^attempt の一様乱数
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _begin_attempt(self):
+        self.breaker.before_call()
+        with self._lock:
+            self.attempts += 1
+
+    def _retry_delay(self, response, attempt):
+        """応答を記録し、再試行するなら待ち時間、しないなら None を返します。"""
+        with self._lock:
+            self.status_counts[response.status_code] = self.status_counts.get(response.status_code, 0) + 1
+        retryable = response.status_code in RETRY_STATUSES
+        # 429/5xx 以外 (4xx など) は上流の不調ではないので成功として数える
+        self.breaker.record(not retryable)
+        if not retryable or attempt >= self.max_retries:
+            return None
+        delay = self._backoff(attempt, _parse_retry_after(response.headers.get("Retry-After")))
+        # 待ち時間が長すぎる場合は再試行せず、そのまま返す
+        return delay if delay <= self.backoff_max else None
+
+    def _abort_attempt(self, error):
+        """再試行の対象外の例外で試行が終わったときに呼びます。
+
+        記録しないと half_open の試行が終わらず、ブレーカーがすべての呼び出しを拒み続けるため、
+        通常の例外は失敗として記録し、キャンセルなど (Exception 以外) は結果を記録せずに試行だけを終えます。
+        """
+        if isinstance(error, Exception):
+            self.breaker.record(False)
+        else:
+            self.breaker.release_trial()
+
+    def max_call_seconds(self):
+        """再試行を含めた post() 1回の最大の所要時間の目安 (秒)。
+
+        待ち時間が backoff_max を超える再試行はしないため、(再試行回数 + 1) 回のタイムアウトと
+        再試行回数分の backoff_max の合計になります。
+        """
+        return (self.max_retries + 1) * self.timeout + self.max_retries * self.backoff_max
+
+    def _finish_call(self, started, failed):
+        with self._lock:
+            if failed:
+                self.failures += 1
+            self._latencies.append(time.perf_counter() - started)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        started = time.perf_counter()
+        with self._lock:
+            self.calls += 1
+        failed = True
+        try:
+            attempt = 0
+            while True:
+                self._begin_attempt()
+                try:
+                    response = self.session.post(url, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    self.breaker.record(False)
+                    if attempt >= self.max_retries:
+                        raise
+                    delay = self._backoff(attempt, None)
+                except BaseException as e:
+                    self._abort_attempt(e)
+                    raise
+                else:
+                    delay = self._retry_delay(response, attempt)
+                    if delay is None:
+                        # 再試行しきった (または待ち時間が長すぎる) 429/5xx は失敗として数える
+                        failed = response.status_code in RETRY_STATUSES
+                        return response
+                    response.close()
+
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                time.sleep(delay)
+        finally:
+            self._finish_call(started, failed)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            calls = self.calls
+
+            def percentile(p):
+                if not latencies:
+                    return 0.0
+                return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 1)
+
+            result = {
+                "calls": calls,
+                "attempts": self.attempts,
+                "retries": self.retries,
+                "failures": self.failures,
+                "status_counts": {str(k): v for k, v in sorted(self.status_counts.items())},
+                "latency_p50_ms": percentile(0.50),
+                "latency_p95_ms": percentile(0.95),
+                "latency_max_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+            }
+        result["breaker"] = self.breaker.stats()
+        return result
+
+
+class HTTPStatusError(Exception):
+    """AsyncResilientHTTPClient の応答がエラーステータスだったことを表します。"""
+
+    def __init__(self, response):
+        super().__init__(f"HTTP {response.status_code}")
+        self.response = response
+
+
+class AsyncHTTPResponse:
+    """AsyncResilientHTTPClient の応答 (本文は読み込み済み)。requests.Response と同じ名前で値を参照できます。"""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HTTPStatusError(self)
+
+
+class AsyncResilientHTTPClient(ResilientHTTPClient):
+    """ResilientHTTPClient の asyncio 版 (aiohttp を使用)。
+
+    再試行・サーキットブレーカー・統計は同期版と同じです。
+    同期版とブレーカーを共有すると、上流の不調をどちらの経路でも同じように検知できます。
+    """
+
+    def _make_session(self, pool_size):
+        # aiohttp のセッションはイベントループ内で作る必要があるため、最初の apost() で作る
+        self._pool_size = pool_size
+        return None
+
+    def _ensure_session(self):
+        import aiohttp  # ASGI モードでのみ使う任意依存のため遅延インポート
+        if self.session is None:
+            self._transport_errors = (aiohttp.ClientError, asyncio.TimeoutError)
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def apost(self, url, **kwargs):
+        """post() と同じですが、戻り値は本文を読み込み済みの AsyncHTTPResponse です。
+
+        data にはバイト列か、何度でもイテレートできる非同期イテラブルを渡してください。
+        """
+        session = self._ensure_session()
+        started = time.perf_counter()
+        with self._lock:
+            self.calls += 1
+        failed = True
+        try:
+            attempt = 0
+            while True:
+                self._begin_attempt()
+                try:
+                    async with session.post(url, **kwargs) as raw:
+                        response = AsyncHTTPResponse(raw.status, raw.headers, await raw.read())
+                except self._transport_errors:
+                    self.breaker.record(False)
+                    if attempt >= self.max_retries:
+                        raise
+                    delay = self._backoff(attempt, None)
+                except BaseException as e:
+                    self._abort_attempt(e)
+                    raise
+                else:
+                    delay = self._retry_delay(response, attempt)
+                    if delay is None:
+                        # 再試行しきった (または待ち時間が長すぎる) 429/5xx は失敗として数える
+                        failed = response.status_code in RETRY_STATUSES
+                        return response
+
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                await asyncio.sleep(delay)
+        finally:
+            self._finish_call(started, failed)
+
+    async def aclose(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+def client_from_env(client_class=ResilientHTTPClient, breaker=None):
+    """GEMINI_HTTP_* 環境変数からクライアントを作ります。
+
+    - GEMINI_HTTP_POOL_SIZE: 接続プールの上限
+    - GEMINI_HTTP_MAX_RETRIES / GEMINI_HTTP_BACKOFF_BASE / GEMINI_HTTP_BACKOFF_MAX: 再試行
+    - GEMINI_HTTP_TIMEOUT: 1回のリクエストのタイムアウト (秒)
+    - GEMINI_BREAKER_THRESHOLD / GEMINI_BREAKER_MIN_REQUESTS / GEMINI_BREAKER_WINDOW / GEMINI_BREAKER_OPEN_SECONDS
+
+    client_class に AsyncResilientHTTPClient を渡すと asyncio 版を作ります。
+    breaker を渡すと、既存のクライアントとサーキットブレーカーを共有します。
+    """
+    breaker = breaker or CircuitBreaker(
+        failure_threshold=float(os.environ.get('GEMINI_BREAKER_THRESHOLD', 0.5)),
+        min_requests=int(os.environ.get('GEMINI_BREAKER_MIN_REQUESTS', 10)),
+        window=float(os.environ.get('GEMINI_BREAKER_WINDOW', 30)),
+        open_seconds=float(os.environ.get('GEMINI_BREAKER_OPEN_SECONDS', 30)),
+    )
+    return client_class(
+        pool_size=int(os.environ.get('GEMINI_HTTP_POOL_SIZE', 20)),
+        max_retries=int(os.environ.get('GEMINI_HTTP_MAX_RETRIES', 3)),
+        backoff_base=float(os.environ.get('GEMINI_HTTP_BACKOFF_BASE', 0.5)),
+        backoff_max=float(os.environ.get('GEMINI_HTTP_BACKOFF_MAX', 20)),
+        timeout=float(os.environ.get('GEMINI_HTTP_TIMEOUT', 30)),
+        breaker=breaker,
+    )
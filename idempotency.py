@@ -0,0 +1,292 @@
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import threading
+
+from app_logging import get_logger
+from db_pool import db_connection, get_async_pool
+
+logger = get_logger("idempotency")
+
+# -------------------------------------------------------------
+# 冪等キーによる重複リクエストの抑止
+# -------------------------------------------------------------
+# submit_feedback / generate_summary の再送やダブルタップで、sessions の行や Gemini の呼び出しが
+# 重複しないようにします。
+# - キーは Idempotency-Key ヘッダー。なければリクエストボディのハッシュを使います (有効期間は短め)
+# - public.idempotency_keys の主キー (scope, key) で、同じキーを処理できるのは1リクエストだけにします
+# - 処理が成功 (2xx) したら応答を保存し、以降の同じキーのリクエストには保存した応答をそのまま返します
+#   (DBへの挿入も Gemini の呼び出しも行いません)
+# - 失敗した場合はキーを解放し、クライアントが再試行できるようにします
+#   (成功した後に応答を保存できなかった場合は解放せず、ロックの期限まで処理中のままにします)
+# - キーを確保した時刻 (created_at) を確保のトークンにし、応答の保存と解放はトークンが一致する場合だけ行います。
+#   ロックの期限が切れて別のリクエストが取り直したキーを、元のリクエストが上書き・削除しないためです
+# - 処理中のまま lock_seconds を過ぎたキー (プロセスが落ちた場合など) と、有効期間を過ぎたキーは取り直せます
+
+CLAIM_SQL = """
+    INSERT INTO public.idempotency_keys AS k (scope, key, request_hash, locked_until, expires_at)
+    VALUES (
+        %(scope)s, %(key)s, %(request_hash)s,
+        now() + make_interval(secs => %(lock_seconds)s),
+        now() + make_interval(secs => %(ttl)s)
+    )
+    ON CONFLICT (scope, key) DO UPDATE SET
+        request_hash = EXCLUDED.request_hash,
+        status_code = NULL,
+        response = NULL,
+        locked_until = EXCLUDED.locked_until,
+        created_at = now(),
+        expires_at = EXCLUDED.expires_at
+    WHERE
+        k.expires_at < now()
+        OR (k.response IS NULL AND k.locked_until < now())
+    RETURNING k.created_at;
+"""
+
+EXISTING_SQL = """
+    SELECT request_hash, status_code, response
+    FROM public.idempotency_keys
+    WHERE scope = %(scope)s AND key = %(key)s;
+"""
+
+COMPLETE_SQL = """
+    UPDATE public.idempotency_keys
+    SET status_code = %(status_code)s, response = %(response)s, locked_until = NULL
+    WHERE scope = %(scope)s AND key = %(key)s AND created_at = %(token)s AND response IS NULL;
+"""
+
+RELEASE_SQL = """
+    DELETE FROM public.idempotency_keys
+    WHERE scope = %(scope)s AND key = %(key)s AND created_at = %(token)s AND response IS NULL;
+"""
+
+PURGE_EXPIRED_SQL = """
+    DELETE FROM public.idempotency_keys
+    WHERE ctid IN (
+        SELECT ctid FROM public.idempotency_keys
+        WHERE expires_at < now()
+        LIMIT %(limit)s
+    );
+"""
+
+MAX_KEY_LENGTH = 255
+
+
+def _asyncpg_sql(sql):
+    """%(name)s 形式のSQLを asyncpg の $n 形式にし、(SQL, 引数名のリスト) を返します。"""
+    names = []
+
+    def replace(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f"${names.index(match.group(1)) + 1}"
+
+    return re.sub(r"%\((\w+)\)s", replace, sql), names
+
+
+class IdempotencyConflict(Exception):
+    """同じキーのリクエストを今は処理できないことを表します (status: 409 か 422)。"""
+
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class IdempotencyStore:
+    """public.idempotency_keys を使った冪等キーの管理。
+
+    1. begin() でキーを確保する。(トークン, None) か、保存済みの応答があれば (None, (ステータス, ボディ)) を返す
+    2. 処理が成功したら complete()、失敗したら release() (どちらも begin() のトークンを渡す)
+    """
+
+    def __init__(self, key_ttl=86400, hash_ttl=60, lock_seconds=30, wait_seconds=5, purge_every=200):
+        self.key_ttl = key_ttl            # Idempotency-Key ヘッダーのキーの有効期間
+        self.hash_ttl = hash_ttl          # ボディのハッシュをキーにした場合の有効期間
+        self.lock_seconds = lock_seconds  # 処理中のキーを他のリクエストが取り直せるようになるまで
+        self.wait_seconds = wait_seconds  # 同じキーが処理中のとき、結果を待つ最大秒数
+        self.purge_every = purge_every
+
+        self._lock = threading.Lock()
+        self._begins = 0
+        self.claimed = 0
+        self.replayed = 0
+        self.conflicts = 0
+        self.lock_lost = 0
+
+    # --- キー ---
+
+    def request_key(self, header_key, data):
+        """(キー, リクエストのハッシュ, 有効期間) を返します。ヘッダーがなければボディのハッシュをキーにします。"""
+        request_hash = hashlib.sha256(
+            json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        ).hexdigest()
+        if header_key:
+            header_key = header_key.strip()
+            if len(header_key) > MAX_KEY_LENGTH:
+                raise IdempotencyConflict(400, f"Idempotency-Key は {MAX_KEY_LENGTH} 文字以下にしてください")
+            return header_key, request_hash, self.key_ttl
+        return f"sha256:{request_hash}", request_hash, self.hash_ttl
+
+    def _params(self, scope, key, request_hash=None, ttl=None, token=None):
+        return {"scope": scope, "key": key, "request_hash": request_hash, "ttl": ttl, "token": token,
+                "lock_seconds": self.lock_seconds, "limit": 1000}
+
+    def _check_completed(self, scope, key, updated):
+        """応答を保存できたかを返します。0件ならロックの期限が切れて別のリクエストがキーを取り直しています。"""
+        if updated:
+            return True
+        with self._lock:
+            self.lock_lost += 1
+        logger.warning("⚠️ 冪等キー %s:%s のロックの期限が切れていたため、応答を保存しませんでした。", scope, key)
+        return False
+
+    def _count_begin(self):
+        with self._lock:
+            self._begins += 1
+            return self._begins % self.purge_every == 0
+
+    def _resolve_existing(self, row, request_hash):
+        """既存のキーの行から、応答を返すか、まだ処理中かを判断します。処理中なら None。"""
+        if row is None:
+            return None
+        existing_hash, status_code, response = row
+        if response is None:
+            return None
+        if existing_hash != request_hash:
+            with self._lock:
+                self.conflicts += 1
+            raise IdempotencyConflict(422, "同じ Idempotency-Key で異なる内容のリクエストが送信されました")
+        if isinstance(response, str):
+            response = json.loads(response)
+        with self._lock:
+            self.replayed += 1
+        return status_code, response
+
+    def _in_progress(self):
+        with self._lock:
+            self.conflicts += 1
+        # lock_seconds は最悪の場合の長さなので、再試行の目安には結果を待つ秒数を使う
+        return IdempotencyConflict(409, "同じリクエストを処理中です。しばらくしてから再度お試しください。",
+                                   retry_after=max(1, self.wait_seconds))
+
+    # --- 同期版 (flask_app.py) ---
+
+    def begin(self, scope, key, request_hash, ttl):
+        """キーを確保できたら (トークン, None)、保存済みの応答があれば (None, (ステータス, ボディ)) を返します。"""
+        params = self._params(scope, key, request_hash, ttl)
+        deadline = time.monotonic() + self.wait_seconds
+        with db_connection() as conn, conn.cursor() as cursor:
+            if self._count_begin():
+                cursor.execute(PURGE_EXPIRED_SQL, params)
+            while True:
+                cursor.execute(CLAIM_SQL, params)
+                claimed = cursor.fetchone()
+                if claimed is None:
+                    cursor.execute(EXISTING_SQL, params)
+                    replay = self._resolve_existing(cursor.fetchone(), request_hash)
+                conn.commit()
+                if claimed is not None:
+                    with self._lock:
+                        self.claimed += 1
+                    return claimed[0], None
+                if replay is not None:
+                    return None, replay
+                # 同じキーを別のリクエストが処理中。結果が保存されるのを少し待つ
+                if time.monotonic() >= deadline:
+                    raise self._in_progress()
+                time.sleep(0.1)
+
+    def complete(self, scope, key, token, status_code, body):
+        """応答を保存します。ロックの期限が切れて別のリクエストがキーを取り直していたら False。"""
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(COMPLETE_SQL, {**self._params(scope, key, token=token), "status_code": status_code,
+                                          "response": json.dumps(body, ensure_ascii=False)})
+            updated = cursor.rowcount
+            conn.commit()
+        return self._check_completed(scope, key, updated)
+
+    def release(self, scope, key, token):
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(RELEASE_SQL, self._params(scope, key, token=token))
+            conn.commit()
+
+    # --- asyncio 版 (asgi_app.py) ---
+
+    async def _aexecute(self, connection, sql, params, fetch=False):
+        query, names = _asyncpg_sql(sql)
+        args = [params[name] for name in names]
+        if fetch:
+            return await connection.fetchrow(query, *args)
+        return await connection.execute(query, *args)
+
+    async def abegin(self, scope, key, request_hash, ttl):
+        """begin() の asyncio 版。"""
+        params = self._params(scope, key, request_hash, ttl)
+        deadline = time.monotonic() + self.wait_seconds
+        pool = await get_async_pool()
+        if self._count_begin():
+            await self._aexecute(pool, PURGE_EXPIRED_SQL, params)
+        while True:
+            async with pool.acquire() as connection:
+                claimed = await self._aexecute(connection, CLAIM_SQL, params, fetch=True)
+                row = None if claimed is not None else await self._aexecute(connection, EXISTING_SQL, params,
+                                                                            fetch=True)
+            if claimed is not None:
+                with self._lock:
+                    self.claimed += 1
+                return claimed[0], None
+            replay = self._resolve_existing(tuple(row) if row is not None else None, request_hash)
+            if replay is not None:
+                return None, replay
+            if time.monotonic() >= deadline:
+                raise self._in_progress()
+            await asyncio.sleep(0.1)
+
+    async def acomplete(self, scope, key, token, status_code, body):
+        pool = await get_async_pool()
+        status = await self._aexecute(pool, COMPLETE_SQL, {**self._params(scope, key, token=token),
+                                                           "status_code": status_code,
+                                                           "response": json.dumps(body, ensure_ascii=False)})
+        # asyncpg の execute() はコマンドタグ ("UPDATE 1") を返す
+        return self._check_completed(scope, key, int(status.split()[-1]))
+
+    async def arelease(self, scope, key, token):
+        pool = await get_async_pool()
+        await self._aexecute(pool, RELEASE_SQL, self._params(scope, key, token=token))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "claimed": self.claimed,
+                "replayed": self.replayed,
+                "conflicts": self.conflicts,
+                "lock_lost": self.lock_lost,
+                "key_ttl": self.key_ttl,
+                "hash_ttl": self.hash_ttl,
+                "lock_seconds": self.lock_seconds,
+            }
+
+
+def idempotency_from_env(lock_seconds=None):
+    """IDEMPOTENCY_* 環境変数から IdempotencyStore を作ります。IDEMPOTENCY=0 なら None (無効)。
+
+    - IDEMPOTENCY_KEY_TTL: Idempotency-Key ヘッダーのキーを覚えておく秒数
+    - IDEMPOTENCY_HASH_TTL: ヘッダーがない場合 (ボディのハッシュ) の秒数。別の来場者が偶然同じ内容を
+      送った場合と区別できないため、再送・ダブルタップを防げる程度に短くします
+    - IDEMPOTENCY_LOCK_SECONDS: 処理中のまま放置されたキーを取り直せるようになるまでの秒数。
+      指定しなければ lock_seconds (handler の最大の所要時間から求めた値) を使います
+    - IDEMPOTENCY_WAIT_SECONDS: 同じキーが処理中のとき、結果を待つ最大秒数 (超えたら 409)
+    """
+    if os.environ.get('IDEMPOTENCY', '1') == '0':
+        return None
+    return IdempotencyStore(
+        key_ttl=float(os.environ.get('IDEMPOTENCY_KEY_TTL', 86400)),
+        hash_ttl=float(os.environ.get('IDEMPOTENCY_HASH_TTL', 60)),
+        lock_seconds=float(os.environ.get('IDEMPOTENCY_LOCK_SECONDS') or lock_seconds or 30),
+        wait_seconds=float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 5)),
+    )
@@ -0,0 +1,412 @@
+import os
+import sys
+import json
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from app_logging import get_logger
+
+logger = get_logger("metrics")
+
+# -------------------------------------------------------------
+# ホットパスの計測 (ステージごとの所要時間・ペイロードサイズ) と /metrics
+# -------------------------------------------------------------
+# - span("db.connect") などで囲んだ区間の所要時間を、ステージごとのヒストグラムに集計します
+#   リクエストの処理中であれば、そのリクエストのトレースにも記録します (遅いリクエストのログ用)
+# - observe_size("gemini.request", n) でペイロードのバイト数を集計します
+# - instrument_flask(app) でリクエスト全体の所要時間・サイズを集計し、GET /metrics で
+#   Prometheus のテキスト形式で返します。既存の stats() は add_collector() でゲージとして出せます
+# - SLOW_REQUEST_MS を設定すると、それ以上かかったリクエストをステージの内訳付きでログに出します
+# - PROFILE_SAMPLE_HZ を設定すると、処理中のリクエストのスタックを定期的にサンプリングし、
+#   GET /metrics/profile で folded 形式 (flamegraph.pl / speedscope で読める) で返します
+# METRICS=0 で計測を無効にできます (span() などは何もしません)。
+
+METRICS_ENABLED = os.environ.get('METRICS', '1') != '0'
+
+# 秒単位のヒストグラムの境界 (5ms〜60s)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# バイト数のヒストグラムの境界 (1KB〜64MB)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(9))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (list(extra.items()) if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """ラベルごとの累積ヒストグラム (Prometheus の histogram 型)。"""
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}  # ラベルの値 -> [バケットごとの件数 (+Inf を含む), 合計, 件数]
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: ([*counts], total, count) for labels, (counts, total, count) in self._series.items()}
+        for labelvalues, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _labels(self.labelnames, labelvalues, {"le": _number(bound)})
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {_number(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Counter:
+    """ラベルごとのカウンター (Prometheus の counter 型)。"""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for labelvalues, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    """メトリクスと、stats() を返す関数 (ゲージとして出力) をまとめて Prometheus の形式にします。"""
+
+    def __init__(self, prefix="hyoka"):
+        self.prefix = prefix
+        self._metrics = []
+        self._collectors = []
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(f"{self.prefix}_{name}", help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(f"{self.prefix}_{name}", help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, name, collect):
+        """collect() が返す dict の数値 (入れ子は _ でつなぐ) を {prefix}_{name}_<キー> のゲージにします。"""
+        self._collectors.append((f"{self.prefix}_{name}", collect))
+
+    def _collector_lines(self, name, collect):
+        try:
+            values = collect()
+        except Exception as e:
+            # 統計の取得に失敗しても /metrics 全体は返す (DB未設定のプールなど)
+            logger.debug("⚠️ %s の統計を取得できませんでした: %s", name, e)
+            return []
+        lines = []
+
+        def walk(key, value):
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, dict):
+                for child, child_value in value.items():
+                    walk(f"{key}_{child}", child_value)
+            elif isinstance(value, (int, float)) and value is not None:
+                metric = "".join(c if c.isalnum() or c == "_" else "_" for c in key)
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {_number(value)}")
+
+        walk(name, values)
+        return lines
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, collect in self._collectors:
+            lines.extend(self._collector_lines(name, collect))
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+REQUEST_SECONDS = registry.histogram(
+    "request_duration_seconds", "リクエストの処理時間", ("service", "method", "route", "status"))
+REQUEST_BYTES = registry.histogram(
+    "request_size_bytes", "リクエストボディのバイト数", ("service", "route"), SIZE_BUCKETS)
+RESPONSE_BYTES = registry.histogram(
+    "response_size_bytes", "レスポンスボディのバイト数 (ストリーミング応答を除く)", ("service", "route"), SIZE_BUCKETS)
+STAGE_SECONDS = registry.histogram(
+    "stage_duration_seconds", "処理ステージ (DB接続・SQL・JSON組み立て・上流呼び出しなど) の所要時間", ("stage",))
+STAGE_ERRORS = registry.counter("stage_errors_total", "例外で終わった処理ステージの回数", ("stage",))
+PAYLOAD_BYTES = registry.histogram(
+    "payload_size_bytes", "上流とのやり取りなどのペイロードのバイト数", ("kind",), SIZE_BUCKETS)
+SLOW_REQUESTS = registry.counter("slow_requests_total", "SLOW_REQUEST_MS を超えたリクエスト数", ("service", "route"))
+
+
+# -------------------------------------------------------------
+# リクエストのトレース
+# -------------------------------------------------------------
+class RequestTrace:
+    """1リクエスト分のステージの記録 (遅いリクエストのログとプロファイラ用)。"""
+
+    MAX_SPANS = 200
+
+    def __init__(self, service, method, path):
+        self.service = service
+        self.method = method
+        self.path = path
+        self.route = None
+        self.started = time.perf_counter()
+        self.spans = []   # [(ステージ, 開始からの秒, 所要秒)]
+        self.sizes = {}   # 種類 -> バイト数
+        self.samples = {}  # folded スタック -> サンプル数 (PROFILE_SAMPLE_HZ のとき)
+
+    def add_span(self, stage, started, seconds):
+        if len(self.spans) < self.MAX_SPANS:
+            self.spans.append((stage, started - self.started, seconds))
+
+    def summary(self, elapsed, status):
+        stages = {}
+        for stage, _, seconds in self.spans:
+            total, count = stages.get(stage, (0.0, 0))
+            stages[stage] = (total + seconds, count + 1)
+        top_stacks = sorted(self.samples.items(), key=lambda item: -item[1])[:3]
+        return {
+            "service": self.service,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": status,
+            "duration_ms": round(elapsed * 1000, 1),
+            "stages": {stage: {"ms": round(total * 1000, 1), "count": count}
+                       for stage, (total, count) in sorted(stages.items(), key=lambda item: -item[1][0])},
+            "sizes": self.sizes,
+            **({"profile": [{"stack": stack, "samples": count} for stack, count in top_stacks]} if top_stacks else {}),
+        }
+
+
+_current_trace = contextvars.ContextVar("hyoka_request_trace", default=None)
+# プロファイラがサンプリングする、処理中のリクエストのスレッド
+_active_traces = {}
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def span(stage):
+    """区間の所要時間を stage のヒストグラム (と処理中のリクエストのトレース) に記録します。"""
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage)
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        STAGE_SECONDS.observe(seconds, stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(stage, started, seconds)
+
+
+def observe_size(kind, nbytes):
+    """ペイロードのバイト数を記録します (None は無視)。"""
+    if not METRICS_ENABLED or nbytes is None:
+        return
+    PAYLOAD_BYTES.observe(nbytes, kind)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.sizes[kind] = trace.sizes.get(kind, 0) + nbytes
+
+
+# -------------------------------------------------------------
+# サンプリングプロファイラ
+# -------------------------------------------------------------
+class SamplingProfiler:
+    """処理中のリクエストのスレッドのスタックを一定間隔で取り、folded 形式で集計します。
+
+    sys._current_frames() を読むだけなので、リクエストを処理するスレッドには手を入れません。
+    """
+
+    def __init__(self, hz=50, max_depth=40, max_stacks=5000):
+        self.interval = 1.0 / hz
+        self.max_depth = max_depth
+        self.max_stacks = max_stacks
+        self._lock = threading.Lock()
+        self._stacks = {}
+        self.samples = 0
+        self.dropped = 0
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+                self._thread.start()
+
+    def _folded(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            active = dict(_active_traces)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for thread_id, trace in active.items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = f"{trace.service}:{trace.route or trace.path};{self._folded(frame)}"
+                trace.samples[stack] = trace.samples.get(stack, 0) + 1
+                with self._lock:
+                    self.samples += 1
+                    if stack in self._stacks or len(self._stacks) < self.max_stacks:
+                        self._stacks[stack] = self._stacks.get(stack, 0) + 1
+                    else:
+                        self.dropped += 1
+
+    def folded(self, reset=False):
+        with self._lock:
+            stacks = self._stacks
+            if reset:
+                self._stacks = {}
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
+
+    def stats(self):
+        with self._lock:
+            return {"samples": self.samples, "stacks": len(self._stacks), "dropped": self.dropped,
+                    "interval_ms": round(self.interval * 1000, 2)}
+
+
+def profiler_from_env():
+    """PROFILE_SAMPLE_HZ が設定されているときだけプロファイラを作ります (既定は無効)。"""
+    hz = float(os.environ.get('PROFILE_SAMPLE_HZ', 0))
+    if hz <= 0 or not METRICS_ENABLED:
+        return None
+    return SamplingProfiler(hz=hz)
+
+
+# -------------------------------------------------------------
+# Flask への組み込み
+# -------------------------------------------------------------
+def instrument_flask(app, service):
+    """リクエストごとの計測と GET /metrics (と GET /metrics/profile) を app に組み込みます。
+
+    - SLOW_REQUEST_MS: これ以上かかったリクエストをステージの内訳付きで WARNING ログに出す (既定は無効)
+    - PROFILE_SAMPLE_HZ: サンプリングプロファイラの頻度 (既定は無効)
+    Server-Sent Events の応答は接続している間ずっと続くため、処理時間のヒストグラムには入れません。
+    """
+    from flask import Response, g, request
+
+    slow_seconds = float(os.environ.get('SLOW_REQUEST_MS', 0)) / 1000
+    profiler = profiler_from_env()
+    if profiler is not None:
+        profiler.start()
+        registry.add_collector("profiler", profiler.stats)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """Prometheus のテキスト形式のメトリクス"""
+        return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+    @app.route('/metrics/profile', methods=['GET'])
+    def metrics_profile():
+        """サンプリングしたスタックを folded 形式で返します (?reset=1 で集計をクリア)。"""
+        if profiler is None:
+            return Response("PROFILE_SAMPLE_HZ が設定されていません。\n", status=404, mimetype="text/plain")
+        return Response(profiler.folded(reset=request.args.get('reset') == '1'), mimetype="text/plain")
+
+    if not METRICS_ENABLED:
+        return
+
+    @app.before_request
+    def _start_trace():
+        trace = RequestTrace(service, request.method, request.path)
+        trace.route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        g._metrics_trace = trace
+        g._metrics_token = _current_trace.set(trace)
+        if profiler is not None:
+            _active_traces[threading.get_ident()] = trace
+        if request.content_length:
+            REQUEST_BYTES.observe(request.content_length, service, trace.route)
+
+    @app.after_request
+    def _record_response(response):
+        trace = g.get("_metrics_trace")
+        if trace is not None:
+            trace.status = response.status_code
+            trace.streamed = response.is_streamed
+            trace.event_stream = response.mimetype == "text/event-stream"
+            if not response.is_streamed and response.content_length is not None:
+                RESPONSE_BYTES.observe(response.content_length, service, trace.route)
+        return response
+
+    @app.teardown_request
+    def _finish_trace(error):
+        trace = g.pop("_metrics_trace", None)
+        if trace is None:
+            return
+        _active_traces.pop(threading.get_ident(), None)
+        token = g.pop("_metrics_token", None)
+        if token is not None:
+            try:
+                _current_trace.reset(token)
+            except ValueError:
+                # ストリーミング応答は別のコンテキストで後片付けされることがある
+                _current_trace.set(None)
+        if getattr(trace, "event_stream", False):
+            return
+        elapsed = time.perf_counter() - trace.started
+        status = getattr(trace, "status", 500)
+        REQUEST_SECONDS.observe(elapsed, service, trace.method, trace.route, str(status))
+        if slow_seconds and elapsed >= slow_seconds:
+            SLOW_REQUESTS.inc(service, trace.route)
+            logger.warning("🐢 slow request %s", json.dumps(trace.summary(elapsed, status), ensure_ascii=False))
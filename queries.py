@@ -0,0 +1,288 @@
+from metrics import span
+
+# -------------------------------------------------------------
+# ダッシュボード (GET /api/feedback/<email>) で使うSQL
+# -------------------------------------------------------------
+# 列を TRIM(LOWER(...)) で包むとインデックスが使えずシーケンシャルスキャンになるため、
+# 正規化済みのキー列 (schema.py のマイグレーションで追加) と直接比較します。
+# パラメータは呼び出し側で lower().strip() 済みの値を渡してください。
+
+# 1. チーム名とブースIDを学生テーブルから取得
+TEAM_INFO_SQL = """
+    SELECT
+        t.team_name,
+        t.booth_id
+    FROM
+        public.students t
+    WHERE
+        t.email_key = %s;
+"""
+
+# 2. 該当チームのメンバーリストを取得
+TEAM_MEMBERS_SQL = """
+    SELECT
+        s.full_name,
+        s.email
+    FROM
+        public.students s
+    WHERE
+        s.team_key = %s;
+"""
+
+# 3. 全チームの総数を取得 (students のトリガーで更新される event_stats から読む)
+TOTAL_TEAMS_SQL = "SELECT e.value FROM public.event_stats e WHERE e.key = 'total_teams_count';"
+
+# 4. 該当ブースIDのセッションデータを取得 (id の降順)
+# sessions.booth_id は submit_feedback で正規化して保存されている
+# after_id/limit によるキーセットページネーション (どちらも None なら全件)。
+# psycopg2 はパラメータをクライアント側で埋め込むため、after_id が NULL のときは
+# 条件が定数畳み込みされ (booth_id, id DESC) インデックスをそのまま使えます。
+SESSIONS_SQL = """
+    SELECT
+        s.id,
+        s.raw_text,
+        s.summary_text,
+        s.is_processed,
+        s.visitor_attribute,
+        s.praise_ratio,
+        s.advice_ratio,
+        s.score
+    FROM
+        public.sessions s
+    WHERE
+        s.booth_id = %(booth_id)s
+        AND (%(after_id)s::bigint IS NULL OR s.id < %(after_id)s::bigint)
+    ORDER BY
+        s.id DESC
+    LIMIT %(limit)s;
+"""
+
+# 5. ブース全体の件数・処理済み件数・スコア合計 (total_count / average_score 用)
+# sessions のトリガーで増分更新される booth_stats の1行を読むだけで済む
+BOOTH_STATS_SQL = """
+    SELECT
+        b.total_count,
+        b.processed_count,
+        b.score_sum,
+        b.last_session_id,
+        b.updated_at
+    FROM
+        public.booth_stats b
+    WHERE
+        b.booth_id = %s;
+"""
+
+# -------------------------------------------------------------
+# 1往復版: 上記クエリをCTEでまとめたもの
+# -------------------------------------------------------------
+# セッション1件につき1行を返し、チーム情報・メンバー(JSON)・チーム総数・ブース集計は各行に同じ値が入ります。
+# セッションが0件でも LEFT JOIN によりチーム情報の1行は返ります (学生が見つからなければ0行)。
+DASHBOARD_COMBINED_SQL = """
+    WITH team AS (
+        SELECT
+            t.team_name,
+            t.booth_id,
+            TRIM(LOWER(t.booth_id)) AS booth_key
+        FROM
+            public.students t
+        WHERE
+            t.email_key = %(email)s
+        LIMIT 1
+    ),
+    members AS (
+        SELECT
+            COALESCE(
+                json_agg(json_build_object('name', s.full_name, 'email', s.email)),
+                '[]'::json
+            ) AS team_members
+        FROM
+            public.students s, team
+        WHERE
+            s.team_key = TRIM(LOWER(team.team_name))
+    ),
+    teams AS (
+        SELECT
+            COALESCE(MAX(e.value), 0) AS total_teams_count
+        FROM
+            public.event_stats e
+        WHERE
+            e.key = 'total_teams_count'
+    ),
+    booth_stats AS (
+        -- 集計行がまだないブースは0件として扱う
+        SELECT
+            COALESCE(MAX(b.total_count), 0) AS total_count,
+            COALESCE(MAX(b.processed_count), 0) AS processed_count,
+            COALESCE(MAX(b.score_sum), 0) AS score_sum,
+            MAX(b.last_session_id) AS last_session_id,
+            MAX(b.updated_at) AS updated_at
+        FROM
+            public.booth_stats b, team
+        WHERE
+            b.booth_id = team.booth_key
+    )
+    SELECT
+        team.team_name,
+        team.booth_id,
+        members.team_members,
+        teams.total_teams_count,
+        booth_stats.total_count,
+        booth_stats.processed_count,
+        booth_stats.score_sum,
+        booth_stats.last_session_id,
+        booth_stats.updated_at,
+        s.id,
+        s.raw_text,
+        s.summary_text,
+        s.is_processed,
+        s.visitor_attribute,
+        s.praise_ratio,
+        s.advice_ratio,
+        s.score
+    FROM
+        team
+        CROSS JOIN members
+        CROSS JOIN teams
+        CROSS JOIN booth_stats
+        LEFT JOIN LATERAL (
+            SELECT
+                s.id,
+                s.raw_text,
+                s.summary_text,
+                s.is_processed,
+                s.visitor_attribute,
+                s.praise_ratio,
+                s.advice_ratio,
+                s.score
+            FROM
+                public.sessions s
+            WHERE
+                s.booth_id = team.booth_key
+                AND (%(after_id)s::bigint IS NULL OR s.id < %(after_id)s::bigint)
+            ORDER BY
+                s.id DESC
+            LIMIT %(limit)s
+        ) s ON true
+    ORDER BY
+        s.id DESC;
+"""
+
+
+# ETag 用: メールアドレスからブースの集計行のバージョン情報と、チーム名・メンバー・全チーム数を取得
+# (セッション本体は読まない)。メンバーは [名前, メールアドレス] のJSON配列
+DASHBOARD_VERSION_SQL = """
+    SELECT
+        TRIM(LOWER(t.booth_id)),
+        COALESCE(b.total_count, 0),
+        b.last_session_id,
+        b.updated_at,
+        t.team_name,
+        (
+            SELECT COALESCE(json_agg(json_build_array(s.full_name, s.email)), '[]'::json)
+            FROM public.students s
+            WHERE s.team_key = TRIM(LOWER(t.team_name))
+        ),
+        (
+            SELECT COALESCE(MAX(e.value), 0)
+            FROM public.event_stats e
+            WHERE e.key = 'total_teams_count'
+        )
+    FROM
+        public.students t
+        LEFT JOIN public.booth_stats b ON b.booth_id = TRIM(LOWER(t.booth_id))
+    WHERE
+        t.email_key = %s
+    LIMIT 1;
+"""
+
+# リアルタイム配信 (feedback_events.py) 用: 登録・要約された行と、更新後のブース集計
+# 行は SESSIONS_SQL と同じ列順。集計行がまだなければ0行、該当する行がなければ id が NULL の1行
+FEEDBACK_EVENT_SQL = """
+    SELECT
+        b.total_count,
+        b.score_sum,
+        s.id,
+        s.raw_text,
+        s.summary_text,
+        s.is_processed,
+        s.visitor_attribute,
+        s.praise_ratio,
+        s.advice_ratio,
+        s.score
+    FROM
+        public.booth_stats b
+        LEFT JOIN public.sessions s ON s.booth_id = b.booth_id AND s.id = ANY(%(session_ids)s)
+    WHERE
+        b.booth_id = %(booth_id)s
+    ORDER BY
+        s.id DESC;
+"""
+
+
+def fetch_dashboard_separate(cursor, search_email, limit=None, after_id=None):
+    """複数回のクエリでダッシュボードのデータを取得します (従来の方式)。
+
+    戻り値は (team_name, booth_id, members, total_teams_count, booth_stats, sessions)。
+    members は (full_name, email) のリスト、booth_stats は (total_count, processed_count, score_sum, last_session_id, updated_at)、
+    sessions は SESSIONS_SQL の列順のタプルのリスト。
+    学生が見つからない場合は None を返します。
+    """
+    with span("sql.team_info"):
+        cursor.execute(TEAM_INFO_SQL, (search_email,))
+        team_result = cursor.fetchone()
+    if not team_result:
+        return None
+    team_name, booth_id = team_result
+    booth_key = booth_id.lower().strip()
+
+    with span("sql.team_members"):
+        cursor.execute(TEAM_MEMBERS_SQL, (team_name.lower().strip(),))
+        members = cursor.fetchall()
+
+    with span("sql.total_teams"):
+        cursor.execute(TOTAL_TEAMS_SQL)
+        total_teams_count = cursor.fetchone()[0] if cursor.rowcount else 0
+
+    with span("sql.booth_stats"):
+        cursor.execute(BOOTH_STATS_SQL, (booth_key,))
+        booth_stats = cursor.fetchone() or (0, 0, 0, None, None)
+
+    with span("sql.sessions"):
+        cursor.execute(SESSIONS_SQL, {"booth_id": booth_key, "after_id": after_id, "limit": limit})
+        sessions = cursor.fetchall()
+
+    return team_name, booth_id, members, total_teams_count, booth_stats, sessions
+
+
+def fetch_dashboard_combined(cursor, search_email, limit=None, after_id=None):
+    """DASHBOARD_COMBINED_SQL の1往復でダッシュボードのデータを取得します。
+
+    戻り値の形式は fetch_dashboard_separate と同じです。
+    """
+    with span("sql.dashboard_combined"):
+        cursor.execute(DASHBOARD_COMBINED_SQL, {"email": search_email, "after_id": after_id, "limit": limit})
+        rows = cursor.fetchall()
+    if not rows:
+        return None
+
+    team_name, booth_id, team_members, total_teams_count = rows[0][:4]
+    booth_stats = tuple(rows[0][4:9])
+    members = [(member["name"], member["email"]) for member in team_members]
+    # セッション0件の場合は id が NULL の1行だけが返る
+    sessions = [row[9:] for row in rows if row[9] is not None]
+
+    return team_name, booth_id, members, total_teams_count, booth_stats, sessions
+
+
+# EXPLAINチェック (schema.py check) の対象: (名前, SQL, サンプルパラメータ)
+DASHBOARD_QUERIES = [
+    ("team_info", TEAM_INFO_SQL, ("student@example.com",)),
+    ("team_members", TEAM_MEMBERS_SQL, ("team",)),
+    ("total_teams", TOTAL_TEAMS_SQL, ()),
+    ("sessions", SESSIONS_SQL, {"booth_id": "booth", "after_id": None, "limit": None}),
+    ("sessions_page", SESSIONS_SQL, {"booth_id": "booth", "after_id": 100, "limit": 20}),
+    ("booth_stats", BOOTH_STATS_SQL, ("booth",)),
+    ("dashboard_version", DASHBOARD_VERSION_SQL, ("student@example.com",)),
+    ("dashboard_combined", DASHBOARD_COMBINED_SQL, {"email": "student@example.com", "after_id": None, "limit": None}),
+    ("feedback_event", FEEDBACK_EVENT_SQL, {"booth_id": "booth", "session_ids": [1, 2, 3]}),
+]
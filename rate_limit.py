@@ -0,0 +1,485 @@
+import os
+import json
+import asyncio
+import time
+import uuid
+import heapq
+import sqlite3
+import itertools
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+# -------------------------------------------------------------
+# 上流AI呼び出しのレート制限と同時実行数の制御
+# -------------------------------------------------------------
+# - トークンバケット: モデルごとの 1分あたりのリクエスト数 (RPM)
+# - 同時実行数: モデルごと、および「モデル:エンドポイント」ごと
+# - 優先度: 待ち行列では STT などの対話的な呼び出しを先に通し、
+#   バックグラウンドの要約には同時実行枠の一部 (BACKGROUND_RESERVE) を使わせない
+# 共有ストア (SQLite / Redis) を使うと、複数ワーカープロセスで同じ上限を共有します。
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# 同時実行枠のリース期間の既定値 (プロセスが落ちても枠が戻るように)。
+# 枠を持ったまま行う呼び出し (再試行を含む) より短いと、実行中に枠が切れて同時実行数の上限を超えるため、
+# gemini_api.py では HTTP クライアントのタイムアウトと再試行の設定から求めた値を使います。
+SLOT_LEASE_SECONDS = 300
+
+
+class RateLimitTimeout(Exception):
+    """待ち時間の上限までに実行枠を確保できなかったことを表します。"""
+
+    def __init__(self, key, retry_after):
+        super().__init__(f"上流APIの呼び出しが混雑しています ({key} の実行枠を確保できませんでした)")
+        self.retry_after = retry_after
+
+
+# -------------------------------------------------------------
+# ストア (トークンバケットと同時実行枠の状態)
+# -------------------------------------------------------------
+class LocalLimitStore:
+    """単一プロセス用のストア。"""
+
+    # 操作がロックやネットワークを待つか (True ならイベントループからはスレッドで呼ぶ)
+    blocking = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}  # key -> (tokens, updated_at)
+        self._slots = {}    # key -> set(holder)
+
+    def take_token(self, key, rate, capacity):
+        """トークンを1つ取れれば 0、取れなければ次に取れるまでの秒数を返します。"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+
+    def acquire_slot(self, key, limit, holder, lease_seconds=SLOT_LEASE_SECONDS):
+        with self._lock:
+            holders = self._slots.setdefault(key, set())
+            if len(holders) >= limit:
+                return False
+            holders.add(holder)
+            return True
+
+    def release_slot(self, key, holder):
+        with self._lock:
+            self._slots.get(key, set()).discard(holder)
+
+
+class SQLiteLimitStore:
+    """同一ホスト上の複数ワーカーで共有するストア。"""
+
+    blocking = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS rate_slots (key TEXT NOT NULL, holder TEXT NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (key, holder))")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def take_token(self, key, rate, capacity):
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT tokens, updated_at FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated_at = row if row else (capacity, now)
+            tokens = min(capacity, tokens + max(0.0, now - updated_at) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            conn.execute("INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                         (key, tokens, now))
+        return wait
+
+    def acquire_slot(self, key, limit, holder, lease_seconds=SLOT_LEASE_SECONDS):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM rate_slots WHERE key = ? AND expires_at < ?", (key, now))
+            in_use = conn.execute("SELECT COUNT(*) FROM rate_slots WHERE key = ?", (key,)).fetchone()[0]
+            if in_use >= limit:
+                return False
+            conn.execute("INSERT INTO rate_slots (key, holder, expires_at) VALUES (?, ?, ?)",
+                         (key, holder, now + lease_seconds))
+        return True
+
+    def release_slot(self, key, holder):
+        self._connect().execute("DELETE FROM rate_slots WHERE key = ? AND holder = ?", (key, holder))
+
+
+class RedisLimitStore:
+    """Redis を使うストア (redis パッケージがある場合のみ)。"""
+
+    blocking = True
+
+    TAKE_TOKEN_SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local capacity = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+        local tokens = tonumber(state[1]) or capacity
+        local updated_at = tonumber(state[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+        return tostring(wait)
+    """
+
+    ACQUIRE_SLOT_SCRIPT = """
+        local limit = tonumber(ARGV[1])
+        local now = tonumber(ARGV[2])
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+        if redis.call('ZCARD', KEYS[1]) >= limit then
+            return 0
+        end
+        redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[4])
+        redis.call('EXPIRE', KEYS[1], tonumber(ARGV[3]) + 60)
+        return 1
+    """
+
+    def __init__(self, url, prefix="hyoka:rate:"):
+        import redis  # 任意依存のため遅延インポート
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._take_token = self._redis.register_script(self.TAKE_TOKEN_SCRIPT)
+        self._acquire_slot = self._redis.register_script(self.ACQUIRE_SLOT_SCRIPT)
+
+    def take_token(self, key, rate, capacity):
+        return float(self._take_token(keys=[self.prefix + "bucket:" + key], args=[rate, capacity, time.time()]))
+
+    def acquire_slot(self, key, limit, holder, lease_seconds=SLOT_LEASE_SECONDS):
+        args = [limit, time.time(), lease_seconds, holder]
+        return bool(self._acquire_slot(keys=[self.prefix + "slots:" + key], args=args))
+
+    def release_slot(self, key, holder):
+        self._redis.zrem(self.prefix + "slots:" + key, holder)
+
+
+def limit_store_from_url(url):
+    """RATE_LIMIT_SHARED_URL (未指定なら CACHE_SHARED_URL) の値からストアを作ります。"""
+    if not url:
+        return LocalLimitStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteLimitStore(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://")):
+        return RedisLimitStore(url)
+    raise ValueError(f"未対応のレート制限共有バックエンドです: {url}")
+
+
+# -------------------------------------------------------------
+# 制御本体
+# -------------------------------------------------------------
+class _WaitStats:
+    def __init__(self):
+        self.acquired = 0
+        self.timeouts = 0
+        self.waiting = 0
+        self.in_flight = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.recent_waits = deque(maxlen=1000)
+
+    def as_dict(self):
+        waits = sorted(self.recent_waits)
+        return {
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "waiting": self.waiting,
+            "in_flight": self.in_flight,
+            "wait_avg_ms": round(self.wait_total / self.acquired * 1000, 2) if self.acquired else 0.0,
+            "wait_p95_ms": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 2) if waits else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 2),
+        }
+
+
+class UpstreamGovernor:
+    """モデル・エンドポイントごとのレート制限と同時実行数の上限を守って実行枠を渡します。
+
+    limits は {"<model>": {"rpm": 600, "concurrency": 16}, "<model>:<endpoint>": {"concurrency": 4}} の形式。
+    モデルに設定がなければ default_rpm / default_concurrency を使います。
+    同じモデルを待つ呼び出しは、このプロセス内では (優先度, 到着順) の順に実行枠を取ります。
+    共有ストアの実行枠は lease_seconds で切れるため、枠を持つ間の処理の最大の所要時間より長くしてください。
+    """
+
+    def __init__(self, limits=None, store=None, default_rpm=600, default_concurrency=16,
+                 max_wait=30.0, background_reserve=1, lease_seconds=SLOT_LEASE_SECONDS):
+        self.limits = limits or {}
+        self.store = store or LocalLimitStore()
+        self.default_rpm = default_rpm
+        self.default_concurrency = default_concurrency
+        self.max_wait = max_wait
+        self.background_reserve = background_reserve
+        self.lease_seconds = lease_seconds
+
+        self._cond = threading.Condition()
+        self._waiters = {}  # model -> heap of (priority, seq)
+        self._seq = itertools.count()
+        self._stats = {}    # "model:endpoint" -> _WaitStats
+
+    def _model_limits(self, model):
+        config = self.limits.get(model, {})
+        return config.get("rpm", self.default_rpm), config.get("concurrency", self.default_concurrency)
+
+    def _slot_limit(self, limit, priority):
+        if priority == PRIORITY_INTERACTIVE:
+            return limit
+        return max(1, limit - self.background_reserve)
+
+    def _try_acquire(self, model, endpoint, priority, holder):
+        """実行枠を確保できれば (0, 確保したキー)、できなければ (待つべき秒数, []) を返します。"""
+        rpm, concurrency = self._model_limits(model)
+        slot_keys = [(model, concurrency)]
+        endpoint_limit = self.limits.get(f"{model}:{endpoint}", {}).get("concurrency")
+        if endpoint_limit:
+            slot_keys.append((f"{model}:{endpoint}", endpoint_limit))
+
+        acquired = []
+        for key, limit in slot_keys:
+            if not self.store.acquire_slot(key, self._slot_limit(limit, priority), holder, self.lease_seconds):
+                self._release_slots(acquired, holder)
+                # 空きは release 時の通知で分かるが、他プロセスの解放は分からないので短い間隔で確認する
+                return 0.05, []
+            acquired.append(key)
+
+        if rpm:
+            rate = rpm / 60.0
+            wait = self.store.take_token(model, rate, max(1.0, rate))
+            if wait > 0:
+                self._release_slots(acquired, holder)
+                return wait, []
+        return 0.0, acquired
+
+    def _stats_for(self, stats_key):
+        with self._cond:
+            return self._stats.setdefault(stats_key, _WaitStats())
+
+    def _release_slots(self, acquired, holder):
+        for key in acquired:
+            self.store.release_slot(key, holder)
+
+    def _has_waiters(self, model):
+        with self._cond:
+            return bool(self._waiters.get(model))
+
+    def _acquire_immediately(self, model, endpoint, priority, holder):
+        """待っている呼び出しがなければ、待ち行列に並ばずに実行枠を取ります。取れなければ None。"""
+        if self._has_waiters(model):
+            return None
+        wait, acquired = self._try_acquire(model, endpoint, priority, holder)
+        return None if wait else acquired
+
+    def _enqueue(self, model, stats, priority):
+        ticket = (priority, next(self._seq))
+        with self._cond:
+            stats.waiting += 1
+            heapq.heappush(self._waiters.setdefault(model, []), ticket)
+        return ticket
+
+    def _dequeue(self, model, ticket, stats, timed_out):
+        with self._cond:
+            heap = self._waiters[model]
+            heap.remove(ticket)
+            heapq.heapify(heap)
+            stats.waiting -= 1
+            if timed_out:
+                stats.timeouts += 1
+            self._cond.notify_all()
+
+    def _is_head(self, model, ticket):
+        return self._waiters[model][0] == ticket
+
+    def _record_acquired(self, stats, waited):
+        with self._cond:
+            stats.acquired += 1
+            stats.in_flight += 1
+            stats.wait_total += waited
+            stats.wait_max = max(stats.wait_max, waited)
+            stats.recent_waits.append(waited)
+
+    def _release(self, acquired, holder, stats):
+        self._release_slots(acquired, holder)
+        self._record_released(stats)
+
+    def _record_released(self, stats):
+        with self._cond:
+            stats.in_flight -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, model, endpoint, priority=PRIORITY_BACKGROUND):
+        """実行枠を確保してから with ブロックを実行します。
+
+        max_wait 秒以内に確保できなければ RateLimitTimeout を投げます。
+        """
+        stats_key = f"{model}:{endpoint}"
+        holder = uuid.uuid4().hex
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        stats = self._stats_for(stats_key)
+        acquired = self._acquire_immediately(model, endpoint, priority, holder)
+
+        timed_out = False
+        ticket = self._enqueue(model, stats, priority) if acquired is None else None
+        try:
+            while ticket is not None:
+                with self._cond:
+                    # 先頭 (最も優先度が高く、早く来たもの) になるまで待つ
+                    while not self._is_head(model, ticket):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            timed_out = True
+                            raise RateLimitTimeout(stats_key, self.max_wait)
+                        self._cond.wait(remaining)
+
+                wait, acquired = self._try_acquire(model, endpoint, priority, holder)
+                if not wait:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    timed_out = True
+                    raise RateLimitTimeout(stats_key, max(wait, 1.0))
+                with self._cond:
+                    self._cond.wait(min(wait, remaining))
+        finally:
+            if ticket is not None:
+                self._dequeue(model, ticket, stats, timed_out)
+
+        self._record_acquired(stats, time.monotonic() - started)
+        try:
+            yield
+        finally:
+            self._release(acquired, holder, stats)
+
+    async def _atry_acquire(self, model, endpoint, priority, holder):
+        """_try_acquire() の asyncio 版。
+
+        共有ストアの操作 (SQLite のロック待ち・Redis の往復) はイベントループを止めないようスレッドで行います。
+        待っている間にキャンセルされた場合は、スレッド側で確保してしまった枠を後で返します。
+        """
+        if not self.store.blocking:
+            return self._try_acquire(model, endpoint, priority, holder)
+        future = asyncio.ensure_future(asyncio.to_thread(self._try_acquire, model, endpoint, priority, holder))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(lambda done: self._release_abandoned(done, holder))
+            raise
+
+    def _release_abandoned(self, future, holder):
+        if future.cancelled() or future.exception() is not None:
+            return
+        _, acquired = future.result()
+        if acquired:
+            asyncio.ensure_future(asyncio.to_thread(self._release_slots, acquired, holder))
+
+    async def _arelease(self, acquired, holder, stats):
+        if self.store.blocking:
+            await asyncio.to_thread(self._release_slots, acquired, holder)
+        else:
+            self._release_slots(acquired, holder)
+        self._record_released(stats)
+
+    @asynccontextmanager
+    async def aslot(self, model, endpoint, priority=PRIORITY_BACKGROUND):
+        """slot() の asyncio 版。イベントループを止めないよう、待ちは短い間隔の asyncio.sleep で行い、
+        共有ストアの操作はスレッドで行います。
+
+        同期版の待ち行列と同じものを使うため、優先度はスレッドとコルーチンの間でも守られます。
+        """
+        stats_key = f"{model}:{endpoint}"
+        holder = uuid.uuid4().hex
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        stats = self._stats_for(stats_key)
+        acquired = None
+        if not self._has_waiters(model):
+            wait, acquired = await self._atry_acquire(model, endpoint, priority, holder)
+            acquired = None if wait else acquired
+
+        timed_out = False
+        ticket = self._enqueue(model, stats, priority) if acquired is None else None
+        try:
+            while ticket is not None:
+                with self._cond:
+                    is_head = self._is_head(model, ticket)
+                if is_head:
+                    wait, acquired = await self._atry_acquire(model, endpoint, priority, holder)
+                else:
+                    wait, acquired = 0.01, []
+                if not wait:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    timed_out = True
+                    raise RateLimitTimeout(stats_key, max(wait, 1.0))
+                await asyncio.sleep(min(wait, remaining))
+        finally:
+            if ticket is not None:
+                self._dequeue(model, ticket, stats, timed_out)
+
+        self._record_acquired(stats, time.monotonic() - started)
+        try:
+            yield
+        finally:
+            await self._arelease(acquired, holder, stats)
+
+    def stats(self):
+        with self._cond:
+            return {key: stats.as_dict() for key, stats in sorted(self._stats.items())}
+
+
+def governor_from_env(lease_seconds=None):
+    """環境変数から UpstreamGovernor を作ります。
+
+    - GEMINI_RATE_LIMITS: モデル・エンドポイントごとの上限 (JSON)
+      例: {"gemini-2.5-flash": {"rpm": 600, "concurrency": 16}, "gemini-2.5-flash:summary": {"concurrency": 4}}
+    - GEMINI_DEFAULT_RPM / GEMINI_DEFAULT_CONCURRENCY: 設定のないモデルの上限
+    - GEMINI_MAX_QUEUE_WAIT: 実行枠を待つ最大秒数
+    - GEMINI_BACKGROUND_RESERVE: バックグラウンド処理に使わせない同時実行枠の数
+    - RATE_LIMIT_SHARED_URL (未指定なら CACHE_SHARED_URL): ワーカー間で上限を共有するストア
+    - GEMINI_SLOT_LEASE_SECONDS: 共有ストアの実行枠のリース期間 (未指定なら lease_seconds、それもなければ既定値)
+    """
+    return UpstreamGovernor(
+        limits=json.loads(os.environ.get('GEMINI_RATE_LIMITS') or "{}"),
+        store=limit_store_from_url(os.environ.get('RATE_LIMIT_SHARED_URL') or os.environ.get('CACHE_SHARED_URL')),
+        default_rpm=float(os.environ.get('GEMINI_DEFAULT_RPM', 600)),
+        default_concurrency=int(os.environ.get('GEMINI_DEFAULT_CONCURRENCY', 16)),
+        max_wait=float(os.environ.get('GEMINI_MAX_QUEUE_WAIT', 30)),
+        background_reserve=int(os.environ.get('GEMINI_BACKGROUND_RESERVE', 1)),
+        lease_seconds=float(os.environ.get('GEMINI_SLOT_LEASE_SECONDS') or lease_seconds or SLOT_LEASE_SECONDS),
+    )
@@ -0,0 +1,410 @@
+"""
+スキーマのマイグレーションとクエリプランのチェック。
+
+使い方:
+    python schema.py migrate   # 未適用のマイグレーションを適用
+    python schema.py check     # ダッシュボード・検索のクエリがSeq Scanになっていないか確認
+"""
+import os
+import sys
+import json
+
+import psycopg2
+from dotenv import load_dotenv
+
+from feedback_search import SEARCH_QUERIES
+from queries import DASHBOARD_QUERIES
+
+# -------------------------------------------------------------
+# マイグレーション定義: (バージョン, 名前, SQL)
+# 追加するときは末尾にバージョンを増やして追記してください。
+# -------------------------------------------------------------
+MIGRATIONS = [
+    (1, "normalized_lookup_keys", """
+        -- students: 正規化済みキーを生成列として保持
+        ALTER TABLE public.students
+            ADD COLUMN IF NOT EXISTS email_key text
+                GENERATED ALWAYS AS (TRIM(LOWER(email))) STORED,
+            ADD COLUMN IF NOT EXISTS team_key text
+                GENERATED ALWAYS AS (TRIM(LOWER(team_name))) STORED;
+
+        CREATE INDEX IF NOT EXISTS students_email_key_idx
+            ON public.students (email_key);
+        CREATE INDEX IF NOT EXISTS students_team_key_idx
+            ON public.students (team_key);
+
+        -- sessions: booth_id は submit_feedback で正規化して書き込むので、
+        -- 過去に正規化されずに入った行だけを揃える
+        UPDATE public.sessions
+            SET booth_id = TRIM(LOWER(booth_id))
+            WHERE booth_id <> TRIM(LOWER(booth_id));
+
+        CREATE INDEX IF NOT EXISTS sessions_booth_id_id_desc_idx
+            ON public.sessions (booth_id, id DESC);
+    """),
+    (2, "booth_aggregates", """
+        -- 暫定スコア (flask_app.py の _feedback_score と同じロジック)
+        CREATE OR REPLACE FUNCTION public.session_score(is_processed boolean)
+            RETURNS integer LANGUAGE sql IMMUTABLE AS $$
+                SELECT CASE WHEN COALESCE(is_processed, false) THEN 85 ELSE 50 END
+            $$;
+
+        -- ブースごとの集計 (sessions のトリガーで増分更新)
+        CREATE TABLE IF NOT EXISTS public.booth_stats (
+            booth_id text PRIMARY KEY,
+            total_count bigint NOT NULL DEFAULT 0,
+            processed_count bigint NOT NULL DEFAULT 0,
+            score_sum bigint NOT NULL DEFAULT 0,
+            praise_ratio_sum double precision NOT NULL DEFAULT 0,
+            advice_ratio_sum double precision NOT NULL DEFAULT 0,
+            last_session_id bigint,
+            updated_at timestamptz NOT NULL DEFAULT now()
+        );
+
+        CREATE OR REPLACE FUNCTION public.booth_stats_apply() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    UPDATE public.booth_stats SET
+                        total_count = total_count - 1,
+                        processed_count = processed_count - COALESCE(OLD.is_processed, false)::int,
+                        score_sum = score_sum - public.session_score(OLD.is_processed),
+                        praise_ratio_sum = praise_ratio_sum - COALESCE(OLD.praise_ratio, 0),
+                        advice_ratio_sum = advice_ratio_sum - COALESCE(OLD.advice_ratio, 0),
+                        updated_at = now()
+                    WHERE booth_id = OLD.booth_id;
+                END IF;
+
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    INSERT INTO public.booth_stats AS b (
+                        booth_id, total_count, processed_count, score_sum,
+                        praise_ratio_sum, advice_ratio_sum, last_session_id
+                    ) VALUES (
+                        NEW.booth_id, 1, COALESCE(NEW.is_processed, false)::int,
+                        public.session_score(NEW.is_processed),
+                        COALESCE(NEW.praise_ratio, 0), COALESCE(NEW.advice_ratio, 0), NEW.id
+                    )
+                    ON CONFLICT (booth_id) DO UPDATE SET
+                        total_count = b.total_count + 1,
+                        processed_count = b.processed_count + EXCLUDED.processed_count,
+                        score_sum = b.score_sum + EXCLUDED.score_sum,
+                        praise_ratio_sum = b.praise_ratio_sum + EXCLUDED.praise_ratio_sum,
+                        advice_ratio_sum = b.advice_ratio_sum + EXCLUDED.advice_ratio_sum,
+                        last_session_id = GREATEST(b.last_session_id, EXCLUDED.last_session_id),
+                        updated_at = now();
+                END IF;
+
+                RETURN NULL;
+            END
+            $$;
+
+        DROP TRIGGER IF EXISTS sessions_booth_stats ON public.sessions;
+        CREATE TRIGGER sessions_booth_stats
+            AFTER INSERT OR UPDATE OR DELETE ON public.sessions
+            FOR EACH ROW EXECUTE FUNCTION public.booth_stats_apply();
+
+        -- イベント全体の集計 (students の文単位トリガーで再計算)
+        CREATE TABLE IF NOT EXISTS public.event_stats (
+            key text PRIMARY KEY,
+            value bigint NOT NULL
+        );
+
+        CREATE OR REPLACE FUNCTION public.event_stats_refresh_teams() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                INSERT INTO public.event_stats (key, value)
+                    SELECT 'total_teams_count', COUNT(DISTINCT team_key) FROM public.students
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+                RETURN NULL;
+            END
+            $$;
+
+        DROP TRIGGER IF EXISTS students_event_stats ON public.students;
+        CREATE TRIGGER students_event_stats
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.students
+            FOR EACH STATEMENT EXECUTE FUNCTION public.event_stats_refresh_teams();
+
+        -- 既存データから集計を作成
+        -- (適用済みのマイグレーションと内容が変わらないよう、aggregates.py の再構築SQLを参照せずにこの時点の内容を固定)
+        LOCK TABLE public.sessions IN SHARE MODE;
+
+        DELETE FROM public.booth_stats;
+
+        INSERT INTO public.booth_stats (
+            booth_id, total_count, processed_count, score_sum,
+            praise_ratio_sum, advice_ratio_sum, last_session_id
+        )
+        SELECT
+            s.booth_id,
+            COUNT(*),
+            COUNT(*) FILTER (WHERE s.is_processed),
+            SUM(public.session_score(s.is_processed)),
+            SUM(COALESCE(s.praise_ratio, 0)),
+            SUM(COALESCE(s.advice_ratio, 0)),
+            MAX(s.id)
+        FROM
+            public.sessions s
+        GROUP BY
+            s.booth_id;
+
+        INSERT INTO public.event_stats (key, value)
+            SELECT 'total_teams_count', COUNT(DISTINCT team_key) FROM public.students
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+    """),
+    (3, "summary_job_queue", """
+        -- 要約ジョブのキュー管理用 (is_processed = false の行がジョブ)
+        ALTER TABLE public.sessions
+            ADD COLUMN IF NOT EXISTS summary_attempts integer NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS summary_locked_until timestamptz,
+            ADD COLUMN IF NOT EXISTS summary_error text;
+
+        CREATE INDEX IF NOT EXISTS sessions_unprocessed_idx
+            ON public.sessions (id)
+            WHERE NOT is_processed;
+
+        -- ジョブ管理列だけの更新で集計 (とETag) が動かないよう、UPDATE トリガーを条件付きにする
+        DROP TRIGGER IF EXISTS sessions_booth_stats ON public.sessions;
+        CREATE TRIGGER sessions_booth_stats
+            AFTER INSERT OR DELETE ON public.sessions
+            FOR EACH ROW EXECUTE FUNCTION public.booth_stats_apply();
+        CREATE TRIGGER sessions_booth_stats_update
+            AFTER UPDATE ON public.sessions
+            FOR EACH ROW
+            WHEN ((OLD.booth_id, OLD.is_processed, OLD.praise_ratio, OLD.advice_ratio, OLD.raw_text, OLD.summary_text)
+                  IS DISTINCT FROM
+                  (NEW.booth_id, NEW.is_processed, NEW.praise_ratio, NEW.advice_ratio, NEW.raw_text, NEW.summary_text))
+            EXECUTE FUNCTION public.booth_stats_apply();
+    """),
+    (4, "idempotency_keys", """
+        -- submit_feedback / generate_summary の冪等キー (idempotency.py)
+        -- 主キーで同じキーのリクエストを1件に絞り、成功した応答を保存して再送時に返す
+        CREATE TABLE IF NOT EXISTS public.idempotency_keys (
+            scope text NOT NULL,
+            key text NOT NULL,
+            request_hash text NOT NULL,
+            status_code integer,
+            response jsonb,
+            locked_until timestamptz,
+            created_at timestamptz NOT NULL DEFAULT now(),
+            expires_at timestamptz NOT NULL,
+            PRIMARY KEY (scope, key)
+        );
+
+        CREATE INDEX IF NOT EXISTS idempotency_keys_expires_at_idx
+            ON public.idempotency_keys (expires_at);
+    """),
+    (5, "local_feedback_score", """
+        -- 本文から算出したスコアと採点方法 (feedback_scorer.py: 'local:<版>' / 'client' / 'gemini')
+        ALTER TABLE public.sessions
+            ADD COLUMN IF NOT EXISTS score smallint,
+            ADD COLUMN IF NOT EXISTS scorer text;
+
+        -- score があればそれを、なければ従来の暫定スコアを使う (flask_app.py の _feedback_score と同じロジック)
+        CREATE OR REPLACE FUNCTION public.session_score(score integer, is_processed boolean)
+            RETURNS integer LANGUAGE sql IMMUTABLE AS $$
+                SELECT COALESCE(score, public.session_score(is_processed))
+            $$;
+
+        CREATE OR REPLACE FUNCTION public.booth_stats_apply() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    UPDATE public.booth_stats SET
+                        total_count = total_count - 1,
+                        processed_count = processed_count - COALESCE(OLD.is_processed, false)::int,
+                        score_sum = score_sum - public.session_score(OLD.score, OLD.is_processed),
+                        praise_ratio_sum = praise_ratio_sum - COALESCE(OLD.praise_ratio, 0),
+                        advice_ratio_sum = advice_ratio_sum - COALESCE(OLD.advice_ratio, 0),
+                        updated_at = now()
+                    WHERE booth_id = OLD.booth_id;
+                END IF;
+
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    INSERT INTO public.booth_stats AS b (
+                        booth_id, total_count, processed_count, score_sum,
+                        praise_ratio_sum, advice_ratio_sum, last_session_id
+                    ) VALUES (
+                        NEW.booth_id, 1, COALESCE(NEW.is_processed, false)::int,
+                        public.session_score(NEW.score, NEW.is_processed),
+                        COALESCE(NEW.praise_ratio, 0), COALESCE(NEW.advice_ratio, 0), NEW.id
+                    )
+                    ON CONFLICT (booth_id) DO UPDATE SET
+                        total_count = b.total_count + 1,
+                        processed_count = b.processed_count + EXCLUDED.processed_count,
+                        score_sum = b.score_sum + EXCLUDED.score_sum,
+                        praise_ratio_sum = b.praise_ratio_sum + EXCLUDED.praise_ratio_sum,
+                        advice_ratio_sum = b.advice_ratio_sum + EXCLUDED.advice_ratio_sum,
+                        last_session_id = GREATEST(b.last_session_id, EXCLUDED.last_session_id),
+                        updated_at = now();
+                END IF;
+
+                RETURN NULL;
+            END
+            $$;
+
+        -- 再採点 (score の更新) でも集計が動くよう、UPDATE トリガーの条件に score を加える
+        DROP TRIGGER IF EXISTS sessions_booth_stats_update ON public.sessions;
+        CREATE TRIGGER sessions_booth_stats_update
+            AFTER UPDATE ON public.sessions
+            FOR EACH ROW
+            WHEN ((OLD.booth_id, OLD.is_processed, OLD.praise_ratio, OLD.advice_ratio, OLD.raw_text, OLD.summary_text,
+                   OLD.score)
+                  IS DISTINCT FROM
+                  (NEW.booth_id, NEW.is_processed, NEW.praise_ratio, NEW.advice_ratio, NEW.raw_text, NEW.summary_text,
+                   NEW.score))
+            EXECUTE FUNCTION public.booth_stats_apply();
+
+        -- 未採点・古い版で採点した行の再採点 (feedback_scorer.py rescore) 用
+        CREATE INDEX IF NOT EXISTS sessions_rescore_idx
+            ON public.sessions (id)
+            WHERE scorer IS NULL OR scorer LIKE 'local:%';
+    """),
+    (6, "feedback_search", """
+        -- 全文検索 (feedback_search.py) 用の正規化: 小文字化 + NFKC (全角英数・半角カナ・全角スペースを揃える)
+        CREATE OR REPLACE FUNCTION public.search_normalize(body text)
+            RETURNS text LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+                SELECT normalize(lower(COALESCE(body, '')), NFKC)
+            $$;
+
+        -- 文字列の 1-gram と 2-gram (2-gram は偶数・奇数の位置から regexp_matches で2文字ずつ切り出す)。
+        -- 日本語は単語の区切りがなく、pg_trgm は3文字未満の語を引けないため、文字の bi-gram で索引します。
+        -- 重複はGINが取り除くので DISTINCT しません。空白を含む gram も残りますが、検索語からは作られません。
+        -- COST: 1行ずつ評価するプラン (主キーの逆順走査 + フィルタなど) をプランナに選ばせないため
+        CREATE OR REPLACE FUNCTION public.search_text_grams(body text)
+            RETURNS text[] LANGUAGE sql IMMUTABLE PARALLEL SAFE COST 10000 AS $$
+                SELECT regexp_split_to_array(body, '')
+                    || ARRAY(SELECT m[1] FROM regexp_matches(body, '..', 'g') AS m)
+                    || ARRAY(SELECT m[1] FROM regexp_matches(substr(body, 2), '..', 'g') AS m)
+            $$;
+
+        -- 検索語から引く gram: 2文字以上なら 2-gram、1文字ならその文字
+        CREATE OR REPLACE FUNCTION public.search_query_grams(term text)
+            RETURNS text[] LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+                SELECT CASE WHEN length(t.body) < 2 THEN ARRAY[t.body] ELSE ARRAY(
+                    SELECT DISTINCT substr(t.body, i, 2) FROM generate_series(1, length(t.body) - 1) AS i
+                ) END
+                FROM (SELECT public.search_normalize(term) AS body) t
+            $$;
+
+        -- 正規化した本文・要約 (一致の確認と出現回数の計算を、検索のたびに正規化せずに行う)
+        ALTER TABLE public.sessions
+            ADD COLUMN IF NOT EXISTS search_raw text
+                GENERATED ALWAYS AS (public.search_normalize(raw_text)) STORED,
+            ADD COLUMN IF NOT EXISTS search_summary text
+                GENERATED ALWAYS AS (public.search_normalize(summary_text)) STORED;
+
+        -- 式インデックス (検索は同じ式で比較すること)
+        CREATE INDEX IF NOT EXISTS sessions_search_grams_idx
+            ON public.sessions USING gin (public.search_text_grams(search_raw || E'\\n' || search_summary));
+    """),
+]
+
+
+def _ensure_migrations_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS public.schema_migrations (
+            version integer PRIMARY KEY,
+            name text NOT NULL,
+            applied_at timestamptz NOT NULL DEFAULT now()
+        );
+    """)
+
+
+def migrate(conn):
+    """未適用のマイグレーションを1件ずつトランザクション内で適用します。"""
+    with conn.cursor() as cursor:
+        _ensure_migrations_table(cursor)
+        conn.commit()
+
+        cursor.execute("SELECT version FROM public.schema_migrations;")
+        applied = {row[0] for row in cursor.fetchall()}
+
+    applied_now = []
+    for version, name, sql in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql)
+                cursor.execute(
+                    "INSERT INTO public.schema_migrations (version, name) VALUES (%s, %s);",
+                    (version, name),
+                )
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        print(f"✅ マイグレーション {version:03d}_{name} を適用しました。")
+        applied_now.append(version)
+
+    if not applied_now:
+        print("✅ 適用が必要なマイグレーションはありません。")
+    return applied_now
+
+
+# -------------------------------------------------------------
+# EXPLAINによるクエリプランのチェック
+# -------------------------------------------------------------
+def _find_seq_scans(plan):
+    """EXPLAIN (FORMAT JSON) のプランツリーから Seq Scan のテーブル名を集めます。"""
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        found.append(plan.get("Relation Name", "?"))
+    for child in plan.get("Plans", []):
+        found.extend(_find_seq_scans(child))
+    return found
+
+
+def check_query_plans(conn, queries=DASHBOARD_QUERIES):
+    """ダッシュボードの各クエリを EXPLAIN し、Seq Scan を含むクエリを返します。
+
+    テーブルが小さいとプランナはインデックスがあっても Seq Scan を選ぶため、
+    enable_seqscan を off にしてもなお Seq Scan になる (= 使えるインデックスがない)
+    クエリだけを検出します。
+    """
+    failures = {}
+    with conn.cursor() as cursor:
+        cursor.execute("SET LOCAL enable_seqscan = off;")
+        for name, sql, params in queries:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql.strip().rstrip(";"), params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            seq_scans = _find_seq_scans(plan[0]["Plan"])
+            if seq_scans:
+                failures[name] = seq_scans
+    conn.rollback()
+    return failures
+
+
+def main(argv):
+    load_dotenv()
+    command = argv[1] if len(argv) > 1 else "migrate"
+    if command not in ("migrate", "check"):
+        print(__doc__)
+        return 2
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        print("❌ DATABASE_URLが設定されていません。")
+        return 1
+
+    conn = psycopg2.connect(database_url, connect_timeout=5)
+    try:
+        if command == "migrate":
+            migrate(conn)
+            return 0
+
+        failures = check_query_plans(conn, DASHBOARD_QUERIES + SEARCH_QUERIES)
+        if failures:
+            for name, tables in failures.items():
+                print(f"❌ {name}: Seq Scan が発生しています ({', '.join(tables)})")
+            return 1
+        print("✅ ダッシュボードと検索の全クエリがインデックスを使用しています。")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -13,7 +13,6 @@ const FeedbackForm = ({ onSubmit }) => {
 
   const [isSubmitting, setIsSubmitting] = useState(false);
   const [isProcessingAudio, setIsProcessingAudio] = useState(false); // 音声処理中のステート
-  const [isGeneratingSummary, setIsGeneratingSummary] = useState(false); // ★★★ 追加: 要約生成中のステート ★★★
 
   // 録音関連のステートと参照
   const [isRecording, setIsRecording] = useState(false);
@@ -33,12 +32,12 @@ const FeedbackForm = ({ onSubmit }) => {
     setFormData((prev) => ({ ...prev, [name]: value }));
   };
 
-  // ★★★ 修正箇所: handleSubmit関数 - 要約生成とデータベース送信を統合 ★★★
+  // ★★★ 修正箇所: handleSubmit関数 - 先にデータベースへ送信し、要約はサーバー側で非同期に生成 ★★★
   const handleSubmit = async (e) => {
     e.preventDefault();
 
     // 処理中の場合は何もしない
-    if (isSubmitting || isProcessingAudio || isGeneratingSummary) return;
+    if (isSubmitting || isProcessingAudio) return;
 
     if (!formData.booth_id || !formData.visitor_attribute) {
       customAlert("必須項目（属性とブース番号）をすべて入力してください。");
@@ -54,49 +53,13 @@ const FeedbackForm = ({ onSubmit }) => {
     }
 
     setIsSubmitting(true);
-    setIsGeneratingSummary(true); // 要約生成を開始
-    let summaryText = "";
 
-    try {
-      customAlert("要約を生成しています。しばらくお待ちください...");
-      const API_URL_SUMMARY = "http://localhost:5000/api/generate_summary";
-
-      // 1. 要約生成APIを呼び出し
-      const summaryResponse = await fetch(API_URL_SUMMARY, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ raw_text: rawText }),
-      });
-
-      const summaryResult = await summaryResponse.json();
-
-      if (summaryResponse.ok) {
-        summaryText = summaryResult.summary_text;
-        console.log(`要約生成成功: ${summaryText}`);
-      } else {
-        // 要約生成に失敗した場合は、エラーメッセージをSummaryとして保存し、警告する
-        summaryText = `【要約エラー: ${
-          summaryResult.message || "不明なエラー"
-        } 詳細: ${summaryResult.error_detail || ""}}`;
-        customAlert(
-          `要約生成エラー: ${summaryResult.message || "不明なエラー"}`
-        );
-      }
-    } catch (error) {
-      summaryText = `【要約エラー: ネットワーク接続】`;
-      customAlert("要約生成中にネットワークエラーが発生しました。");
-      console.error("Summary Fetch Error:", error);
-    } finally {
-      setIsGeneratingSummary(false); // 要約生成を終了
-    }
-
-    // 2. データベースに送信
+    // 要約はサーバー側のバックグラウンドジョブで生成されるため、
+    // ここでは要約を待たずにデータベースへ送信する
+    // (褒め/アドバイスの割合とスコアはサーバーが本文から算出する)
     const dataToSend = {
       ...formData,
       raw_text: rawText, // 編集後のテキストを使用
-      summary_text: summaryText, // 生成した要約を追加
-      praise_ratio: "50",
-      advice_ratio: "50",
     };
 
     // onSubmitの非同期処理が完了したら、isSubmittingを解除
@@ -106,8 +69,8 @@ const FeedbackForm = ({ onSubmit }) => {
   // ====== 音声認識機能の追加 ======
 
   const startRecording = async () => {
-    // 録音中、音声処理中、要約生成中は開始できない
-    if (isRecording || isProcessingAudio || isGeneratingSummary) return;
+    // 録音中、音声処理中は開始できない
+    if (isRecording || isProcessingAudio) return;
 
     try {
       const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
@@ -141,60 +104,54 @@ const FeedbackForm = ({ onSubmit }) => {
           type: options.mimeType,
         });
 
-        // BlobからBase64文字列に変換
-        const reader = new FileReader();
-        reader.readAsDataURL(audioBlob);
-        reader.onloadend = async () => {
-          const base64Audio = reader.result.split(",")[1]; // 'data:audio/...' のヘッダーを削除
-
-          const API_URL = "http://localhost:5000/api/process_audio";
-
-          try {
-            const response = await fetch(API_URL, {
-              method: "POST",
-              headers: { "Content-Type": "application/json" },
-              body: JSON.stringify({
-                audio_data: base64Audio,
-                mime_type: options.mimeType,
-                booth_id: formData.booth_id || "UNKNOWN", // ブースIDも送信
-              }),
-            });
-
-            const result = await response.json();
-
-            if (response.ok) {
-              setFormData((prev) => ({
-                ...prev,
-                raw_text: result.stt_text,
-              }));
-              // ★★★ 修正: STTが完了したことと、次のアクションをユーザーに指示 ★★★
-              customAlert(
-                "音声のテキスト化が完了しました。内容を確認し、「送信」を押して要約を生成・保存してください。"
-              );
-            } else {
-              customAlert(
-                `音声処理エラー: ${result.message || "不明なエラー"}\n詳細: ${
-                  result.error_detail || ""
-                }`
-              );
-              setFormData((prev) => ({
-                ...prev,
-                raw_text:
-                  "音声処理エラーが発生しました。手動で入力してください。",
-              }));
-            }
-          } catch (error) {
-            customAlert("ネットワークエラー: サーバーに接続できませんでした。");
-            console.error("Fetch Error:", error);
+        // Blobをそのままmultipart/form-dataで送信（Base64変換によるサイズ増加を避ける）
+        const uploadData = new FormData();
+        uploadData.append("audio", audioBlob, "recording.webm");
+        uploadData.append("mime_type", options.mimeType);
+        uploadData.append("booth_id", formData.booth_id || "UNKNOWN"); // ブースIDも送信
+
+        const API_URL = "http://localhost:5000/api/process_audio";
+
+        try {
+          const response = await fetch(API_URL, {
+            method: "POST",
+            body: uploadData,
+          });
+
+          const result = await response.json();
+
+          if (response.ok) {
+            setFormData((prev) => ({
+              ...prev,
+              raw_text: result.stt_text,
+            }));
+            // ★★★ 修正: STTが完了したことと、次のアクションをユーザーに指示 ★★★
+            customAlert(
+              "音声のテキスト化が完了しました。内容を確認し、「送信」を押して保存してください（要約は自動で生成されます）。"
+            );
+          } else {
+            customAlert(
+              `音声処理エラー: ${result.message || "不明なエラー"}\n詳細: ${
+                result.error_detail || ""
+              }`
+            );
             setFormData((prev) => ({
               ...prev,
               raw_text:
-                "ネットワークエラーが発生しました。手動で入力してください。",
+                "音声処理エラーが発生しました。手動で入力してください。",
             }));
-          } finally {
-            setIsProcessingAudio(false);
           }
-        };
+        } catch (error) {
+          customAlert("ネットワークエラー: サーバーに接続できませんでした。");
+          console.error("Fetch Error:", error);
+          setFormData((prev) => ({
+            ...prev,
+            raw_text:
+              "ネットワークエラーが発生しました。手動で入力してください。",
+          }));
+        } finally {
+          setIsProcessingAudio(false);
+        }
       };
 
       mediaRecorder.start();
@@ -356,12 +313,12 @@ const FeedbackForm = ({ onSubmit }) => {
           <button
             type="button"
             onClick={startRecording}
-            // 録音中、音声処理中、要約生成中は無効
-            disabled={isRecording || isProcessingAudio || isGeneratingSummary}
+            // 録音中、音声処理中は無効
+            disabled={isRecording || isProcessingAudio}
             className={`flex-1 py-3 px-4 rounded-xl font-bold text-white transition duration-150 shadow-md flex items-center justify-center ${
               isRecording
                 ? "bg-red-500 animate-pulse" // 録音中は赤く点滅
-                : isProcessingAudio || isGeneratingSummary
+                : isProcessingAudio
                 ? "bg-gray-500 cursor-not-allowed" // 処理中は灰色
                 : "bg-green-600 hover:bg-green-700" // 通常は緑
             }`}
@@ -372,8 +329,8 @@ const FeedbackForm = ({ onSubmit }) => {
           <button
             type="button"
             onClick={stopRecording}
-            // 録音中で、かつ音声処理中、要約生成中でない場合のみ有効
-            disabled={!isRecording || isProcessingAudio || isGeneratingSummary}
+            // 録音中で、かつ音声処理中でない場合のみ有効
+            disabled={!isRecording || isProcessingAudio}
             className={`flex-1 py-3 px-4 rounded-xl font-bold transition duration-150 shadow-md flex items-center justify-center ${
               !isRecording
                 ? "bg-gray-400 cursor-not-allowed text-gray-700"
@@ -384,11 +341,9 @@ const FeedbackForm = ({ onSubmit }) => {
             ストップ
           </button>
         </div>
-        {(isProcessingAudio || isGeneratingSummary) && (
+        {isProcessingAudio && (
           <div className="mt-2 text-center text-sm font-medium text-indigo-600">
-            {isProcessingAudio
-              ? "AIが音声をテキスト化中..."
-              : "AIが要約を生成中..."}
+            AIが音声をテキスト化中...
           </div>
         )}
       </div>
@@ -402,8 +357,8 @@ const FeedbackForm = ({ onSubmit }) => {
           value={formData.raw_text}
           onChange={handleChange}
           required
-          // 音声処理中、要約生成中はテキストエリアを無効化
-          disabled={isProcessingAudio || isGeneratingSummary}
+          // 音声処理中はテキストエリアを無効化
+          disabled={isProcessingAudio}
           className="block w-full px-4 py-3 text-lg border border-gray-300 rounded-xl shadow-inner focus:ring-indigo-500 focus:border-indigo-500 bg-white placeholder-gray-500"
           placeholder="録音されたフィードバックがテキスト化されてここに入ります。必要に応じて直接編集も可能です。"
         ></textarea>
@@ -413,13 +368,13 @@ const FeedbackForm = ({ onSubmit }) => {
       <button
         type="submit"
         className={`w-full py-4 px-4 rounded-xl text-xl font-bold text-white transition duration-150 shadow-lg mt-8 ${
-          isSubmitting || isProcessingAudio || isGeneratingSummary // 処理中は送信を無効化
+          isSubmitting || isProcessingAudio // 処理中は送信を無効化
             ? "bg-gray-400 cursor-not-allowed"
             : "bg-indigo-600 hover:bg-indigo-700"
         }`}
-        disabled={isSubmitting || isProcessingAudio || isGeneratingSummary}
+        disabled={isSubmitting || isProcessingAudio}
       >
-        {isSubmitting || isGeneratingSummary ? "処理中..." : "送信"}
+        {isSubmitting ? "処理中..." : "送信"}
       </button>
     </form>
   );
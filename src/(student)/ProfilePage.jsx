@@ -2,6 +2,8 @@ import React, { useState, useEffect, useCallback } from "react";
 
 // Flask APIのエンドポイント。
 const FLASK_API_BASE_URL = "http://localhost:5000/api/feedback";
+// 新着フィードバックのリアルタイム配信 (Server-Sent Events)
+const BOOTH_EVENTS_BASE_URL = "http://localhost:5000/api/booths";
 
 // --- UIコンポーネント用のアイコン (変更なし) ---
 const RefreshIcon = (props) => (
@@ -212,6 +214,48 @@ const ProfilePage = ({ user }) => {
     // userEmailとfetchFeedbackDataが変更されたときのみ実行
   }, [userEmail, fetchFeedbackData]);
 
+  // ブースの新着フィードバック・要約の完了をSSEで受け取り、全件を取り直さずに反映する
+  const subscribedBoothId = feedback?.booth_id || null;
+  useEffect(() => {
+    if (!userEmail || !subscribedBoothId || typeof EventSource === "undefined") {
+      return undefined;
+    }
+    // EventSource は切断時に Last-Event-ID 付きで自動的に再接続する
+    const source = new EventSource(
+      `${BOOTH_EVENTS_BASE_URL}/${encodeURIComponent(subscribedBoothId)}/events`
+    );
+
+    const applyEvent = (event) => {
+      const data = JSON.parse(event.data);
+      setFeedback((current) => {
+        if (!current) return current;
+        // 届いた行で置き換え、新しい行は先頭に追加する (id の降順を保つ)
+        const updated = new Map(data.feedbacks.map((item) => [item.id, item]));
+        const merged = (current.feedbacks || []).map((item) =>
+          updated.has(item.id) ? updated.get(item.id) : item
+        );
+        const known = new Set(merged.map((item) => item.id));
+        const added = data.feedbacks.filter((item) => !known.has(item.id));
+        return {
+          ...current,
+          total_count: data.total_count,
+          average_score: data.average_score,
+          feedbacks: [...added, ...merged],
+        };
+      });
+      if (data.truncated) {
+        fetchFeedbackData(userEmail);
+      }
+    };
+
+    source.addEventListener("feedback", applyEvent);
+    source.addEventListener("summary", applyEvent);
+    // サーバーが続きを送れない場合 (履歴切れ・取りこぼし) は全件を取り直す
+    source.addEventListener("reset", () => fetchFeedbackData(userEmail));
+
+    return () => source.close();
+  }, [userEmail, subscribedBoothId, fetchFeedbackData]);
+
   // --- データ抽出ロジックの更新 ★★★ ---
   const emailToDisplay = userEmail || "未ログイン";
 
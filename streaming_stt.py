@@ -0,0 +1,299 @@
+import os
+import time
+import queue
+import uuid
+import tempfile
+import threading
+
+from app_logging import get_logger
+from audio_preprocess import TARGET_SAMPLE_RATE, preprocess_audio
+from metrics import observe_size, span
+
+logger = get_logger("streaming_stt")
+
+# -------------------------------------------------------------
+# Google Cloud Speech-to-Text のストリーミング認識 (app.py で使用)
+# -------------------------------------------------------------
+# 録音中の音声をチャンク (MediaRecorder の timeslice ごとの Blob) で受け取り、
+# streaming_recognize に流しながら途中結果・確定結果をイベントとして蓄積します。
+# イベントは app.py の SSE エンドポイントから配信します。
+# - ストリーミング認識には1ストリームあたりの時間上限があるため、上限に近づいたら送信を止め、
+#   録音終了後に全音声を long_running_recognize で認識し直して最終結果にします。
+# - 一括アップロード (/recognize) も、同期認識の上限を超える音声は long_running_recognize に回します。
+
+# 同期認識 (recognize) の上限は約1分。前処理した音声は長さで、前処理できなかった WEBM_OPUS は
+# 長さが分からないためバイト数の目安で振り分け、それでも上限エラーが返ったら long_running_recognize で再試行します。
+SYNC_RECOGNIZE_MAX_SECONDS = 55
+SYNC_RECOGNIZE_MAX_BYTES = int(os.environ.get('STT_SYNC_MAX_BYTES', 900 * 1024))
+LONG_RUNNING_TIMEOUT = float(os.environ.get('STT_LONG_RUNNING_TIMEOUT', 600))
+
+# streaming_recognize の上限 (約305秒) より少し短い時間で送信を打ち切る
+STREAMING_LIMIT_SECONDS = float(os.environ.get('STT_STREAM_LIMIT_SECONDS', 290))
+
+# ストリーミングセッション中は音声全体を保持する (上限超過時の再認識用)
+STREAM_SPOOL_MAX_MEMORY = 1024 * 1024
+
+
+def _speech():
+    """google.cloud.speech は読み込みに時間がかかるため、最初に使うときに import します (ai_clients.py を参照)。"""
+    from google.cloud import speech_v1p1beta1 as speech
+    return speech
+
+
+def recognition_config(encoding="WEBM_OPUS", sample_rate_hertz=48000):
+    """/recognize と共通の認識設定。既定は ReactのMediaRecorderがデフォルトで出力する形式 (48kHz の WebM Opus)。
+
+    encoding は RecognitionConfig.AudioEncoding の名前です。
+    """
+    speech = _speech()
+    return speech.RecognitionConfig(
+        encoding=getattr(speech.RecognitionConfig.AudioEncoding, encoding),
+        sample_rate_hertz=sample_rate_hertz,
+        language_code="ja-JP",
+    )
+
+
+def transcript_of(response):
+    """recognize / long_running_recognize の応答から最も確信度の高い結果をつなげます。"""
+    return "".join(result.alternatives[0].transcript for result in response.results if result.alternatives)
+
+
+def _invalid_argument():
+    from google.api_core.exceptions import InvalidArgument
+    return InvalidArgument
+
+
+def _is_sync_limit_error(error):
+    message = str(error)
+    return "too long" in message or "LongRunningRecognize" in message
+
+
+def recognize_content(client, audio_content):
+    """音声全体を認識し、(文字起こし, 使った方式, 前処理のレポート) を返します。
+
+    先に無音除去・16kHzモノラル化 (audio_preprocess.py) をしてから送ります。前処理できなければ元の音声のまま送ります。
+    同期認識の上限を超える音声は long_running_recognize で認識します。
+    """
+    config = recognition_config()
+    report = None
+    fits_sync = len(audio_content) <= SYNC_RECOGNIZE_MAX_BYTES
+    observe_size("stt.audio", len(audio_content))
+    with span("audio.preprocess"):
+        processed = preprocess_audio(audio_content)
+    if processed is not None:
+        audio_content = processed.data
+        config = recognition_config("OGG_OPUS", TARGET_SAMPLE_RATE)
+        report = processed.report()
+        fits_sync = processed.processed_seconds <= SYNC_RECOGNIZE_MAX_SECONDS
+    audio = _speech().RecognitionAudio(content=audio_content)
+
+    if fits_sync:
+        try:
+            with span("stt.recognize"):
+                response = client.recognize(config=config, audio=audio)
+            return transcript_of(response), "sync", report
+        except _invalid_argument() as e:
+            if not _is_sync_limit_error(e):
+                raise
+            logger.warning("⚠️ 同期認識の上限を超えたため long_running_recognize で再試行します: %s", e)
+
+    with span("stt.long_running_recognize"):
+        operation = client.long_running_recognize(config=config, audio=audio)
+        response = operation.result(timeout=LONG_RUNNING_TIMEOUT)
+    return transcript_of(response), "long_running", report
+
+
+class StreamingRecognitionSession:
+    """1回の録音分のストリーミング認識。
+
+    feed() で受け取った音声チャンクを別スレッドで streaming_recognize に流し、
+    応答を次の形のイベントとして events に追記します。
+    - {"type": "interim", "text": ...}  途中結果 (次のイベントで置き換わる)
+    - {"type": "final", "text": ...}    確定した区間の結果
+    - {"type": "done", "text": ..., "mode": ..., "first_word_ms": ...}  録音全体の最終結果
+    - {"type": "error", "error": ...}
+    """
+
+    def __init__(self, client, session_id=None, limit_seconds=STREAMING_LIMIT_SECONDS):
+        self.client = client
+        self.session_id = session_id or uuid.uuid4().hex
+        self.limit_seconds = limit_seconds
+        self.created_at = time.monotonic()
+        self.last_activity = self.created_at
+
+        self._audio = queue.Queue()
+        self._spool = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_MAX_MEMORY)
+        self._cond = threading.Condition()
+        self.events = []
+        self.finished = False  # クライアントが録音終了を通知した
+        self.closed = False    # done / error を送り終えた
+        self.truncated = False
+        self.bytes_received = 0
+        self.first_chunk_at = None
+        self.first_word_ms = None
+        self._finals = []
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # --- クライアントからの入力 ---
+
+    def feed(self, chunk):
+        if self.finished or self.closed:
+            raise ValueError("録音はすでに終了しています")
+        if not chunk:
+            return
+        now = time.monotonic()
+        if self.first_chunk_at is None:
+            self.first_chunk_at = now
+        self.last_activity = now
+        self.bytes_received += len(chunk)
+        self._spool.write(chunk)
+        self._audio.put(chunk)
+
+    def finish(self):
+        self.finished = True
+        self.last_activity = time.monotonic()
+        self._audio.put(None)
+
+    # --- 認識スレッド ---
+
+    def _requests(self):
+        speech = _speech()
+        started = time.monotonic()
+        while True:
+            chunk = self._audio.get()
+            if chunk is None:
+                return
+            if time.monotonic() - started > self.limit_seconds:
+                # ストリームの上限。以降の音声は録音終了後にまとめて認識する
+                self.truncated = True
+                return
+            yield speech.StreamingRecognizeRequest(audio_content=chunk)
+
+    def _emit(self, event):
+        with self._cond:
+            self.events.append(event)
+            if event["type"] in ("done", "error"):
+                self.closed = True
+            self._cond.notify_all()
+
+    def _run(self):
+        streaming_config = _speech().StreamingRecognitionConfig(config=recognition_config(), interim_results=True)
+        try:
+            responses = self.client.streaming_recognize(config=streaming_config, requests=self._requests())
+            for response in responses:
+                for result in response.results:
+                    if not result.alternatives:
+                        continue
+                    text = result.alternatives[0].transcript
+                    if text and self.first_word_ms is None:
+                        self.first_word_ms = round((time.monotonic() - self.first_chunk_at) * 1000, 1)
+                    if result.is_final:
+                        self._finals.append(text)
+                    self._emit({"type": "final" if result.is_final else "interim", "text": text})
+
+            mode = "streaming"
+            transcript = "".join(self._finals)
+            if self.truncated:
+                # 録音終了まで待ってから全体を認識し直す
+                while self._audio.get() is not None:
+                    pass
+                self._spool.seek(0)
+                transcript, mode, _ = recognize_content(self.client, self._spool.read())
+            self._emit({"type": "done", "text": transcript, "mode": mode, "first_word_ms": self.first_word_ms})
+
+        except Exception as e:
+            logger.error("❌ ストリーミング認識エラー: %s", e)
+            self._emit({"type": "error", "error": f"Speech-to-Textエラーが発生しました: {e}"})
+        finally:
+            self._spool.close()
+
+    # --- SSE 配信 ---
+
+    def wait_events(self, after, timeout):
+        """after 番目より後のイベントを (番号, イベント) のリストで返します。なければ timeout 秒まで待ちます。"""
+        with self._cond:
+            if len(self.events) <= after and not self.closed:
+                self._cond.wait(timeout)
+            return list(enumerate(self.events))[after:]
+
+    def abort(self):
+        if not self.finished:
+            self.finish()
+
+
+class StreamingSessionRegistry:
+    """ストリーミング認識セッションの管理。同時セッション数の上限と、放置されたセッションの破棄を行います。"""
+
+    def __init__(self, max_sessions=50, idle_seconds=60, keep_seconds=300):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds  # 録音中にチャンクが来なくなってから破棄するまで
+        self.keep_seconds = keep_seconds  # 終了後に結果を再取得できる期間
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._first_word_ms = []
+        self.created = 0
+        self.rejected = 0
+
+    def _reap(self, now):
+        for session_id, session in list(self._sessions.items()):
+            idle = now - session.last_activity
+            if session.closed and idle > self.keep_seconds:
+                self._forget(session_id)
+            elif not session.finished and idle > self.idle_seconds:
+                logger.warning("⚠️ ストリーミング認識セッション %s が放置されたため終了します", session_id)
+                session.abort()
+
+    def _forget(self, session_id):
+        session = self._sessions.pop(session_id)
+        if session.first_word_ms is not None:
+            self._first_word_ms = (self._first_word_ms + [session.first_word_ms])[-1000:]
+
+    def create(self, client):
+        """新しいセッションを作ります。上限に達している場合は None を返します。"""
+        with self._lock:
+            self._reap(time.monotonic())
+            active = sum(1 for session in self._sessions.values() if not session.closed)
+            if active >= self.max_sessions:
+                self.rejected += 1
+                return None
+            session = StreamingRecognitionSession(client)
+            self._sessions[session.session_id] = session
+            self.created += 1
+            return session
+
+    def get(self, session_id):
+        with self._lock:
+            self._reap(time.monotonic())
+            return self._sessions.get(session_id)
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            latencies = sorted(self._first_word_ms + [s.first_word_ms for s in sessions if s.first_word_ms is not None])
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else None
+
+        return {
+            "active": sum(1 for s in sessions if not s.closed),
+            "retained": len(sessions),
+            "created": self.created,
+            "rejected": self.rejected,
+            "first_word_p50_ms": percentile(0.50),
+            "first_word_p95_ms": percentile(0.95),
+        }
+
+
+def stream_registry_from_env():
+    """STT_STREAM_* 環境変数からセッション管理を作ります。
+
+    - STT_STREAM_MAX_SESSIONS: 同時に録音中にできるセッション数
+    - STT_STREAM_IDLE_SECONDS: チャンクが途絶えてから録音を打ち切るまでの秒数
+    - STT_STREAM_KEEP_SECONDS: 終了後に結果を再取得できる秒数
+    """
+    return StreamingSessionRegistry(
+        max_sessions=int(os.environ.get('STT_STREAM_MAX_SESSIONS', 50)),
+        idle_seconds=float(os.environ.get('STT_STREAM_IDLE_SECONDS', 60)),
+        keep_seconds=float(os.environ.get('STT_STREAM_KEEP_SECONDS', 300)),
+    )
@@ -0,0 +1,360 @@
+import os
+import time
+import queue
+import threading
+from collections import OrderedDict
+
+import psycopg2
+
+from app_logging import get_logger
+from db_pool import DBPoolError, db_connection
+
+logger = get_logger("summary_jobs")
+
+# -------------------------------------------------------------
+# 要約生成のバックグラウンドジョブ
+# -------------------------------------------------------------
+# sessions の is_processed = false の行をそのままジョブとして扱います。
+# プロセス内のキューは高速化のためだけのもので、再起動などで失われても
+# 定期的なリカバリで is_processed = false の行から拾い直されます。
+# 複数ワーカープロセスでの二重実行は summary_locked_until のリースで防ぎます。
+# リースは要約1件分の上流呼び出し (レート制限の待ちと再試行を含む) の最大の所要時間より長くし、
+# それでも期限切れ後に他のワーカーがリースし直した場合に備えて、保存・失敗の記録はリースした時の
+# summary_attempts (リースするたびに増える) が変わっていない場合だけ行います。
+
+# 1件分をリースする (他のワーカーが処理中、または処理済みなら何も返さない)
+CLAIM_SQL = """
+    UPDATE public.sessions
+    SET
+        summary_locked_until = now() + make_interval(secs => %(lease_seconds)s),
+        summary_attempts = summary_attempts + 1
+    WHERE
+        id = %(session_id)s
+        AND NOT is_processed
+        AND summary_attempts < %(max_attempts)s
+        AND (summary_locked_until IS NULL OR summary_locked_until < now())
+    RETURNING raw_text, booth_id, summary_attempts;
+"""
+
+# 複数件をまとめてリースする (batch_summary.py のCLIで使用)
+CLAIM_BATCH_SQL = """
+    UPDATE public.sessions
+    SET
+        summary_locked_until = now() + make_interval(secs => %(lease_seconds)s),
+        summary_attempts = summary_attempts + 1
+    WHERE
+        id IN (
+            SELECT s.id
+            FROM public.sessions s
+            WHERE
+                NOT s.is_processed
+                AND s.summary_attempts < %(max_attempts)s
+                AND (s.summary_locked_until IS NULL OR s.summary_locked_until < now())
+            ORDER BY s.id
+            LIMIT %(limit)s
+            FOR UPDATE SKIP LOCKED
+        )
+    RETURNING id, raw_text, booth_id, summary_attempts;
+"""
+
+# リースを持っている (リース後に他のワーカーがリースし直していない) 場合だけ保存する
+COMPLETE_SQL = """
+    UPDATE public.sessions
+    SET
+        summary_text = %(summary_text)s,
+        is_processed = true,
+        summary_locked_until = NULL,
+        summary_error = NULL
+    WHERE
+        id = %(session_id)s
+        AND summary_attempts = %(attempts)s
+        AND NOT is_processed;
+"""
+
+# 失敗時はバックオフ時間だけリースを延ばし、他のワーカーもすぐには再実行しないようにする
+FAIL_SQL = """
+    UPDATE public.sessions
+    SET
+        summary_locked_until = now() + make_interval(secs => %(delay)s),
+        summary_error = %(error)s
+    WHERE
+        id = %(session_id)s
+        AND summary_attempts = %(attempts)s
+        AND NOT is_processed;
+"""
+
+# 再起動後などに取り残されたジョブを拾う
+PENDING_SQL = """
+    SELECT
+        s.id
+    FROM
+        public.sessions s
+    WHERE
+        NOT s.is_processed
+        AND s.summary_attempts < %(max_attempts)s
+        AND (s.summary_locked_until IS NULL OR s.summary_locked_until < now())
+    ORDER BY
+        s.id
+    LIMIT %(limit)s;
+"""
+
+STATUS_SQL = """
+    SELECT
+        s.is_processed,
+        s.summary_attempts,
+        s.summary_locked_until > now(),
+        s.summary_error
+    FROM
+        public.sessions s
+    WHERE
+        s.id = %s;
+"""
+
+
+class SummaryJobQueue:
+    """上限付きのキューと固定数のワーカースレッドで要約ジョブを処理します。
+
+    summarize(raw_text) は要約文字列を返し、失敗時は例外を投げる関数。
+    on_complete(session_id, booth_id) は要約の保存後に呼ばれます (キャッシュの無効化など)。
+    lease_seconds は summarize() 1回の最大の所要時間より長くしてください。
+    """
+
+    def __init__(self, summarize, on_complete=None, workers=4, queue_size=100, max_attempts=5,
+                 lease_seconds=300, retry_base_delay=2.0, recovery_interval=60.0, recovery_batch=100):
+        self.summarize = summarize
+        self.on_complete = on_complete
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.retry_base_delay = retry_base_delay
+        self.recovery_interval = recovery_interval
+        self.recovery_batch = recovery_batch
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._statuses = OrderedDict()  # session_id -> 状態 (直近のものだけ保持)
+        self._max_statuses = 10000
+        self._queued_ids = set()
+        self._started = False
+        self._stopping = threading.Event()
+
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.lease_lost = 0
+
+    # ---------------------------------------------------------
+    # 起動・投入
+    # ---------------------------------------------------------
+    def start(self):
+        """ワーカーとリカバリ用スレッドを起動します (2回目以降は何もしません)。"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"summary-worker-{i}", daemon=True).start()
+        threading.Thread(target=self._recovery_loop, name="summary-recovery", daemon=True).start()
+        logger.info("✅ 要約ワーカーを %d 件起動しました。", self.workers)
+
+    def stop(self):
+        self._stopping.set()
+
+    def submit(self, session_id):
+        """ジョブを投入します。キューが満杯なら False (後でリカバリが拾います)。"""
+        with self._lock:
+            if session_id in self._queued_ids:
+                return True
+            self._queued_ids.add(session_id)
+        try:
+            self._queue.put_nowait(session_id)
+        except queue.Full:
+            with self._lock:
+                self._queued_ids.discard(session_id)
+                self.dropped += 1
+            self._set_status(session_id, "pending")
+            return False
+        self._set_status(session_id, "queued")
+        return True
+
+    def recover(self):
+        """DB上の未処理の行をキューに積み直します。積んだ件数を返します。"""
+        try:
+            with db_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(PENDING_SQL, {"max_attempts": self.max_attempts, "limit": self.recovery_batch})
+                pending = [row[0] for row in cursor.fetchall()]
+        except (DBPoolError, psycopg2.Error) as e:
+            logger.error("❌ 未処理の要約ジョブの取得に失敗しました: %s", e)
+            return 0
+        return sum(1 for session_id in pending if self.submit(session_id))
+
+    # ---------------------------------------------------------
+    # 状態
+    # ---------------------------------------------------------
+    def _set_status(self, session_id, status, **extra):
+        with self._lock:
+            entry = self._statuses.pop(session_id, {})
+            entry.update(extra, status=status, updated_at=time.time())
+            self._statuses[session_id] = entry
+            while len(self._statuses) > self._max_statuses:
+                self._statuses.popitem(last=False)
+
+    def status(self, session_id):
+        """ジョブの状態を返します。プロセス内で把握していなければDBから判断します。"""
+        with self._lock:
+            entry = self._statuses.get(session_id)
+        if entry is not None and entry["status"] != "done":
+            return {"session_id": session_id, **entry}
+
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(STATUS_SQL, (session_id,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        is_processed, attempts, locked, error = row
+        if is_processed:
+            status = "done"
+        elif locked:
+            status = "running"
+        elif attempts >= self.max_attempts:
+            status = "failed"
+        else:
+            status = "pending"
+        return {"session_id": session_id, "status": status, "attempts": attempts, "error": error}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queued": self._queue.qsize(),
+                "queue_size": self._queue.maxsize,
+                "completed": self.completed,
+                "failed": self.failed,
+                "retried": self.retried,
+                "dropped": self.dropped,
+                "lease_lost": self.lease_lost,
+            }
+
+    # ---------------------------------------------------------
+    # ワーカー
+    # ---------------------------------------------------------
+    def _worker(self):
+        while not self._stopping.is_set():
+            try:
+                session_id = self._queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            with self._lock:
+                self._queued_ids.discard(session_id)
+            try:
+                self._process(session_id)
+            except Exception as e:
+                logger.exception("❌ 要約ジョブ %s の処理中に予期せぬエラー: %s", session_id, e)
+            finally:
+                self._queue.task_done()
+
+    def _process(self, session_id):
+        params = {
+            "session_id": session_id,
+            "lease_seconds": self.lease_seconds,
+            "max_attempts": self.max_attempts,
+        }
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(CLAIM_SQL, params)
+            claimed = cursor.fetchone()
+            conn.commit()
+        if claimed is None:
+            # 処理済み、他のワーカーが処理中、または試行回数の上限
+            with self._lock:
+                known = self._statuses.get(session_id)
+            if known and known["status"] in ("queued", "pending"):
+                self._set_status(session_id, "skipped")
+            return
+
+        raw_text, booth_id, attempts = claimed
+        self._set_status(session_id, "running", attempts=attempts)
+
+        # Gemini の呼び出し中はDB接続を保持しない
+        try:
+            summary_text = self.summarize(raw_text)
+        except Exception as e:
+            self._fail(session_id, attempts, str(e))
+            return
+
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(COMPLETE_SQL, {"summary_text": summary_text, "session_id": session_id, "attempts": attempts})
+            saved = cursor.rowcount
+            conn.commit()
+        if not saved:
+            # リースの期限が切れ、他のワーカーがリースし直した (その結果を優先する)
+            logger.warning("⚠️ 要約ジョブ %s はリースの期限が切れたため結果を破棄しました (%d回目)", session_id, attempts)
+            with self._lock:
+                self.lease_lost += 1
+            self._set_status(session_id, "skipped", attempts=attempts)
+            return
+        with self._lock:
+            self.completed += 1
+        self._set_status(session_id, "done", attempts=attempts, error=None)
+        if self.on_complete:
+            self.on_complete(session_id, booth_id)
+
+    def _fail(self, session_id, attempts, error):
+        # 指数バックオフ
+        delay = self.retry_base_delay * (2 ** (attempts - 1)) if attempts < self.max_attempts else 0
+        try:
+            with db_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(FAIL_SQL, {"delay": delay, "error": error[:500], "session_id": session_id,
+                                          "attempts": attempts})
+                recorded = cursor.rowcount
+                conn.commit()
+        except (DBPoolError, psycopg2.Error) as e:
+            # リースの期限が切れればリカバリで再実行される
+            logger.error("❌ 要約ジョブ %s の失敗の記録に失敗しました: %s", session_id, e)
+            recorded = None
+        if recorded == 0:
+            # リースの期限が切れ、他のワーカーがリースし直した (再試行はそちらに任せる)
+            logger.warning("⚠️ 要約ジョブ %s はリースの期限が切れたため失敗を記録しませんでした (%d回目): %s",
+                           session_id, attempts, error)
+            with self._lock:
+                self.lease_lost += 1
+            self._set_status(session_id, "skipped", attempts=attempts)
+            return
+        logger.error("❌ 要約ジョブ %s が失敗しました (%d/%d回目): %s", session_id, attempts, self.max_attempts, error)
+
+        if attempts >= self.max_attempts:
+            with self._lock:
+                self.failed += 1
+            self._set_status(session_id, "failed", attempts=attempts, error=error)
+            return
+
+        with self._lock:
+            self.retried += 1
+        self._set_status(session_id, "retrying", attempts=attempts, error=error)
+        # リースが切れた直後に再投入 (DBとの時計のずれを考慮して少し待つ)
+        timer = threading.Timer(delay + 0.5, self.submit, args=(session_id,))
+        timer.daemon = True
+        timer.start()
+
+    def _recovery_loop(self):
+        while not self._stopping.is_set():
+            recovered = self.recover()
+            if recovered:
+                logger.info("✅ 未処理の要約ジョブを %d 件キューに積み直しました。", recovered)
+            self._stopping.wait(self.recovery_interval)
+
+
+def queue_from_env(summarize, on_complete=None, lease_seconds=None):
+    """環境変数 SUMMARY_* から設定を読み込んでキューを作ります。
+
+    SUMMARY_LEASE_SECONDS を指定しなければ lease_seconds (summarize() の最大の所要時間から求めた値) を使います。
+    """
+    return SummaryJobQueue(
+        summarize,
+        on_complete=on_complete,
+        workers=int(os.environ.get('SUMMARY_WORKERS', 4)),
+        queue_size=int(os.environ.get('SUMMARY_QUEUE_SIZE', 100)),
+        max_attempts=int(os.environ.get('SUMMARY_MAX_ATTEMPTS', 5)),
+        lease_seconds=float(os.environ.get('SUMMARY_LEASE_SECONDS') or lease_seconds or 300),
+        recovery_interval=float(os.environ.get('SUMMARY_RECOVERY_INTERVAL', 60)),
+    )
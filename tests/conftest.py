@@ -0,0 +1,20 @@
+"""
+pytest の共通設定。
+
+リポジトリ直下のモジュール (flask_app.py など) を import できるようにし、
+テスト中に要約ワーカーが動いたり .env のデータベースに接続したりしないよう環境変数を設定します。
+
+使い方:
+    pip install pytest
+    python -m pytest tests
+    TEST_DATABASE_URL=postgresql://... python -m pytest tests   # DBを使うテストも実行 (マイグレーション適用済みのDB)
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# load_dotenv() は設定済みの環境変数を上書きしないため、.env の DATABASE_URL は使われない
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "")
+os.environ["SUMMARY_WORKERS"] = "0"
+os.environ.setdefault("GEMINI_API_KEY", "test")
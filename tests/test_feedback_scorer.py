@@ -0,0 +1,52 @@
+"""
+feedback_scorer.score_feedback のテスト (モジュールと使い方に書かれている例)。
+"""
+import pytest
+
+from feedback_scorer import SCORER_VERSION, score_feedback, score_from_ratio
+
+
+def praise(text):
+    return score_feedback(text)["praise_ratio"]
+
+
+def test_usage_example_has_both_praise_and_advice():
+    result = score_feedback("説明が丁寧で分かりやすかった。もう少し字が大きいと良い")
+
+    assert 40 < result["praise_ratio"] < 60
+    assert result["praise_ratio"] + result["advice_ratio"] == pytest.approx(100)
+    assert result["score"] == score_from_ratio(result["praise_ratio"])
+    assert result["confidence"] == 1.0
+    assert result["scorer"] == SCORER_VERSION
+
+
+@pytest.mark.parametrize("text", ["", None, "展示を見ました"])
+def test_no_cues_is_neutral(text):
+    result = score_feedback(text)
+
+    assert result["praise_ratio"] == 50.0
+    assert result["advice_ratio"] == 50.0
+    assert result["confidence"] == 0.0
+
+
+@pytest.mark.parametrize("text", ["良くない", "面白くなかった"])
+def test_negated_praise_counts_as_advice(text):
+    assert praise(text) < 50
+
+
+def test_negated_advice_counts_as_praise():
+    assert praise("不満はありません") > 50
+
+
+def test_intensifier_strengthens_praise():
+    assert praise("とても良かった") > praise("良かった") > 50
+
+
+def test_text_after_contrast_weighs_more():
+    # 「けど」の後ろのアドバイスの方が重いので、全体としてはアドバイス寄りになる
+    assert praise("良かったけど、もう少し説明がほしい") < 50
+
+
+@pytest.mark.parametrize("ratio, score", [(0, 40), (50, 70), (100, 100), (-10, 40), (150, 100)])
+def test_score_from_ratio_range(ratio, score):
+    assert score_from_ratio(ratio) == score
@@ -0,0 +1,123 @@
+"""
+サーキットブレーカーの half_open の試行と、ResilientHTTPClient の失敗の記録のテスト。
+"""
+import time
+import asyncio
+from unittest import mock
+
+import pytest
+
+from http_client import RETRY_STATUSES, CircuitBreaker, CircuitOpenError, ResilientHTTPClient
+
+OPEN_SECONDS = 0.05
+
+
+def open_breaker():
+    breaker = CircuitBreaker(min_requests=2, open_seconds=OPEN_SECONDS)
+    breaker.record(False)
+    breaker.record(False)
+    assert breaker.state == "open"
+    return breaker
+
+
+def half_open_breaker():
+    breaker = open_breaker()
+    time.sleep(OPEN_SECONDS * 1.5)
+    assert breaker.state == "half_open"
+    return breaker
+
+
+def test_open_breaker_rejects_calls():
+    breaker = open_breaker()
+
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    assert breaker.rejected == 1
+
+
+def test_half_open_allows_a_single_trial():
+    breaker = half_open_breaker()
+
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_successful_trial_closes_breaker():
+    breaker = half_open_breaker()
+
+    breaker.before_call()
+    breaker.record(True)
+
+    assert breaker.state == "closed"
+    breaker.before_call()
+
+
+def test_failed_trial_reopens_breaker():
+    breaker = half_open_breaker()
+
+    breaker.before_call()
+    breaker.record(False)
+
+    assert breaker.state == "open"
+    assert breaker.opened_count == 2
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_released_trial_lets_next_call_try():
+    breaker = half_open_breaker()
+
+    breaker.before_call()
+    breaker.release_trial()
+
+    assert breaker.state == "half_open"
+    breaker.before_call()
+
+
+def test_unexpected_exception_during_trial_is_recorded_as_failure():
+    client = ResilientHTTPClient(breaker=half_open_breaker())
+
+    with mock.patch.object(client.session, "post", side_effect=ValueError("bad body")):
+        with pytest.raises(ValueError):
+            client.post("http://upstream.invalid")
+
+    # 試行が終わっていなければ、ブレーカーはすべての呼び出しを拒み続ける
+    assert client.breaker.state == "open"
+    assert client.stats()["failures"] == 1
+
+
+def test_cancelled_trial_is_released_without_recording():
+    client = ResilientHTTPClient(breaker=half_open_breaker())
+
+    with mock.patch.object(client.session, "post", side_effect=asyncio.CancelledError()):
+        with pytest.raises(asyncio.CancelledError):
+            client.post("http://upstream.invalid")
+
+    assert client.breaker.state == "half_open"
+    client.breaker.before_call()
+
+
+def test_exhausted_retries_count_as_failure():
+    client = ResilientHTTPClient(max_retries=1, backoff_base=0, breaker=CircuitBreaker(min_requests=100))
+    status = sorted(RETRY_STATUSES)[-1]
+    response = mock.Mock(status_code=status, headers={})
+
+    with mock.patch.object(client.session, "post", return_value=response) as post:
+        assert client.post("http://upstream.invalid") is response
+
+    stats = client.stats()
+    assert post.call_count == 2
+    assert stats["retries"] == 1
+    assert stats["failures"] == 1
+
+
+def test_non_retryable_status_is_not_a_failure():
+    client = ResilientHTTPClient()
+    response = mock.Mock(status_code=400, headers={})
+
+    with mock.patch.object(client.session, "post", return_value=response):
+        client.post("http://upstream.invalid")
+
+    assert client.stats()["failures"] == 0
+    assert client.breaker.state == "closed"
@@ -0,0 +1,192 @@
+"""
+冪等キーのラッパー (flask_app._idempotent / asgi_app._idempotent) の失敗時の動作と、
+IdempotencyStore のトークンによる保護のテスト。
+"""
+import os
+import time
+import asyncio
+import types
+
+import psycopg2
+import pytest
+from flask import jsonify, make_response
+
+import flask_app
+from db_pool import DBPoolError
+from idempotency import IdempotencyConflict, IdempotencyStore
+
+STORAGE_ERRORS = [psycopg2.OperationalError("connection lost"), DBPoolError("pool exhausted")]
+
+
+class FakeIdempotencyStore:
+    """IdempotencyStore の代わり。呼び出しを記録し、指定された例外を投げます。"""
+
+    def __init__(self, begin_result=("token-1", None), begin_error=None, complete_error=None):
+        self.begin_result = begin_result
+        self.begin_error = begin_error
+        self.complete_error = complete_error
+        self.calls = []
+
+    def request_key(self, header_key, data):
+        return header_key, "hash", 60
+
+    def begin(self, scope, key, request_hash, ttl):
+        self.calls.append(("begin", key))
+        if self.begin_error is not None:
+            raise self.begin_error
+        return self.begin_result
+
+    def complete(self, scope, key, token, status_code, body):
+        self.calls.append(("complete", key, token, status_code, body))
+        if self.complete_error is not None:
+            raise self.complete_error
+        return True
+
+    def release(self, scope, key, token):
+        self.calls.append(("release", key, token))
+
+    async def abegin(self, scope, key, request_hash, ttl):
+        return self.begin(scope, key, request_hash, ttl)
+
+    async def acomplete(self, scope, key, token, status_code, body):
+        return self.complete(scope, key, token, status_code, body)
+
+    async def arelease(self, scope, key, token):
+        self.release(scope, key, token)
+
+
+@pytest.fixture
+def install_store(monkeypatch):
+    def install(**kwargs):
+        store = FakeIdempotencyStore(**kwargs)
+        monkeypatch.setattr(flask_app, "idempotency", store)
+        return store
+    return install
+
+
+def call_idempotent(handler, key="key-1"):
+    with flask_app.app.test_request_context(json={"a": 1}, headers={"Idempotency-Key": key}):
+        return make_response(flask_app._idempotent("submit_feedback", {"a": 1}, handler))
+
+
+def created():
+    return jsonify({"status": "success", "inserted_id": 1}), 201
+
+
+def test_success_saves_response_with_claim_token(install_store):
+    store = install_store()
+
+    response = call_idempotent(created)
+
+    assert response.status_code == 201
+    assert store.calls == [
+        ("begin", "key-1"),
+        ("complete", "key-1", "token-1", 201, {"status": "success", "inserted_id": 1}),
+    ]
+
+
+@pytest.mark.parametrize("error", STORAGE_ERRORS)
+def test_complete_storage_error_returns_response_and_keeps_key(install_store, error):
+    # 挿入はコミット済みなので、応答を保存できなくても 201 を返し、キーは解放しない (再送で重複させない)
+    store = install_store(complete_error=error)
+
+    response = call_idempotent(created)
+
+    assert response.status_code == 201
+    assert response.get_json()["inserted_id"] == 1
+    assert not any(call[0] == "release" for call in store.calls)
+
+
+def test_error_response_releases_key(install_store):
+    store = install_store()
+
+    response = call_idempotent(lambda: (jsonify({"message": "❌"}), 500))
+
+    assert response.status_code == 500
+    assert store.calls[-1] == ("release", "key-1", "token-1")
+    assert not any(call[0] == "complete" for call in store.calls)
+
+
+def test_handler_exception_releases_key(install_store):
+    store = install_store()
+
+    def fail():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        call_idempotent(fail)
+    assert store.calls[-1] == ("release", "key-1", "token-1")
+
+
+@pytest.mark.parametrize("error", STORAGE_ERRORS)
+def test_begin_storage_error_runs_handler_without_key(install_store, error):
+    store = install_store(begin_error=error)
+
+    response = call_idempotent(created)
+
+    assert response.status_code == 201
+    assert store.calls == [("begin", "key-1")]
+
+
+def test_replay_skips_handler(install_store):
+    install_store(begin_result=(None, (201, {"inserted_id": 7})))
+
+    def handler():
+        raise AssertionError("handler must not run for a replayed key")
+
+    response = call_idempotent(handler)
+
+    assert response.status_code == 201
+    assert response.get_json() == {"inserted_id": 7}
+    assert response.headers["Idempotent-Replayed"] == "true"
+
+
+def test_in_progress_conflict_sets_retry_after(install_store):
+    install_store(begin_error=IdempotencyConflict(409, "処理中です", retry_after=5))
+
+    response = call_idempotent(created)
+
+    assert response.status_code == 409
+    assert response.headers["Retry-After"] == "5"
+
+
+def test_asgi_complete_storage_error_returns_response_and_keeps_key(monkeypatch):
+    pytest.importorskip("starlette")
+    pytest.importorskip("a2wsgi")
+    asyncpg = pytest.importorskip("asyncpg")
+    import asgi_app
+    from starlette.responses import JSONResponse
+
+    store = FakeIdempotencyStore(complete_error=asyncpg.PostgresError("connection lost"))
+    monkeypatch.setattr(asgi_app, "idempotency", store)
+
+    async def handler():
+        return JSONResponse({"inserted_id": 1}, status_code=201)
+
+    request = types.SimpleNamespace(headers={"Idempotency-Key": "key-1"})
+    response = asyncio.run(asgi_app._idempotent(request, "submit_feedback", {"a": 1}, handler))
+
+    assert response.status_code == 201
+    assert not any(call[0] == "release" for call in store.calls)
+
+
+# -------------------------------------------------------------
+# DBを使うテスト (TEST_DATABASE_URL を設定した場合のみ)
+# -------------------------------------------------------------
+requires_db = pytest.mark.skipif(not os.environ.get("TEST_DATABASE_URL"), reason="TEST_DATABASE_URL が未設定")
+
+
+@requires_db
+def test_expired_claim_cannot_complete_or_release_new_claim():
+    store = IdempotencyStore(lock_seconds=0.2, wait_seconds=0.1)
+    key = f"fence-{time.time_ns()}"
+
+    stale_token, _ = store.begin("test", key, "hash", 60)
+    time.sleep(0.3)
+    token, replay = store.begin("test", key, "hash", 60)
+    assert replay is None and token != stale_token
+
+    assert store.complete("test", key, stale_token, 201, {"from": "stale"}) is False
+    store.release("test", key, stale_token)
+    assert store.complete("test", key, token, 201, {"from": "current"}) is True
+    assert store.begin("test", key, "hash", 60) == (None, (201, {"from": "current"}))